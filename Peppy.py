@@ -10,9 +10,19 @@ import os,sys
 import __builtin__
 __builtin__._ = unicode
 
-try:
-    import peppy.main
-except AttributeError:
-    raise RuntimeError("Peppy needs wxPython version 2.8.7.1 or later to function.  Minimum recommended version is 2.8.8.0")
+if __name__ == "__main__":
+    # Worker processes of the multiprocessing pools used by the search and
+    # cube comparison code start by running this script; on Windows they
+    # must not start another copy of the application
+    try:
+        import multiprocessing
+        multiprocessing.freeze_support()
+    except ImportError:
+        pass
 
-peppy.main.main()
+    try:
+        import peppy.main
+    except AttributeError:
+        raise RuntimeError("Peppy needs wxPython version 2.8.7.1 or later to function.  Minimum recommended version is 2.8.8.0")
+
+    peppy.main.main()
@@ -1,12 +1,23 @@
 # peppy Copyright (c) 2006-2010 Rob McMullen
 # Licenced under the GPLv2; see http://peppy.flipturn.org for more info
-"""
+"""Autosave and backup files
 
+Modified documents are autosaved using an append-only journal of the text
+inserted into and deleted from the document rather than by writing the
+entire document every few keystrokes.  The journal is relative to a base
+file, which is either the file that was loaded (if the document matched it
+when the journal was started) or a snapshot of the document in the usual
+autosave file.  The snapshot is only rewritten when the journal grows
+larger than the document, so the cost of autosaving scales with the size of
+the edits instead of the size of the file.
 """
 
-import os
+import os, threading, Queue
+
+import wx.stc
 
 from peppy.lib.userparams import *
+from peppy.debug import *
 import peppy.vfs as vfs
 
 
@@ -16,11 +27,15 @@ class Autosave(ClassPrefs):
     default_classprefs = (
         BoolParam('use_autosave', True, 'Periodically save all files that have been changed to allow for recovery if there is a system crash'),
         IntParam('keystroke_interval', 10, 'Number of keystrokes before file is autosaved'),
+        IntParam('journal_compact_size', 1000000, 'Minimum size in bytes of the autosave journal before it is replaced by a full copy of the file'),
     )
     
     def getKeystrokeInterval(self):
         return self.classprefs.keystroke_interval
     
+    def getJournalCompactSize(self):
+        return self.classprefs.journal_compact_size
+    
     def isFilesystemSchemeAllowed(self, url):
         return url.scheme == 'file'
     
@@ -30,6 +45,13 @@ class Autosave(ClassPrefs):
             filename = vfs.get_filename(original_url)
             filename = "%%23%s%%23" % filename
             return dirname.resolve2(filename)
+    
+    def getJournalFilename(self, original_url):
+        if self.classprefs.use_autosave and self.isFilesystemSchemeAllowed(original_url):
+            dirname = vfs.get_dirname(original_url)
+            filename = vfs.get_filename(original_url)
+            filename = "%%23%s%%23.journal" % filename
+            return dirname.resolve2(filename)
 
 
 class BackupFiles(ClassPrefs):
@@ -48,3 +70,283 @@ class BackupFiles(ClassPrefs):
     def getFilename(self, original_url):
         if self.classprefs.use_backups:
             return self.calculateFilename(original_url)
+
+
+class AutosaveJournalWriter(threading.Thread, debugmixin):
+    """Append the pending records of the journals to their files.
+    
+    A single writer thread is shared by all the journals so that the disk
+    writes never happen on the GUI thread.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.queue = Queue.Queue()
+    
+    def run(self):
+        while True:
+            journal = self.queue.get()
+            journal.write()
+
+
+class AutosaveJournal(debugmixin):
+    """Append-only journal of the modifications of a document.
+    
+    The journal file starts with a header identifying the base file that the
+    modifications are relative to, using the size and modification time of
+    the base file to check that it hasn't changed since.  It is followed by
+    records of the form::
+    
+        I <pos> <bytes>
+        <utf-8 text>
+        D <pos> <length>
+    
+    where the positions and lengths are those of the STC.  The records are
+    collected on the GUI thread from the modification events of the
+    document and are appended to the file by the L{AutosaveJournalWriter}.
+    """
+    magic = "peppy-autosave-journal 1\n"
+    
+    writer = None
+    
+    @classmethod
+    def getWriter(cls):
+        if cls.writer is None:
+            cls.writer = AutosaveJournalWriter()
+            cls.writer.start()
+        return cls.writer
+    
+    def __init__(self):
+        # lock for the pending records
+        self.lock = threading.Lock()
+        # lock for the journal file, always acquired before self.lock
+        self.file_lock = threading.Lock()
+        self.stc = None
+        self.url = None
+        self.pending = []
+        self.size = 0
+        self.queued = False
+        self.needs_snapshot = False
+        self.matches_file = False
+    
+    def start(self, stc):
+        """Start recording the modifications of the STC"""
+        if self.stc is None:
+            if stc.addDocumentModifiedEvent(self.OnModified):
+                self.stc = stc
+    
+    def stop(self):
+        if self.stc is not None:
+            self.stc.removeDocumentModifiedEvent(self.OnModified)
+            self.stc = None
+    
+    def isRecording(self):
+        return self.stc is not None
+    
+    def hasBase(self):
+        return self.url is not None
+    
+    def OnModified(self, evt):
+        mod = evt.GetModificationType()
+        if mod & wx.stc.STC_MOD_INSERTTEXT:
+            text = evt.GetText().encode('utf-8')
+            record = "I %d %d\n%s\n" % (evt.GetPosition(), len(text), text)
+        elif mod & wx.stc.STC_MOD_DELETETEXT:
+            record = "D %d %d\n" % (evt.GetPosition(), evt.GetLength())
+        else:
+            return
+        self.lock.acquire()
+        try:
+            self.pending.append(record)
+            self.size += len(record)
+        finally:
+            self.lock.release()
+    
+    def clear(self, matches_file=False):
+        """Discard the journal.
+        
+        The journal file itself must be removed by the caller.
+        
+        @param matches_file: True if the document is currently the same as
+        the file that it was loaded from, allowing that file to be used as
+        the base of the journal
+        """
+        self.file_lock.acquire()
+        try:
+            self.lock.acquire()
+            self.url = None
+            self.pending = []
+            self.size = 0
+            self.needs_snapshot = False
+            self.matches_file = matches_file
+            self.lock.release()
+        finally:
+            self.file_lock.release()
+    
+    def needsSnapshot(self, length, compact_size):
+        """Check if the journal should be replaced by a snapshot
+        
+        @param length: current length of the document
+        
+        @param compact_size: minimum size of the journal before a snapshot
+        is needed
+        """
+        return self.needs_snapshot or self.size > max(length, compact_size)
+    
+    def writeHeader(self, url, kind, base_url):
+        fh = vfs.open_write(url)
+        try:
+            fh.write(self.magic)
+            fh.write("%s %d %s\n" % (kind, vfs.get_size(base_url), vfs.get_mtime(base_url)))
+        finally:
+            fh.close()
+    
+    def startFromFile(self, url, base_url):
+        """Start the journal file using the file loaded into the document as
+        its base.
+        
+        The modifications recorded since the document matched the file are
+        kept, and will be written by the next L{flush}.
+        """
+        self.file_lock.acquire()
+        try:
+            self.writeHeader(url, "file", base_url)
+            self.url = url
+            self.needs_snapshot = False
+        finally:
+            self.file_lock.release()
+    
+    def startFromSnapshot(self, url, snapshot_url, save):
+        """Replace the journal with a snapshot of the document
+        
+        @param url: url of the journal
+        
+        @param snapshot_url: url of the snapshot
+        
+        @param save: callable that writes the snapshot to the url passed to
+        it and returns True if successful
+        """
+        self.file_lock.acquire()
+        try:
+            if save(snapshot_url):
+                self.lock.acquire()
+                self.pending = []
+                self.size = 0
+                self.lock.release()
+                self.writeHeader(url, "snapshot", snapshot_url)
+                self.url = url
+                self.needs_snapshot = False
+        finally:
+            self.file_lock.release()
+    
+    def flush(self):
+        """Ask the writer thread to append the pending records to the file"""
+        if self.url is not None and self.pending and not self.queued:
+            self.queued = True
+            self.getWriter().queue.put(self)
+    
+    def write(self):
+        """Append the pending records to the journal file.
+        
+        Called from the writer thread.
+        """
+        self.file_lock.acquire()
+        try:
+            self.lock.acquire()
+            records = self.pending
+            self.pending = []
+            self.queued = False
+            url = self.url
+            self.lock.release()
+            if url is not None and records:
+                try:
+                    fh = vfs.open(url, vfs.APPEND)
+                    try:
+                        fh.write("".join(records))
+                    finally:
+                        fh.close()
+                except Exception, e:
+                    # The records are lost, so the journal can't be used
+                    # until it is replaced by a snapshot
+                    self.dprint(u"Failed writing journal %s: %s" % (url, e))
+                    self.needs_snapshot = True
+        finally:
+            self.file_lock.release()
+    
+    @classmethod
+    def read(cls, url):
+        """Read the journal file
+        
+        A truncated record at the end of the file, left by a crash while it
+        was being written, is ignored.
+        
+        @returns: tuple of the kind of base ("file" or "snapshot"), the size
+        and modification time string of the base file when the journal was
+        started, and the list of records as tuples ("I", pos, text) or
+        ("D", pos, length)
+        """
+        fh = vfs.open(url)
+        try:
+            data = fh.read()
+        finally:
+            fh.close()
+        if not data.startswith(cls.magic):
+            raise ValueError("%s is not an autosave journal" % url)
+        index = data.find("\n", len(cls.magic))
+        if index < 0:
+            raise ValueError("%s is missing the journal header" % url)
+        kind, size, mtime = data[len(cls.magic):index].split(" ", 2)
+        size = int(size)
+        records = []
+        index += 1
+        while True:
+            end = data.find("\n", index)
+            if end < 0:
+                break
+            try:
+                op, pos, length = data[index:end].split(" ")
+                pos = int(pos)
+                length = int(length)
+            except ValueError:
+                break
+            index = end + 1
+            if op == "I":
+                end = index + length
+                if end >= len(data) or data[end] != "\n":
+                    break
+                records.append((op, pos, data[index:end].decode('utf-8')))
+                index = end + 1
+            elif op == "D":
+                records.append((op, pos, length))
+            else:
+                break
+        return kind, size, mtime, records
+    
+    @classmethod
+    def isBaseValid(cls, base_url, size, mtime):
+        """Check that the base file hasn't changed since the journal was
+        started"""
+        return vfs.exists(base_url) and vfs.get_size(base_url) == size and str(vfs.get_mtime(base_url)) == mtime
+    
+    @classmethod
+    def replay(cls, stc, records):
+        """Apply the records to the document as a single undo action
+        
+        @raises ValueError: if a record doesn't fit in the document, in
+        which case the records before it have been applied
+        """
+        stc.BeginUndoAction()
+        try:
+            for op, pos, value in records:
+                if pos > stc.GetLength():
+                    raise ValueError("Journal position %d past the end of the document" % pos)
+                if op == "I":
+                    stc.InsertText(pos, value)
+                else:
+                    if pos + value > stc.GetLength():
+                        raise ValueError("Journal deletion at %d past the end of the document" % pos)
+                    stc.SetTargetStart(pos)
+                    stc.SetTargetEnd(pos + value)
+                    stc.ReplaceTarget("")
+        finally:
+            stc.EndUndoAction()
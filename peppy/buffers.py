@@ -19,6 +19,8 @@ from peppy.dialogs import *
 from peppy.stcinterface import *
 from peppy.stcbase import *
 from peppy.majormodematcher import *
+from peppy.wordindex import WordIndex
+from peppy.autosave import AutosaveJournal
 from peppy.debug import *
 
 class BufferList(OnDemandGlobalListAction):
@@ -37,6 +39,9 @@ class BufferList(OnDemandGlobalListAction):
     # display
     needs_sort = True
     
+    # index of the words in the buffers, created when first needed
+    word_index = None
+    
     @classmethod
     def addBuffer(cls, buf):
         """Convenience function to add a buffer and flag to be sorted"""
@@ -48,6 +53,24 @@ class BufferList(OnDemandGlobalListAction):
         """Convenience function to remove a buffer and flag to be sorted"""
         cls.remove(buf)
         cls.needsSort()
+        if cls.word_index is not None:
+            cls.word_index.removeBuffer(buf)
+    
+    @classmethod
+    def getWordIndex(cls, buffers=None):
+        """Get the L{WordIndex} shared by all the buffers
+        
+        @param buffers: list of buffers whose words must be current in the
+        index, or None for all the buffers other than the permanent ones
+        """
+        if cls.word_index is None:
+            cls.word_index = WordIndex()
+        if buffers is None:
+            buffers = [buf for buf in cls.storage if not buf.permanent]
+        for buf in buffers:
+            if not buf.busy:
+                cls.word_index.updateBuffer(buf)
+        return cls.word_index
     
     @classmethod
     def findBufferByURL(cls, url):
@@ -392,6 +415,7 @@ class Buffer(BufferVFSMixin):
         self.permanent = False
         
         self.autosave_valid = True
+        self.autosave_journal = AutosaveJournal()
         self.backup_saved = False
 
         self.stc=None
@@ -463,6 +487,7 @@ class Buffer(BufferVFSMixin):
             BufferList.removeBuffer(self)
             # Need to destroy the base STC or self will never get garbage
             # collected
+            self.autosave_journal.stop()
             self.stc.Destroy()
             pub.sendMessage('buffer.closed', url=self.url)
             dprint(u"removed buffer %s" % self.url)
@@ -500,7 +525,7 @@ class Buffer(BufferVFSMixin):
         if self.defaultmode is None:
             self.defaultmode = MajorModeMatcherDriver.match(self)
         if self.defaultstc is None:
-            self.defaultstc = self.defaultmode.stc_class
+            self.defaultstc = self.defaultmode.getSTCClass(self.url)
         self.dprint("mode=%s" % (str(self.defaultmode)))
 
         self.stc = self.defaultstc(self.dummyframe)
@@ -516,6 +541,7 @@ class Buffer(BufferVFSMixin):
         self.closeBufferedReader()
         
         self.stc.openSuccess(self)
+        self.autosave_journal.clear(True)
         
         self.setName()
 
@@ -546,7 +572,10 @@ class Buffer(BufferVFSMixin):
         self.modified=False
         self.forEachView('applySettings')
         self.forEachView('revertPostHook')
-        self.removeAutosaveIfExists()
+        # The journal can only use the file as its base if the document was
+        # loaded from the file in the same way as the journal will be
+        # restored
+        self.removeAutosaveIfExists(alternate_url is None and encoding is None)
         self.showModifiedAll()
     
     def save(self, url=None):
@@ -596,9 +625,11 @@ class Buffer(BufferVFSMixin):
     def startChangeDetection(self):
         self.change_count = 0
         self.stc.addDocumentChangeEvent(self.OnChanged)
+        self.autosave_journal.start(self.stc)
 
     def stopChangeDetection(self):
         self.stc.removeDocumentChangeEvent()
+        self.autosave_journal.stop()
 
     def setInitialStateIsUnmodified(self):
         """Set the initial state of the file as unmodified.
@@ -625,6 +656,7 @@ class Buffer(BufferVFSMixin):
         self.stc.SetSavePoint()
         self.modified = True
         self.initial_modified_state = True
+        self.autosave_journal.clear()
         
     def OnChanged(self, evt):
         #dprint("stc = %s" % self.stc)
@@ -646,7 +678,7 @@ class Buffer(BufferVFSMixin):
                 # stuff like the folding being changed on a massive undo) and
                 # a potentially expensive call to remove files is only needed
                 # once.
-                self.removeAutosaveIfExists()
+                self.removeAutosaveIfExists(not self.initial_modified_state)
         if changed!=self.modified:
             #self.dprint("different!")
             self.modified=changed
@@ -659,16 +691,46 @@ class Buffer(BufferVFSMixin):
             self.change_count = 0
 
     def autosave(self):
+        """Save the changes to the document since the last autosave.
+        
+        If the STC supports an autosave journal, only the modifications are
+        appended to the journal by a background thread.  The entire document
+        is written to the autosave file when the journal is started without
+        the original file as its base, and when the journal grows larger than
+        the document.
+        """
+        journal = self.autosave_journal
         if not self.autosave_valid:
+            journal.clear()
             return
         
         # Update keystrokes in case user has changed the settings
-        self.keystrokes_until_autosave = wx.GetApp().autosave.getKeystrokeInterval()
+        autosave = wx.GetApp().autosave
+        self.keystrokes_until_autosave = autosave.getKeystrokeInterval()
         if self.readonly:
+            journal.clear()
             return
         temp_url = self.stc.getAutosaveTemporaryFilename(self)
-        if temp_url:
+        if not temp_url:
+            journal.clear()
+            return
+        journal_url = self.stc.getAutosaveJournalFilename(self)
+        if not journal_url or not journal.isRecording():
+            journal.clear()
             self.saveTemporaryCopy(temp_url)
+            return
+        try:
+            if not journal.hasBase():
+                if journal.matches_file and vfs.exists(self.url) and not self.isTimestampChanged():
+                    journal.startFromFile(journal_url, self.url)
+                else:
+                    journal.startFromSnapshot(journal_url, temp_url, self.saveTemporaryCopy)
+            elif journal.needsSnapshot(self.stc.GetLength(), autosave.getJournalCompactSize()):
+                self.dprint(u"Compacting autosave journal %s" % journal_url)
+                journal.startFromSnapshot(journal_url, temp_url, self.saveTemporaryCopy)
+            journal.flush()
+        except Exception, e:
+            self.dprint(u"Failed starting autosave journal %s with %s" % (journal_url, e))
 
     def saveTemporaryCopy(self, temp_url):
         self.dprint(u"Saving backup copy to %s" % temp_url)
@@ -677,30 +739,40 @@ class Buffer(BufferVFSMixin):
             fh = vfs.open_write(temp_url)
             self.stc.writeTo(fh, temp_url)
             fh.close()
+            return True
         except Exception, e:
             self.dprint(u"Failed autosaving to %s with %s" % (temp_url, e))
+        return False
     
-    def removeAutosaveIfExists(self):
+    def removeAutosaveIfExists(self, matches_file=True):
+        """Remove the autosave file and journal
+        
+        @param matches_file: True if the document is the same as the file
+        it was loaded from or saved to
+        """
+        self.autosave_journal.clear(matches_file)
         temp_url = self.stc.getAutosaveTemporaryFilename(self)
-        if temp_url and vfs.exists(temp_url):
-            try:
-                vfs.remove(temp_url)
-                self.dprint(u"Removed autosave file %s" % temp_url)
-            except OSError:
-                self.dprint("Can't remove autosave file %s" % temp_url)
-                self.autosave_valid = False
+        journal_url = self.stc.getAutosaveJournalFilename(self)
+        for url in (temp_url, journal_url):
+            if url and vfs.exists(url):
+                try:
+                    vfs.remove(url)
+                    self.dprint(u"Removed autosave file %s" % url)
+                except OSError:
+                    self.dprint("Can't remove autosave file %s" % url)
+                    self.autosave_valid = False
 
     def restoreFromAutosaveIfExists(self):
         temp_url = self.stc.getAutosaveTemporaryFilename(self)
-        if temp_url and vfs.exists(temp_url):
+        journal_url = self.stc.getAutosaveJournalFilename(self)
+        if journal_url and vfs.exists(journal_url):
+            self.restoreFromAutosaveJournal(temp_url, journal_url)
+        elif temp_url and vfs.exists(temp_url):
             # If the original URL no longer exists, the autosave file will be
             # removed without prompting.
             if vfs.exists(self.url) and vfs.get_mtime(temp_url) >= vfs.get_mtime(self.url) and vfs.get_size(temp_url) > 0:
                 # backup file is newer than saved file.
-                dlg = CustomOkDialog(wx.GetApp().GetTopWindow(), u"Autosave file for %s\nis newer than last saved version.\n\nRestore from autosave file?" % self.url, "Restore from Autosave", "Ignore Autosave")
-                retval=dlg.ShowModal()
-                dlg.Destroy()
-                if retval==wx.ID_OK:
+                if self.promptRestoreFromAutosave():
                     self.dprint(u"Recovering from autosave file %s" % temp_url)
                     self.revert(temp_url, allow_undo=True)
                     self.modified = True
@@ -708,6 +780,45 @@ class Buffer(BufferVFSMixin):
             else:
                 vfs.remove(temp_url)
 
+    def promptRestoreFromAutosave(self):
+        dlg = CustomOkDialog(wx.GetApp().GetTopWindow(), u"Autosave file for %s\nis newer than last saved version.\n\nRestore from autosave file?" % self.url, "Restore from Autosave", "Ignore Autosave")
+        retval=dlg.ShowModal()
+        dlg.Destroy()
+        return retval == wx.ID_OK
+    
+    def restoreFromAutosaveJournal(self, temp_url, journal_url):
+        """Restore the document from the base file of the journal and the
+        modifications recorded in the journal.
+        
+        If the base file has changed since the journal was started, the
+        journal can't be used and is removed without prompting.
+        """
+        try:
+            kind, size, mtime, records = AutosaveJournal.read(journal_url)
+        except Exception, e:
+            self.dprint(u"Failed reading autosave journal %s: %s" % (journal_url, e))
+            kind = None
+        if kind == "file":
+            base_url = self.url
+        else:
+            base_url = temp_url
+        if kind is None or not base_url or not AutosaveJournal.isBaseValid(base_url, size, mtime) or (kind == "file" and not records):
+            self.removeAutosaveIfExists()
+            return
+        if not self.promptRestoreFromAutosave():
+            return
+        self.dprint(u"Recovering from autosave journal %s" % journal_url)
+        if kind == "snapshot":
+            self.revert(temp_url, allow_undo=True)
+        try:
+            AutosaveJournal.replay(self.stc, records)
+        except ValueError, e:
+            eprint(u"Failed restoring all changes from %s: %s" % (journal_url, e))
+        self.modified = True
+        # The journal is restarted using the restored document as its base
+        self.autosave()
+        wx.CallAfter(self.showModifiedAll)
+
     def backupCallback(self):
         # This is only called once, the first time the document is modified,
         # regardless of the outcome of this method.
@@ -5,7 +5,7 @@
 Major mode for displaying a list of files in a directory
 """
 
-import os, datetime
+import os, time, datetime, threading
 
 import wx
 from wx.lib.pubsub import Publisher
@@ -79,13 +79,20 @@ class DiredPopupActions(ContextMenuActions):
 class DiredEntry(object):
     """Helper class representing one line in the dired list
     
+    The entry is created with only its name so the list can be shown
+    immediately; the size, date, mode and description are filled in later
+    by L{setMetadata}.  Until then, the missing values sort before any real
+    values.
     """
-    def __init__(self, index, base_url, name):
+    def __init__(self, index, base_url, name, metadata=None):
         self.index = index
         self.basename = name
-        self.url, self.mode = self.getKey(base_url, name)
+        self.url = self.getKey(base_url, name)
         self.flags = ""
-        self.metadata = vfs.get_metadata(self.url)
+        self.mode = ""
+        self.metadata = {}
+        if metadata is not None:
+            self.setMetadata(metadata)
     
     def __getitem__(self, k):
         if k==0:
@@ -95,7 +102,9 @@ class DiredEntry(object):
         elif k==2:
             return self.getSize()
         elif k==3:
-            return self.getDate()
+            # datetimes can't be compared to None, so entries without
+            # metadata use the earliest date when sorting
+            return self.getDate() or datetime.datetime.min
         elif k==4:
             return self.getMode()
         elif k==5:
@@ -110,23 +119,33 @@ class DiredEntry(object):
         import urllib
         name = urllib.quote(name)
         url = base_url.resolve2(name)
+        return url
+    
+    def setMetadata(self, metadata):
+        """Set the metadata of the entry
         
+        @param metadata: dict as returned by L{vfs.get_entry_metadata}
+        """
+        self.metadata = metadata
         mode = []
-        if vfs.is_folder(url):
-            url.path.endswith_slash = True
+        if metadata['is_folder']:
+            self.url.path.endswith_slash = True
             mode.append("d")
         else:
-            url.path.endswith_slash = False
+            self.url.path.endswith_slash = False
             mode.append("-")
-        if vfs.can_read(url):
+        if metadata['can_read']:
             mode.append("r")
         else:
             mode.append("-")
-        if vfs.can_write(url):
+        if metadata['can_write']:
             mode.append("w")
         else:
             mode.append("-")
-        return url, "".join(mode)
+        self.mode = "".join(mode)
+    
+    def isLoaded(self):
+        return bool(self.metadata)
 
     def getBasename(self):
         return self.basename
@@ -138,24 +157,36 @@ class DiredEntry(object):
         return unicode(self.url)
     
     def getSize(self):
-        return self.metadata['size']
+        return self.metadata.get('size')
+    
+    def getSizeString(self):
+        size = self.getSize()
+        if size is None:
+            return ""
+        return str(size)
     
     def getDate(self):
-        return self.metadata['mtime']
+        return self.metadata.get('mtime')
     
     def getCompactDate(self):
-        return getCompactDate(self.metadata['mtime'])
+        mtime = self.getDate()
+        if mtime is None:
+            return ""
+        return getCompactDate(mtime)
     
     def getMode(self):
         return self.mode
     
     def getDescription(self):
-        desc = self.metadata['description']
+        desc = self.metadata.get('description')
         if not desc:
-            desc = self.metadata['mimetype']
+            desc = self.metadata.get('mimetype', "")
         return desc
     
     def getMimeType(self):
+        if not self.metadata:
+            # The context menu needs the real mimetype
+            self.setMetadata(vfs.get_entry_metadata(self.url))
         return self.metadata['mimetype']
 
     def getFlags(self):
@@ -174,6 +205,63 @@ class DiredEntry(object):
         self.flags = flags
 
 
+class DiredMetadataLoader(threading.Thread, debugmixin):
+    """Get the metadata of the dired entries in a background thread
+    
+    The metadata is passed back to the mode on the GUI thread in batches,
+    sent when either the batch is full or the interval has passed since the
+    last batch.
+    """
+    def __init__(self, mode, items, batch_size=100, interval=0.25):
+        """Create the loader
+        
+        @param mode: the L{DiredMode} receiving the metadata
+        
+        @param items: list of (index, url) tuples, where the index is the
+        original index of the entry
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.mode = mode
+        self.items = items
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stop_request = False
+    
+    def stop(self):
+        self.stop_request = True
+    
+    def getMetadata(self, url):
+        try:
+            return vfs.get_entry_metadata(url)
+        except Exception, e:
+            self.dprint("Failed getting metadata for %s: %s" % (url, e))
+            return {
+                'mimetype': '',
+                'description': unicode(e),
+                'mtime': None,
+                'size': None,
+                'is_folder': False,
+                'can_read': False,
+                'can_write': False,
+                }
+    
+    def run(self):
+        batch = []
+        last = time.time()
+        for index, url in self.items:
+            if self.stop_request:
+                return
+            batch.append((index, self.getMetadata(url)))
+            now = time.time()
+            if len(batch) >= self.batch_size or now - last > self.interval:
+                wx.CallAfter(self.mode.addMetadataBatch, self, batch)
+                batch = []
+                last = now
+        if not self.stop_request:
+            wx.CallAfter(self.mode.addMetadataBatch, self, batch, True)
+
+
 class DiredSTC(NonResidentSTC):
     """Dummy STC just to prevent other modes from being able to change their
     major mode to this one.
@@ -213,6 +301,13 @@ class DiredMode(ListMode):
         # of the column headings is clicked.
         self.origDataMap = {}
         
+        # The metadata of the entries is loaded in the background after the
+        # names are displayed
+        self.loader = None
+        
+        # Cache of the list row of each original index
+        self.rows = {}
+        
         ListMode.__init__(self, parent, wrapper, buffer, frame)
     
     def setViewPositionData(self, options=None):
@@ -347,6 +442,72 @@ class DiredMode(ListMode):
             self.list.SortListItems()
         self.list.Thaw()
     
+    def resetListPostHook(self):
+        """Start loading the metadata of the new entries"""
+        self.stopMetadataLoader()
+        items = [(index, entry.getURL()) for index, entry in self.origDataMap.iteritems()]
+        items.sort()
+        self.loader = DiredMetadataLoader(self, items)
+        self.loader.start()
+    
+    def stopMetadataLoader(self):
+        if self.loader is not None:
+            self.loader.stop()
+            self.loader = None
+    
+    def deleteWindowPreHook(self):
+        self.stopMetadataLoader()
+    
+    def getRowFromOrigIndex(self, orig_index):
+        """Get the current row of the entry, or -1 if it isn't in the list
+        
+        The rows are cached, and the cache is rebuilt when the list has been
+        reordered.
+        """
+        row = self.rows.get(orig_index)
+        if row is None or row >= self.list.GetItemCount() or self.list.GetItemData(row) != orig_index:
+            self.rows = {}
+            for row in range(self.list.GetItemCount()):
+                self.rows[self.list.GetItemData(row)] = row
+            row = self.rows.get(orig_index, -1)
+        return row
+    
+    def addMetadataBatch(self, loader, batch, finished=False):
+        """Update the entries from a batch of metadata produced by the
+        L{DiredMetadataLoader}
+        
+        @param loader: the loader that produced the batch; the batch is
+        ignored if the list has been reset since the loader was started
+        
+        @param batch: list of (index, metadata) tuples
+        
+        @param finished: True if this is the last batch
+        """
+        if not self or loader is not self.loader:
+            return
+        self.list.Freeze()
+        for orig_index, metadata in batch:
+            entry = self.origDataMap.get(orig_index)
+            if entry is None:
+                continue
+            entry.setMetadata(metadata)
+            row = self.getRowFromOrigIndex(orig_index)
+            if row < 0:
+                continue
+            values = self.convertRawValuesToStrings(entry)
+            for col in range(2, self.list.GetColumnCount()):
+                self.list.SetStringItem(row, col, values[col])
+        if finished:
+            self.loader = None
+            # Sorting by one of the metadata columns was done with partial
+            # data, so sort again now that all the values are known
+            col, ascending = self.list.GetSortState()
+            if 2 <= col <= 5:
+                self.list.SortListItems(col, ascending)
+                self.list.OnSortOrderChanged()
+            self.list.ResizeColumns()
+        self.list.Thaw()
+    
     def getListItems(self):
         use_hidden = self.classprefs.show_hidden
         for name in vfs.get_names(self.url):
@@ -359,7 +520,7 @@ class DiredMode(ListMode):
         return entry
     
     def convertRawValuesToStrings(self, entry):
-        return (entry.getFlags(), entry.getBasename(), str(entry.getSize()),
+        return (entry.getFlags(), entry.getBasename(), entry.getSizeString(),
                 entry.getCompactDate(), entry.getMode(), entry.getDescription(),
                 entry.getUnicode())
     
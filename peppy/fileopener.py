@@ -228,12 +228,25 @@ class FileOpener(debugmixin):
         self.buffer = self.buffer.clone()
         self.dprint("Replaced LoadingBuffer with %s" % self.buffer)
         self.buffer.openGUIThreadStart()
+        self.buffer.stc.setFirstScreenCallback(self.showFirstScreen)
         self.progress = self.mode_to_replace.status_info
         self.progress.startProgress(u"Loading %s" % self.url, message="loading.%s" % self.mode_to_replace.__class__.__name__)
         thread = BufferLoadThread(self)
         wx.GetApp().cooperativeYield()
         thread.start()
 
+    def showFirstScreen(self, text):
+        """Show the start of the file in the temporary loading mode while the
+        rest of the file is being loaded.
+        
+        Called from the GUI thread by the buffer's STC after the first screen
+        of text has been loaded.  The real major mode is still created in
+        L{finalizeAfterSuccessfulLoad}, because major modes expect the whole
+        file to be available when they are created.
+        """
+        if isinstance(self.mode_to_replace, LoadingMode):
+            self.mode_to_replace.showPreview(text)
+
     def finalizeAfterSuccessfulLoad(self):
         try:
             self.dprint(u"Successful load of %s" % self.url)
@@ -297,6 +310,14 @@ class LoadingMode(BlankMode):
 
     def createPostHook(self):
         self.showBusy(True)
+        self.preview = None
+    
+    def showPreview(self, text):
+        """Replace the loading message with the first screen of the file"""
+        if self.preview is None:
+            self.DestroyChildren()
+            self.preview = wx.StaticText(self, -1, text, (10,10))
+            self.preview.SetFont(wx.Font(10, wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
 
 # This major mode doesn't show up in a plugin, so we need to tell the major
 # mode matcher driver about it otherwise it won't show up in the list of
@@ -357,6 +378,11 @@ class BufferLoadThread(threading.Thread, debugmixin):
         threading.Thread.__init__(self)
         
         self.opener = opener
+        
+        # The thread may be waiting for the GUI thread to add the chunks it
+        # has already read, so it shouldn't prevent the application from
+        # exiting
+        self.setDaemon(True)
 
     def run(self):
         self.dprint(u"starting to load %s" % self.opener.buffer.url)
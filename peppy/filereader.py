@@ -10,6 +10,7 @@ import peppy.vfs as vfs
 
 from peppy.debug import *
 from peppy.lib.textutil import detectEncoding
+from peppy.stcbase import toStyledText
 
 
 class FileReader(debugmixin):
@@ -77,7 +78,7 @@ class FileReader(debugmixin):
                     # to the mem: filesystem, but if it does happen to be
                     # unicode, there's no need to convert the data
                     self.encoding = "utf-8"
-                    self.tempstore.write(unicode.encode('utf-8'))
+                    self.tempstore.write(txt.encode('utf-8'))
                 else:
                     self.tempstore.write(txt)
             else:
@@ -115,6 +116,4 @@ class FileReader(debugmixin):
                 raise UnicodeDecodeError("bad encoding %s:" % self.encoding)
     
     def getBinaryBytesForStyledTextCtrl(self):
-        bytes = self.getBytes()
-        styledtxt = '\0'.join(bytes)+'\0'
-        return styledtxt
+        return toStyledText(self.getBytes())
@@ -0,0 +1,252 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Incrementally maintained fold hierarchy
+
+Restyling the entire document and asking scintilla for the fold level of
+every line each time a fold changes is too slow for large files.  The
+L{FoldHierarchy} keeps the fold entries of the document in line order and,
+using the text modifications and fold changes recorded since the last
+update, only restyles and rescans the range of lines that has changed.  The
+entries outside of that range are reused, with their line numbers shifted
+to account for inserted or deleted lines.
+
+The tree is linked from the flat list of entries after every update, which
+doesn't require any calls to scintilla.  The nodes whose children have
+changed are recorded so that views of the hierarchy like the code explorer
+only have to update those parts of their display.
+"""
+
+from peppy.debug import *
+from peppy.lib.foldexplorer import FoldExplorerNode
+
+
+class FoldHierarchy(debugmixin):
+    """Fold hierarchy of a document, updated from the changed line ranges.
+
+    The hierarchy is shared by all views of a document that use the same
+    major mode.  Because every view receives the modification events of the
+    document, the changes are only recorded from one of the views: the
+    recorder, which is the view that performed the last full rebuild.
+    """
+    #: Number of lines restyled at a time when looking for the end of the
+    #: fold changes caused by an edit
+    colourise_lines = 500
+
+    #: Maximum number of pending changes; past this, the next update
+    #: rebuilds the entire hierarchy
+    max_changes = 1000
+
+    #: Number of updates whose changed nodes are remembered for
+    #: L{getChangesSince}
+    max_log = 16
+
+    def __init__(self):
+        self.root = FoldExplorerNode(level=0, start=0, end=0, text='root')
+        self.root.parent = None
+        self.entries = []
+        self.changes = []
+        self.rebuild = True
+        self.recorder = None
+        self.restyled = None
+        self.version = 0
+        self.log = []
+
+    def isChanged(self):
+        return self.rebuild or bool(self.changes)
+
+    def addChange(self, line, added=0):
+        """Record a change to the document
+
+        @param line: line containing the start of the modification, or the
+        line whose fold level changed
+
+        @param added: number of lines inserted (or, if negative, deleted) by
+        the modification
+        """
+        if self.restyled is not None:
+            # fold changes caused by the restyling in colourise
+            self.restyled.append(line)
+        elif not self.rebuild:
+            self.changes.append((line, added))
+            if len(self.changes) > self.max_changes:
+                self.rebuild = True
+                self.changes = []
+
+    def removeRecorder(self, view):
+        """Stop recording the changes from the view.
+
+        Changes made after the recorder is removed would be lost, so the next
+        update rebuilds the hierarchy and the view calling it becomes the
+        new recorder.
+        """
+        if view is self.recorder:
+            self.recorder = None
+            self.rebuild = True
+            self.changes = []
+
+    def findEntry(self, line):
+        """Get the index of the first entry that starts after the line"""
+        lo = 0
+        hi = len(self.entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entries[mid].start > line:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def shiftEntries(self, line, added):
+        """Adjust the entries after the line for inserted or deleted lines"""
+        index = self.findEntry(line)
+        if added < 0:
+            # entries on lines that have been deleted are removed
+            del self.entries[index:self.findEntry(line - added)]
+        for node in self.entries[index:]:
+            node.start += added
+
+    def shiftLine(self, num, line, added):
+        if num <= line:
+            return num
+        if added < 0 and num <= line - added:
+            return line
+        return num + added
+
+    def applyChanges(self):
+        """Shift the entries by the pending changes
+
+        @returns: tuple of the first and last line in the current document
+        that have been changed
+        """
+        first = last = None
+        for line, added in self.changes:
+            if added:
+                self.shiftEntries(line, added)
+                if first is not None:
+                    first = self.shiftLine(first, line, added)
+                    last = self.shiftLine(last, line, added)
+            end = line + max(added, 0)
+            if first is None:
+                first, last = line, end
+            else:
+                first = min(first, line)
+                last = max(last, end)
+        self.changes = []
+        return first, last
+
+    def colourise(self, mode, first, last):
+        """Restyle the changed lines so their fold levels are current.
+
+        Restyling continues past the last changed line for as long as the
+        lexer keeps changing fold levels, e.g.  after the start of a block
+        comment is inserted.
+
+        @returns: tuple of the first and last line whose fold levels may
+        have changed
+        """
+        count = mode.GetLineCount()
+        line = min(first, mode.LineFromPosition(mode.GetEndStyled()))
+        while line < count:
+            end = min(line + self.colourise_lines, count)
+            self.restyled = []
+            try:
+                mode.Colourise(mode.PositionFromLine(line), mode.GetLineEndPosition(end - 1))
+                restyled = self.restyled
+            finally:
+                self.restyled = None
+            if restyled:
+                first = min(first, min(restyled))
+                last = max(last, max(restyled))
+            elif end > last:
+                break
+            line = end
+        return first, min(last, count - 1)
+
+    def update(self, mode):
+        """Bring the hierarchy up to date with the document
+
+        @param mode: major mode providing the STC methods and the
+        iterFoldEntries method of the L{FoldExplorerMixin}
+        """
+        count = mode.GetLineCount()
+        if self.rebuild:
+            self.recorder = mode
+            self.changes = []
+            self.rebuild = False
+            first, last = 0, count - 1
+        else:
+            first, last = self.applyChanges()
+            if first is None:
+                return
+            first = min(first, count - 1)
+        first, last = self.colourise(mode, first, last)
+        self.dprint("Updating fold entries from line %d to %d" % (first, last))
+        nodes = [node for node in mode.iterFoldEntries(first, last + 1) if first <= node.start <= last]
+        start = self.findEntry(first - 1)
+        end = self.findEntry(last)
+        self.copyExpansion(self.entries[start:end], nodes)
+        self.entries[start:end] = nodes
+        changed = self.link(count)
+        if changed:
+            self.version += 1
+            self.log.append((self.version, changed))
+            if len(self.log) > self.max_log:
+                self.log.pop(0)
+
+    def copyExpansion(self, old, new):
+        """Keep the expansion state of entries that have been recreated"""
+        expanded = {}
+        for node in old:
+            expanded.setdefault(node.text, []).append(node.expanded)
+        for node in new:
+            states = expanded.get(node.text)
+            if states:
+                node.expanded = states.pop(0)
+
+    def link(self, count):
+        """Link the entries into a tree based on their fold levels
+
+        @returns: list of nodes whose children have changed
+        """
+        root = self.root
+        children = {id(root): []}
+        stack = [root]
+        for node in self.entries:
+            while len(stack) > 1 and stack[-1].level >= node.level:
+                stack.pop().end = node.start - 1
+            parent = stack[-1]
+            node.parent = parent
+            children[id(parent)].append(node)
+            children[id(node)] = []
+            stack.append(node)
+        for node in stack[1:]:
+            node.end = count - 1
+        root.end = count
+
+        changed = []
+        for node in [root] + self.entries:
+            new = children[id(node)]
+            old = node.children
+            if len(old) != len(new) or [1 for a, b in zip(old, new) if a is not b]:
+                node.children = new
+                changed.append(node)
+        return changed
+
+    def getChangesSince(self, version):
+        """Get the nodes whose children have changed since the version
+
+        @param version: version returned by a previous call, or None
+
+        @returns: tuple of the current version and the list of changed nodes,
+        or None in place of the list if the changes aren't known and the
+        entire tree must be refreshed
+        """
+        if version == self.version:
+            return self.version, []
+        if version is None or not self.log or self.log[0][0] > version + 1:
+            return self.version, None
+        changed = []
+        for logged, nodes in self.log:
+            if logged > version:
+                changed.extend(nodes)
+        return self.version, changed
@@ -22,6 +22,7 @@ from peppy.editra import *
 from peppy.editra.stcmixin import *
 
 from peppy.paragraph import *
+from peppy.foldhierarchy import FoldHierarchy
 
 
 class FundamentalSTC(EditraSTCMixin, PeppySTC):
@@ -297,6 +298,13 @@ class FundamentalMode(FoldExplorerMixin, EditraSTCMixin,
         
     def createListenersPostHook(self):
         self.addModifyCallback(self.spellCheckUpdate)
+        self.addModifyCallback(self.recordFoldChange)
+    
+    def removeListenersPostHook(self):
+        self.removeModifyCallback(self.recordFoldChange)
+        stc_class_info = self.getSharedClassInfo(self.__class__)
+        if 'fold_hierarchy' in stc_class_info:
+            stc_class_info['fold_hierarchy'].removeRecorder(self)
 
     def createStatusIcons(self):
         linesep = self.getLinesep()
@@ -740,60 +748,85 @@ class FundamentalMode(FoldExplorerMixin, EditraSTCMixin,
         """Callback to process fold events.
         
         This callback is initiated from within the event handler of PeppySTC.
-        The events could be used to optimize the fold algorithm, but
-        currently this data is not used by anything.
+        The changed line itself is recorded by L{recordFoldChange}, so this
+        only has to let the code explorer know that it should update.
         """
         stc_class_info = self.getSharedClassInfo(self.__class__)
         if 'fold_hierarchy' in stc_class_info:
             #dprint("changed fold at line=%d, pos=%d" % (evt.Line, evt.Position))
-            stc_class_info['fold_changed'].append(evt.Line)
             self.sendMessageWhenIdle('fold_changed', mode=self)
     
+    def recordFoldChange(self, evt):
+        """Modify callback that records the changed line ranges in the fold
+        hierarchy.
+        
+        Folding events aren't fired when only blank lines are inserted or
+        deleted, and inserted or deleted lines shift the line numbers of the
+        following folds without any fold events, so text modifications are
+        recorded along with the fold changes.
+        """
+        stc_class_info = self.getSharedClassInfo(self.__class__)
+        hierarchy = stc_class_info.get('fold_hierarchy')
+        if hierarchy is None or hierarchy.recorder is not self:
+            return
+        mod = evt.GetModificationType()
+        if mod & (wx.stc.STC_MOD_INSERTTEXT | wx.stc.STC_MOD_DELETETEXT):
+            hierarchy.addChange(self.LineFromPosition(evt.GetPosition()), evt.GetLinesAdded())
+        elif mod & wx.stc.STC_MOD_CHANGEFOLD:
+            hierarchy.addChange(evt.GetLine())
+    
     def getFoldHierarchy(self):
         """Get the current fold hierarchy, returning the existing copy if there
         are no changes, or updating if necessary.
+        
+        The same root node is returned after every update; use
+        L{getFoldHierarchyChanges} to find the parts that have changed.
         """
         stc_class_info = self.getSharedClassInfo(self.__class__)
-        if 'fold_hierarchy' not in stc_class_info or stc_class_info['fold_changed'] or self.GetLineCount() != stc_class_info['fold_line_count']:
+        if 'fold_hierarchy' not in stc_class_info or stc_class_info['fold_hierarchy'].isChanged():
             #dprint("Fold hierarchy has changed.  Updating.")
             self.updateFoldHierarchy()
-        fold_hier = stc_class_info['fold_hierarchy']
+        fold_hier = stc_class_info['fold_hierarchy'].root
         return fold_hier
+    
+    def getFoldHierarchyChanges(self, version):
+        """Get the nodes of the fold hierarchy whose children have changed
+        
+        @param version: version number returned by a previous call, or None
+        
+        @returns: tuple of the current version number and the list of nodes
+        changed since the given version, or None instead of the list if the
+        entire hierarchy should be considered changed.
+        """
+        stc_class_info = self.getSharedClassInfo(self.__class__)
+        return stc_class_info['fold_hierarchy'].getChangesSince(version)
 
     def updateFoldHierarchy(self):
-        """Create the fold hierarchy using Stani's fold explorer algorithm.
+        """Update the fold hierarchy using Stani's fold explorer algorithm.
 
         Scintilla's folding code is used to generate the function lists in
         some major modes.  Scintilla doesn't support code folding in all its
         supported languages, so major modes that aren't supported may mimic
-        this interface to provide similar functionality.
+        this interface to provide similar functionality by overriding
+        iterFoldEntries.
+        
+        Only the lines changed since the last update are restyled and
+        searched for fold entries; see L{FoldHierarchy}.
         """
-        # FIXME: Turn this into a threaded operation if it takes too long
         t = time.time()
-        self.Colourise(0, self.GetTextLength())
-        self.dprint("Finished colourise: %0.5f" % (time.time() - t))
         
         # Note that different views of the same buffer *using the same major
         # mode* will have the same fold hierarchy.  So, we use the stc's
         # getSharedClassInfo interface to store data common to all views of
         # this buffer that use this major mode.
         stc_class_info = self.getSharedClassInfo(self.__class__)
-        new_folds = self.computeFoldHierarchy()
-        
-        # Attempt to copy the tree expansion from the old tree to the new one
-        if 'fold_hierarchy' in stc_class_info:
-            old_folds = stc_class_info['fold_hierarchy']
-            self.copyFoldHierarchyTreeExpansion(old_folds, new_folds)
-            
-        stc_class_info['fold_hierarchy'] = new_folds
-        stc_class_info['fold_changed'] = []
-        
-        # Note: folding events aren't fired when only blank lines are inserted
-        # or deleted, so we keep track of the line count as a secondary method
-        # to indicate the folding needs to be recalculated
-        stc_class_info['fold_line_count'] = self.GetLineCount()
+        if 'fold_hierarchy' not in stc_class_info:
+            stc_class_info['fold_hierarchy'] = FoldHierarchy()
+        hierarchy = stc_class_info['fold_hierarchy']
+        hierarchy.update(self)
+        self.dprint("Finished fold hierarchy: %0.5f" % (time.time() - t))
         
-        return stc_class_info['fold_hierarchy']
+        return hierarchy.root
     
     def getFoldEntryFunctionName(self, line):
         """Check if line should be included in a list of functions.
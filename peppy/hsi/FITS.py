@@ -5,9 +5,14 @@
 U{FITS<http://fits.gsfc.nasa.gov>} is a simple file format that allows storage
 of multiple datasets in a single file.  It is commonly used in astronomy, but
 can be used to store arbitrary multi-dimensional arrays.
+
+When the file is on the local filesystem, it is memory mapped once and the
+headers of all the HDUs are indexed from the mapped file without reading any
+of the data.  The image HDUs are then presented as cubes that view the mapped
+file directly, so selecting any HDU requires no reading or copying.
 """
 
-import os,os.path,sys,re,struct,stat
+import os,os.path,sys,re,struct,stat,mmap
 from cStringIO import StringIO
 
 import peppy.hsi.common as HSI
@@ -19,13 +24,20 @@ import numpy
 class FITSHDU(debugmixin):
     """Header Data Unit (HDU) parser for FITS files.
     """
-    def __init__(self, fh):
+    def __init__(self, fh, index=0):
         """Create a HDU object from a file handle.
         
         The file handle should point to an open file at the start of a 2880
-        byte record.
+        byte record.  It can also be an C{mmap.mmap} object, which supports
+        the same read, seek and tell methods.
+        
+        @param index: position of the HDU in the file, where 0 is the primary
+        HDU
         """
+        self.index = index
         self.keywords = {}
+        self.header_offset = 0
+        self.data_size = 0
         self.image_size = 0
         self.image_axes = []
         self.image_bpp = 0
@@ -42,6 +54,7 @@ class FITSHDU(debugmixin):
     def parse(self, fh):
         """Parse a single HDU block
         """
+        self.header_offset = fh.tell()
         while True:
             chunk = fh.read(2880)
             if not chunk:
@@ -49,7 +62,8 @@ class FITSHDU(debugmixin):
             end = self.parseKeywords(chunk)
             if end:
                 break
-        size = self.calcSize()
+        self.calcSize()
+        size = self.data_size
         if size:
             self.image_offset = fh.tell()
             blocks = (size + 2879) / 2880
@@ -70,7 +84,7 @@ class FITSHDU(debugmixin):
             equals = chunk[i+8:i+10]
             if equals == '= ':
                 value = self.getValue(chunk[i+10:i+80])
-                self.dprint("%s = %s" % (repr(keyword), repr(value)))
+                assert self.dprint("%s = %s" % (repr(keyword), repr(value)))
                 self.keywords[keyword] = value
             i += 80
         return False
@@ -101,20 +115,54 @@ class FITSHDU(debugmixin):
                 value = int(text)
         return value
     
+    def getString(self, keyword, default=''):
+        """Return the value of a string keyword without the quotes"""
+        value = self.keywords.get(keyword, default)
+        if isinstance(value, basestring):
+            value = value.strip()
+            if value.startswith("'"):
+                value = value[1:]
+                if value.endswith("'"):
+                    value = value[:-1]
+            value = value.rstrip()
+        return value
+    
+    def isImage(self):
+        """Return True if the HDU is the primary HDU or an image extension;
+        other extensions (e.g. tables) can't be represented as a cube."""
+        if 'XTENSION' in self.keywords:
+            return self.getString('XTENSION').upper() == 'IMAGE'
+        return True
+    
+    def getName(self):
+        """Return a description of the HDU"""
+        name = self.getString('EXTNAME')
+        if name:
+            return "HDU #%d: %s" % (self.index, name)
+        return "HDU #%d" % self.index
+    
     def calcSize(self):
         """Calculate the image size, if there is an image in this HDU
+        
+        Also calculates the size of the data of non-image extensions, which
+        includes the parameter count and group count, so that following HDUs
+        can be found.
         """
         if self.keywords['NAXIS'] > 0:
             self.image_bpp = abs(self.keywords['BITPIX'])
-            size = self.image_bpp / 8
+            size = 1
             self.image_axes = []
             for i in range(self.keywords['NAXIS']):
                 k = 'NAXIS%d' % (i + 1)
                 axis = self.keywords[k]
                 self.image_axes.append(axis)
                 size *= axis
-            self.image_size = size
-            return size
+            pcount = self.keywords.get('PCOUNT', 0)
+            gcount = self.keywords.get('GCOUNT', 1)
+            self.data_size = (self.image_bpp / 8) * gcount * (pcount + size)
+            if self.isImage():
+                self.image_size = (self.image_bpp / 8) * size
+            return self.image_size
         return 0
     
     def getNumPyDataType(self):
@@ -161,6 +209,11 @@ class FITSDataset(HSI.MetadataMixin):
     def __init__(self, filename=None, **kwargs):
         self.url = None
         self.hdus = []
+        self.images = []
+        
+        # Memory map of the entire file, shared by all the cubes
+        self.mmap = None
+        self.data = None
 
         if filename:
             if isinstance(filename, HSI.Cube):
@@ -185,20 +238,56 @@ class FITSDataset(HSI.MetadataMixin):
             self.setURL(url)
 
         if self.url:
+            if self.openMMap():
+                self.read(self.mmap)
+                return
             #fh=self.url.getReader()
             fh = vfs.open(self.url)
             if fh:
                 self.read(fh)
                 fh.close()
+    
+    def openMMap(self):
+        """Memory map the file if it's on the local filesystem
+        
+        @returns: True if the file was mapped
+        """
+        if self.url.scheme != "file":
+            return False
+        try:
+            fh = open(str(self.url.path), "rb")
+            try:
+                self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fh.close()
+        except (IOError, OSError, ValueError, EnvironmentError), e:
+            # empty files can't be mapped, and large files can fail on 32 bit
+            # systems
+            self.dprint("Can't mmap %s: %s" % (self.url, e))
+            self.mmap = None
+            return False
+        self.data = numpy.frombuffer(self.mmap, dtype=numpy.uint8)
+        return True
 
     def read(self, fh):
+        """Index all the HDUs in the file.
+        
+        Only the headers are read; the data is skipped over.
+        """
+        self.hdus = []
+        self.images = []
         while True:
             try:
-                hdu = FITSHDU(fh)
-            except IOError:
+                hdu = FITSHDU(fh, len(self.hdus))
+            except (IOError, KeyError, ValueError), e:
                 break
-            print("Found HDU %s" % hdu)
+            assert self.dprint("Found HDU %s" % hdu)
             self.hdus.append(hdu)
+            if hdu.image_size > 0:
+                self.images.append(hdu)
+    
+    def getCubeNames(self):
+        return [hdu.getName() for hdu in self.images]
     
     def save(self,filename=None):
         if filename:
@@ -225,19 +314,41 @@ class FITSDataset(HSI.MetadataMixin):
         # transfer attributes from cube to self
         pass
     
+    def getMMapCube(self, hdu, progress=None):
+        """Create a cube that uses a view of the shared memory map
+        
+        The view is in the file's big endian byte order, so any byte swapping
+        happens only when the data is used.
+        
+        @returns: the cube, or None if the cube shouldn't be memory mapped
+        """
+        if self.data is None or hdu.image_offset + hdu.image_size > self.data.size:
+            return None
+        cube = HSI.newCube(hdu.getInterleave(), self.url, progress)
+        self.setCubeAttributes(cube, hdu)
+        try:
+            cube_io_cls = HSI.getMMapCubeReader(cube)
+        except TypeError, e:
+            # size limits for mmap are set in the preferences
+            self.dprint(e)
+            return None
+        cube.initialize()
+        raw = self.data[hdu.image_offset:hdu.image_offset + hdu.image_size]
+        raw = raw.view(cube.data_type).newbyteorder(HSI.byteordertext[cube.byte_order])
+        cube.cube_io = cube_io_cls(cube, array=raw)
+        cube.verifyAttributes()
+        return cube
+    
     def getCube(self, filename=None, index=0, progress=None, options=None):
+        if index < 0 or index >= len(self.images):
+            raise IndexError("HDU index out of range")
+        hdu = self.images[index]
+        if filename is None or (self.url and vfs.normalize(filename) == self.url):
+            cube = self.getMMapCube(hdu, progress)
+            if cube is not None:
+                return cube
         if filename is None:
             filename = self.url
-        hdu = None
-        i = 0
-        for h in self.hdus:
-            if h.image_size > 0:
-                if index == i:
-                    hdu = h
-                    break
-                i += 1
-        if not hdu:
-            raise IndexError("HDU index out of range")
         cube = HSI.newCube(hdu.getInterleave(), progress=progress)
         self.setCubeAttributes(cube, hdu)
         cube.verifyAttributes()
@@ -0,0 +1,263 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Memory-limited cache of arrays loaded from HSI cubes.
+
+Each L{Cube} owns a single L{BandCache}, so every view of the cube (the image
+and focal plane views, the profile plotters, the cube comparison routines)
+shares the bands, focal planes, and tiles that have already been loaded.  The
+cache can be filled ahead of time by a L{BandPrefetcher} thread.
+"""
+
+import threading
+
+from peppy.vfs.itools.core.cache import LRUCache
+
+from peppy.debug import *
+
+
+class BandCache(debugmixin):
+    """Least-recently-used cache of numpy arrays, limited by total size.
+
+    Entries are keyed by a tuple describing the slice of the cube, e.g.
+    ('band', 12) or ('tile', 12, line1, line2, sample1, sample2).  When the
+    total number of bytes held in the cache exceeds the size limit, the least
+    recently used arrays are discarded.
+    
+    The cached arrays are shared by every caller, so they are made read-only
+    to make any attempt to modify them in place fail rather than silently
+    changing the data seen by the other views.
+    
+    The cache may be used from multiple threads.  If an entry is requested
+    while another thread is loading it, the caller waits for that load to
+    finish rather than starting a duplicate load.
+    """
+    def __init__(self, max_bytes):
+        # The eviction is handled here based on the number of bytes rather
+        # than the number of entries, so the LRUCache's automatic size limits
+        # are not used.
+        self.lru = LRUCache(1, automatic=False)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        
+        self.lock = threading.RLock()
+        
+        # map of key to threading.Event for entries currently being loaded
+        self.pending = {}
+        
+        # incremented when the cache is cleared so that loads started before
+        # the clear aren't stored afterwards
+        self.generation = 0
+
+    def __contains__(self, key):
+        return key in self.lru
+
+    def get(self, key, loader):
+        """Return the array associated with the key, loading it if necessary.
+
+        @param key: tuple identifying the slice of the cube
+
+        @param loader: functor taking no arguments that returns the array if
+        it is not already in the cache
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                if key in self.lru:
+                    self.lru.touch(key)
+                    self.hits += 1
+                    return self.lru[key]
+                loading = self.pending.get(key, None)
+                if loading is None:
+                    loading = threading.Event()
+                    self.pending[key] = loading
+                    self.misses += 1
+                    generation = self.generation
+                    break
+            finally:
+                self.lock.release()
+            # Another thread is loading this entry; wait for it and try again.
+            # If the entry was too large to store, it will be loaded again.
+            loading.wait()
+        
+        try:
+            data = loader()
+            self.store(key, data, generation)
+        finally:
+            self.lock.acquire()
+            try:
+                del self.pending[key]
+            finally:
+                self.lock.release()
+            loading.set()
+        return data
+
+    def peek(self, key):
+        """Return the array associated with the key if it is in the cache,
+        otherwise None.  Nothing is loaded and the hit/miss counts are not
+        changed.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.lru:
+                self.lru.touch(key)
+                return self.lru[key]
+            return None
+        finally:
+            self.lock.release()
+
+    def store(self, key, data, generation=None):
+        """Add an array to the cache, discarding old entries if necessary.
+
+        Arrays that are larger than the cache itself are not stored.  The
+        array is made read-only whether or not it is stored.
+        
+        @param generation: if specified, the array is only stored if the
+        cache hasn't been cleared since this generation
+        """
+        data.flags.writeable = False
+        self.lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.lru:
+                self.current_bytes -= self.lru.pop(key).nbytes
+            size = data.nbytes
+            if size > self.max_bytes:
+                return
+            self.lru[key] = data
+            self.current_bytes += size
+            self.evict(self.max_bytes)
+        finally:
+            self.lock.release()
+
+    def evict(self, max_bytes):
+        """Remove least recently used entries until the cache holds no more
+        than the specified number of bytes.
+        """
+        self.lock.acquire()
+        try:
+            while self.current_bytes > max_bytes and len(self.lru) > 0:
+                key, data = self.lru.popitem()
+                self.current_bytes -= data.nbytes
+                self.dprint("evicted %s" % str(key))
+        finally:
+            self.lock.release()
+
+    def discard(self, test):
+        """Remove all entries whose key satisfies the test.
+
+        Used when the data in the cube has been changed, so that the cached
+        copies of the old data aren't returned.
+
+        @param test: functor taking the key and returning True if the entry
+        should be removed
+        """
+        self.lock.acquire()
+        try:
+            for key in [key for key in self.lru if test(key)]:
+                self.current_bytes -= self.lru.pop(key).nbytes
+                self.dprint("discarded %s" % str(key))
+        finally:
+            self.lock.release()
+
+    def setMaxBytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict(max_bytes)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.lru.clear()
+            self.current_bytes = 0
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def getSummary(self):
+        """Return a short text string describing the cache usage, suitable for
+        display in the status bar.
+        """
+        return "cache: %d hit/%d miss %.1fMB" % (self.hits, self.misses, self.current_bytes / (1024.0 * 1024.0))
+
+
+class BandPrefetcher(threading.Thread):
+    """Background thread that loads data into a cube's L{BandCache} before
+    it is requested by the user.
+    
+    The thread uses its own cube reader (and therefore its own file handle)
+    so that it never interferes with reads made by the GUI thread.  Only the
+    most recent request is honored: a new call to L{request} or L{cancel}
+    discards any indexes that haven't been loaded yet.
+    """
+    def __init__(self, cube, fetch):
+        """Create the prefetcher.
+        
+        @param cube: the L{Cube} whose cache will be filled
+        
+        @param fetch: functor taking a cube reader and an index that loads
+        the data into the cube's cache, e.g. L{Cube.prefetchBand}
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.cube = cube
+        self.fetch = fetch
+        self.cube_io = None
+        self.queue = []
+        self.condition = threading.Condition()
+        self.stopped = False
+    
+    def request(self, indexes):
+        """Replace any outstanding prefetches with the given list of indexes
+        """
+        self.condition.acquire()
+        try:
+            self.queue = list(indexes)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def cancel(self):
+        """Discard any outstanding prefetches"""
+        self.request([])
+    
+    def stop(self):
+        """Discard outstanding prefetches and end the thread"""
+        self.condition.acquire()
+        try:
+            self.stopped = True
+            self.queue = []
+            self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def getNextIndex(self):
+        """Block until an index is available, returning None if the thread
+        has been stopped.
+        """
+        self.condition.acquire()
+        try:
+            while not self.queue and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return None
+            return self.queue.pop(0)
+        finally:
+            self.condition.release()
+    
+    def run(self):
+        try:
+            self.cube_io = self.cube.getCubeReader()
+        except Exception, e:
+            dprint("Can't prefetch from %s: %s" % (self.cube.url, e))
+            return
+        while True:
+            index = self.getNextIndex()
+            if index is None:
+                break
+            try:
+                self.fetch(self.cube_io, index)
+            except Exception, e:
+                import traceback
+                dprint(traceback.format_exc())
@@ -91,6 +91,7 @@ class Colormap:
         self._i_over = N+1
         self._i_bad = N+2
         self._isinit = False
+        self._byte_lut = None
 
 
     def __call__(self, X, alpha=1.0, bytes=False):
@@ -141,6 +142,20 @@ class Colormap:
             rgba = tuple(rgba[0,:])
         return rgba
 
+    def getByteLUT(self):
+        """Return the colormap as an array of (256, 3) uint8 rgb values.
+
+        This is equivalent to calling the colormap with a uint8 array and
+        bytes=True and discarding the alpha channel, but can be used directly
+        with numpy.take to fill an rgb image.
+        """
+        if not self._isinit: self._init()
+        if self._byte_lut is None:
+            index = np.minimum(np.arange(256), self.N - 1)
+            lut = (self._lut[:self.N, :3] * 255).astype(np.uint8)
+            self._byte_lut = lut.take(index, axis=0)
+        return self._byte_lut
+
     def set_bad(self, color = 'k', alpha = 1.0):
         '''Set color to be used for masked values.
         '''
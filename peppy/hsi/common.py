@@ -40,7 +40,7 @@ def scipy_module():
 
 
 __all__ = ['HSIActionMixin', 'scipy_module',
-           'Cube', 'CubeReader',
+           'Cube', 'CubeReader', 'FileCubeReader',
            'MetadataMixin', 'newCube', 'createCube', 'createCubeLike',
            'LittleEndian', 'BigEndian', 'nativeByteOrder', 'native_endian',
            'HyperspectralFileFormat',
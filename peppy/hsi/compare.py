@@ -0,0 +1,276 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Chunked, multiprocess comparison of two HSI cubes.
+
+The per-pixel comparison metrics used by L{CubeCompare} (euclidean distance,
+spectral angle, heat map, and difference histogram) are computed here on
+ranges of lines using vectorized numpy operations.  When both cubes are raw
+files on the local filesystem, the line ranges are farmed out to a pool of
+worker processes.  Each worker memory maps the files itself, so only the
+small description of each cube is pickled and sent to the workers rather than
+the data.
+"""
+
+import os, sys, math
+
+import numpy
+
+import cube as HSI
+
+from peppy.debug import *
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+
+class MMapCubeSource(object):
+    """Picklable description of the raw data of a cube on the local
+    filesystem.
+
+    The file is memory mapped on first use in whichever process the instance
+    ends up in.
+    """
+    def __init__(self, cube):
+        self.filename = str(cube.url.path)
+        self.offset = cube.data_offset
+        self.dtype = numpy.dtype(cube.data_type).newbyteorder(HSI.byteordertext[cube.byte_order])
+        self.interleave = cube.interleave.lower()
+        self.lines = cube.lines
+        self.samples = cube.samples
+        self.bands = cube.bands
+        self.raw = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['raw'] = None
+        return state
+
+    @classmethod
+    def canMap(cls, cube):
+        """Check whether the cube's raw data can be memory mapped directly"""
+        if cube.url is None or not hasattr(cube.url, 'scheme') or cube.url.scheme != "file":
+            return False
+        if cube.interleave.lower() not in ['bip', 'bil', 'bsq']:
+            return False
+        return isinstance(cube.cube_io, (HSI.MMapCubeReader, HSI.FileCubeReader))
+
+    def open(self):
+        if self.raw is None:
+            if self.interleave == 'bip':
+                shape = (self.lines, self.samples, self.bands)
+            elif self.interleave == 'bil':
+                shape = (self.lines, self.bands, self.samples)
+            else:
+                shape = (self.bands, self.lines, self.samples)
+            self.raw = numpy.memmap(self.filename, dtype=self.dtype, mode="r",
+                                    offset=self.offset, shape=shape)
+        return self.raw
+
+    def getLines(self, start, end):
+        """Return an array of (lines x bands x samples) for the given range
+        of lines.
+        """
+        raw = self.open()
+        if self.interleave == 'bip':
+            return raw[start:end, :, :].transpose(0, 2, 1)
+        elif self.interleave == 'bil':
+            return raw[start:end, :, :]
+        return raw[:, start:end, :].transpose(1, 0, 2)
+
+
+class CubeSource(object):
+    """In-process source of line ranges for cubes that can't be memory mapped
+    by the worker processes (e.g. cubes on remote filesystems, subsets of
+    other cubes, or cubes created in memory).
+    """
+    def __init__(self, cube):
+        self.cube = cube
+
+    def getLines(self, start, end):
+        lines = numpy.empty((end - start, self.cube.bands, self.cube.samples), dtype=self.cube.data_type)
+        for i in range(start, end):
+            lines[i - start] = self.cube.getFocalPlaneRaw(i, use_progress=False)
+        return lines
+
+
+def compareChunk(args):
+    """Compute the comparison metrics for a range of lines.
+
+    This is a module-level function so that it can be sent to the worker
+    processes of a multiprocessing pool.
+
+    @param args: tuple of (source1, source2, line_offset, start, end,
+    samples, good, metrics, nbins) where the sources provide getLines,
+    line_offset is the offset of the first line of source2 within source1,
+    start and end are the line range in source2 coordinates, samples is the
+    number of common samples, good is the list of booleans indicating the
+    good bands, metrics is the list of metrics to compute, and nbins is the
+    number of bins in the difference histogram.
+
+    @returns: tuple of the start line, the end line, and a dict mapping the
+    name of each metric to its result
+    """
+    source1, source2, line_offset, start, end, samples, good, metrics, nbins = args
+    p1 = numpy.asarray(source1.getLines(start + line_offset, end + line_offset)[:, :, :samples], dtype=numpy.float64)
+    p2 = numpy.asarray(source2.getLines(start, end)[:, :, :samples], dtype=numpy.float64)
+    diff = p1 - p2
+    results = {}
+
+    if 'histogram' in metrics:
+        # Histogram of the magnitude of the difference at each band, matching
+        # numpy.histogram(bins=nbins, range=(0, nbins)) for each band but
+        # computed for all bands with a single bincount.
+        values = numpy.abs(diff).transpose(1, 0, 2).reshape(diff.shape[1], -1)
+        bins = numpy.floor(values).astype(numpy.int64)
+        bins[values == nbins] = nbins - 1
+        valid = values <= nbins
+        bins += (numpy.arange(diff.shape[1]) * nbins)[:, numpy.newaxis]
+        counts = numpy.bincount(bins[valid], minlength=diff.shape[1] * nbins)
+        results['histogram'] = counts.reshape(diff.shape[1], nbins).astype(numpy.int32)
+
+    good = numpy.asarray(good, dtype=numpy.bool_)
+    if not good.all():
+        diff = diff[:, good, :]
+        p1 = p1[:, good, :]
+        p2 = p2[:, good, :]
+
+    if 'euclidean' in metrics:
+        results['euclidean'] = numpy.sqrt(numpy.add.reduce(diff * diff, axis=1)).astype(numpy.float32)
+
+    if 'heatmap' in metrics:
+        results['heatmap'] = numpy.add.reduce(numpy.abs(diff), axis=1)
+
+    if 'sam' in metrics:
+        top = numpy.add.reduce(p1 * p2, axis=1)
+        bot = numpy.sqrt(numpy.add.reduce(p1 * p1, axis=1)) * numpy.sqrt(numpy.add.reduce(p2 * p2, axis=1))
+        old = numpy.seterr(divide='ignore', invalid='ignore')
+        try:
+            tot = top / bot
+        finally:
+            numpy.seterr(**old)
+        # the arccos may not be zero if the spectra are exactly the same due
+        # to round-off error in the squaring/sqrt, so force the total to 1.0
+        # if the spectra are identical
+        tot = numpy.where(numpy.logical_not(diff.any(axis=1)), 1.0, tot)
+        tot = numpy.clip(numpy.nan_to_num(tot), -1.0, 1.0)
+        results['sam'] = (numpy.arccos(tot) * (180.0 / math.pi)).astype(numpy.float32)
+    return start, end, results
+
+
+class ChunkedCubeCompare(debugmixin):
+    """Compute per-pixel comparison metrics of two cubes in chunks of lines.
+
+    Cube1 must be at least as large as cube2, with cube2 starting at
+    line_offset within cube1 (see L{CubeCompare}).
+    """
+    #: Approximate number of bytes of input data from each cube processed at
+    #: one time by each worker
+    chunk_bytes = 16 * 1024 * 1024
+
+    #: Number of worker processes; None means use one per CPU, and 1 means
+    #: compute everything in the current process.
+    processes = None
+
+    def __init__(self, cube1, cube2, line_offset=0, bbl=None):
+        self.cube1 = cube1
+        self.cube2 = cube2
+        self.line_offset = line_offset
+        self.lines = cube2.lines
+        self.samples = cube2.samples
+        self.bands = cube2.bands
+        if bbl is None:
+            bbl = cube1.getBadBandList(cube2)
+        self.good = [bool(b) for b in bbl]
+        self.dtype = numpy.find_common_type([cube1.data_type, cube2.data_type], [])
+
+    def getSource(self, cube):
+        if MMapCubeSource.canMap(cube):
+            return MMapCubeSource(cube)
+        return CubeSource(cube)
+
+    def getLinesPerChunk(self):
+        bytes_per_line = self.bands * self.samples * 8
+        return max(1, self.chunk_bytes / max(1, bytes_per_line))
+
+    def iterChunkArgs(self, metrics, nbins):
+        source1 = self.getSource(self.cube1)
+        source2 = self.getSource(self.cube2)
+        step = self.getLinesPerChunk()
+        for start in range(0, self.lines, step):
+            end = min(start + step, self.lines)
+            yield (source1, source2, self.line_offset, start, end, self.samples, self.good, metrics, nbins)
+
+    def getNumProcesses(self):
+        if multiprocessing is None:
+            return 1
+        if self.processes is None:
+            try:
+                return multiprocessing.cpu_count()
+            except NotImplementedError:
+                return 1
+        return self.processes
+
+    def isParallel(self):
+        """Worker processes can only be used if both cubes can be memory
+        mapped by the workers themselves."""
+        return (self.getNumProcesses() > 1 and
+                self.lines > self.getLinesPerChunk() and
+                MMapCubeSource.canMap(self.cube1) and
+                MMapCubeSource.canMap(self.cube2))
+
+    def iterResults(self, metrics, nbins):
+        args = self.iterChunkArgs(metrics, nbins)
+        if self.isParallel():
+            try:
+                pool = multiprocessing.Pool(self.getNumProcesses())
+            except (OSError, ImportError), e:
+                self.dprint("Can't create process pool: %s" % e)
+                pool = None
+            if pool is not None:
+                try:
+                    for result in pool.imap_unordered(compareChunk, args):
+                        yield result
+                finally:
+                    pool.terminate()
+                return
+        for arg in args:
+            yield compareChunk(arg)
+
+    def compute(self, metrics, nbins=500, updater=None):
+        """Compute the requested metrics in a single pass through both cubes.
+
+        @param metrics: list containing any of 'euclidean', 'sam', 'heatmap',
+        or 'histogram'
+
+        @param nbins: number of bins in the difference histogram
+
+        @param updater: optional ThreadStatus-like object used to report
+        progress
+
+        @returns: dict mapping the metric name to a numpy array: (lines x
+        samples) for the per-pixel metrics, or (bands x nbins) for the
+        histogram
+        """
+        output = {}
+        for metric in metrics:
+            if metric == 'histogram':
+                output[metric] = numpy.zeros((self.bands, nbins), dtype=numpy.int32)
+            elif metric == 'heatmap':
+                output[metric] = numpy.zeros((self.lines, self.samples), dtype=self.dtype)
+            else:
+                output[metric] = numpy.zeros((self.lines, self.samples), dtype=numpy.float32)
+
+        done = 0
+        for start, end, results in self.iterResults(metrics, nbins):
+            for metric, values in results.iteritems():
+                if metric == 'histogram':
+                    output[metric] += values
+                else:
+                    output[metric][start:end, :] = values
+            done += end - start
+            if updater:
+                updater.updateStatus(done, self.lines, "Comparing cubes")
+            self.dprint("finished %d of %d lines" % (done, self.lines))
+        return output
@@ -12,6 +12,8 @@ from datetime import datetime
 
 import numpy
 import utils
+from cache import BandCache
+from statistics import CubeStatistics
 
 import peppy.vfs as vfs
 
@@ -137,6 +139,15 @@ class CubeReader(debugmixin):
         """Get an array of (line1:line2, sample1:sample2) at the specified band"""
         raise NotImplementedError
 
+    def getBandDecimated(self, band, step):
+        """Get an array of every step-th line and sample of the specified
+        band, i.e. (lines / step x samples / step), rounded up.
+        
+        Subclasses should override this if there's a way to avoid reading the
+        lines that are skipped.
+        """
+        return self.getBandRaw(band, use_progress=False)[::step, ::step].copy()
+
     def getSpectraRaw(self, line, sample):
         """Get the spectra (bands) at the given pixel"""
         raise NotImplementedError
@@ -251,6 +262,13 @@ class FileCubeReader(CubeReader):
     Note: this is (potentially much) slower than mmap access of the
     L{MMapCubeReader}, but won't throw out of memory exceptions.
     """
+    #: Approximate size in bytes of each read when extracting data that is
+    #: strided through the file (e.g. a band from a BIP or BIL cube).  Whole
+    #: lines are read into a reusable buffer in blocks of about this size and
+    #: the requested values are pulled out using a numpy strided view, so the
+    #: disk sees large sequential reads rather than one seek per pixel.
+    io_block_size = 4 * 1024 * 1024
+    
     def __init__(self, cube, url=None, array=None):
         CubeReader.__init__(self)
         self.fh = vfs.open(url)
@@ -304,6 +322,84 @@ class FileCubeReader(CubeReader):
             start += len
         return s
     
+    def readIntoNumpyArray(self, fh, buf):
+        """Fill a contiguous numpy array with data read from the file handle.
+        
+        Uses the file handle's readinto method where available so that no
+        temporary string is created; otherwise falls back to
+        L{getNumpyArrayFromFile}.  As with L{getNumpyArrayFromFile}, a short
+        read marks the remainder of the file as invalid and fills the missing
+        values with 0xff bytes.
+        """
+        if not hasattr(fh, 'readinto'):
+            buf[:] = self.getNumpyArrayFromFile(fh, buf.size)
+            return buf
+        pos = fh.tell()
+        nbytes = buf.size * self.itemsize
+        count = fh.readinto(buf)
+        if count is None:
+            count = 0
+        if count != nbytes:
+            self.setInvalidAfter(pos + count)
+            buf.view(numpy.uint8)[count:] = 0xff
+        return buf
+    
+    def getStridedItems(self, first, stride, count):
+        """Read single items that are evenly spaced through the file.
+        
+        Only the items themselves are read; the file pointer is moved past
+        the data between them.
+        
+        @param first: index of the first item, relative to the start of the
+        data
+        
+        @param stride: number of items from the start of one item to the
+        start of the next
+        
+        @param count: number of items to read
+        """
+        s = numpy.empty((count,), dtype=self.data_type)
+        fh = self.fh
+        for i in xrange(count):
+            fh.seek(self.offset + ((first + i * stride) * self.itemsize))
+            s[i] = self.getNumpyArrayFromFile(fh, 1)[0]
+        return s
+    
+    def getLinesPerBlock(self):
+        """Return the number of whole lines that fit in L{io_block_size}"""
+        bytes_per_line = self.samples * self.bands * self.itemsize
+        return max(1, self.io_block_size / max(1, bytes_per_line))
+    
+    def iterLineBlocks(self, shape, progress=None):
+        """Iterate through the data cube in blocks of whole lines.
+        
+        Lines are read sequentially from the start of the data into a single
+        buffer that is reused for each block, so the yielded arrays are only
+        valid until the next iteration.
+        
+        @param shape: tuple describing the layout of a single line in the
+        file, e.g. (samples, bands) for BIP or (bands, samples) for BIL
+        
+        @param progress: optional progress bar that will be updated with the
+        number of lines read
+        
+        @returns: tuple of the index of the first line in the block and a
+        numpy array of (lines in block,) + shape
+        """
+        lines_per_block = min(self.getLinesPerBlock(), self.lines)
+        items_per_line = self.samples * self.bands
+        buf = numpy.empty(lines_per_block * items_per_line, dtype=self.data_type)
+        fh = self.fh
+        fh.seek(self.offset)
+        line = 0
+        while line < self.lines:
+            count = min(lines_per_block, self.lines - line)
+            block = self.readIntoNumpyArray(fh, buf[:count * items_per_line])
+            yield line, block.reshape((count,) + shape)
+            line += count
+            if progress:
+                progress.updateProgress(line)
+    
     def getNumpyArrayFromFile(self, fh, count):
         """Convenience function to replace call to numpy.fromfile.
         
@@ -346,30 +442,11 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
     def getBandRaw(self, band, use_progress=True):
         """Get an array of (lines x samples) at the specified band"""
         s = numpy.empty((self.lines, self.samples), dtype=self.data_type)
-        fh = self.fh
-        fh.seek(self.offset + (band * self.itemsize))
-        
-        # the amount to skip between successive reads will be one less than the
-        # number of bands, because the file pointer advances by one item after
-        # a read
-        skip = self.itemsize * (self.bands - 1)
-        samp = 0
-        line = 0
         progress = self.getProgressBar(use_progress)
         if progress:
             progress.startProgress("Loading Band %d" % (band + self.user_counts_from), self.lines, delay=1.0)
-        while True:
-            data = self.getNumpyArrayFromFile(fh, 1)
-            s[line, samp] = data[0]
-            samp += 1
-            if samp >= self.samples:
-                samp = 0
-                line += 1
-                if line >= self.lines:
-                    break
-                if progress:
-                    progress.updateProgress(line)
-            fh.seek(skip, 1)
+        for line, block in self.iterLineBlocks((self.samples, self.bands), progress):
+            s[line:line + block.shape[0], :] = block[:, :, band]
         if progress:
             progress.stopProgress("Loaded Band %d" % (band + self.user_counts_from))
             
@@ -377,6 +454,19 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
             s.byteswap(True)
         return s
 
+    def getBandDecimated(self, band, step):
+        """Read only every step-th line"""
+        lines = range(0, self.lines, step)
+        s = numpy.empty((len(lines), len(range(0, self.samples, step))), dtype=self.data_type)
+        buf = numpy.empty((self.samples * self.bands,), dtype=self.data_type)
+        for i, line in enumerate(lines):
+            self.fh.seek(self.offset + (self.bands * self.samples) * line * self.itemsize)
+            self.readIntoNumpyArray(self.fh, buf)
+            s[i, :] = buf.reshape(self.samples, self.bands)[::step, band]
+        if self.swap:
+            s.byteswap(True)
+        return s
+
     def getSpectraRaw(self, line, sample):
         """Get the spectra at the given pixel"""
         fh = self.fh
@@ -400,21 +490,7 @@ class FileBIPCubeReader(BIPMixin, FileCubeReader):
 
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values along a line, the given sample and band"""
-        s = numpy.empty((self.lines,), dtype=self.data_type)
-        fh = self.fh
-        fh.seek(self.offset + (((self.bands * sample) + band) * self.itemsize))
-        
-        # amount to skip to read the next line at the same sample, band
-        # coordinate is one less because the file pointer will have advanced
-        # by one due to the file read
-        skip = self.itemsize * ((self.samples * self.bands) - 1)
-        line = 0
-        while line < self.lines:
-            data = self.getNumpyArrayFromFile(fh, 1)
-            s[line] = data[0]
-            line += 1
-            fh.seek(skip, 1)
-            
+        s = self.getStridedItems((self.bands * sample) + band, self.samples * self.bands, self.lines)
         if self.swap:
             s.byteswap(True)
         return s
@@ -440,27 +516,16 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
     def getBandRaw(self, band, use_progress=True):
         """Get an array of (lines x samples) at the specified band"""
         s = numpy.empty((self.lines, self.samples), dtype=self.data_type)
-        fh = self.fh
-        fh.seek(self.offset + ((band * self.samples) * self.itemsize))
-        
-        # the amount to skip between successive reads will be less than the
-        # number of bands * samples, because the file pointer advances by the
-        # number of samples after a read
-        skip = self.itemsize * ((self.samples * self.bands) - self.samples)
-        samp = 0
-        line = 0
         progress = self.getProgressBar(use_progress)
         if progress:
             progress.startProgress("Loading Band %d" % (band + self.user_counts_from), self.lines, delay=1)
-        while True:
-            data = self.getNumpyArrayFromFile(fh, self.samples)
-            s[line, :] = data
-            line += 1
-            if line >= self.lines:
-                break
+        # Only the band's portion of each line is read
+        fh = self.fh
+        for line in xrange(self.lines):
+            fh.seek(self.offset + ((self.bands * line) + band) * self.samples * self.itemsize)
+            self.readIntoNumpyArray(fh, s[line])
             if progress:
                 progress.updateProgress(line)
-            fh.seek(skip, 1)
         if progress:
             progress.stopProgress("Loaded Band %d" % (band + self.user_counts_from))
             
@@ -468,6 +533,19 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
             s.byteswap(True)
         return s
 
+    def getBandDecimated(self, band, step):
+        """Read only the band's portion of every step-th line"""
+        lines = range(0, self.lines, step)
+        s = numpy.empty((len(lines), len(range(0, self.samples, step))), dtype=self.data_type)
+        buf = numpy.empty((self.samples,), dtype=self.data_type)
+        for i, line in enumerate(lines):
+            self.fh.seek(self.offset + ((self.bands * line) + band) * self.samples * self.itemsize)
+            self.readIntoNumpyArray(self.fh, buf)
+            s[i, :] = buf[::step]
+        if self.swap:
+            s.byteswap(True)
+        return s
+
     def getSpectraRaw(self, line, sample):
         """Get the spectra at the given pixel"""
         s = numpy.empty((self.bands,), dtype=self.data_type)
@@ -501,21 +579,7 @@ class FileBILCubeReader(BILMixin, FileCubeReader):
 
     def getFocalPlaneDepthRaw(self, sample, band):
         """Get an array of values along a line, the given sample and band"""
-        s = numpy.empty((self.lines,), dtype=self.data_type)
-        fh = self.fh
-        fh.seek(self.offset + (((band * self.samples) + sample) * self.itemsize))
-        
-        # amount to skip to read the next line at the same sample, band
-        # coordinate is one less because the file pointer will have advanced
-        # by one due to the file read
-        skip = self.itemsize * ((self.samples * self.bands) - 1)
-        line = 0
-        while line < self.lines:
-            data = self.getNumpyArrayFromFile(fh, 1)
-            s[line] = data[0]
-            line += 1
-            fh.seek(skip, 1)
-            
+        s = self.getStridedItems((self.samples * band) + sample, self.samples * self.bands, self.lines)
         if self.swap:
             s.byteswap(True)
         return s
@@ -549,6 +613,19 @@ class FileBSQCubeReader(BSQMixin, FileCubeReader):
             s.byteswap(True)
         return s
 
+    def getBandDecimated(self, band, step):
+        """Read only every step-th line of the band"""
+        lines = range(0, self.lines, step)
+        s = numpy.empty((len(lines), len(range(0, self.samples, step))), dtype=self.data_type)
+        buf = numpy.empty((self.samples,), dtype=self.data_type)
+        for i, line in enumerate(lines):
+            self.fh.seek(self.offset + ((self.lines * band) + line) * self.samples * self.itemsize)
+            self.readIntoNumpyArray(self.fh, buf)
+            s[i, :] = buf[::step]
+        if self.swap:
+            s.byteswap(True)
+        return s
+
     def getSpectraRaw(self, line, sample):
         """Get the spectra at the given pixel"""
         s = numpy.empty((self.bands,), dtype=self.data_type)
@@ -869,6 +946,18 @@ class Cube(debugmixin):
     # mmap; otherwise will be loaded with direct file access
     mmap_size_limit = -1
 
+    # : Maximum number of bytes used by each cube to hold recently loaded
+    # bands, focal planes, and tiles.  See L{BandCache}.
+    band_cache_size = 256 * 1024 * 1024
+
+    # : Whether the per-band statistics should be saved in a sidecar file
+    # next to the cube after they are calculated.  See L{CubeStatistics}.
+    save_statistics = True
+
+    # : Maximum number of bytes of the cube held in memory when writing the
+    # cube in a different interleave.  See L{CubeTransposer}.
+    export_memory_budget = 64 * 1024 * 1024
+
     def __init__(self, filename=None, interleave='unknown', progress=None):
         self.url = None
         self.setURL(filename)
@@ -937,10 +1026,18 @@ class Cube(debugmixin):
         # data reader
         self.cube_io = None
         self.itemsize=0
+        
+        # cache of recently loaded data, shared by all views of this cube
+        self.band_cache = None
 
         # calculated quantities
         self.spectraextrema=[None,None] # min and max over whole cube
         
+        # per-band statistics, calculated on demand or loaded from the
+        # sidecar file
+        self.statistics = None
+        self.statistics_checked = False
+        
         # progress bar indicator
         self.progress = progress
 
@@ -1023,6 +1120,7 @@ class Cube(debugmixin):
         if url:
             self.setURL(url)
             self.cube_io = None
+            self.clearCache()
 
         if self.url:
             if self.cube_io is None: # don't try to reopen if already open
@@ -1179,6 +1277,95 @@ class Cube(debugmixin):
     def getUpdatedExtrema(self):
         return self.spectraextrema
 
+    def setStatistics(self, stats):
+        """Use the given L{CubeStatistics}, which also provides the extrema
+        over the whole cube."""
+        self.statistics = stats
+        if stats is not None:
+            mn, mx = stats.getExtrema()
+            if mn is not None:
+                # spectraextrema is modified in place; see updateExtrema
+                self.spectraextrema[0] = mn
+                self.spectraextrema[1] = mx
+
+    def getCachedStatistics(self):
+        """Return the per-band statistics only if they're available without
+        scanning the cube, either because they have already been calculated
+        or because they can be loaded from the sidecar file.
+        
+        @returns: L{CubeStatistics} instance or None
+        """
+        if self.statistics is None and not self.statistics_checked:
+            self.statistics_checked = True
+            self.setStatistics(CubeStatistics.loadSidecar(self))
+        return self.statistics
+
+    def getStatistics(self, progress=None):
+        """Return the per-band statistics, calculating them in a single pass
+        through the cube if necessary.
+        
+        @param progress: optional progress indicator passed to
+        L{CubeStatistics.calculate}
+        
+        @returns: L{CubeStatistics} instance
+        """
+        if self.getCachedStatistics() is None:
+            stats = CubeStatistics.fromCube(self, progress)
+            if self.save_statistics:
+                stats.saveSidecar(self)
+            self.setStatistics(stats)
+        return self.statistics
+
+    def getBandCache(self):
+        """Return the cache of recently loaded data, creating it if necessary.
+        """
+        if self.band_cache is None:
+            self.band_cache = BandCache(self.band_cache_size)
+        return self.band_cache
+
+    def canPrefetch(self):
+        """Return True if loading data ahead of time in a background thread
+        would be worthwhile.
+        
+        Memory mapped data is loaded on demand by the operating system, so
+        only cubes read through direct file access are prefetched.
+        """
+        return self.url is not None and isinstance(self.cube_io, FileCubeReader)
+
+    def prefetchBand(self, cube_io, band):
+        """Load a band into the cache using the given cube reader.
+        
+        Used by L{BandPrefetcher}, which uses its own reader so that file
+        accesses from the background thread don't interfere with the reader
+        used by the GUI thread.
+        """
+        self.getBandCache().get(('band', band), lambda: cube_io.getBandRaw(band, use_progress=False))
+
+    def prefetchFocalPlane(self, cube_io, line):
+        """Load a focal plane into the cache using the given cube reader.
+        
+        @see: L{prefetchBand}
+        """
+        self.getBandCache().get(('focalplane', line), lambda: cube_io.getFocalPlaneRaw(line, use_progress=False))
+
+    def clearCache(self):
+        """Discard all cached data; must be called if the underlying data or
+        the dimensions of the cube change.
+        """
+        if self.band_cache is not None:
+            self.band_cache.clear()
+        self.statistics = None
+        self.statistics_checked = False
+
+    def discardBand(self, band):
+        """Discard the cached data that includes the specified band; must be
+        called after the band is modified through the cube reader.
+        
+        Focal planes contain every band, so they are all discarded.
+        """
+        if self.band_cache is not None:
+            self.band_cache.discard(lambda key: key[0] == 'focalplane' or key[1] == band)
+
     def getPixel(self,line,sample,band):
         """Get an individual pixel at the specified line, sample, & band"""
         return self.cube_io.getPixel(line, sample, band)
@@ -1197,8 +1384,52 @@ class Cube(debugmixin):
         return s
 
     def getBandRaw(self, band, use_progress=True):
-        return self.cube_io.getBandRaw(band, use_progress)
+        return self.getBandCache().get(('band', band), lambda: self.cube_io.getBandRaw(band, use_progress))
     
+    def getBandOverview(self, band, step):
+        """Get a reduced resolution version of a band for display at low
+        zoom levels.
+        
+        The overview contains every step-th line and sample of the band.
+        Overviews are kept in the band cache, and are created from the full
+        band or a finer overview if one is already in the cache; otherwise
+        only the lines needed for the overview are read from the cube.
+        
+        @param band: band number
+        @param step: reduction factor, normally a power of two
+        @returns: numpy array of (lines / step x samples / step), rounded up
+        """
+        if step <= 1:
+            return self.getBandRaw(band)
+        return self.getBandCache().get(('overview', band, step), lambda: self.loadBandOverview(self.cube_io, band, step))
+
+    def loadBandOverview(self, cube_io, band, step):
+        """Create the overview from the finest level of the pyramid that is
+        already in the cache, falling back to reading it from the cube."""
+        cache = self.getBandCache()
+        finer = step / 2
+        while finer >= 1:
+            if finer == 1:
+                key = ('band', band)
+            else:
+                key = ('overview', band, finer)
+            data = cache.peek(key)
+            if data is not None:
+                reduction = step / finer
+                return data[::reduction, ::reduction].copy()
+            finer /= 2
+        return cube_io.getBandDecimated(band, step)
+
+    def prefetchBandOverview(self, cube_io, band, step):
+        """Load a band overview into the cache using the given cube reader.
+        
+        @see: L{prefetchBand}
+        """
+        if step <= 1:
+            self.prefetchBand(cube_io, band)
+        else:
+            self.getBandCache().get(('overview', band, step), lambda: self.loadBandOverview(cube_io, band, step))
+
     def getBandTile(self, line1, line2, sample1, sample2, band):
         """Return a rectangular subset of a band.
         
@@ -1211,7 +1442,8 @@ class Cube(debugmixin):
         @param band: band number
         @returns: numpy array containing the slice of the band
         """
-        return self.cube_io.getBandTile(line1, line2, sample1, sample2, band)
+        key = ('tile', band, line1, line2, sample1, sample2)
+        return self.getBandCache().get(key, lambda: self.cube_io.getBandTile(line1, line2, sample1, sample2, band))
 
     def getFocalPlaneInPlace(self, line, use_progress=True):
         """Get the slice of the data array (bands x samples) at the specified
@@ -1223,7 +1455,7 @@ class Cube(debugmixin):
         return s
 
     def getFocalPlaneRaw(self, line, use_progress=True):
-        return self.cube_io.getFocalPlaneRaw(line, use_progress)
+        return self.getBandCache().get(('focalplane', line), lambda: self.cube_io.getFocalPlaneRaw(line, use_progress))
 
     def getFocalPlaneDepthInPlace(self, sample, band):
         """Get the slice of the data array through the cube at the specified
@@ -1517,22 +1749,32 @@ class Cube(debugmixin):
             return self.iterRaw(block_size, iter, byte_order)
         return None
     
-    def writeRawData(self, fh, options=None, progress=None, block_size=100000):
+    def writeRawData(self, fh, options=None, progress=None, block_size=None):
+        """Write the raw data of the cube to the file handle.
+        
+        The data is converted to the requested interleave and byte order
+        using L{CubeTransposer}, which holds at most a fixed amount of the
+        cube in memory regardless of the size of the cube.
+        
+        @param options: dict that may contain 'interleave' and 'byte_order'
+        entries specifying the output format
+        
+        @param progress: optional functor taking a percentage of completion
+        
+        @param block_size: if specified, the approximate maximum number of
+        bytes of the cube to hold in memory at once; otherwise
+        L{export_memory_budget} is used
+        """
+        from transpose import CubeTransposer
+        
+        if block_size is None:
+            block_size = self.export_memory_budget
         if options is None:
             options = dict()
         interleave = options.get('interleave', self.interleave)
         byte_order = options.get('byte_order', self.byte_order)
-        num_blocks = (self.data_bytes / block_size) + 1
-        iterator = self.getRawIterator(block_size, interleave, byte_order)
-        if iterator:
-            count = 0
-            for block in iterator:
-                fh.write(block)
-                if progress:
-                    progress((count * 100) / num_blocks)
-                count += 1
-        else:
-            raise ValueError("Unknown interleave %s" % interleave)
+        transposer = CubeTransposer(self, interleave, byte_order, block_size)
+        transposer.write(fh, progress)
 
     def registerProgress(self, progress):
         """Register the progress bar that cube functions may use when needed.
@@ -1568,17 +1810,19 @@ class Cube(debugmixin):
         index = 0
         for i in rgb:
             image.wavelengths.append(self.wavelengths[i])
-            store = image.getBandRaw(index)
+            store = image.cube_io.getBandRaw(index)
             source = self.getBandRaw(i)
             store[:,:] = source[:,:]
+            image.discardBand(index)
             index += 1
         return image
     
     
     #### Data modification functions
     def fillBandWithConstant(self, band, value):
-        data = self.getBandRaw(band)
+        data = self.cube_io.getBandRaw(band)
         data[:,:] = value
+        self.discardBand(band)
 
 
 def newCube(interleave, url=None, progress=None):
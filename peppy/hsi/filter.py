@@ -5,7 +5,7 @@
 This file is a repository of actions that operate on the HSI mode.
 """
 
-import os, struct, mmap, math
+import os, struct, mmap, math, threading, thread
 from cStringIO import StringIO
 
 from peppy.hsi.common import *
@@ -16,54 +16,160 @@ import peppy.hsi.colors as colors
 # handled by the major mode wrapper
 import numpy
 
+try:
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    multiprocessing = None
+    ThreadPool = None
 
-class RGBMapper(debugmixin):
-    def scaleChunk(self, raw, minval, maxval, u1, u2, v1, v2, output):
-        assert self.dprint("processing chunk [%d:%d, %d:%d], min=%d max=%d" % (u1, u2, v1, v2, minval, maxval))
-        if minval == maxval:
-            output[u1:u2, v1:v2] = (raw[u1:u2, v1:v2] - minval).astype(numpy.uint8)
-        else:
-            #gray=((raw-minval)*(255.0/(maxval-minval))).astype(numpy.uint8)
-            temp1 = raw[u1:u2, v1:v2] - minval
-            temp2 = temp1 * (255.0/(maxval-minval))
-            output[u1:u2, v1:v2] = temp2.astype(numpy.uint8)
 
-    def getGray(self, raw, tile_size=256):
+class RGBMapper(debugmixin):
+    """Convert the display planes to an RGB image.
+    
+    The planes are scaled to bytes in tiles of whole lines, and the tiles are
+    processed in parallel by a pool of threads shared by all mappers.  numpy
+    releases the GIL during the arithmetic, so the threads run concurrently.
+    """
+    #: Number of threads used to scale the tiles of an image; None means one
+    #: per CPU, and 1 means everything is done in the calling thread.
+    threads = None
+    
+    #: Number of lines in each tile
+    tile_size = 256
+    
+    _pool = None
+    _pool_threads = 0
+    _pool_lock = threading.Lock()
+    
+    def getNumThreads(self):
+        if self.threads is None:
+            try:
+                return multiprocessing.cpu_count()
+            except (NotImplementedError, AttributeError):
+                return 1
+        return max(1, self.threads)
+    
+    def getPool(self):
+        """Return the shared thread pool, or None if the tiles should be
+        processed in the calling thread."""
+        count = self.getNumThreads()
+        if count <= 1 or ThreadPool is None:
+            return None
+        RGBMapper._pool_lock.acquire()
+        try:
+            if RGBMapper._pool is None or RGBMapper._pool_threads != count:
+                if RGBMapper._pool is not None:
+                    RGBMapper._pool.close()
+                try:
+                    RGBMapper._pool = ThreadPool(count)
+                    RGBMapper._pool_threads = count
+                except (OSError, ImportError, thread.error), e:
+                    self.dprint("Can't create thread pool: %s" % e)
+                    RGBMapper._pool = None
+                    RGBMapper._pool_threads = 0
+            return RGBMapper._pool
+        finally:
+            RGBMapper._pool_lock.release()
+    
+    def mapTiles(self, func, lines, tile_size=None):
+        """Call the function for each tile of lines, possibly in parallel.
+        
+        @param func: callable taking the start and end line of the tile
+        @returns: list of results of the function in tile order
+        """
+        if tile_size is None:
+            tile_size = self.tile_size
+        tile_size = max(1, tile_size)
+        tiles = [(u1, min(u1 + tile_size, lines)) for u1 in range(0, lines, tile_size)]
+        if len(tiles) > 1:
+            pool = self.getPool()
+            if pool is not None:
+                return pool.map(lambda tile: func(*tile), tiles)
+        return [func(u1, u2) for u1, u2 in tiles]
+    
+    def getExtrema(self, raw, tile_size=None):
+        """Find the min and max of the plane in a single pass over each
+        tile."""
+        def extrema(u1, u2):
+            tile = raw[u1:u2]
+            return tile.min(), tile.max()
+        results = self.mapTiles(extrema, raw.shape[0], tile_size)
         # Without the following casts, raw.min() and raw.max() remain as ctype
         # variables rather than python ints and will be clamped to the ctype
         # max value.  I was getting the following bad result without the cast:
         # 
         # min=-3624 max=32767 range=-29145 len(raw)=78388745
-        minval = float(raw.min())
-        maxval = float(raw.max())
-        valrange = int(maxval-minval)
-        assert self.dprint("data: min=%s max=%s range=%s len(raw)=%d" % (str(minval),str(maxval),str(valrange), raw.size))
-        gray = numpy.empty(raw.shape, dtype=numpy.uint8)
-        v1 = 0
-        v2 = raw.shape[1]
-        u1 = 0
-        assert self.dprint("raw size: %s" % (str(raw.shape)))
-        while u1 < raw.shape[0]:
-            u2 = u1 + tile_size
-            if u2 > raw.shape[0]:
-                u2 = raw.shape[0]
-            self.scaleChunk(raw, minval, maxval, u1, u2, v1, v2, gray)
-            u1 = u2
+        minval = float(min([r[0] for r in results]))
+        maxval = float(max([r[1] for r in results]))
+        return minval, maxval
+    
+    def scaleTile(self, tile, minval, maxval, output):
+        """Scale the tile to the range 0 - 255, storing the result in the
+        uint8 output array of the same shape."""
+        if minval == maxval:
+            output[...] = tile - minval
+        else:
+            temp = numpy.subtract(tile, minval, numpy.empty(tile.shape, dtype=numpy.float64))
+            temp *= 255.0/(maxval-minval)
+            output[...] = temp
 
-        return gray
+    def scaleChunk(self, raw, minval, maxval, u1, u2, v1, v2, output):
+        assert self.dprint("processing chunk [%d:%d, %d:%d], min=%d max=%d" % (u1, u2, v1, v2, minval, maxval))
+        self.scaleTile(raw[u1:u2, v1:v2], minval, maxval, output[u1:u2, v1:v2])
 
-    def getGrayMapping(self,raw):
-        return self.getGray(raw)
+    def getMinMax(self, raw, stats=None, tile_size=None):
+        if stats is not None:
+            # use the precalculated extrema rather than scanning the data
+            return float(stats.min), float(stats.max)
+        return self.getExtrema(raw, tile_size)
 
-    def getRGB(self, lines, samples, planes):
-        rgb = numpy.zeros((lines, samples, 3),numpy.uint8)
-        assert self.dprint("shapes: rgb=%s planes=%s" % (rgb.shape, planes[0].shape))
+    def getGray(self, raw, tile_size=None, stats=None, output=None):
+        """Scale the plane to bytes.
+        
+        @param stats: optional L{BandStatistics} of the plane
+        
+        @param output: optional uint8 array (or view, e.g. one color plane of
+        an RGB image) of the same shape as the plane to hold the result
+        """
+        minval, maxval = self.getMinMax(raw, stats, tile_size)
+        assert self.dprint("data: min=%s max=%s range=%s len(raw)=%d" % (str(minval),str(maxval),str(maxval-minval), raw.size))
+        if output is None:
+            output = numpy.empty(raw.shape, dtype=numpy.uint8)
+        v1 = 0
+        v2 = raw.shape[1]
+        assert self.dprint("raw size: %s" % (str(raw.shape)))
+        def scale(u1, u2):
+            self.scaleChunk(raw, minval, maxval, u1, u2, v1, v2, output)
+        self.mapTiles(scale, raw.shape[0], tile_size)
+        return output
+
+    def getGrayMapping(self, raw, stats=None, output=None):
+        return self.getGray(raw, stats=stats, output=output)
+
+    def getPlaneStatistics(self, stats, i):
+        """Return the statistics corresponding to the ith plane, or None
+        if they aren't known"""
+        if stats is not None and i < len(stats):
+            return stats[i]
+        return None
+
+    def getRGB(self, lines, samples, planes, stats=None):
+        """Convert the planes to an RGB image.
+        
+        @param stats: optional list of L{BandStatistics} (or None for unknown
+        statistics), one for each plane, used to avoid scanning the planes for
+        their extrema
+        """
         count = len(planes)
-        if count > 0:
-            for i in range(count):
-                rgb[:,:,i] = self.getGrayMapping(planes[i])
-            for i in range(count,3,1):
-                rgb[:,:,i] = rgb[:,:,0]
+        if count == 0:
+            return numpy.zeros((lines, samples, 3),numpy.uint8)
+        rgb = numpy.empty((lines, samples, 3),numpy.uint8)
+        assert self.dprint("shapes: rgb=%s planes=%s" % (rgb.shape, planes[0].shape))
+        for i in range(count):
+            self.getGrayMapping(planes[i], self.getPlaneStatistics(stats, i), rgb[:,:,i])
+        for i in range(count,3,1):
+            rgb[:,:,i] = rgb[:,:,0]
         #dprint(rgb[0,:,0])
         
         return rgb
@@ -76,23 +182,26 @@ class PaletteMapper(RGBMapper):
         else:
             self.colormap = None
         
-    def getRGB(self, lines, samples, planes):
+    def getRGB(self, lines, samples, planes, stats=None):
         # This is designed for grayscale images only; if there is more than one
         # plane, the standard RGB method is used
         count = len(planes)
         if count > 1 or self.colormap is None:
-            return RGBMapper.getRGB(lines, samples, planes)
+            return RGBMapper.getRGB(self, lines, samples, planes, stats)
         
         if count > 0:
-            gray = self.getGrayMapping(planes[0])
+            raw = planes[0]
+            minval, maxval = self.getMinMax(raw, self.getPlaneStatistics(stats, 0))
+            lut = self.colormap.getByteLUT()
+            rgb = numpy.empty((lines, samples, 3),numpy.uint8)
             
-            # Matplotlib returns alpha values in the colormap, so we only need
-            # the first 3 bands
-            rgba = self.colormap(gray, bytes=True)
-            rgb = numpy.zeros((lines, samples, 3),numpy.uint8)
-            for i in range(3):
-                rgb[:,:,i] = rgba[:,:,i]
-            #rgb = rgba[:,:,0:3]
+            # Each tile is scaled to bytes, which are then used as indexes
+            # into the colormap to fill the tile's lines of the image directly
+            def lookup(u1, u2):
+                gray = numpy.empty((u2 - u1, samples), dtype=numpy.uint8)
+                self.scaleTile(raw[u1:u2], minval, maxval, gray)
+                lut.take(gray, axis=0, mode='clip', out=rgb[u1:u2])
+            self.mapTiles(lookup, lines)
         else:
             # blank image
             rgb = numpy.zeros((lines, samples, 3),numpy.uint8)
@@ -107,6 +216,37 @@ class GeneralFilter(debugmixin):
     def getPlane(self,raw):
         return raw
     
+    def isTileable(self):
+        """Return True if the filter only depends on the neighborhood of each
+        pixel, so the plane can be filtered in independent tiles of lines.
+        
+        Filters that use the entire plane (like a histogram) or depend on the
+        position of the line within the plane must return False.
+        """
+        return True
+    
+    def getLineHalo(self):
+        """Return the number of lines on either side of an output line that
+        are needed to compute it."""
+        return 0
+    
+    def getPlaneWithStatistics(self, raw, stats):
+        """Filter the plane, also returning the statistics of the result.
+        
+        Filters that can make use of the precalculated statistics of the band
+        should override this.  The default implementation only passes along
+        the statistics if the plane isn't changed by the filter.
+        
+        @param stats: L{BandStatistics} of the raw plane, or None if unknown
+        
+        @returns: tuple of the filtered plane and its L{BandStatistics} (or
+        None if unknown)
+        """
+        plane = self.getPlane(raw)
+        if plane is not raw:
+            stats = None
+        return plane, stats
+    
     def getXProfile(self, y, raw):
         """Get the x profile at a constant y.
         
@@ -168,6 +308,20 @@ class ContrastFilter(GeneralFilter):
         filtered = numpy.clip(raw, minscaled, maxscaled)
         return filtered
 
+    def isTileable(self):
+        return False
+    
+    def getPlaneWithStatistics(self, raw, stats):
+        """Use the band's precalculated histogram to find the stretch limits
+        rather than computing a histogram of the plane.
+        """
+        if self.contraststretch <= 0.0 or stats is None:
+            return GeneralFilter.getPlaneWithStatistics(self, raw, stats)
+        minscaled, maxscaled = stats.getStretchRange(self.contraststretch)
+        assert self.dprint("scaled from statistics: min=%s max=%s" % (minscaled, maxscaled))
+        filtered = numpy.clip(raw, minscaled, maxscaled)
+        return filtered, stats.getClipped(minscaled, maxscaled)
+
 
 class SubtractFilter(GeneralFilter):
     """Apply a subtraction filter to the band.
@@ -192,8 +346,21 @@ class SubtractFilter(GeneralFilter):
             filtered = raw - darks
         return filtered
     
+    def getDarks(self, shape):
+        """Return the darks decimated to match the shape of the plane, which
+        will be smaller than the darks when displaying an overview."""
+        darks = self.darks
+        step = 2
+        while darks.shape != shape and step <= max(darks.shape):
+            darks = self.darks[::step, ::step]
+            step *= 2
+        return darks
+    
     def getPlane(self, raw):
-        return self.filter(raw, self.darks)
+        return self.filter(raw, self.getDarks(raw.shape))
+    
+    def isTileable(self):
+        return False
     
     def getXProfile(self, y, raw):
         # bands are in array form as line, sample
@@ -237,20 +404,51 @@ class MedianFilter1D(GeneralFilter):
     each dimension to smooth the data.  It tends to preserve edges,
     which is one of the reasons to use this filter as opposed to a
     smoothing function.
+    
+    The result is the same as scipy.signal.medfilt2d, but is computed with
+    numpy by gathering the window around every pixel of a tile of lines and
+    selecting the median of all the windows at once.
     """
+    #: Maximum number of bytes used to hold the windows of a tile
+    window_bytes = 16 * 1024 * 1024
+    
     def __init__(self, kernel_sample=3, kernel_line=1, pos=0):
         GeneralFilter.__init__(self, pos=pos)
 
         # since a band is stored in the array as [line, sample], the
         # kernel must be described that way as well
         self.kernel = [kernel_line, kernel_sample]
+    
+    def getLineHalo(self):
+        return self.kernel[0] / 2
    
     def getPlane(self,raw):
-        scipy = scipy_module()
-        if scipy:
-            filtered = scipy.signal.medfilt2d(raw.astype(numpy.float32), self.kernel)
-            return filtered
-        return raw
+        kl, ks = self.kernel
+        hl = kl / 2
+        hs = ks / 2
+        lines, samples = raw.shape
+        
+        # Edges are padded with zeros, like medfilt2d
+        padded = numpy.zeros((lines + 2 * hl, samples + 2 * hs), dtype=numpy.float32)
+        padded[hl:hl + lines, hs:hs + samples] = raw
+        if kl * ks == 1:
+            return padded
+        
+        filtered = numpy.empty((lines, samples), dtype=numpy.float32)
+        step = max(1, self.window_bytes / max(1, kl * ks * samples * 4))
+        windows = numpy.empty((kl * ks, min(step, lines), samples), dtype=numpy.float32)
+        for u1 in range(0, lines, step):
+            u2 = min(u1 + step, lines)
+            count = u2 - u1
+            tile = windows[:, :count, :]
+            i = 0
+            for dl in range(kl):
+                for ds in range(ks):
+                    tile[i] = padded[u1 + dl:u2 + dl, ds:ds + samples]
+                    i += 1
+            tile.partition(kl * ks / 2, axis=0)
+            filtered[u1:u2] = tile[kl * ks / 2]
+        return filtered
 
 class GaussianFilter(GeneralFilter):
     """Apply a gaussian filter to the band.
@@ -275,49 +473,127 @@ class GaussianFilter(GeneralFilter):
    
     def gaussian(self, x):
         return 1.0/(math.sqrt(2*math.pi))/self.stddev * math.exp(-(math.pow(x-self.offset,2))/2.0/self.stddev/self.stddev)
+    
+    def getLineHalo(self):
+        return self.radius
+    
+    def convolve(self, padded, axis, output):
+        """Convolve the zero padded data with the kernel along one axis.
+        
+        Rather than looping over every line (or sample) in python, the
+        kernel is applied one tap at a time to the entire array.  The kernel
+        is symmetric, so the taps on either side of the center are added
+        before scaling.
+        """
+        r = self.radius
+        size = output.shape[axis]
+        def taps(k):
+            if axis == 0:
+                return padded[k:k + size, :]
+            return padded[:, k:k + size]
+        numpy.multiply(taps(r), self.kernel[r], output)
+        temp = numpy.empty(output.shape, dtype=numpy.float32)
+        for k in range(r):
+            numpy.add(taps(k), taps(self.diameter - k), temp)
+            temp *= self.kernel[k]
+            output += temp
+        return output
 
     def getPlane(self,raw):
         """Compute the convolution using separable convolutions
         """
-        # FIXME:  very strange error here.  If I use
-        #
-        # filtered = numpy.zeros_like(raw)
-        #
-        # I get the following exception at script exit time:
-        #
-        # Exception exceptions.AttributeError: AttributeError("'NoneType'
-        # object has no attribute 'tell'",) in <bound method memmap.__del__
-        # of memmap([[ 0.03383528, 0.03949283, 0.04434881, ...
-        #
-        # But, if I use numpy.zeros directly, this doesn't happen
-        filtered = numpy.zeros((raw.shape[0], raw.shape[1]), dtype=raw.dtype)
-        for line in range(raw.shape[0]):
-            filtered[line,:] = numpy.convolve(raw[line,:], self.kernel, mode='same')
-        for sample in range(raw.shape[1]):
-            filtered[:, sample] = numpy.convolve(filtered[:,sample], self.kernel, mode='same')
-        return filtered
+        r = self.radius
+        lines, samples = raw.shape
+        
+        # Equivalent to numpy.convolve with mode='same' along each line and
+        # then each sample, which pads the edges with zeros
+        padded = numpy.zeros((lines, samples + 2 * r), dtype=numpy.float32)
+        padded[:, r:r + samples] = raw
+        rows = numpy.zeros((lines + 2 * r, samples), dtype=numpy.float32)
+        self.convolve(padded, 1, rows[r:r + lines, :])
+        del padded
+        filtered = numpy.empty((lines, samples), dtype=numpy.float32)
+        self.convolve(rows, 0, filtered)
+        return filtered.astype(raw.dtype)
 
 class ChainFilter(GeneralFilter):
     """Apply a sequence of filters to the band.
+    
+    Consecutive filters that can work on tiles of lines are fused: each tile
+    (plus the surrounding lines needed by the filters) is passed through all
+    of them before moving on to the next tile, so the intermediate results
+    stay small enough to remain in the processor cache.
     """
+    #: Number of output lines in each tile
+    tile_size = 64
+    
     def __init__(self, pos=0, filters=None):
         GeneralFilter.__init__(self, pos=pos)
         if filters:
             self.filters = filters
         else:
             self.filters = []
+    
+    def isTileable(self):
+        for filter in self.filters:
+            if not filter.isTileable():
+                return False
+        return True
+    
+    def getLineHalo(self):
+        halo = 0
+        for filter in self.filters:
+            halo += filter.getLineHalo()
+        return halo
    
     def getPlane(self,raw):
-        for filter in self.filters():
-            raw = filter.getPlane(raw)
+        i = 0
+        while i < len(self.filters):
+            if not self.filters[i].isTileable():
+                raw = self.filters[i].getPlane(raw)
+                i += 1
+                continue
+            j = i + 1
+            while j < len(self.filters) and self.filters[j].isTileable():
+                j += 1
+            raw = self.getPlaneTiled(raw, self.filters[i:j])
+            i = j
         return raw
     
+    def getPlaneTiled(self, raw, filters):
+        """Run the tileable filters over the plane one tile at a time.
+        
+        Each tile includes enough lines above and below for all the filters
+        in the sequence, and only the lines that are unaffected by the edges
+        of the tile are kept.
+        """
+        lines = raw.shape[0]
+        if len(filters) == 1 or lines <= self.tile_size:
+            for filter in filters:
+                raw = filter.getPlane(raw)
+            return raw
+        halo = 0
+        for filter in filters:
+            halo += filter.getLineHalo()
+        output = None
+        for u1 in range(0, lines, self.tile_size):
+            u2 = min(u1 + self.tile_size, lines)
+            s1 = max(0, u1 - halo)
+            s2 = min(lines, u2 + halo)
+            tile = raw[s1:s2]
+            for filter in filters:
+                tile = filter.getPlane(tile)
+            if output is None:
+                output = numpy.empty((lines,) + tile.shape[1:], dtype=tile.dtype)
+            output[u1:u2] = tile[u1 - s1:u2 - s1]
+        return output
+    
     def getXProfile(self, y, raw):
-        for filter in self.filters():
+        for filter in self.filters:
             raw = filter.getXProfile(y, raw)
         return raw
     
     def getYProfile(self, x, raw):
-        for filter in self.filters():
+        for filter in self.filters:
             raw = filter.getYProfile(x, raw)
         return raw
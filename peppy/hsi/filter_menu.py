@@ -109,9 +109,6 @@ class MedianFilterAction(HSIActionMixin, RadioAction):
              'Median 3x1 pixel', 'Median 1x3 pixel', 'Median 3x3 pixel',
              'Median 5x1 pixel', 'Median 1x5 pixel', 'Median 5x5 pixel']
 
-    def isEnabled(self):
-        return bool(scipy_module())
-
     def getIndex(self):
         mode = self.mode
         filt = mode.filter
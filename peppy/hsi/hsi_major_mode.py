@@ -70,6 +70,13 @@ class HSIMode(BitmapScroller, MajorMode):
         BoolParam('use_cube_min_max', False, help="Use overall cube min/max for profile min/max"),
         BoolParam('immediate_slider_updates', True, help="Refresh the image as the band slider moves rather than after releasing the slider"),
         BoolParam('use_mmap', False, help="Use memory mapping for data access when possible"),
+        IntParam('band_cache_size', 256, help="Maximum memory in megabytes used by each cube to hold recently viewed bands"),
+        IntParam('prefetch_count', 2, help="Number of bands to load in the background ahead of the currently displayed band when stepping through the cube"),
+        IntParam('file_io_block_size', 4*1024*1024, help="Size in bytes of each read when loading bands using direct file access (i.e. when not using memory mapping)"),
+        IntParam('export_memory_budget', 64, help="Maximum memory in megabytes used when converting a cube to a different interleave during export"),
+        BoolParam('save_statistics', True, help="Save the per-band statistics of a cube in a sidecar file (the cube's filename plus '.stats') so they don't have to be recalculated"),
+        IntParam('colormap_threads', 0, help="Number of threads used to convert the bands to a displayable image, or 0 to use one thread per CPU"),
+        BoolParam('use_overviews', True, help="When zoomed out, display reduced resolution overviews of the bands rather than processing every pixel of the full resolution bands"),
         )
 
     def __init__(self, parent, wrapper, buffer, frame):
@@ -96,7 +103,61 @@ class HSIMode(BitmapScroller, MajorMode):
     def getStatusBarWidths(self):
         """Get the HSI status bar
         """
-        return [-1, 100, 170]
+        return [-1, 100, 170, 200]
+    
+    def getDisplayZoom(self):
+        """Return the zoom factor of the displayed image relative to the
+        full resolution cube.
+        
+        The scroller's zoom is relative to the image it is displaying, which
+        is reduced in size when an overview is displayed.
+        """
+        return self.zoom / self.cubeview.overview_factor
+    
+    def getCubeCoords(self, x, y):
+        """Convert coordinates of the displayed image to the coordinates of
+        the full resolution cube."""
+        return self.cubeview.getFullResolutionCoords(x, y)
+    
+    def getCubeBox(self, ul, lr):
+        """Convert a box in the displayed image to the corresponding box in
+        the full resolution cube, including all the pixels represented by the
+        overview pixels at the lower right."""
+        factor = self.cubeview.overview_factor
+        x0, y0 = self.getCubeCoords(*ul)
+        x1, y1 = self.getCubeCoords(*lr)
+        x1 = min(x1 + factor - 1, self.cubeview.width - 1)
+        y1 = min(y1 + factor - 1, self.cubeview.height - 1)
+        return (x0, y0), (x1, y1)
+    
+    def getSelectedCubeBox(self):
+        """Return the selected box in full resolution cube coordinates.
+        
+        @returns: tuple of x, y, width, height
+        """
+        x, y, w, h = self.selector.getSelectedBox()
+        if self.cubeview.overview_factor > 1:
+            (x, y), (x1, y1) = self.getCubeBox((x, y), (x + w - 1, y + h - 1))
+            w = x1 - x + 1
+            h = y1 - y + 1
+        return x, y, w, h
+    
+    def zoomIn(self, *args, **kwargs):
+        BitmapScroller.zoomIn(self, *args, **kwargs)
+        self.updateOverview()
+    
+    def zoomOut(self, *args, **kwargs):
+        BitmapScroller.zoomOut(self, *args, **kwargs)
+        self.updateOverview()
+    
+    def updateOverview(self):
+        """Redisplay the cube if the zoom level calls for a different
+        overview level than the one currently displayed."""
+        if self.cube is None:
+            return
+        factor = self.cubeview.getOverviewFactor(self.getDisplayZoom())
+        if factor != self.cubeview.overview_factor:
+            self.update()
     
     def updateInfo(self, x=-1, y=-1):
         line, sample, band = self.cubeview.getCoords(x, y)
@@ -118,13 +179,14 @@ class HSIMode(BitmapScroller, MajorMode):
     def OnUpdateUI(self, evt):
         assert self.dprint("updating HSI user interface!")
         if hasattr(evt, 'imageCoords'):
-            self.updateInfo(*evt.imageCoords)
+            coords = self.getCubeCoords(*evt.imageCoords)
+            self.updateInfo(*coords)
             for minor in self.wrapper.getActiveMinorModes(True):
                 if hasattr(minor, 'updateProxies'):
-                    minor.updateProxies(*evt.imageCoords)
+                    minor.updateProxies(*coords)
         elif hasattr(evt, 'upperLeftImageCoords'):
             
-            self.updateBox(evt.upperLeftImageCoords, evt.lowerRightImageCoords)
+            self.updateBox(*self.getCubeBox(evt.upperLeftImageCoords, evt.lowerRightImageCoords))
         if evt is not None:
             evt.Skip()
     
@@ -134,18 +196,37 @@ class HSIMode(BitmapScroller, MajorMode):
             Cube.mmap_size_limit = -1
         else:
             Cube.mmap_size_limit = 1
+        FileCubeReader.io_block_size = self.classprefs.file_io_block_size
+        
+        Cube.band_cache_size = self.classprefs.band_cache_size * 1024 * 1024
+        Cube.save_statistics = self.classprefs.save_statistics
+        Cube.export_memory_budget = self.classprefs.export_memory_budget * 1024 * 1024
+        if self.classprefs.colormap_threads > 0:
+            RGBMapper.threads = self.classprefs.colormap_threads
+        else:
+            RGBMapper.threads = None
+        cube = getattr(self, 'cube', None)
+        if cube is not None:
+            cube.getBandCache().setMaxBytes(Cube.band_cache_size)
 
     def update(self, refresh=True):
         self.dprint("refresh=%s" % refresh)
         self.setStatusText(self.cubeview.getWorkingMessage())
         self.cubeview.swapEndian(self.swap_endian)
         self.cubeview.setFilterOrder([self.filter])
+        
+        # Pick the overview level for the current zoom, and adjust the
+        # scroller's zoom so the reduced size image appears at the same scale
+        zoom = self.getDisplayZoom()
+        factor = self.cubeview.setDisplayZoom(zoom)
         self.cubeview.show(self.colormapper)
+        self.zoom = zoom * factor
         self.setImage(self.cubeview.image)
         self.frame.updateMenumap()
         if refresh:
             self.Update()
         self.updateInfo()
+        self.setStatusText(self.cube.getBandCache().getSummary(), 3)
     
     def getProperties(self):
         pairs = MajorMode.getProperties(self)
@@ -180,7 +261,12 @@ class HSIMode(BitmapScroller, MajorMode):
         #self.cube.open()
         assert self.dprint(self.cube)
     
+    def deleteWindowPreHook(self):
+        self.cubeview.stopPrefetch()
+
     def setViewer(self, viewcls):
+        self.cubeview.stopPrefetch()
+        self.zoom = self.getDisplayZoom()
         self.cubeview = viewcls(self, self.cube, self.classprefs.display_rgb)
         self.cubeview.swapEndian(self.swap_endian)
         for minor in self.wrapper.getActiveMinorModes():
@@ -256,7 +256,7 @@ class SpatialSubset(HSIActionMixin, SelectAction):
     
     def isEnabled(self):
         if self.mode.cubeview.__class__ == CubeView and self.mode.selector.__class__ == RubberBand:
-            x, y, w, h = self.mode.selector.getSelectedBox()
+            x, y, w, h = self.mode.getSelectedCubeBox()
             return w > 1 and h > 1
         return False
     
@@ -270,7 +270,7 @@ class SpatialSubset(HSIActionMixin, SelectAction):
         name = self.getTempName()
         fh = vfs.make_file(name)
         subcube = SubCube(cube)
-        sample, line, ds, dl = self.mode.selector.getSelectedBox()
+        sample, line, ds, dl = self.mode.getSelectedCubeBox()
         subcube.subset(line, line+dl, sample, sample+ds, 0, cube.bands)
         fh.setCube(subcube)
         # must close file handle or it won't be registered with the DatasetFS
@@ -332,6 +332,29 @@ class FocalPlaneAverage(HSIActionMixin, SelectAction):
         self.frame.open(name, options=options)
 
 
+class CalculateStatistics(HSIActionMixin, SelectAction):
+    """Calculate the min, max, mean, standard deviation and histogram of
+    every band.
+    
+    The statistics are calculated in a single pass through the cube and are
+    used by the contrast stretching and color mapping instead of scanning each
+    band as it is displayed.
+    """
+    name = "Calculate Band Statistics"
+    default_menu = ("Tools", 110)
+    
+    def action(self, index=-1, multiplier=1):
+        cube = self.mode.cube
+        try:
+            self.mode.showBusy(True)
+            stats = cube.getStatistics(progress=self.mode.status_info)
+        finally:
+            self.mode.showBusy(False)
+        minval, maxval = stats.getExtrema()
+        self.mode.update()
+        self.mode.setStatusText("Cube min=%s max=%s" % (minval, maxval))
+
+
 class ScaledImageMixin(HSIActionMixin):
     minibuffer = IntMinibuffer
     minibuffer_label = "Scale Dimensions by Integer Factor:"
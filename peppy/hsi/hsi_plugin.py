@@ -90,6 +90,7 @@ class HSIPlugin(IPeppyPlugin):
                         peppy.hsi.hsi_menu.TestSubset,
                         peppy.hsi.hsi_menu.SpatialSubset,
                         peppy.hsi.hsi_menu.FocalPlaneAverage,
+                        peppy.hsi.hsi_menu.CalculateStatistics,
                         peppy.hsi.hsi_menu.ScaleImageDimensions,
                         peppy.hsi.hsi_menu.ReduceImageDimensions,
                         
@@ -0,0 +1,459 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Per-band statistics of HSI cubes computed in a single pass.
+
+The statistics (min, max, mean, standard deviation, and a histogram from
+which percentiles are estimated) of every band are accumulated in one
+sequential sweep through the cube in its native interleave order, so BIP and
+BIL cubes are read by blocks of lines and BSQ cubes by bands.  The results
+are stored in a small text sidecar file next to the cube so that they only
+need to be calculated once, and are used by the contrast stretching and
+color mapping filters in place of scanning each band as it is displayed.
+"""
+
+import os, sys, math
+
+import numpy
+
+import peppy.vfs as vfs
+
+from peppy.debug import *
+
+
+class BandStatistics(object):
+    """Statistics of a single band, as returned by L{CubeStatistics.getBand}
+    """
+    def __init__(self, band, count, minval, maxval, mean, stddev, histogram, bin_min, bin_width):
+        self.band = band
+        self.count = count
+        self.min = minval
+        self.max = maxval
+        self.mean = mean
+        self.stddev = stddev
+        self.histogram = histogram
+        self.bin_min = bin_min
+        self.bin_width = bin_width
+
+    def __str__(self):
+        return "band %d: min=%s max=%s mean=%s stddev=%s" % (self.band, self.min, self.max, self.mean, self.stddev)
+
+    def getPercentile(self, fraction):
+        """Estimate the value below which the given fraction of the pixels
+        fall.
+
+        The estimate is interpolated within the histogram bin that contains
+        the percentile, so its accuracy is limited to the width of one bin.
+
+        @param fraction: value between 0.0 and 1.0
+        """
+        if self.count == 0:
+            return self.min
+        target = fraction * self.count
+        cumulative = numpy.cumsum(self.histogram)
+        i = int(numpy.searchsorted(cumulative, target))
+        if i >= len(cumulative):
+            return self.max
+        before = 0
+        if i > 0:
+            before = cumulative[i - 1]
+        inside = self.histogram[i]
+        if inside > 0:
+            offset = (target - before) / float(inside)
+        else:
+            offset = 0.0
+        value = self.bin_min + (i + offset) * self.bin_width
+        return min(max(value, self.min), self.max)
+
+    def getStretchRange(self, stretch):
+        """Return the (low, high) pair of values that excludes the given
+        fraction of pixels from each end of the histogram.
+        """
+        return (self.getPercentile(stretch), self.getPercentile(1.0 - stretch))
+
+    def getClipped(self, minval, maxval):
+        """Return the statistics of the band after its values have been
+        clipped to the given range.
+
+        Only the extrema are known exactly after clipping; the mean, standard
+        deviation and histogram are those of the unclipped band.
+        """
+        return BandStatistics(self.band, self.count,
+                              max(self.min, minval), min(self.max, maxval),
+                              self.mean, self.stddev, self.histogram,
+                              self.bin_min, self.bin_width)
+
+
+class CubeStatistics(debugmixin):
+    """Accumulator for the per-band statistics of a cube.
+
+    Data is added in arbitrarily sized chunks using L{add}.  Means and
+    variances of the chunks are combined using the pairwise update of Chan et
+    al., so no second pass is needed for the standard deviation.  Each band
+    has a fixed number of histogram bins; when new data falls outside the
+    current histogram range, the bin width is doubled (merging pairs of
+    existing bins) until the range covers the new data, so the histogram is
+    also built in a single pass.  Integer data starts with a bin width of one
+    so that histograms of data with a small range are exact.
+    """
+    #: Number of histogram bins in each band
+    nbins = 256
+
+    #: Approximate number of bytes of cube data passed to L{add} at one time
+    #: when calculating the statistics of a cube
+    chunk_bytes = 4 * 1024 * 1024
+
+    #: Extension added to the cube's filename to create the sidecar file
+    sidecar_extension = ".stats"
+
+    def __init__(self, bands, data_type=numpy.float64, nbins=None):
+        self.bands = bands
+        if nbins is not None:
+            self.nbins = nbins
+        self.integer = numpy.issubdtype(numpy.dtype(data_type), numpy.integer)
+        self.count = numpy.zeros((bands,), dtype=numpy.int64)
+        self.minval = numpy.zeros((bands,), dtype=numpy.float64)
+        self.maxval = numpy.zeros((bands,), dtype=numpy.float64)
+        self.mean = numpy.zeros((bands,), dtype=numpy.float64)
+        self.m2 = numpy.zeros((bands,), dtype=numpy.float64)
+        self.histogram = numpy.zeros((bands, self.nbins), dtype=numpy.int64)
+        self.bin_min = numpy.zeros((bands,), dtype=numpy.float64)
+        self.bin_width = numpy.zeros((bands,), dtype=numpy.float64)
+
+        # Description of the file from which the statistics were calculated,
+        # used to check that a sidecar file is still valid
+        self.source = {}
+
+    def add(self, values, band=0):
+        """Add a chunk of data to the statistics.
+
+        @param values: array of (number of bands x number of pixels); may be
+        a strided view of the data in its native interleave
+
+        @param band: index of the band corresponding to the first row of
+        values
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        nb = values.shape[0]
+        if nb == 0 or values.shape[1] == 0:
+            return
+        bands = slice(band, band + nb)
+
+        valid = None
+        if not self.integer:
+            finite = numpy.isfinite(values)
+            if not finite.all():
+                valid = finite
+        if valid is None:
+            count = numpy.zeros((nb,), dtype=numpy.int64) + values.shape[1]
+            chunk_min = values.min(axis=1)
+            chunk_max = values.max(axis=1)
+            chunk_mean = values.mean(axis=1)
+            centered = values - chunk_mean[:, numpy.newaxis]
+        else:
+            count = valid.sum(axis=1).astype(numpy.int64)
+            chunk_min = numpy.where(valid, values, numpy.inf).min(axis=1)
+            chunk_max = numpy.where(valid, values, -numpy.inf).max(axis=1)
+            total = numpy.where(valid, values, 0.0).sum(axis=1)
+            chunk_mean = total / numpy.maximum(count, 1)
+            centered = numpy.where(valid, values - chunk_mean[:, numpy.newaxis], 0.0)
+        chunk_m2 = numpy.add.reduce(centered * centered, axis=1)
+
+        has_data = count > 0
+        old_count = self.count[bands].copy()
+        new = numpy.logical_and(has_data, old_count == 0)
+        self.minval[bands] = numpy.where(new, chunk_min, numpy.where(has_data, numpy.minimum(self.minval[bands], chunk_min), self.minval[bands]))
+        self.maxval[bands] = numpy.where(new, chunk_max, numpy.where(has_data, numpy.maximum(self.maxval[bands], chunk_max), self.maxval[bands]))
+
+        total = old_count + count
+        divisor = numpy.maximum(total, 1).astype(numpy.float64)
+        delta = chunk_mean - self.mean[bands]
+        self.mean[bands] = numpy.where(has_data, self.mean[bands] + delta * count / divisor, self.mean[bands])
+        self.m2[bands] = numpy.where(has_data, self.m2[bands] + chunk_m2 + delta * delta * old_count * count / divisor, self.m2[bands])
+        self.count[bands] = total
+
+        for i in numpy.nonzero(new)[0]:
+            self.initHistogram(band + i, chunk_min[i], chunk_max[i])
+        for i in numpy.nonzero(has_data)[0]:
+            self.expandHistogram(band + i, chunk_min[i], chunk_max[i])
+        self.addHistogram(values, band, valid)
+
+    def initHistogram(self, band, minval, maxval):
+        """Set the initial histogram range of the band based on the extrema
+        of the first chunk of data.
+        """
+        if self.integer:
+            self.bin_min[band] = math.floor(minval)
+            span = maxval - self.bin_min[band] + 1
+            width = 1.0
+            while width * self.nbins < span:
+                width *= 2.0
+        else:
+            self.bin_min[band] = minval
+            span = maxval - minval
+            if span > 0:
+                # Widen slightly so that the maximum value falls inside the
+                # last bin rather than on its upper edge
+                width = span * (1.0 + 1e-6) / self.nbins
+            else:
+                width = max(abs(minval), 1.0) * 1e-6
+        self.bin_width[band] = width
+
+    def expandHistogram(self, band, minval, maxval):
+        """Increase the histogram range of the band to include the given
+        values, merging existing bins as necessary.
+        """
+        lo = self.bin_min[band]
+        width = self.bin_width[band]
+        if minval >= lo and maxval < lo + width * self.nbins:
+            return
+        shift = 0
+        if minval < lo:
+            # move the start of the range down by a whole number of the
+            # current bins so the old bins still line up with the new ones
+            shift = int(math.ceil((lo - minval) / width))
+        new_lo = lo - shift * width
+        factor = 1
+        while (new_lo + width * factor * self.nbins <= maxval or
+               self.nbins * factor < shift + self.nbins):
+            factor *= 2
+        index = (numpy.arange(self.nbins) + shift) // factor
+        self.histogram[band] = numpy.bincount(index, weights=self.histogram[band], minlength=self.nbins)[:self.nbins].astype(numpy.int64)
+        self.bin_min[band] = new_lo
+        self.bin_width[band] = width * factor
+        self.dprint("band %d: histogram now starts at %s with width %s" % (band, new_lo, width * factor))
+
+    def addHistogram(self, values, band, valid=None):
+        """Add the values to the histogram counts of all bands using a
+        single bincount.
+        """
+        nb = values.shape[0]
+        bands = slice(band, band + nb)
+        lo = self.bin_min[bands][:, numpy.newaxis]
+        width = self.bin_width[bands][:, numpy.newaxis]
+        old = numpy.seterr(divide='ignore', invalid='ignore')
+        try:
+            index = numpy.floor((values - lo) / width)
+            index = numpy.clip(index, 0, self.nbins - 1)
+        finally:
+            numpy.seterr(**old)
+        index = index.astype(numpy.int64)
+        index += (numpy.arange(nb) * self.nbins)[:, numpy.newaxis]
+        if valid is not None:
+            index = index[valid]
+        counts = numpy.bincount(index.ravel(), minlength=nb * self.nbins)
+        self.histogram[bands] += counts.reshape(nb, self.nbins)
+
+    def getStddev(self):
+        """Return the array of population standard deviations of all bands"""
+        return numpy.sqrt(self.m2 / numpy.maximum(self.count, 1))
+
+    def getExtrema(self):
+        """Return the min and max values over all bands"""
+        valid = self.count > 0
+        if not valid.any():
+            return (None, None)
+        return (self.minval[valid].min(), self.maxval[valid].max())
+
+    def getBand(self, band):
+        """Return a L{BandStatistics} object for the band"""
+        count = int(self.count[band])
+        if count > 0:
+            stddev = math.sqrt(self.m2[band] / count)
+        else:
+            stddev = 0.0
+        return BandStatistics(band, count, self.minval[band],
+                              self.maxval[band], self.mean[band], stddev,
+                              self.histogram[band], self.bin_min[band],
+                              self.bin_width[band])
+
+    def calculate(self, cube, progress=None):
+        """Calculate the statistics of all bands in one sequential pass
+        through the cube.
+
+        BIP and BIL cubes read through direct file access are read in blocks
+        of whole lines; other BIP and BIL cubes are read one focal plane at a
+        time, and BSQ cubes one band at a time.  The data is read through the
+        cube's reader so that the band cache isn't flushed by the sweep.
+
+        @param progress: optional object with startProgress, updateProgress,
+        and stopProgress methods, e.g. the mode's status_info
+        """
+        cube_io = cube.cube_io
+        interleave = cube.interleave.lower()
+        if cube.isFasterBand():
+            total = cube.bands
+        else:
+            total = cube.lines
+        if progress:
+            progress.startProgress("Calculating statistics...", total, delay=1.0)
+        if interleave in ['bip', 'bil'] and hasattr(cube_io, 'iterLineBlocks'):
+            if interleave == 'bip':
+                shape = (cube.samples, cube.bands)
+            else:
+                shape = (cube.bands, cube.samples)
+            for line, block in cube_io.iterLineBlocks(shape, progress):
+                if cube_io.swap:
+                    block = block.byteswap()
+                if interleave == 'bip':
+                    values = block.reshape(-1, cube.bands).T
+                else:
+                    values = block.transpose(1, 0, 2).reshape(cube.bands, -1)
+                self.add(values)
+        elif cube.isFasterBand():
+            for band in range(cube.bands):
+                self.add(cube_io.getBandRaw(band, use_progress=False).reshape(1, -1), band)
+                if progress:
+                    progress.updateProgress(band + 1)
+        else:
+            bytes_per_line = max(1, cube.samples * cube.bands * cube.itemsize)
+            lines_per_chunk = max(1, self.chunk_bytes / bytes_per_line)
+            planes = []
+            for line in range(cube.lines):
+                planes.append(cube_io.getFocalPlaneRaw(line, use_progress=False))
+                if len(planes) >= lines_per_chunk or line == cube.lines - 1:
+                    self.add(numpy.hstack(planes))
+                    planes = []
+                    if progress:
+                        progress.updateProgress(line + 1)
+        if progress:
+            progress.stopProgress("Calculated statistics of %s" % cube.url)
+
+    @classmethod
+    def getSidecarURL(cls, cube):
+        """Return the url of the sidecar file for the cube, or None if the
+        cube isn't stored in a file of its own on the local filesystem.
+        """
+        if cube.url is None or not hasattr(cube.url, 'scheme') or cube.url.scheme != "file":
+            return None
+        return vfs.normalize(str(cube.url) + cls.sidecar_extension)
+
+    @classmethod
+    def getSourceDescription(cls, cube):
+        """Return a dict describing the cube's data file, used to determine
+        whether a sidecar file is out of date.
+        """
+        source = {
+            'samples': str(cube.samples),
+            'lines': str(cube.lines),
+            'bands': str(cube.bands),
+            'interleave': cube.interleave.lower(),
+            'data type': numpy.dtype(cube.data_type).name,
+            'byte order': str(cube.byte_order),
+            'data offset': str(cube.data_offset),
+            }
+        try:
+            source['size'] = str(vfs.get_size(cube.url))
+            source['mtime'] = str(vfs.get_mtime(cube.url))
+        except Exception, e:
+            dprint("Can't stat %s: %s" % (cube.url, e))
+        return source
+
+    def __str__(self):
+        lines = ["peppy statistics"]
+        keys = self.source.keys()
+        keys.sort()
+        for key in keys:
+            lines.append("%s = %s" % (key, self.source[key]))
+        lines.append("bins = %d" % self.nbins)
+        for band in range(self.bands):
+            values = [repr(v) for v in (self.minval[band], self.maxval[band],
+                                        self.mean[band], self.m2[band],
+                                        self.bin_min[band],
+                                        self.bin_width[band])]
+            values[0:0] = [str(band), str(self.count[band])]
+            lines.append("band = %s" % " ".join(values))
+            lines.append("histogram = %s" % " ".join([str(c) for c in self.histogram[band]]))
+        lines.append("")
+        return os.linesep.join(lines)
+
+    def save(self, url):
+        fh = vfs.open_write(url)
+        fh.write(str(self))
+        fh.close()
+
+    @classmethod
+    def load(cls, url, bands, data_type=numpy.float64):
+        """Load the statistics from a sidecar file.
+
+        @returns: new L{CubeStatistics} instance
+        """
+        fh = vfs.open(url)
+        text = fh.read()
+        fh.close()
+        lines = text.splitlines()
+        if not lines or lines[0] != "peppy statistics":
+            raise ValueError("%s is not a statistics file" % url)
+        source = {}
+        nbins = cls.nbins
+        rows = []
+        for line in lines[1:]:
+            if "=" not in line:
+                continue
+            key, val = [s.strip() for s in line.split("=", 1)]
+            if key == "bins":
+                nbins = int(val)
+            elif key == "band":
+                rows.append([val, None])
+            elif key == "histogram":
+                rows[-1][1] = val
+            else:
+                source[key] = val
+        if len(rows) != bands:
+            raise ValueError("%s contains %d bands; expected %d" % (url, len(rows), bands))
+        stats = cls(bands, data_type, nbins)
+        stats.source = source
+        for band_text, hist_text in rows:
+            values = band_text.split()
+            band = int(values[0])
+            stats.count[band] = int(values[1])
+            (stats.minval[band], stats.maxval[band], stats.mean[band],
+             stats.m2[band], stats.bin_min[band],
+             stats.bin_width[band]) = [float(v) for v in values[2:8]]
+            stats.histogram[band] = [int(v) for v in hist_text.split()]
+        return stats
+
+    @classmethod
+    def loadSidecar(cls, cube):
+        """Load the statistics of the cube from its sidecar file, if the file
+        exists and matches the current contents of the cube.
+
+        @returns: L{CubeStatistics} instance, or None if there isn't a valid
+        sidecar file
+        """
+        url = cls.getSidecarURL(cube)
+        if url is None or not vfs.exists(url):
+            return None
+        try:
+            stats = cls.load(url, cube.bands, cube.data_type)
+        except Exception, e:
+            dprint("Failed loading statistics from %s: %s" % (url, e))
+            return None
+        if stats.source != cls.getSourceDescription(cube):
+            dprint("Statistics in %s are out of date" % url)
+            return None
+        return stats
+
+    def saveSidecar(self, cube):
+        """Save the statistics next to the cube if possible.
+
+        Failures are not fatal (the directory may not be writable, for
+        instance); the statistics will simply be recalculated next time.
+        """
+        url = self.getSidecarURL(cube)
+        if url is None:
+            return
+        try:
+            self.save(url)
+        except Exception, e:
+            dprint("Failed saving statistics to %s: %s" % (url, e))
+
+    @classmethod
+    def fromCube(cls, cube, progress=None):
+        """Calculate the statistics of the cube, recording the description of
+        its data file so that the results can be reused from a sidecar file.
+        """
+        stats = cls(cube.bands, cube.data_type)
+        stats.calculate(cube, progress)
+        if cls.getSidecarURL(cube) is not None:
+            stats.source = cls.getSourceDescription(cube)
+        return stats
@@ -163,6 +163,7 @@ class SubCube(HSI.Cube):
         self.rgbbands=[0]
         
         self.cube_io = SubCubeReader(parent)
+        self.clearCache()
         
     def open(self, url=None):
         pass
@@ -194,6 +195,7 @@ class SubCube(HSI.Cube):
         the full cube should be used.
         """
         self.cube_io.markSubset(l1, l2, s1, s2, b1, b2)
+        self.clearCache()
         self.lines = self.cube_io.l2 - self.cube_io.l1
         self.samples = self.cube_io.s2 - self.cube_io.s1
         self.bands = self.cube_io.b2 - self.cube_io.b1
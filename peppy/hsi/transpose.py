@@ -0,0 +1,214 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Out-of-core conversion of HSI cubes between interleave formats.
+
+The raw data of a cube is written in any interleave and byte order while
+holding no more than a fixed amount of the cube in memory.  The source cube
+is read in blocks of whole lines, and each block is rearranged into the
+output order with a single numpy assignment into a reusable buffer, which
+also takes care of any byte swapping.  The buffers are written directly from
+memory without creating intermediate strings.
+
+Converting to BSQ writes each band's portion of the line block at its final
+position in the output file, so as long as the output file is seekable every
+conversion takes one pass through the source and one through the output.
+"""
+
+import os, sys
+
+import numpy
+
+import cube as HSI
+
+from peppy.debug import *
+
+
+class CubeTransposer(debugmixin):
+    """Write the raw data of a cube in a different interleave and/or byte
+    order using bounded memory.
+    """
+    #: Approximate maximum number of bytes of the cube held in memory at once
+    memory_budget = 64 * 1024 * 1024
+
+    def __init__(self, cube, interleave=None, byte_order=None, memory_budget=None):
+        """Create the transposer.
+
+        @param cube: source L{Cube}
+
+        @param interleave: output interleave, one of 'bip', 'bil', or 'bsq';
+        if None, the cube's interleave is used
+
+        @param byte_order: output byte order, L{LittleEndian} or L{BigEndian}
+        (or '<' or '>'); if None, the cube's byte order is used
+
+        @param memory_budget: if specified, overrides L{memory_budget}
+        """
+        self.cube = cube
+        if interleave is None:
+            interleave = cube.interleave
+        self.interleave = interleave.lower()
+        if self.interleave not in ['bip', 'bil', 'bsq']:
+            raise ValueError("Unknown interleave %s" % interleave)
+        if byte_order is None:
+            byte_order = cube.byte_order
+        if byte_order in [HSI.LittleEndian, HSI.BigEndian]:
+            byte_order = HSI.byteordertext[byte_order]
+        self.dtype = numpy.dtype(cube.data_type).newbyteorder(byte_order)
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        self.lines = cube.lines
+        self.samples = cube.samples
+        self.bands = cube.bands
+
+    def getLinesPerBlock(self):
+        """Return the number of lines in each block, leaving room in the
+        memory budget for both the source block and the output buffer.
+        """
+        bytes_per_line = self.samples * self.bands * max(1, self.dtype.itemsize)
+        return max(1, min(self.lines, self.memory_budget / (2 * max(1, bytes_per_line))))
+
+    def getFileDtype(self):
+        """Return the dtype of the data as stored in the source file"""
+        cube = self.cube
+        return numpy.dtype(cube.data_type).newbyteorder(HSI.byteordertext[cube.byte_order])
+
+    def iterSourceBlocks(self):
+        """Iterate through the source cube in blocks of whole lines.
+
+        The data is read in the cube's native interleave, so BIP and BIL
+        files are read sequentially and BSQ files are read with one seek per
+        band per block.
+
+        @returns: tuple of the first line of the block and an array (usually
+        a strided view) of (lines in block x bands x samples) that is only
+        valid until the next iteration
+        """
+        cube = self.cube
+        cube_io = cube.cube_io
+        interleave = cube.interleave.lower()
+        step = self.getLinesPerBlock()
+        if isinstance(cube_io, HSI.FileCubeReader) and interleave in ['bip', 'bil', 'bsq']:
+            # The reader fills the buffer with the raw bytes from the file,
+            # which are then reinterpreted in the file's byte order.  Any
+            # byte swapping happens when the output buffer is filled.
+            dtype = self.getFileDtype()
+            if interleave == 'bsq':
+                buf = numpy.empty((self.bands, step, self.samples), dtype=cube_io.data_type)
+            else:
+                buf = numpy.empty((step * self.bands * self.samples,), dtype=cube_io.data_type)
+            for start in range(0, self.lines, step):
+                count = min(step, self.lines - start)
+                if interleave == 'bsq':
+                    block = buf[:, :count, :]
+                    for band in range(self.bands):
+                        cube_io.fh.seek(cube_io.offset + ((band * self.lines) + start) * self.samples * dtype.itemsize)
+                        cube_io.readIntoNumpyArray(cube_io.fh, block[band].reshape(-1))
+                    yield start, block.view(dtype).transpose(1, 0, 2)
+                else:
+                    cube_io.fh.seek(cube_io.offset + start * self.bands * self.samples * dtype.itemsize)
+                    block = cube_io.readIntoNumpyArray(cube_io.fh, buf[:count * self.bands * self.samples]).view(dtype)
+                    if interleave == 'bip':
+                        yield start, block.reshape(count, self.samples, self.bands).transpose(0, 2, 1)
+                    else:
+                        yield start, block.reshape(count, self.bands, self.samples)
+        elif isinstance(cube_io, HSI.MMapCubeReader) and interleave in ['bip', 'bil', 'bsq']:
+            raw = cube_io.getRaw()
+            for start in range(0, self.lines, step):
+                end = min(start + step, self.lines)
+                if interleave == 'bip':
+                    yield start, raw[start:end, :, :].transpose(0, 2, 1)
+                elif interleave == 'bil':
+                    yield start, raw[start:end, :, :]
+                else:
+                    yield start, raw[:, start:end, :].transpose(1, 0, 2)
+        else:
+            block = numpy.empty((step, self.bands, self.samples), dtype=cube.data_type)
+            for start in range(0, self.lines, step):
+                count = min(step, self.lines - start)
+                for i in range(count):
+                    block[i] = cube_io.getFocalPlaneRaw(start + i, use_progress=False)
+                yield start, block[:count]
+
+    def writeBuffer(self, fh, buf):
+        """Write a contiguous array to the file without copying it to a
+        string first.
+        
+        The old-style buffer is used rather than a memoryview because the
+        file-like objects based on StringIO.StringIO convert their argument
+        using str, which only returns the data of a buffer.
+        """
+        fh.write(buffer(buf.reshape(-1).view(numpy.uint8)))
+
+    def canSeek(self, fh):
+        try:
+            fh.tell()
+            return hasattr(fh, 'seek')
+        except (AttributeError, IOError):
+            return False
+
+    def write(self, fh, progress=None):
+        """Write the cube's data to the file handle in the output interleave
+        and byte order.
+
+        @param progress: optional functor taking a percentage of completion
+        """
+        if self.lines == 0 or self.samples == 0 or self.bands == 0:
+            return
+        if self.interleave == 'bsq':
+            if self.canSeek(fh):
+                self.writeBSQSeekable(fh, progress)
+            else:
+                self.writeBSQSequential(fh, progress)
+        else:
+            self.writeLineInterleaved(fh, progress)
+
+    def writeLineInterleaved(self, fh, progress=None):
+        """Write BIP or BIL output, which is in the same line order as the
+        blocks read from the source."""
+        step = self.getLinesPerBlock()
+        if self.interleave == 'bip':
+            out = numpy.empty((step, self.samples, self.bands), dtype=self.dtype)
+        else:
+            out = numpy.empty((step, self.bands, self.samples), dtype=self.dtype)
+        for start, block in self.iterSourceBlocks():
+            count = block.shape[0]
+            if self.interleave == 'bip':
+                out[:count] = block.transpose(0, 2, 1)
+            else:
+                out[:count] = block
+            self.writeBuffer(fh, out[:count])
+            if progress:
+                progress(((start + count) * 100) / self.lines)
+
+    def writeBSQSeekable(self, fh, progress=None):
+        """Write BSQ output by scattering each block's bands to their final
+        positions in the output file."""
+        base = fh.tell()
+        step = self.getLinesPerBlock()
+        seg = numpy.empty((step, self.samples), dtype=self.dtype)
+        itemsize = self.dtype.itemsize
+        for start, block in self.iterSourceBlocks():
+            count = block.shape[0]
+            for band in range(self.bands):
+                seg[:count] = block[:, band, :]
+                fh.seek(base + ((band * self.lines) + start) * self.samples * itemsize)
+                self.writeBuffer(fh, seg[:count])
+            if progress:
+                progress(((start + count) * 100) / self.lines)
+        fh.seek(base + self.bands * self.lines * self.samples * itemsize)
+
+    def writeBSQSequential(self, fh, progress=None):
+        """Write BSQ output to a file that can't seek by gathering as many
+        whole bands as will fit in the memory budget on each pass through the
+        source."""
+        band_bytes = self.lines * self.samples * max(1, self.dtype.itemsize)
+        group = max(1, min(self.bands, (self.memory_budget / 2) / max(1, band_bytes)))
+        out = numpy.empty((group, self.lines, self.samples), dtype=self.dtype)
+        for first in range(0, self.bands, group):
+            last = min(first + group, self.bands)
+            for start, block in self.iterSourceBlocks():
+                count = block.shape[0]
+                out[:last - first, start:start + count, :] = block[:, first:last, :].transpose(1, 0, 2)
+            self.writeBuffer(fh, out[:last - first])
+            if progress:
+                progress((last * 100) / self.bands)
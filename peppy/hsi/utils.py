@@ -15,6 +15,7 @@ from peppy.debug import *
 import numpy
 
 import cube as HSI
+from compare import ChunkedCubeCompare
 
 # number of meters per unit
 units_scale={
@@ -514,16 +515,31 @@ class CubeCompare(debugmixin):
         self.dprint(h)
         return self.histogram
     
+    def getCompareEngine(self):
+        """Return the L{ChunkedCubeCompare} instance used by the driver
+        methods to compute the comparison metrics.
+        """
+        return ChunkedCubeCompare(self.cube1, self.cube2, self.line_offset, self.bbl)
+    
+    def createMetricCube(self, data):
+        """Create a single band cube holding the results of a metric"""
+        cube = HSI.createCube('bsq', self.lines, self.samples, 1, data.dtype)
+        # The arrays in the band cache are read-only, so new cubes are filled
+        # through their reader
+        cube.cube_io.getBandRaw(0)[:,:] = data
+        return cube
+    
     def getHistogram(self, nbins=500):
         """Generate a histogram.
         
-        The driver method for generating a histogram.  Selects the best
-        histogram calculation method as appropriate for both cubes.
+        The driver method for generating a histogram.  Uses
+        L{ChunkedCubeCompare} to process chunks of both cubes in parallel.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            return self.getHistogramByFocalPlane(iter, nbins)
-        return self.getHistogramByBand(nbins)
+        self.histogram = Histogram(self.cube1,nbins,self.bbl)
+        results = self.getCompareEngine().compute(['histogram'], nbins)
+        self.histogram.data[:,:] = results['histogram']
+        self.dprint(self.histogram.data)
+        return self.histogram
     
     def getHeatMapByBand(self,nbins=500):
         """Generate a heat map using bands
@@ -534,7 +550,7 @@ class CubeCompare(debugmixin):
         them, and puts the results into the instance histogram.
         """
         self.heatmap = HSI.createCube('bsq', self.lines, self.samples, 1, self.dtype)
-        data = self.heatmap.getBandRaw(0)
+        data = self.heatmap.cube_io.getBandRaw(0)
 
         for i in range(self.bands):
             if self.bbl[i]:
@@ -559,7 +575,7 @@ class CubeCompare(debugmixin):
         work is done by numpy.
         """
         self.heatmap = HSI.createCube('bsq', self.lines, self.samples, 1, self.dtype)
-        data = self.heatmap.getBandRaw(0)
+        data = self.heatmap.cube_io.getBandRaw(0)
         bblmask = self.getFocalPlaneBadBandMask()
 
         for i, plane1, plane2 in iter:
@@ -574,13 +590,12 @@ class CubeCompare(debugmixin):
     def getHeatMap(self):
         """Generate a heat map
         
-        The driver method -- selects the fastest calculation method based
-        on the interleave of both cubes.
+        The driver method -- uses L{ChunkedCubeCompare} to process chunks of
+        both cubes in parallel.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            return self.getHeatMapByFocalPlane(iter)
-        return self.getHeatMapByBand()
+        results = self.getCompareEngine().compute(['heatmap'])
+        self.heatmap = self.createMetricCube(results['heatmap'].astype(self.dtype))
+        return self.heatmap
     
     def getDifferenceByFocalPlane(self, iter):
         """Difference the cubes using focal planes
@@ -594,7 +609,7 @@ class CubeCompare(debugmixin):
             p1 = plane1 * bblmask
             p2 = plane2 * bblmask
             diff = p1 - p2
-            plane = self.difference.getFocalPlaneRaw(i)
+            plane = self.difference.cube_io.getFocalPlaneRaw(i)
             plane[:,:] = diff
             self.dprint("%s %s" % (plane.shape, plane))
         return self.difference
@@ -611,7 +626,7 @@ class CubeCompare(debugmixin):
 
         for i in range(self.cube1.bands):
             if self.bbl[i]:
-                band = self.difference.getBandRaw(i)
+                band = self.difference.cube_io.getBandRaw(i)
                 band1 = self.cube1.getBand(i)
                 band2 = self.cube2.getBand(i)
                 band[:,:] = band1 - band2
@@ -639,7 +654,7 @@ class CubeCompare(debugmixin):
         Fast for BIP and BIL, slow for BSQ.
         """
         euclidean = HSI.createCube('bsq', self.lines, self.samples, 1, numpy.float32)
-        data = euclidean.getBandRaw(0)
+        data = euclidean.cube_io.getBandRaw(0)
         bblmask = self.getFocalPlaneBadBandMask()
 
         for i, plane1, plane2 in iter:
@@ -661,7 +676,7 @@ class CubeCompare(debugmixin):
         Fast for BSQ cubes, slow for BIL, and extremely slow for BIP.
         """
         euclidean = HSI.createCube('bsq', self.lines, self.samples, 1, numpy.float32)
-        data = euclidean.getBandRaw(0)
+        data = euclidean.cube_io.getBandRaw(0)
         
         working = numpy.zeros((self.lines, self.samples), dtype=numpy.float32)
         for i in range(self.bands):
@@ -680,16 +695,12 @@ class CubeCompare(debugmixin):
     def getEuclideanDistance(self, updater=None):
         """Generate a cube containing the euclidean distance between the two cubes
         
-        The driver method -- selects the fastest calculation method based
-        on the interleave of both cubes.
+        The driver method -- uses L{ChunkedCubeCompare} to process chunks of
+        both cubes in parallel.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            cube = self.getEuclideanDistanceByFocalPlane(iter, updater)
-        else:
-            cube = self.getEuclideanDistanceByBand(updater)
-        self.calcStatistics(cube)
-        self.euclidean = cube
+        results = self.getCompareEngine().compute(['euclidean'], updater=updater)
+        self.euclidean = self.createMetricCube(results['euclidean'])
+        self.calcStatistics(self.euclidean)
         return self.euclidean
 
     def getSpectralAngleByFocalPlane(self, iter, updater=None):
@@ -699,7 +710,7 @@ class CubeCompare(debugmixin):
         Fast for BIP and BIL, slow for BSQ.
         """
         sam = HSI.createCube('bsq', self.lines, self.samples, 1, numpy.float32)
-        data = sam.getBandRaw(0)
+        data = sam.cube_io.getBandRaw(0)
         bblmask = self.getFocalPlaneBadBandMask()
 
         for i, plane1, plane2 in iter:
@@ -730,7 +741,7 @@ class CubeCompare(debugmixin):
         Fast for BSQ cubes, slow for BIL, and extremely slow for BIP.
         """
         sam = HSI.createCube('bsq', self.lines, self.samples, 1, numpy.float32)
-        data = sam.getBandRaw(0)
+        data = sam.cube_io.getBandRaw(0)
         
         top = numpy.zeros((self.lines, self.samples), dtype=numpy.float32)
         bot1 = numpy.zeros((self.lines, self.samples), dtype=numpy.float32)
@@ -754,18 +765,27 @@ class CubeCompare(debugmixin):
     def getSpectralAngle(self, updater=None):
         """Generate a cube containing the spectral angle between the two cubes
         
-        The driver method -- selects the fastest calculation method based
-        on the interleave of both cubes.
+        The driver method -- uses L{ChunkedCubeCompare} to process chunks of
+        both cubes in parallel.
         """
-        if self.isBILBIP():
-            iter = self.iterBILBIP()
-            sam = self.getSpectralAngleByFocalPlane(iter, updater)
-        else:
-            sam = self.getSpectralAngleByBand(updater)
-        self.calcStatistics(sam)
-        self.sam = sam
+        results = self.getCompareEngine().compute(['sam'], updater=updater)
+        self.sam = self.createMetricCube(results['sam'])
+        self.calcStatistics(self.sam)
         return self.sam
     
+    def getEuclideanDistanceAndSpectralAngle(self, updater=None):
+        """Generate both the euclidean distance and spectral angle cubes using
+        a single pass through the data.
+        
+        @returns: tuple of euclidean distance cube, spectral angle cube
+        """
+        results = self.getCompareEngine().compute(['euclidean', 'sam'], updater=updater)
+        self.euclidean = self.createMetricCube(results['euclidean'])
+        self.calcStatistics(self.euclidean)
+        self.sam = self.createMetricCube(results['sam'])
+        self.calcStatistics(self.sam)
+        return self.euclidean, self.sam
+    
     def calcStatistics(self, cube):
         """Calculate the min, max, mean, and std dev of the data cube
         
@@ -780,30 +800,11 @@ class CubeCompare(debugmixin):
         cube.description = text
 
     def getExtrema(self):
-        """Really just a test function to see how long it takes to
-        seek all the way through one file."""
-        
-        f1=self.cube1.getFlatView()
-        self.dprint(f1)
-        i1=0
-        progress=0
-        minval=100000
-        maxval=0
-        try:
-            while True:
-                val=f1[i1]
-                if (val>maxval): maxval=val
-                if (val<minval): minval=val
-                progress+=1
-                if progress>1000:
-                    #print "#",
-                    self.dprint("i1=%d " % (i1))
-                    progress=0
-                i1+=1
-                    
-        except IndexError:
-            pass
-        return (minval,maxval)
+        """Return the min and max values of the first cube, using a single
+        sequential pass through the cube in its native interleave (or the
+        cube's saved statistics if they have already been calculated).
+        """
+        return tuple(self.cube1.getStatistics().getExtrema())
     
     def getExtremaChunk(self):
         """Really just a test function to see how long it takes to
@@ -836,17 +837,15 @@ class ThreadedCubeCompare(threading.Thread):
     def run(self):
         try:
             comp = self.comp
-            self.updater.setNumberOfWorkItems(2)
-            dist = comp.getEuclideanDistance(updater=self.updater)
-            self.updater.finishedWorkItem()
-            sam = comp.getSpectralAngle(updater=self.updater)
+            self.updater.setNumberOfWorkItems(1)
+            dist, sam = comp.getEuclideanDistanceAndSpectralAngle(updater=self.updater)
             self.updater.finishedWorkItem()
             dtype = numpy.find_common_type([dist.data_type, sam.data_type], [])
             self.output = HSI.createCubeLike(dist, 'bsq', bands=2, datatype=dtype)
-            outputband = self.output.getBandRaw(0)
+            outputband = self.output.cube_io.getBandRaw(0)
             source = dist.getBandRaw(0)
             outputband[:,:] = source[:,:]
-            outputband = self.output.getBandRaw(1)
+            outputband = self.output.cube_io.getBandRaw(1)
             source = sam.getBandRaw(0)
             outputband[:,:] = source[:,:]
             
@@ -16,6 +16,7 @@ from peppy.actions import *
 
 from peppy.debug import *
 from peppy.hsi.common import *
+from peppy.hsi.cache import BandPrefetcher
 
 import numpy
 
@@ -39,9 +40,12 @@ class CubeView(debugmixin):
         self.mode = mode
         self.display_rgb = display_rgb
         self.cube = None
+        self.prefetcher = None
         self.setCube(cube)
     
     def setCube(self, cube):
+        self.stopPrefetch()
+        
         # list of tuples (band number, band) where band is an array as
         # returned from cube.getBand
         self.bands=[]
@@ -49,6 +53,10 @@ class CubeView(debugmixin):
         # list of arrays containing filtered data, one step before turning into
         # RGB that can be displayed on the screen
         self.planes = []
+        
+        # list of BandStatistics (or None if not known) corresponding to the
+        # filtered data in self.planes
+        self.plane_stats = []
 
         # Min/max for this group of bands only.  The cube's extrema is
         # held in cube.spectraextrema and is updated as more bands are
@@ -58,6 +66,11 @@ class CubeView(debugmixin):
         # simple list of arrays, one array for each color plane r, g, b
         self.image = None
         self.contraststretch=0.0 # percentage
+        
+        # Reduction factor of the displayed image relative to the full
+        # resolution of the cube; the bands are loaded as overviews when the
+        # image is displayed at low zoom levels.  See setDisplayZoom.
+        self.overview_factor = 1
 
         self.initBitmap(cube)
         self.initDisplayIndexes()
@@ -95,11 +108,146 @@ class CubeView(debugmixin):
         return "Building %dx%d bitmap..." % (self.cube.samples, self.cube.lines)
     
     def getBand(self, index):
-        raw = self.cube.getBandInPlace(index)
+        if self.overview_factor > 1:
+            raw = self.cube.getBandOverview(index, self.overview_factor)
+        else:
+            raw = self.cube.getBandInPlace(index)
         if self.swap:
             raw = raw.byteswap()
         return raw
     
+    def getFullResolutionBand(self, index):
+        """Return the full resolution band if it is the one being displayed.
+        
+        @returns: the band, or None if an overview is being displayed
+        """
+        if self.overview_factor > 1:
+            return None
+        for band in self.bands:
+            if band[0] == index:
+                return band[1]
+        return self.getBand(index)
+    
+    def getFullResolutionRow(self, index, y):
+        """Return a full resolution line of the band.
+        
+        If an overview is being displayed, only the line is read from the cube
+        rather than the whole band.
+        """
+        raw = self.getFullResolutionBand(index)
+        if raw is not None:
+            return raw[y,:]
+        raw = self.cube.getFocalPlaneInPlace(y, use_progress=False)[index,:]
+        if self.swap:
+            raw = raw.byteswap()
+        return raw
+    
+    def getFullResolutionColumn(self, index, x):
+        """Return a full resolution column of the band.
+        
+        If an overview is being displayed, only the column is read from the
+        cube rather than the whole band.
+        """
+        raw = self.getFullResolutionBand(index)
+        if raw is not None:
+            return raw[:,x]
+        raw = self.cube.getFocalPlaneDepthInPlace(x, index)
+        if self.swap:
+            raw = raw.byteswap()
+        return raw
+    
+    def getOverviewFactor(self, zoom):
+        """Return the overview reduction factor appropriate for displaying
+        the image at the given zoom level.
+        
+        The factor is the largest power of two that doesn't exceed the
+        reduction in size caused by the zoom, so the overview is never
+        magnified by the display.
+        """
+        if not self.cube or zoom >= 1.0 or not self.mode.classprefs.use_overviews:
+            return 1
+        factor = 1
+        while (factor * 2) * zoom <= 1.0 + 1e-9 and factor * 2 <= min(self.cube.lines, self.cube.samples):
+            factor *= 2
+        return factor
+    
+    def setDisplayZoom(self, zoom):
+        """Choose the overview level for the zoom factor at which the image
+        will be displayed.
+        
+        @param zoom: zoom factor relative to the full resolution cube
+        @returns: the overview reduction factor
+        """
+        factor = self.getOverviewFactor(zoom)
+        if factor != self.overview_factor:
+            assert self.dprint("changing overview factor from %d to %d" % (self.overview_factor, factor))
+            self.overview_factor = factor
+            self.cancelPrefetch()
+            # force the bands to be reloaded at the new resolution
+            self.bands = []
+        return self.overview_factor
+    
+    def getFullResolutionCoords(self, x, y):
+        """Convert coordinates in the displayed image, which may be an
+        overview, to coordinates in the full resolution image."""
+        if x < 0:
+            return x, y
+        return x * self.overview_factor, y * self.overview_factor
+    
+    def getBandStatistics(self, index):
+        """Return the L{BandStatistics} for the given index if they are
+        available without scanning the cube, otherwise None.
+        """
+        if self.swap:
+            return None
+        stats = self.cube.getCachedStatistics()
+        if stats is not None:
+            return stats.getBand(index)
+        return None
+    
+    def prefetch(self, cube_io, index):
+        """Load the data for the given index into the cube's cache.
+        
+        Called from the L{BandPrefetcher} thread, so this must not use the
+        GUI.
+        """
+        self.cube.prefetchBandOverview(cube_io, index, self.overview_factor)
+    
+    def startPrefetch(self, direction):
+        """Start loading the next few indexes in the direction that the user
+        is moving through the cube.
+        
+        Any prefetches that were still outstanding are discarded.
+        
+        @param direction: +1 if the indexes are increasing, -1 if decreasing
+        """
+        count = self.mode.classprefs.prefetch_count
+        if count < 1 or not self.cube or not self.cube.canPrefetch():
+            return
+        if self.prefetcher is None:
+            self.prefetcher = BandPrefetcher(self.cube, self.prefetch)
+            self.prefetcher.start()
+        indexes = []
+        for step in range(1, count + 1):
+            for index in self.indexes:
+                i = index + (step * direction)
+                if i >= 0 and i <= self.max_index and i not in indexes:
+                    indexes.append(i)
+        assert self.dprint("prefetching %s" % str(indexes))
+        self.prefetcher.request(indexes)
+    
+    def cancelPrefetch(self):
+        """Discard any outstanding prefetches"""
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+    
+    def stopPrefetch(self):
+        """Stop the prefetch thread; must be called when the view is no
+        longer in use."""
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+    
     def loadBands(self, progress=None):
         if not self.cube: return
 
@@ -109,8 +257,13 @@ class CubeView(debugmixin):
         emax=None
         for i in self.indexes:
             raw=self.getBand(i)
-            minval=raw.min()
-            maxval=raw.max()
+            stats = self.getBandStatistics(i)
+            if stats is not None:
+                minval = stats.min
+                maxval = stats.max
+            else:
+                minval=raw.min()
+                maxval=raw.max()
             self.bands.append((i,raw,minval,maxval))
             count+=1
             if emin==None or minval<emin:
@@ -139,7 +292,7 @@ class CubeView(debugmixin):
 
         profiles=[]
         for band in self.bands:
-            profile=band[1][y,:]
+            profile=self.getFullResolutionRow(band[0], y)
             profiles.append(profile)
         return profiles
 
@@ -152,7 +305,7 @@ class CubeView(debugmixin):
 
         profiles=[]
         for band in self.bands:
-            profile=band[1][:,x]
+            profile=self.getFullResolutionColumn(band[0], x)
             profiles.append(profile)
         return profiles
     
@@ -203,13 +356,19 @@ class CubeView(debugmixin):
         newbands=[]
         for i in range(len(self.indexes)):
             newbands.append(self.indexes[i]+1)
-        return self.setIndexes(newbands)
+        if self.setIndexes(newbands):
+            self.startPrefetch(1)
+            return True
+        return False
 
     def prevIndex(self):
         newbands=[]
         for i in range(len(self.indexes)):
             newbands.append(self.indexes[i]-1)
-        return self.setIndexes(newbands)
+        if self.setIndexes(newbands):
+            self.startPrefetch(-1)
+            return True
+        return False
 
     def getIndex(self, band, user=False):
         if user:
@@ -220,7 +379,18 @@ class CubeView(debugmixin):
 
     def gotoIndex(self, band, user=False):
         newbands=[self.getIndex(band, user)]
-        return self.setIndexes(newbands)
+        last = self.indexes[0]
+        if self.setIndexes(newbands):
+            # Single steps (e.g. dragging the band slider) continue to
+            # prefetch in the same direction, but any other jump makes the
+            # outstanding prefetches useless.
+            delta = self.indexes[0] - last
+            if delta == 1 or delta == -1:
+                self.startPrefetch(delta)
+            else:
+                self.cancelPrefetch()
+            return True
+        return False
 
     def getIndexes(self):
         return self.indexes
@@ -258,12 +428,15 @@ class CubeView(debugmixin):
         
         """
         self.planes = []
+        self.plane_stats = []
         for band in self.bands:
             assert self.dprint("getRGB: band=%s" % str(band))
             plane = band[1]
+            stats = self.getBandStatistics(band[0])
             for filt in self.filters:
-                plane = filt.getPlane(plane)
+                plane, stats = filt.getPlaneWithStatistics(plane, stats)
             self.planes.append(plane)
+            self.plane_stats.append(stats)
             if progress: progress.Update(50+((count+1)*50)/len(self.bands))
 
     def getCurrentPlanes(self):
@@ -291,10 +464,14 @@ class CubeView(debugmixin):
                 self.loadBands()
             
             self.processFilters(progress)
-            rgb = colormapper.getRGB(self.height, self.width, self.planes)
+            
+            # The planes may be overviews that are smaller than the full
+            # resolution image
+            height, width = self.planes[0].shape
+            rgb = colormapper.getRGB(height, width, self.planes, self.plane_stats)
             
             # image uses the rgb data and doesn't create a new copy
-            self.image = wx.ImageFromBuffer(self.width, self.height, rgb)
+            self.image = wx.ImageFromBuffer(width, height, rgb)
             # self.Refresh()
         except Exception, e:
             import traceback
@@ -367,6 +544,17 @@ class FocalPlaneView(CubeView):
         if self.swap:
             raw = raw.byteswap()
         return raw
+    
+    def getBandStatistics(self, index):
+        # The cube statistics are per band, not per focal plane
+        return None
+    
+    def getOverviewFactor(self, zoom):
+        # Focal planes are small enough that overviews aren't needed
+        return 1
+    
+    def prefetch(self, cube_io, index):
+        self.cube.prefetchFocalPlane(cube_io, index)
 
     def getAvailableXAxisLabels(self):
         labels = ['line']
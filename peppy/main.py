@@ -22,6 +22,7 @@ from peppy.i18n import *
 
 from peppy.yapsy.plugins import *
 from peppy.yapsy.PeppyPluginManager import *
+from peppy.yapsy.PluginManifest import PluginManifest
 
 from peppy.lib.gaugesplash import *
 from peppy.lib.loadfileserver import LoadFileProxy
@@ -158,6 +159,23 @@ class Mouse(ClassPrefs):
         clipboard.setAllowX11PrimarySelection(self.classprefs.middle_mouse_x11_primary_selection)
 
 
+class RemoteFiles(ClassPrefs):
+    preferences_tab = "General"
+    icon = "icons/folder_explore.png"
+    default_classprefs = (
+        FloatParam('metadata_cache_time', 10.0, 'Number of seconds that the metadata (size, modification time, etc.) of files on remote filesystems is reused before asking the server again'),
+        IntParam('metadata_cache_size', 5000, 'Maximum number of remote files for which metadata is cached'),
+    )
+
+    def __init__(self):
+        Publisher().subscribe(self.settingsChanged, 'peppy.preferences.changed')
+        Publisher().subscribe(self.settingsChanged, 'initialize.preferences')
+    
+    def settingsChanged(self, msg=None):
+        vfs.metadata_cache.set_limits(self.classprefs.metadata_cache_time,
+                                      self.classprefs.metadata_cache_size)
+
+
 class Tabs(ClassPrefs):
     preferences_tab = "General"
     icon = "icons/tab.png"
@@ -324,6 +342,8 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
     standard_plugin_dirs = ['plugins', 'hsi', 'project', 'major_modes']
     preferences_plugin_dir = "plugins"
     server_port_filename = ".server.port"
+    plugin_manifest_filename = "plugin-manifest"
+    index_cache_dirname = "index-cache"
 
     ##
     # This mapping controls the verbosity level required for debug
@@ -354,9 +374,11 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
         FloatParam('minimum_idle_delay', 0.5, 'Minimum delay (in seconds) between idle event updates to prevent a slowdown by propagating too many idle events in a short time period.'),
         BoolParam('load_threaded', True, 'Load files in a separate thread?'),
         BoolParam('show_splash', False, 'Show the splash screen on start?'),
+        BoolParam('lazy_load_plugins', True, 'Delay loading plugins that only provide major modes until one of their major modes is needed.  The list of plugins and their compiled code is cached in the configuration directory, and is updated automatically when plugins are added or changed.'),
         StrParam('default_text_encoding', 'latin1', 'Default file encoding if otherwise not specified in the file'),
         )
     mouse = Mouse()
+    remote_files = RemoteFiles()
     user = User()
     tabs = Tabs()
     language = Language()
@@ -395,6 +417,7 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
         Called by the wx framework and used instead of the __init__
         method in a wx application.
         """
+        self.startStartupTimer()
         name = self.__class__.__name__
         if wx.Platform not in ["__WXMAC__", "__WXMSW__"]:
             name = name.lower()
@@ -417,6 +440,7 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
         # option is set, so convert as many configuration params as
         # are currently known.
         GlobalPrefs.convertConfig()
+        self.markStartupTime("configuration")
         
         self.findRunningServer()
         if self.otherInstanceRunning():
@@ -425,6 +449,7 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
             self.startServer()
 
         self.startSplash()
+        self.markStartupTime("server and splash")
 
         self.initPluginManager()
         count = self.countImports()
@@ -438,11 +463,16 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
         count += 7
         self.splash.setTicks(count)
         
+        self.markStartupTime("finding plugins")
+        
         self.splash.tick("Loading standard plugins...")
         self.autoloadImports()
+        self.markStartupTime("standard plugins")
         self.splash.tick("Loading setuptools plugins...")
         self.autoloadSetuptoolsPlugins()
+        self.markStartupTime("setuptools plugins")
         self.autoloadYapsyPlugins(load_yapsy)
+        self.markStartupTime("yapsy plugins")
             
         # Now that the remaining plugins and classes are loaded, we
         # can convert the rest of the configuration params
@@ -453,6 +483,11 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
         # configuration information has been loaded.
         self.splash.tick("Initializing plugins...")
         self.activatePlugins()
+        
+        # The manifest is updated after the plugins have their configuration
+        # so the deferred plugins will use the user's settings
+        self.plugin_manager.saveManifest()
+        self.markStartupTime("plugin initialization")
 
         # Command line args can now be processed
         self.splash.tick("Processing command line arguments...")
@@ -460,13 +495,15 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
 
         self.splash.tick("Setting up graphics...")
         self.initGraphics()
+        self.markStartupTime("command line and graphics")
 
         # set verbosity on any new plugins that may have been loaded
         # and set up the debug menu
         #self.setVerbosity(menu=DebugClass,reset=self.verbose)
 
         Publisher().sendMessage('peppy.startup.complete')
-        self.splash.tick("Starting peppy...")
+        self.splash.tick("Starting peppy... (%s)" % self.getStartupTimeSummary())
+        if self.verbose > 0: dprint("Startup times: %s" % self.getStartupTimeText())
 
         wx.SetDefaultPyEncoding(self.classprefs.default_text_encoding)
         
@@ -547,6 +584,7 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
                 confdir = sys.argv[index + 1]
                 del sys.argv[index:index + 2]
         self.config = HomeConfigDir(confdir)
+        vfs.register_index_cache_dir(self.config.fullpath(self.index_cache_dirname))
 
         if "--dbg" in sys.argv:
             index = sys.argv.index("--dbg")
@@ -814,11 +852,14 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
         assert self.dprint("found home dir=%s" % self.config.dir)
         return os.path.join(self.config.dir,filename)
 
+    def getConfigFileNames(self):
+        return [self.base_preferences,
+                "%s.cfg" % platform.system(),
+                "%s.cfg" % platform.node(),
+                self.override_preferences]
+
     def loadConfig(self):
-        files = [self.base_preferences,
-                 "%s.cfg" % platform.system(),
-                 "%s.cfg" % platform.node(),
-                 self.override_preferences]
+        files = self.getConfigFileNames()
 
         for filename in files:
             self.loadConfigFile(filename)
@@ -869,6 +910,24 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
             return False
         return True
 
+    def startStartupTimer(self):
+        self.startup_times = []
+        self.startup_start = self.startup_last = time.time()
+    
+    def markStartupTime(self, phase):
+        """Record the time taken by a phase of the application startup"""
+        now = time.time()
+        self.startup_times.append((phase, now - self.startup_last))
+        self.startup_last = now
+    
+    def getStartupTimeSummary(self):
+        return "%.2fs" % (self.startup_last - self.startup_start)
+    
+    def getStartupTimeText(self):
+        """Get the breakdown of the startup time by phase"""
+        phases = ["%s %.3fs" % (phase, elapsed) for phase, elapsed in self.startup_times]
+        return "%s total: %s" % (self.getStartupTimeSummary(), ", ".join(phases))
+    
     def countImports(self):
         try:
             import peppy.py2exe_plugins_count
@@ -927,6 +986,15 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
             directories_list=paths,
             plugin_info_ext="peppy-plugin",
             )
+        
+        if self.config.dir:
+            # The manifest stores the user configuration of the deferred
+            # major modes, so it must be recreated if any of the config
+            # files change
+            manifest = PluginManifest(self.config.fullpath(self.plugin_manifest_filename))
+            manifest.load()
+            config_files = [self.config.fullpath(name) for name in self.getConfigFileNames()]
+            self.plugin_manager.setManifest(manifest, config_files, self.classprefs.lazy_load_plugins)
 
     def countYapsyPlugins(self):
         """Count all yapsy plugins from all plugin directories.
@@ -1069,6 +1137,7 @@ class Peppy(wx.App, ClassPrefs, debugmixin):
         if not BufferList.promptUnsaved():
             return False
         BufferList.removeAllAutosaveFiles()
+        self.plugin_manager.saveManifest()
         plugins = self.plugin_manager.getActivePluginObjects()
         exceptions = []
         for plugin in plugins:
@@ -564,7 +564,11 @@ class ModeSelectMixin(object):
         return self.items
 
     def action(self, index=-1, multiplier=1):
-        self.frame.changeMajorMode(self.modes[index])
+        # Plugins providing the modes in the list aren't loaded until one
+        # of their modes is chosen
+        mode = MajorModeMatcherDriver.loadDeferredMode(self.modes[index])
+        if mode is not None:
+            self.frame.changeMajorMode(mode)
 
 
 class CommonlyUsedMajorModes(BufferBusyActionMixin, ModeSelectMixin, RadioAction, ClassPrefs):
@@ -639,6 +639,9 @@ class MajorMode(ContextMenuMixin, ClassPrefs, debugmixin):
     #: The VFS also provides metadata, including MIME type, and the MIME types supported by the major mode can be listed here.  The MIME types can be a single string or a list of strings for multiple types.
     mimetype = None
     
+    #: Magic bytes at the start of a file that identify it as a file for this mode.  The magic can be a single string or a list of strings if the file can start with any of several different values.  If no magic bytes, set to None
+    magic = None
+    
     #: If this mode represents a temporary view and should be replaced by a new tab, make this True
     temporary = False
     
@@ -911,6 +914,14 @@ class MajorMode(ContextMenuMixin, ClassPrefs, debugmixin):
         the file is not capable of being opened by this mode, or None
         if indeterminate.
         """
+        if cls.magic:
+            if isinstance(cls.magic, str):
+                if header.startswith(cls.magic):
+                    return True
+            else:
+                for magic in cls.magic:
+                    if header.startswith(magic):
+                        return True
         return None
 
     @classmethod
@@ -945,6 +956,16 @@ class MajorMode(ContextMenuMixin, ClassPrefs, debugmixin):
         #dprint("%s: subclass=%s other=%s self=%s" % (cls.keyword, issubclass(stc_class, cls.stc_class), stc_class, cls.stc_class))
         return issubclass(stc_class, cls.stc_class)
     
+    @classmethod
+    def getSTCClass(cls, url):
+        """Returns the STC class used to store the data of the given URL
+        
+        Most major modes always use their L{stc_class}, but this allows a
+        major mode to choose a different storage mechanism based on the URL,
+        for example when the file is too large to be held in memory.
+        """
+        return cls.stc_class
+
     @classmethod
     def preferThreadedLoading(cls, url):
         """Returns preference for using threaded loading of the given URL
@@ -8,10 +8,13 @@ import wx.grid as Grid
 from wx.lib.evtmgr import eventManager
 import wx.lib.newevent
 
+import peppy.vfs as vfs
 from peppy.yapsy.plugins import *
 from peppy.actions import *
 from peppy.major import *
 from peppy.stcinterface import *
+from peppy.mmapstc import MMapSTC
+from peppy.vfs.itools.core.cache import LRUCache
 from peppy.actions.minibuffer import *
 
 
@@ -105,9 +108,13 @@ class ShowRecordNumbers(WorksWithHexEdit, ToggleAction):
     
 
 class HugeTable(Grid.PyGridTableBase,debugmixin):
+    #: Minimum number of rows that are read and decoded at once
+    min_block_rows = 32
+    
     def __init__(self,stc,format="16c"):
         Grid.PyGridTableBase.__init__(self)
 
+        self._block_rows = self.min_block_rows
         self.setFormat(format)
         self.setSTC(stc)
         
@@ -125,6 +132,7 @@ class HugeTable(Grid.PyGridTableBase,debugmixin):
             
             self.format = format
             self.nbytes = nbytes
+            self.setBlockFormat(format)
             self._hexcols = self.nbytes
             self.parseFormat(self.format)
             self._cols = self._hexcols + self._textcols
@@ -134,6 +142,36 @@ class HugeTable(Grid.PyGridTableBase,debugmixin):
         # also stores the unpacked version of the data
         self.invalidateCache()
 
+    def setBlockFormat(self, format):
+        """Prepare the structs used to decode blocks of rows
+        
+        A block of rows can be decoded with a single struct if repeating the
+        format doesn't change the alignment of the rows, which is always the
+        case with an explicit byte order.  Otherwise, each row is decoded
+        separately with a precompiled struct.
+        """
+        self._struct = struct.Struct(format)
+        if format[0] in "@=<>!":
+            self._block_prefix, self._block_body = format[0], format[1:]
+        else:
+            self._block_prefix, self._block_body = "", format
+        self._block_structs = {}
+        self._block_uniform = struct.calcsize(self._block_prefix + self._block_body * 2) == self.nbytes * 2
+    
+    def unpackRows(self, data, count):
+        """Unpack a number of consecutive rows from the data
+        
+        @returns: list of the tuples of unpacked values for each row
+        """
+        if self._block_uniform:
+            if count not in self._block_structs:
+                self._block_structs[count] = struct.Struct(self._block_prefix + self._block_body * count)
+            values = self._block_structs[count].unpack(data)
+            num = len(values) / count
+            return [values[i * num:(i + 1) * num] for i in range(count)]
+        unpack = self._struct.unpack_from
+        return [unpack(data, i * self.nbytes) for i in range(count)]
+
     def parseFormat(self, format):
         """
         Given a format specifier, parse the string into individual
@@ -330,45 +368,56 @@ class HugeTable(Grid.PyGridTableBase,debugmixin):
         else:
             return False
     
-    def invalidateCache(self, max=100):
-        self._cache = {}
-        self._cache_max = max
-        self._cache_fifo = []
+    def setVisibleRows(self, rows):
+        """Size the row cache and the block of rows decoded at once to the
+        number of rows visible in the grid
+        """
+        rows = max(self.min_block_rows, rows)
+        if rows != self._block_rows:
+            self._block_rows = rows
+            self.invalidateCache()
+    
+    def invalidateCache(self):
+        # Keep a few screens worth of rows so that scrolling back and forth
+        # doesn't need to decode them again
+        size = self._block_rows * 4
+        self._cache = LRUCache(size, size * 2)
     
     def invalidateCacheRow(self, row):
         if row in self._cache:
             del self._cache[row]
-            self._cache_fifo.remove(row)
     
     def getRowData(self, row):
-        if len(self._cache_fifo) > self._cache_max:
-            amt = self._cache_max / 8
-            remove = self._cache_fifo[:amt]
-            self._cache_fifo = self._cache_fifo[amt:]
-            for r in remove:
-                if r != row:
-                    del self._cache[r]
-                else:
-                    # add back the row that we didn't remove
-                    self._cache_fifo.append(row)
-            #dprint("Removed 1/8 of the cache: %d elements: %s.  cache=%s" % (amt, str(remove), str(self._cache_fifo)))
-        if row not in self._cache:
-            startpos = row*self.nbytes
-            endpos = startpos + self.nbytes
-            data = self.stc.GetBinaryData(startpos,endpos)
-            
-            # pad data with dummy bytes if we've hit the end of file and it's
-            # not an even multiple of the column size
-            if len(data) < self.nbytes:
-                data += '\0' * (self.nbytes - len(data))
-            
-            s = struct.unpack(self.format, data)
-            self._cache[row] = (data, s)
-            #dprint("Storing cached data for row %d: %s, %s" % (row, repr(data), str(s)))
-            
-            self._cache_fifo.append(row)
+        if row in self._cache:
+            self._cache.touch(row)
+        else:
+            self.decodeRows(row)
         return self._cache[row]
     
+    def decodeRows(self, row):
+        """Read and decode the block of rows that includes the row
+        
+        Blocks are aligned to multiples of the block size so scrolling in
+        either direction decodes each row only once.
+        """
+        start = (row / self._block_rows) * self._block_rows
+        count = max(1, min(self._block_rows, self._rows - start))
+        nbytes = self.nbytes
+        startpos = start * nbytes
+        data = self.stc.GetBinaryData(startpos, startpos + count * nbytes)
+        
+        # pad data with dummy bytes if we've hit the end of file and it's
+        # not an even multiple of the column size
+        if len(data) < count * nbytes:
+            data += '\0' * (count * nbytes - len(data))
+        
+        values = self.unpackRows(data, count)
+        for i in range(count):
+            r = start + i
+            if r in self._cache:
+                del self._cache[r]
+            self._cache[r] = (data[i * nbytes:(i + 1) * nbytes], values[i])
+    
     def GetValue(self, row, col):
         data, s = self.getRowData(row)
         if col<self._hexcols:
@@ -820,9 +869,22 @@ class HexEditMode(STCInterface, Grid.Grid, MajorMode):
     icon='icons/tux.png'
     mimetype = 'application/octet-stream'
     
+    default_classprefs = (
+        IntParam('mmap_threshold', 16, 'Files larger than this size (in megabytes) are edited directly from the file rather than loaded into memory.  These files can only be viewed in the hex editor.'),
+        )
+    
     @classmethod
     def verifyCompatibleSTC(self, stc_class):
         return hasattr(stc_class, 'GetBinaryData')
+    
+    @classmethod
+    def getSTCClass(cls, url):
+        try:
+            if vfs.get_size(url) > cls.classprefs.mmap_threshold * 1024 * 1024:
+                return MMapSTC
+        except (OSError, IOError):
+            pass
+        return cls.stc_class
 
     def __init__(self, parent, wrapper, buffer, frame):
         """Create the HexEdit viewer
@@ -850,6 +912,7 @@ class HexEditMode(STCInterface, Grid.Grid, MajorMode):
         self.Bind(Grid.EVT_GRID_SELECT_CELL, self.OnSelectCell)
         self.Bind(wx.EVT_KEY_DOWN, self.OnKeyDown)
         self.Bind(EVT_WAIT_UPDATE,self.OnUnderlyingUpdate)
+        self.Bind(wx.EVT_SIZE, self.OnSize)
         self.Show(True)
 
     def createPostHook(self):
@@ -896,6 +959,12 @@ class HexEditMode(STCInterface, Grid.Grid, MajorMode):
         if loc is not None:
             self.GotoPos(loc)
 
+    def OnSize(self, evt):
+        evt.Skip()
+        height = self.GetDefaultRowSize()
+        if height > 0:
+            self.table.setVisibleRows(self.GetClientSize().GetHeight() / height + 1)
+
     def OnRightDown(self, evt):
         assert self.dprint(self.GetSelectedRows())
 
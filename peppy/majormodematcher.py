@@ -4,7 +4,9 @@
 
 """
 
-import os
+import os, re
+
+from wx.lib.pubsub import Publisher
 
 import peppy.vfs as vfs
 
@@ -21,10 +23,358 @@ class IgnoreMajorMode(RuntimeError):
     """ 
     pass
 
+class MajorModeDispatchTable(debugmixin):
+    """Lookup tables used to match data to a list of major modes.
+    
+    Rather than calling the verify classmethods of every major mode for every
+    file, the information used by the default implementations of the verify
+    methods in L{MajorMode} is collected into dicts: filename extensions,
+    keywords and emacs synonyms, and magic prefixes.  The bangpaths of all the
+    keywords are combined into a single regular expression, and MIME type
+    matches are remembered the first time each MIME type is seen.  Modes that
+    override a verify method are still called individually, so the matched
+    modes are the same as looping over all the modes.
+    
+    All results are returned in the order of the list of modes.
+    """
+    def __init__(self, modes):
+        self.modes = list(modes)
+        self.order = {}
+        for mode in self.modes:
+            if mode not in self.order:
+                self.order[mode] = len(self.order)
+        self.mimetypes = {}
+        if self.modes:
+            # MajorMode is always the last class in the hierarchy
+            self.base = self.modes[0].getSubclassHierarchy()[-1]
+        else:
+            self.base = None
+        self.protocol_modes = self.getOverridingModes('verifyProtocol')
+        self.rewrite_modes = self.getOverridingModes('verifyOpenWithRewrittenURL')
+        self.metadata_modes = self.getOverridingModes('verifyMetadata')
+        self.createFilenameTable()
+        self.createKeywordTable()
+        self.createMagicTable()
+        self.createShellRegex()
+    
+    def isOverridden(self, mode, name):
+        return getattr(mode, name).im_func is not getattr(self.base, name).im_func
+    
+    def getOverridingModes(self, name):
+        """Get the modes that override the named verify method of L{MajorMode}
+        """
+        return [m for m in self.modes if self.isOverridden(m, name)]
+    
+    def sort(self, modes):
+        """Sort the modes into the order of the list of modes"""
+        return sorted(modes, key=self.order.get)
+    
+    def createFilenameTable(self):
+        self.extensions = {}
+        self.filename_regexes = []
+        self.filename_modes = []
+        for mode in self.modes:
+            if self.isOverridden(mode, 'verifyFilename'):
+                self.filename_modes.append(mode)
+                continue
+            regexes = []
+            for regex in [getattr(mode, 'regex', None), mode.classprefs.filename_regex]:
+                if regex:
+                    try:
+                        regexes.append(re.compile(regex))
+                    except re.error, e:
+                        eprint("%s: bad filename regex %s: %s" % (mode.keyword, regex, e))
+            if regexes:
+                self.filename_regexes.append((mode, regexes))
+            if mode.classprefs.extensions:
+                for ext in mode.classprefs.extensions.split():
+                    self.extensions.setdefault(ext, []).append(mode)
+    
+    def createKeywordTable(self):
+        self.keywords = {}
+        self.keyword_modes = []
+        for mode in self.modes:
+            if self.isOverridden(mode, 'verifyKeyword'):
+                self.keyword_modes.append(mode)
+                continue
+            keywords = [mode.keyword]
+            if mode.emacs_synonyms:
+                if isinstance(mode.emacs_synonyms, str):
+                    keywords.append(mode.emacs_synonyms)
+                else:
+                    keywords.extend(mode.emacs_synonyms)
+            for keyword in keywords:
+                self.keywords.setdefault(keyword, []).append(mode)
+    
+    def createMagicTable(self):
+        # Maps the length of the magic string to a dict of the magic strings
+        # of that length, so a header is checked with one lookup per length
+        self.magic = {}
+        self.magic_modes = []
+        for mode in self.modes:
+            if self.isOverridden(mode, 'verifyMagic'):
+                self.magic_modes.append(mode)
+            elif mode.magic:
+                if isinstance(mode.magic, str):
+                    magics = [mode.magic]
+                else:
+                    magics = mode.magic
+                for magic in magics:
+                    self.magic.setdefault(len(magic), {}).setdefault(magic, []).append(mode)
+    
+    def createShellRegex(self):
+        self.shell_keywords = {}
+        for mode in self.modes:
+            self.shell_keywords.setdefault(mode.keyword.lower(), []).append(mode)
+        
+        # A keyword matches only if it's bounded by non-word characters, so
+        # the only other keywords that can match at the same position are
+        # prefixes of it that end before a non-word character.
+        keywords = sorted(self.shell_keywords.keys(), key=len, reverse=True)
+        self.shell_prefixes = {}
+        for keyword in keywords:
+            self.shell_prefixes[keyword] = [k for k in keywords if len(k) < len(keyword) and keyword.startswith(k) and re.match(r'\W', keyword[len(k)])]
+        
+        # The lookahead allows overlapping matches, and the alternatives are
+        # sorted longest first so the longest bounded keyword is found at
+        # each position
+        if keywords:
+            regex = r'(?=[\W](%s)(?:[\W]|$))' % "|".join([re.escape(k) for k in keywords])
+            self.shell_regex = re.compile(regex)
+        else:
+            self.shell_regex = None
+    
+    def getMimetypeModes(self, mimetype):
+        """Get the modes that support the MIME type
+        
+        @returns: tuple of the list of modes that verify the MIME type and
+        the list of modes that raised L{IgnoreMajorMode}
+        """
+        if mimetype not in self.mimetypes:
+            modes = []
+            ignored = []
+            for mode in self.modes:
+                try:
+                    if mode.verifyMimetype(mimetype):
+                        modes.append(mode)
+                except IgnoreMajorMode:
+                    ignored.append(mode)
+            self.mimetypes[mimetype] = (modes, ignored)
+        return self.mimetypes[mimetype]
+    
+    def getFilenameModes(self, filename):
+        """Get the modes that use the default L{MajorMode.verifyFilename} and
+        match the filename.  Modes that override verifyFilename must be
+        checked separately using the list in filename_modes.
+        """
+        modes = set()
+        for mode, regexes in self.filename_regexes:
+            for regex in regexes:
+                if regex.search(filename):
+                    modes.add(mode)
+                    break
+        ext = os.path.splitext(filename)[1][1:]
+        if ext in self.extensions:
+            modes.update(self.extensions[ext])
+        return modes
+    
+    def getKeywordModes(self, keyword):
+        """Get the modes that use the default L{MajorMode.verifyKeyword} and
+        match the keyword."""
+        return self.keywords.get(keyword, [])
+    
+    def getMagicModes(self, header):
+        """Get the modes that use the default L{MajorMode.verifyMagic} and
+        whose magic matches the header."""
+        modes = set()
+        for length, magics in self.magic.iteritems():
+            prefix = header[:length]
+            if prefix in magics:
+                modes.update(magics[prefix])
+        return modes
+    
+    def getShellModes(self, bangpath):
+        """Get the modes whose keywords appear in the lower-cased bangpath
+        bounded by non-word characters."""
+        modes = set()
+        if self.shell_regex is not None:
+            for match in self.shell_regex.finditer(bangpath):
+                keyword = match.group(1)
+                modes.update(self.shell_keywords[keyword])
+                for prefix in self.shell_prefixes[keyword]:
+                    modes.update(self.shell_keywords[prefix])
+        return modes
+
+
+def getClassName(cls):
+    """Get the full name of a class, used to identify a class without
+    loading it"""
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+
+class DeferredMajorMode(object):
+    """Stand-in for a major mode of a L{DeferredPlugin} in the lists of
+    major modes shown to the user.
+    
+    The plugin isn't loaded until the mode is selected; see
+    L{MajorModeMatcherDriver.loadDeferredMode}.
+    """
+    def __init__(self, plugin, desc):
+        self.plugin = plugin
+        self.keyword = desc['keyword']
+        self.stc_class = desc['stc_class']
+    
+    def __repr__(self):
+        return "<DeferredMajorMode %s>" % self.keyword
+    
+    def verifyCompatibleSTC(self, stc_class):
+        """Same as L{MajorMode.verifyCompatibleSTC}, using the name of the
+        mode's STC class"""
+        for cls in stc_class.__mro__:
+            if getClassName(cls) == self.stc_class:
+                return True
+        return False
+
+
+class DeferredModeTable(debugmixin):
+    """Lookup tables used to find the deferred plugins whose major modes
+    might match some data.
+
+    Plugins that only provide major modes can be replaced at startup by a
+    L{DeferredPlugin} that describes its modes using L{describeMode}.  Only
+    modes that use the default verify methods of L{MajorMode} are deferred,
+    so the descriptions contain everything used to match them.  The table
+    may find plugins whose modes won't end up matching (e.g. a keyword in a
+    bangpath that isn't bounded the same way), but it never misses a plugin
+    that would match.
+    """
+    #: Modes that handle these MIME types are generic modes that are
+    #: checked for every file, so they must always be loaded
+    generic_mimetypes = set(['text/plain', 'application/octet-stream', 'inode/directory', 'x-directory/normal'])
+
+    #: Verify methods that must not be overridden for the mode to be
+    #: deferred
+    verify_methods = ['verifyProtocol', 'verifyOpenWithRewrittenURL',
+                      'verifyFilename', 'verifyMimetype', 'verifyMetadata',
+                      'verifyMagic', 'verifyKeyword', 'verifyCompatibleSTC']
+
+    @classmethod
+    def getList(cls, value):
+        if not value:
+            return []
+        if isinstance(value, basestring):
+            return [value]
+        return list(value)
+
+    @classmethod
+    def describeMode(cls, mode):
+        """Get the information needed to match the mode without loading it.
+
+        @returns: dict of the keywords, filename regexes and extensions, MIME
+        types, magic strings, and STC class name of the mode, or None if the
+        mode must be loaded at startup because it doesn't use the default
+        matching
+        """
+        base = mode.getSubclassHierarchy()[-1]
+        for name in cls.verify_methods:
+            if getattr(mode, name).im_func is not getattr(base, name).im_func:
+                return None
+        hook = mode.verifyMimetypeHook.im_func
+        if hook.__module__ not in ('peppy.major', 'peppy.fundamental'):
+            return None
+        for mimetype in cls.generic_mimetypes:
+            if mode.verifyMimetype(mimetype):
+                return None
+        regexes = [r for r in [getattr(mode, 'regex', None), mode.classprefs.filename_regex] if r]
+        keywords = [mode.keyword]
+        keywords.extend(cls.getList(mode.emacs_synonyms))
+        extensions = []
+        if mode.classprefs.extensions:
+            extensions = mode.classprefs.extensions.split()
+        return {'keyword': mode.keyword,
+                'keywords': keywords,
+                'regexes': regexes,
+                'extensions': extensions,
+                'mimetypes': cls.getList(mode.mimetype),
+                'magic': cls.getList(mode.magic),
+                'stc_class': getClassName(mode.stc_class),
+                }
+
+    def __init__(self, plugins):
+        self.plugins = list(plugins)
+        self.extensions = {}
+        self.regexes = []
+        self.keywords = {}
+        self.mimetypes = {}
+        self.magic = []
+        self.shell = []
+        for plugin in self.plugins:
+            for desc in plugin.getDeferredModes():
+                for ext in desc['extensions']:
+                    self.extensions.setdefault(ext, set()).add(plugin)
+                for regex in desc['regexes']:
+                    try:
+                        self.regexes.append((re.compile(regex), plugin))
+                    except re.error:
+                        pass
+                for keyword in desc['keywords']:
+                    self.keywords.setdefault(keyword, set()).add(plugin)
+                for mimetype in desc['mimetypes']:
+                    self.mimetypes.setdefault(mimetype, set()).add(plugin)
+                for magic in desc['magic']:
+                    self.magic.append((magic, plugin))
+                regex = re.compile(r'[\W]%s(?:[\W]|$)' % re.escape(desc['keyword'].lower()))
+                self.shell.append((regex, plugin))
+
+    def getPlugins(self, filename=None, mimetype=None, header=None, keyword=None):
+        """Get the plugins whose major modes might match any of the filename,
+        MIME type, header or keyword.
+
+        @returns: list of plugins in the order they were passed to the
+        constructor
+        """
+        found = set()
+        if filename:
+            ext = os.path.splitext(filename)[1][1:]
+            found.update(self.extensions.get(ext, []))
+            for regex, plugin in self.regexes:
+                if plugin not in found and regex.search(filename):
+                    found.add(plugin)
+        if mimetype:
+            found.update(self.mimetypes.get(mimetype, []))
+        if keyword:
+            found.update(self.keywords.get(keyword, []))
+        if header:
+            for magic, plugin in self.magic:
+                if header.startswith(magic):
+                    found.add(plugin)
+            modename, settings = parseEmacs(header)
+            if modename:
+                found.update(self.keywords.get(modename, []))
+            if header.startswith("#!"):
+                bangpath = header.splitlines()[0].lower()
+                for regex, plugin in self.shell:
+                    if plugin not in found and regex.search(bangpath):
+                        found.add(plugin)
+        return [p for p in self.plugins if p in found]
+
+
 class MajorModeMatcherDriver(debugmixin):
     current_modes = []
     skipped_modes = set()
     
+    # The active plugins used to create the current_modes and the dispatch
+    # table.  The table is recreated if the plugins change, and discarded
+    # when the preferences change because they can change the filename
+    # matching.
+    current_plugins = None
+    dispatch = None
+    
+    # The plugins that haven't been loaded yet and the table used to find
+    # the ones that have to be loaded to match a file
+    deferred_plugins = None
+    deferred_table = None
+    
     # This list holds all major modes that aren't defined in a plugin
     global_major_modes = []
     
@@ -48,6 +398,10 @@ class MajorModeMatcherDriver(debugmixin):
         mode.  Currently, this means that they share a common STC class,
         but this is not necessarily going to remain this way.  It might be
         possible in the future to change STCs when changing modes.
+        
+        The modes of plugins that haven't been loaded yet are represented by
+        L{DeferredMajorMode} instances, which must be passed through
+        L{loadDeferredMode} before they are used.
         """
         buffer = mode.buffer
         stc_class = buffer.stc.__class__
@@ -60,8 +414,10 @@ class MajorModeMatcherDriver(debugmixin):
     
     @classmethod
     def getMajorModesCompatibleWithSTCClass(cls, stc_class):
-        plugins = wx.GetApp().plugin_manager.getActivePluginObjects()
+        plugin_manager = wx.GetApp().plugin_manager
+        plugins = plugin_manager.getActivePluginObjects()
         modes = [m for m in cls.global_major_modes if m.verifyCompatibleSTC(stc_class)]
+        modes.extend([m for m in cls.getDeferredModes() if m.verifyCompatibleSTC(stc_class)])
         for plugin in plugins:
             # Only display those modes that use the same type of STC as the
             # current mode.
@@ -137,18 +493,103 @@ class MajorModeMatcherDriver(debugmixin):
     @classmethod
     def findAndCacheActiveModes(cls, plugins):
         """Uses L{findActiveModes} to cache the list of currently active major
-        modes
+        modes and the L{MajorModeDispatchTable} used to match them.
+        
+        The cached values are reused until the list of active plugins changes.
         """
-        cls.current_modes = cls.findActiveModes(plugins)
-        cls.dprint("Currently active major modes: %s" % str(cls.current_modes))
+        plugins = list(plugins)
+        if cls.dispatch is None or plugins != cls.current_plugins:
+            cls.current_modes = cls.findActiveModes(plugins)
+            cls.current_plugins = plugins
+            cls.dispatch = MajorModeDispatchTable(cls.current_modes)
+            cls.dprint("Currently active major modes: %s" % str(cls.current_modes))
         cls.skipped_modes = set()
     
+    @classmethod
+    def clearDispatchTable(cls, msg=None):
+        """Force the dispatch table to be recreated on the next match"""
+        cls.dispatch = None
+    
+    @classmethod
+    def getDeferredModes(cls):
+        """Get L{DeferredMajorMode} instances for the major modes of the
+        plugins that haven't been loaded yet"""
+        modes = []
+        for plugin in wx.GetApp().plugin_manager.getDeferredPlugins():
+            for desc in plugin.getDeferredModes():
+                modes.append(DeferredMajorMode(plugin, desc))
+        return modes
+    
+    @classmethod
+    def loadDeferredMode(cls, mode):
+        """Get the major mode class, loading the plugin if the mode is a
+        L{DeferredMajorMode}
+        """
+        if isinstance(mode, DeferredMajorMode):
+            cls.loadPlugins([mode.plugin])
+            mode = cls.findModeByKeyword(mode.keyword)
+        return mode
+    
+    @classmethod
+    def loadPlugins(cls, plugins):
+        """Load the deferred plugins and update the active modes"""
+        plugin_manager = wx.GetApp().plugin_manager
+        for plugin in plugins:
+            plugin_manager.loadDeferredPlugin(plugin)
+        skipped = cls.skipped_modes
+        cls.findAndCacheActiveModes(plugin_manager.getActivePluginObjects())
+        cls.skipped_modes = skipped
+    
+    @classmethod
+    def loadDeferredModes(cls, filename=None, mimetype=None, header=None, keyword=None):
+        """Load the deferred plugins whose major modes might match the
+        filename, MIME type, header, or keyword.
+        
+        The active modes and dispatch table are updated if any plugins are
+        loaded.
+        
+        @returns: True if any plugins were loaded
+        """
+        plugin_manager = wx.GetApp().plugin_manager
+        plugins = plugin_manager.getDeferredPlugins()
+        if not plugins:
+            return False
+        if cls.deferred_table is None or plugins != cls.deferred_plugins:
+            cls.deferred_plugins = plugins
+            cls.deferred_table = DeferredModeTable(plugins)
+        found = cls.deferred_table.getPlugins(filename, mimetype, header, keyword)
+        if not found:
+            return False
+        cls.loadPlugins(found)
+        return True
+    
+    @classmethod
+    def loadAllDeferredModes(cls):
+        """Load all the deferred plugins and update the active modes"""
+        plugin_manager = wx.GetApp().plugin_manager
+        plugin_manager.loadDeferredPlugins()
+        cls.findAndCacheActiveModes(plugin_manager.getActivePluginObjects())
+    
     @classmethod
     def iterActiveModes(cls):
         for mode in cls.current_modes:
             if mode not in cls.skipped_modes:
                 yield mode
     
+    @classmethod
+    def getActiveModes(cls, modes):
+        """Get the modes that haven't been skipped, in the order of the
+        active modes"""
+        return [m for m in cls.dispatch.sort(modes) if m not in cls.skipped_modes]
+    
+    @classmethod
+    def getMimetypeModes(cls, mimetype):
+        modes, ignored = cls.dispatch.getMimetypeModes(mimetype)
+        for mode in ignored:
+            if mode not in cls.skipped_modes:
+                cls.ignoreMode(mode)
+        return set(modes)
+    
     @classmethod
     def ignoreMode(cls, mode):
         cls.dprint("Ignoring mode %s" % mode)
@@ -167,9 +608,11 @@ class MajorModeMatcherDriver(debugmixin):
         app = wx.GetApp()
         plugins = app.plugin_manager.getActivePluginObjects()
         cls.findAndCacheActiveModes(plugins)
-        for mode in cls.iterActiveModes():
-            if mode.verifyKeyword(keyword):
-                return mode
+        if cls.loadDeferredModes(keyword=keyword):
+            plugins = app.plugin_manager.getActivePluginObjects()
+        mode = cls.findModeByKeyword(keyword)
+        if mode:
+            return mode
         
         if not url:
             url = buffer.raw_url
@@ -208,6 +651,8 @@ class MajorModeMatcherDriver(debugmixin):
         # ok, it's not a specific protocol.  Try to match a url pattern and
         # generate a list of possible modes
         metadata = cls.getFailsafeMetadata(url)
+        if cls.loadDeferredModes(mimetype=metadata['mimetype']):
+            plugins = app.plugin_manager.getActivePluginObjects()
         modes, generic_modes = cls.scanFolderURL(url, metadata)
         cls.dprint("scanFolderURL matches %s (generic: %s) using metadata %s" % (modes, generic_modes, metadata))
         if modes:
@@ -250,6 +695,8 @@ class MajorModeMatcherDriver(debugmixin):
         # ok, it's not a specific protocol.  Try to match a url pattern and
         # generate a list of possible modes
         metadata = cls.getFailsafeMetadata(url)
+        if cls.loadDeferredModes(filename=url.path.get_name(), mimetype=metadata['mimetype']):
+            plugins = app.plugin_manager.getActivePluginObjects()
         modes, text_modes, binary_modes = cls.scanFileURL(url, metadata)
         cls.dprint("scanFileURL matches %s (text: %s) (binary: %s) using metadata %s" % (modes, text_modes, binary_modes, metadata))
 
@@ -264,6 +711,11 @@ class MajorModeMatcherDriver(debugmixin):
                 else:
                     return cls.findModeByMimetype("text/plain")
             header = fh.read(magic_size)
+        
+        # Deferred modes that match the filename or MIME type are already
+        # loaded, so only the scans of the header can find any new modes
+        if cls.loadDeferredModes(header=header):
+            plugins = app.plugin_manager.getActivePluginObjects()
 
         url_match = None
         if modes:
@@ -366,10 +818,20 @@ class MajorModeMatcherDriver(debugmixin):
 
     @classmethod
     def findModeByMimetype(cls, mimetype):
-        for mode in cls.iterActiveModes():
-            cls.dprint("searching %s" % mode.keyword)
-            if mode.verifyMimetype(mimetype):
-                return mode
+        modes = cls.getActiveModes(cls.getMimetypeModes(mimetype))
+        if modes:
+            return modes[0]
+        return None
+    
+    @classmethod
+    def findModeByKeyword(cls, keyword):
+        modes = set(cls.dispatch.getKeywordModes(keyword))
+        for mode in cls.dispatch.keyword_modes:
+            if mode not in cls.skipped_modes and mode.verifyKeyword(keyword):
+                modes.add(mode)
+        modes = cls.getActiveModes(modes)
+        if modes:
+            return modes[0]
         return None
 
     @classmethod
@@ -386,7 +848,9 @@ class MajorModeMatcherDriver(debugmixin):
         """
         
         modes = []
-        for mode in cls.iterActiveModes():
+        for mode in cls.dispatch.protocol_modes:
+            if mode in cls.skipped_modes:
+                continue
             try:
                 if mode.verifyProtocol(url):
                     modes.append(mode)
@@ -408,7 +872,9 @@ class MajorModeMatcherDriver(debugmixin):
         @returns: 2-tuple containing the major mode and the rewritten URL.  If
         no modes match, returns (None, None)
         """
-        for mode in cls.iterActiveModes():
+        for mode in cls.dispatch.rewrite_modes:
+            if mode in cls.skipped_modes:
+                continue
             try:
                 rewritten = mode.verifyOpenWithRewrittenURL(url)
                 if rewritten:
@@ -430,24 +896,51 @@ class MajorModeMatcherDriver(debugmixin):
         to edit the data pointed to by the URL, and a list of modes compatible
         with inode/directory or x-directory/normal that can edit it.
         """
-        modes = []
-        generics = []
-        
         mimetype = metadata['mimetype']
-        for mode in cls.iterActiveModes():
+        matched = cls.getMimetypeModes(mimetype)
+        if mimetype == 'inode/directory' or mimetype == 'x-directory/normal':
+            modes = set()
+            generics = matched
+        else:
+            modes = matched
+            generics = set()
+        modes.update(cls.scanMetadata(metadata, matched))
+        found = matched | modes
+        folders = cls.getMimetypeModes("inode/directory") | cls.getMimetypeModes("x-directory/normal")
+        generics.update(folders - found)
+        return cls.getActiveModes(modes), cls.getActiveModes(generics)
+    
+    @classmethod
+    def scanMetadata(cls, metadata, exclude):
+        """Find the modes that override L{MajorMode.verifyMetadata} and match
+        the metadata, skipping any modes in the exclude set.
+        """
+        modes = set()
+        for mode in cls.dispatch.metadata_modes:
+            if mode in exclude or mode in cls.skipped_modes:
+                continue
             try:
-                if mode.verifyMimetype(mimetype):
-                    if mimetype == 'inode/directory' or mimetype == 'x-directory/normal':
-                        generics.append(mode)
-                    else:
-                        modes.append(mode)
-                elif mode.verifyMetadata(metadata):
-                    modes.append(mode)
-                elif mode.verifyMimetype("inode/directory") or mode.verifyMimetype("x-directory/normal"):
-                    generics.append(mode)
+                if mode.verifyMetadata(metadata):
+                    modes.add(mode)
             except IgnoreMajorMode:
                 cls.ignoreMode(mode)
-        return modes, generics
+        return modes
+    
+    @classmethod
+    def scanFilename(cls, filename, exclude):
+        """Find the modes that match the filename, skipping any modes in the
+        exclude set.
+        """
+        modes = cls.dispatch.getFilenameModes(filename)
+        for mode in cls.dispatch.filename_modes:
+            if mode in exclude or mode in cls.skipped_modes:
+                continue
+            try:
+                if mode.verifyFilename(filename):
+                    modes.add(mode)
+            except IgnoreMajorMode:
+                cls.ignoreMode(mode)
+        return modes - exclude
 
     @classmethod
     def scanFileURL(cls, url, metadata):
@@ -464,34 +957,28 @@ class MajorModeMatcherDriver(debugmixin):
         application/octet-stream that can edit it.
         """
         
-        modes = []
-        generics = []
+        # Each mode is placed in the list of the first test that it
+        # passes, in the order: MIME type, metadata, filename, and then the
+        # generic application/octet-stream and text/plain MIME types.
+        mimetype = metadata['mimetype']
+        matched = cls.getMimetypeModes(mimetype)
+        found = set(matched)
+        found.update(cls.scanMetadata(metadata, found))
+        found.update(cls.scanFilename(url.path.get_name(), found))
         
         # Anything that matches application/octet-stream is a generic mode, so
         # save it for last.
-        binary = []
-        binary_generics = []
+        binary_generics = cls.getMimetypeModes("application/octet-stream") - found
+        generics = cls.getMimetypeModes("text/plain") - found - binary_generics
         
-        mimetype = metadata['mimetype']
-        for mode in cls.iterActiveModes():
-            try:
-                if mode.verifyMimetype(mimetype):
-                    if mimetype == 'application/octet-stream':
-                        binary.append(mode)
-                    else:
-                        modes.append(mode)
-                elif mode.verifyMetadata(metadata):
-                    modes.append(mode)
-                elif mode.verifyFilename(url.path.get_name()):
-                    modes.append(mode)
-                elif mode.verifyMimetype("application/octet-stream"):
-                    binary_generics.append(mode)
-                elif mode.verifyMimetype("text/plain"):
-                    generics.append(mode)
-            except IgnoreMajorMode:
-                cls.ignoreMode(mode)
-        binary.extend(binary_generics)
-        return modes, generics, binary
+        if mimetype == 'application/octet-stream':
+            binary = cls.getActiveModes(matched)
+            modes = cls.getActiveModes(found - matched)
+        else:
+            binary = []
+            modes = cls.getActiveModes(found)
+        binary.extend(cls.getActiveModes(binary_generics))
+        return modes, cls.getActiveModes(generics), binary
 
     @classmethod
     def scanMagic(cls, header):
@@ -505,14 +992,16 @@ class MajorModeMatcherDriver(debugmixin):
         @returns: list of matching L{MajorMode} subclasses
         """
         
-        modes = []
-        for mode in cls.iterActiveModes():
+        modes = cls.dispatch.getMagicModes(header)
+        for mode in cls.dispatch.magic_modes:
+            if mode in cls.skipped_modes:
+                continue
             try:
                 if mode.verifyMagic(header):
-                    modes.append(mode)
+                    modes.add(mode)
             except IgnoreMajorMode:
                 cls.ignoreMode(mode)
-        return modes
+        return cls.getActiveModes(modes)
 
     @classmethod
     def scanLanguage(cls, header, modes):
@@ -563,10 +1052,7 @@ class MajorModeMatcherDriver(debugmixin):
         
         modename, settings = parseEmacs(header)
         cls.dprint("modename = %s, settings = %s" % (modename, settings))
-        for mode in cls.iterActiveModes():
-            if mode.verifyKeyword(modename):
-                return mode
-        return None
+        return cls.findModeByKeyword(modename)
         
     @classmethod
     def scanShell(cls, header):
@@ -584,18 +1070,15 @@ class MajorModeMatcherDriver(debugmixin):
         if header.startswith("#!"):
             lines = header.splitlines()
             bangpath = lines[0].lower()
-            for mode in cls.iterActiveModes():
-                keyword = mode.keyword.lower()
-
-                # only match words that are bounded by some sort
-                # of non-word delimiter.  For instance, if the
-                # mode is "test", it will match "/usr/bin/test" or
-                # "/usr/bin/test.exe" or "/usr/bin/env test", but
-                # not /usr/bin/testing or /usr/bin/attested
-                regex = r'[\W]%s([\W]|$)' % re.escape(keyword)
-                match=re.search(regex, bangpath)
-                if match:
-                    return mode
+            
+            # only match words that are bounded by some sort
+            # of non-word delimiter.  For instance, if the
+            # mode is "test", it will match "/usr/bin/test" or
+            # "/usr/bin/test.exe" or "/usr/bin/env test", but
+            # not /usr/bin/testing or /usr/bin/attested
+            modes = cls.getActiveModes(cls.dispatch.getShellModes(bangpath))
+            if modes:
+                return modes[0]
         return None
     
     @classmethod
@@ -624,3 +1107,6 @@ class MajorModeMatcherDriver(debugmixin):
         if modes:
             return modes[0]
         return None
+
+
+Publisher().subscribe(MajorModeMatcherDriver.clearDispatchTable, 'peppy.preferences.changed')
@@ -0,0 +1,433 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""STC interface for editing binary files without loading them into memory
+
+Local files are memory mapped read-only and edits are recorded in a piece
+table, so opening a file of any size takes constant time and memory.  When
+the file is saved, only the changed ranges are written if none of the
+original data has moved.
+"""
+
+import os, mmap, bisect, tempfile, shutil
+
+import wx.stc
+
+import peppy.vfs as vfs
+
+from peppy.debug import *
+from peppy.stcinterface import *
+
+
+class PieceTable(object):
+    """Sequence of bytes made from pieces of read-only original data and
+    inserted data.
+
+    Each piece is a tuple of (source, offset, length), where the source is
+    either the original data or a string of inserted bytes.  The original
+    data can be anything that supports slicing and len, like a string or an
+    mmap object.
+    """
+    def __init__(self, original):
+        self.original = original
+        if len(original) > 0:
+            self.pieces = [(original, 0, len(original))]
+        else:
+            self.pieces = []
+        self.calcStarts()
+
+    def calcStarts(self):
+        """Calculate the offset of each piece in the document"""
+        self.starts = []
+        pos = 0
+        for source, offset, length in self.pieces:
+            self.starts.append(pos)
+            pos += length
+        self.length = pos
+
+    def __len__(self):
+        return self.length
+
+    def findPiece(self, pos):
+        """Return the index of the piece that contains the position"""
+        return bisect.bisect_right(self.starts, pos) - 1
+
+    def get(self, start, end):
+        """Return the bytes from start to end-1"""
+        end = min(end, self.length)
+        if start >= end:
+            return ""
+        data = []
+        index = self.findPiece(start)
+        while start < end:
+            source, offset, length = self.pieces[index]
+            piece_start = self.starts[index]
+            first = offset + start - piece_start
+            last = offset + min(end - piece_start, length)
+            data.append(source[first:last])
+            start = piece_start + length
+            index += 1
+        return "".join(data)
+
+    def split(self, pos):
+        """Make sure a piece boundary exists at the position
+
+        @returns: index of the piece that starts at the position
+        """
+        if pos >= self.length:
+            return len(self.pieces)
+        index = self.findPiece(pos)
+        piece_start = self.starts[index]
+        if piece_start == pos:
+            return index
+        source, offset, length = self.pieces[index]
+        cut = pos - piece_start
+        self.pieces[index:index + 1] = [(source, offset, cut),
+                                        (source, offset + cut, length - cut)]
+        self.starts[index + 1:index + 1] = [pos]
+        return index + 1
+
+    def replace(self, start, end, bytes):
+        """Replace the bytes from start to end-1 with the new bytes
+
+        @returns: the bytes that were replaced
+        """
+        end = min(end, self.length)
+        start = min(start, end)
+        old = self.get(start, end)
+        first = self.split(start)
+        last = self.split(end)
+        if bytes:
+            new = [(bytes, 0, len(bytes))]
+        else:
+            new = []
+        self.pieces[first:last] = new
+        self.calcStarts()
+        return old
+
+    def iterPieces(self):
+        """Iterate over the pieces in document order
+
+        @returns: generator that yields tuples of the document position and
+        the piece
+        """
+        for i, piece in enumerate(self.pieces):
+            yield self.starts[i], piece
+
+    def isOriginalInPlace(self):
+        """Return True if all the pieces of the original data are at the
+        same position in the document as they are in the original.
+
+        If true, the document can be saved by overwriting only the inserted
+        pieces.
+        """
+        for pos, (source, offset, length) in self.iterPieces():
+            if source is self.original and pos != offset:
+                return False
+        return True
+
+    def iterChangedRanges(self):
+        """Iterate over the inserted pieces
+
+        @returns: generator that yields tuples of the document position and
+        the inserted bytes
+        """
+        for pos, (source, offset, length) in self.iterPieces():
+            if source is not self.original:
+                yield pos, source[offset:offset + length]
+
+    def iterBlocks(self, block_size=1024*1024):
+        """Iterate over the entire document in blocks no larger than the
+        block size"""
+        for pos, (source, offset, length) in self.iterPieces():
+            end = offset + length
+            while offset < end:
+                size = min(block_size, end - offset)
+                yield source[offset:offset + size]
+                offset += size
+
+
+class PieceTableEdit(UndoableItem):
+    """Undo information for a single replacement in the L{PieceTable}"""
+    def __init__(self, start, old, new):
+        self.start = start
+        self.old = old
+        self.new = new
+
+    def undo(self, stc):
+        stc.table.replace(self.start, self.start + len(self.new), self.old)
+        stc.notifyChange(self.start, len(self.new), len(self.old), self.old)
+
+    def redo(self, stc):
+        stc.table.replace(self.start, self.start + len(self.old), self.new)
+        stc.notifyChange(self.start, len(self.old), len(self.new), self.new)
+
+
+class PieceTableModifiedEvent(object):
+    """Description of a replacement in the L{PieceTable} passed to the
+    modify callbacks in place of the wx.stc.StyledTextEvent that a real STC
+    would send.
+    
+    A replacement is reported as both a deletion and an insertion.
+    """
+    def __init__(self, pos, deleted, inserted, text):
+        self.pos = pos
+        self.deleted = deleted
+        self.inserted = inserted
+        self.text = text
+
+    def GetModificationType(self):
+        mod = 0
+        if self.deleted:
+            mod |= wx.stc.STC_MOD_DELETETEXT
+        if self.inserted:
+            mod |= wx.stc.STC_MOD_INSERTTEXT
+        return mod
+
+    def GetPosition(self):
+        return self.pos
+
+    def GetLinesAdded(self):
+        return 0
+
+    def GetLength(self):
+        return self.inserted
+
+    def GetText(self):
+        return self.text
+
+
+class MMapSTC(UndoMixin, NonResidentSTC, debugmixin):
+    """Binary file storage using a memory mapped file and a piece table.
+
+    Implements the L{STCBinaryMixin} interface for the hex editor.  Files
+    that aren't on the local filesystem (or can't be memory mapped) are read
+    into memory and use the same piece table.
+    """
+    #: Number of bytes written at once when saving the whole file
+    block_size = 1024 * 1024
+
+    def __init__(self, parent=None, copy=None):
+        NonResidentSTC.__init__(self, parent, copy)
+        UndoMixin.__init__(self)
+        self.url = None
+        self.mmap = None
+        self.table = PieceTable("")
+        self.change_callback = None
+        self.modified_callbacks = []
+
+    def open(self, buffer, message=None):
+        self.url = buffer.url
+        self.table = PieceTable(self.getOriginal(buffer))
+
+    def getLocalPath(self):
+        if self.url is not None and self.url.scheme == "file":
+            return unicode(self.url.path)
+        return None
+
+    def getOriginal(self, buffer=None):
+        """Get the original contents of the file, using a memory map if
+        possible"""
+        self.closeMMap()
+        path = self.getLocalPath()
+        if path is not None:
+            try:
+                fh = open(path, "rb")
+                try:
+                    self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                finally:
+                    fh.close()
+                return self.mmap
+            except (IOError, OSError, ValueError, EnvironmentError), e:
+                # Empty files can't be mapped, and very large files can
+                # fail on 32 bit systems
+                self.dprint("Can't mmap %s: %s" % (path, e))
+                self.mmap = None
+        if buffer is not None:
+            fh = buffer.getBufferedReader()
+        elif vfs.exists(self.url):
+            fh = vfs.open(self.url)
+        else:
+            fh = None
+        if fh:
+            return fh.read()
+        return ""
+
+    def closeMMap(self):
+        """Close the memory map.
+        
+        The piece table still refers to the closed map, so it must be
+        replaced by L{reload} or L{restoreTable} before it is used again.
+        """
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def reload(self):
+        """Reread the file after a save so the piece table refers to the
+        new contents"""
+        old = len(self.table)
+        self.table = PieceTable(self.getOriginal())
+        # The text isn't included because the whole document was replaced
+        self.notifyChange(0, old, len(self.table))
+
+    def restoreTable(self, table):
+        """Restore the piece table after a failed save.
+        
+        If the memory map of the original data was closed by the save, the
+        file is mapped again and the pieces of the original data are
+        pointed to the new map.  The save never overwrites the parts of the
+        file that are used by the pieces of the original data, so the
+        document is unchanged.
+        """
+        if self.mmap is None and isinstance(table.original, mmap.mmap):
+            original = self.getOriginal()
+            pieces = []
+            for source, offset, length in table.pieces:
+                if source is table.original:
+                    source = original
+                pieces.append((source, offset, length))
+            table.original = original
+            table.pieces = pieces
+        self.table = table
+
+    def revertEncoding(self, buffer, url=None, message=None, encoding=None, allow_undo=False):
+        self.EmptyUndoBuffer()
+        self.reload()
+
+    def Destroy(self):
+        self.closeMMap()
+
+    def GetLength(self):
+        return len(self.table)
+
+    GetTextLength = GetLength
+
+    def CanSave(self):
+        return True
+
+    def GetBinaryData(self, start=0, end=-1):
+        if end == -1:
+            end = len(self.table)
+        return self.table.get(start, end)
+
+    def SetBinaryData(self, start, end, bytes):
+        old = self.table.replace(start, end, bytes)
+        self.undoMixinSaveUndoableItem(PieceTableEdit(start, old, bytes))
+        self.notifyChange(start, len(old), len(bytes), bytes)
+
+    def addDocumentChangeEvent(self, callback):
+        self.change_callback = callback
+
+    def removeDocumentChangeEvent(self):
+        self.change_callback = None
+
+    def addModifyCallback(self, func):
+        self.modified_callbacks.append(func)
+
+    def removeModifyCallback(self, func):
+        if func in self.modified_callbacks:
+            self.modified_callbacks.remove(func)
+
+    def notifyChange(self, pos, deleted, inserted, text=""):
+        """Notify the listeners that bytes at the position have been
+        replaced
+        
+        @param pos: position of the replacement
+        
+        @param deleted: number of bytes removed
+        
+        @param inserted: number of bytes inserted
+        
+        @param text: the inserted bytes, if available
+        """
+        if self.modified_callbacks:
+            evt = PieceTableModifiedEvent(pos, deleted, inserted, text)
+            for func in self.modified_callbacks:
+                func(evt)
+        if self.change_callback is not None:
+            self.change_callback(None)
+
+    def openFileForWriting(self, url):
+        if url == self.url and self.getLocalPath() is not None:
+            # Saving to the mapped file is handled in writeTo
+            return None
+        return vfs.open_write(url)
+
+    def writeTo(self, fh, url):
+        if fh is None:
+            self.saveInPlace()
+        else:
+            for bytes in self.table.iterBlocks(self.block_size):
+                fh.write(bytes)
+
+    def closeFileAfterWriting(self, fh):
+        if fh is not None:
+            fh.close()
+
+    def saveInPlace(self):
+        """Save to the mapped file
+
+        If none of the original data has moved, only the inserted pieces
+        are written into the existing file.  Otherwise, the file is written
+        to a temporary file in the same directory that replaces the
+        original.
+        """
+        path = self.getLocalPath()
+        table = self.table
+        try:
+            if table.isOriginalInPlace():
+                self.writeChangedRanges(path, table)
+            else:
+                self.replaceFile(path, table)
+        except:
+            self.restoreTable(table)
+            raise
+        self.reload()
+
+    def writeChangedRanges(self, path, table):
+        """Overwrite only the inserted pieces in the file"""
+        changes = list(table.iterChangedRanges())
+        length = len(table)
+        # The map must be closed before the file can be modified on some
+        # platforms
+        self.closeMMap()
+        fh = open(path, "r+b")
+        try:
+            for pos, bytes in changes:
+                fh.seek(pos)
+                fh.write(bytes)
+            fh.truncate(length)
+        finally:
+            fh.close()
+
+    def replaceFile(self, path, table):
+        """Write the document to a temporary file that replaces the file"""
+        dirname, basename = os.path.split(path)
+        fd, temp = tempfile.mkstemp(prefix=basename, dir=dirname)
+        try:
+            fh = os.fdopen(fd, "wb")
+            try:
+                for bytes in table.iterBlocks(self.block_size):
+                    fh.write(bytes)
+            finally:
+                fh.close()
+            shutil.copymode(path, temp)
+            self.closeMMap()
+            if os.name == "nt":
+                # Windows can't rename over an existing file, so the
+                # original is moved out of the way and put back if the
+                # rename fails
+                backup = temp + ".orig"
+                os.rename(path, backup)
+                try:
+                    os.rename(temp, path)
+                except:
+                    os.rename(backup, path)
+                    raise
+                os.remove(backup)
+            else:
+                os.rename(temp, path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
@@ -50,6 +50,8 @@ class CodeExplorerMinorMode(MinorMode, wx.TreeCtrl):
         MinorMode.__init__(self, parent, **kwargs)
         self.root = self.AddRoot(self.mode.getTabName())
         self.hierarchy = None
+        self.fold_version = None
+        self.items = None
         self.Bind(wx.EVT_TREE_ITEM_ACTIVATED, self.OnActivate)
         self.Bind(wx.EVT_TREE_ITEM_EXPANDED, self.OnExpand)
         self.Bind(wx.EVT_TREE_ITEM_COLLAPSED, self.OnCollapse)
@@ -82,7 +84,15 @@ class CodeExplorerMinorMode(MinorMode, wx.TreeCtrl):
         """Update tree with the source code of the editor"""
         hierarchy = self.mode.getFoldHierarchy()
         #dprint(hierarchy)
+        if hasattr(self.mode, 'getFoldHierarchyChanges'):
+            # Major modes that update the hierarchy in place report the nodes
+            # that have changed so only those parts of the tree are patched
+            self.fold_version, changed = self.mode.getFoldHierarchyChanges(self.fold_version)
+        else:
+            changed = []
         if hierarchy != self.hierarchy:
+            changed = None
+        if changed is None or changed:
             self.hierarchy = hierarchy
             
             self.Freeze()
@@ -90,7 +100,11 @@ class CodeExplorerMinorMode(MinorMode, wx.TreeCtrl):
             self.item_before = None
             top_item = self.GetFirstVisibleItem()
             #print("Top: %s" % self.GetItemText(top_item))
-            self.replaceChildren(self.root,self.hierarchy)
+            if changed is None:
+                self.items = None
+                self.replaceChildren(self.root,self.hierarchy)
+            else:
+                self.patchChanged(changed)
             self.highlightCurrentItem(self.root)
             if self.has_root and not self.IsExpanded(self.root):
                 self.Expand(self.root)
@@ -105,6 +119,115 @@ class CodeExplorerMinorMode(MinorMode, wx.TreeCtrl):
         if evt:
             evt.Skip()
     
+    def getItemMap(self):
+        """Get the map of the tree items, creating it from the tree if
+        necessary.
+        
+        The map is keyed on the id of each displayed node (and the root of
+        the hierarchy), and each value is a tuple of the node, its tree item,
+        and the list of (node, tree item) tuples of its displayed children.
+        """
+        if self.items is None:
+            self.items = {}
+            self.mapChildren(self.root, self.hierarchy)
+        return self.items
+    
+    def mapChildren(self, wxParent, nodeParent):
+        children = []
+        wxItem, cookie = self.GetFirstChild(wxParent)
+        while wxItem:
+            nodeItem = self.GetPyData(wxItem)
+            children.append((nodeItem, wxItem))
+            self.mapChildren(wxItem, nodeItem)
+            wxItem, cookie = self.GetNextChild(wxParent, cookie)
+        self.items[id(nodeParent)] = (nodeParent, wxParent, children)
+    
+    def unmapChildren(self, nodeParent):
+        entry = self.items.pop(id(nodeParent), None)
+        if entry is not None:
+            for nodeItem, wxItem in entry[2]:
+                self.unmapChildren(nodeItem)
+    
+    def getShownChildren(self, nodeParent):
+        """Get the list of child nodes that are displayed under the node,
+        replacing hidden nodes with their children.
+        """
+        shown = []
+        for nodeItem in nodeParent.children:
+            if nodeItem.show:
+                shown.append(nodeItem)
+            else:
+                shown.extend(self.getShownChildren(nodeItem))
+        return shown
+    
+    def getShownParent(self, nodeItem):
+        """Get the depth and the node that displays the node's children"""
+        parent = nodeItem
+        while parent is not self.hierarchy and not parent.show:
+            parent = parent.parent
+        depth = 0
+        node = parent
+        while node is not self.hierarchy and node is not None:
+            node = node.parent
+            depth += 1
+        return depth, parent
+    
+    def patchChanged(self, changed):
+        """Update the parts of the tree whose nodes have changed children
+        
+        @param changed: list of nodes in the hierarchy whose children have
+        been changed
+        """
+        items = self.getItemMap()
+        parents = {}
+        for nodeItem in changed:
+            depth, parent = self.getShownParent(nodeItem)
+            parents[id(parent)] = (depth, parent)
+        # Patch from the top down, because patching a node may remove the
+        # entries of its descendants from the map
+        for depth, parent in sorted(parents.values()):
+            entry = items.get(id(parent))
+            if entry is not None and entry[0] is parent:
+                self.patchChildren(entry)
+    
+    def patchChildren(self, entry):
+        """Replace the tree items of the changed children of a node, keeping
+        the unchanged items at the beginning and end of the list.
+        """
+        nodeParent, wxParent, old = entry
+        new = self.getShownChildren(nodeParent)
+        count = min(len(old), len(new))
+        first = 0
+        while first < count and old[first][0] is new[first]:
+            first += 1
+        last = 0
+        while last < count - first and old[-1 - last][0] is new[-1 - last]:
+            last += 1
+        
+        for nodeItem, wxItem in old[first:len(old) - last]:
+            self.unmapChildren(nodeItem)
+            self.Delete(wxItem)
+        if first > 0:
+            previous = old[first - 1][1]
+        else:
+            previous = None
+        added = []
+        for nodeItem in new[first:len(new) - last]:
+            if previous is None:
+                wxItem = self.PrependItem(wxParent, nodeItem.text.strip())
+            else:
+                wxItem = self.InsertItem(wxParent, previous, nodeItem.text.strip())
+            self.SetPyData(wxItem, nodeItem)
+            self.appendChildren(wxItem, nodeItem)
+            self.mapChildren(wxItem, nodeItem)
+            if nodeItem.expanded:
+                self.Expand(wxItem)
+            else:
+                self.Collapse(wxItem)
+            added.append((nodeItem, wxItem))
+            previous = wxItem
+        old[first:len(old) - last] = added
+    
     def appendChildren(self, wxParent, nodeParent):
         """Recursive capable function to add items from the fold explorer
         hierarchy to the tree
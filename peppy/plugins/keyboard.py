@@ -411,6 +411,7 @@ class KeybindingMode(ListMode):
         dprint(self.buffer)
     
     def getActiveModesAndNames(self):
+        MajorModeMatcherDriver.loadAllDeferredModes()
         modes = []
         names = []
         for mode in MajorModeMatcherDriver.iterActiveModes():
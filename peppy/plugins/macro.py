@@ -1158,9 +1158,12 @@ class MacroListSidebar(MacroTreeCtrl, Sidebar):
         # Put the major mode first
         keywords.append(mode_classes.pop(0).keyword)
         
+        # Modes of plugins that haven't been loaded yet can still have macros
+        mode_classes.extend(MajorModeMatcherDriver.getDeferredModes())
         mode_classes.sort(cmp=lambda a,b: cmp(a.keyword, b.keyword))
         for cls in mode_classes:
-            keywords.append(cls.keyword)
+            if cls.keyword not in keywords:
+                keywords.append(cls.keyword)
         return keywords
     
     def getPopupActions(self, evt, x, y):
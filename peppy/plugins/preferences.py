@@ -30,6 +30,9 @@ class Preferences(SelectAction):
 
     @classmethod
     def showDialog(self, msg=None):
+        # The preferences of all the plugins are shown, so any plugins that
+        # haven't been loaded yet are needed now
+        wx.GetApp().plugin_manager.loadDeferredPlugins()
         frame = wx.GetApp().GetTopWindow()
         mode = frame.getActiveMajorMode()
         dlg = PeppyPrefDialog(frame, mode)
@@ -6,7 +6,7 @@ Major mode to search for pattern matches from files in a directory or in
 a project.
 """
 
-import os, time, fnmatch, heapq, re
+import os, time, fnmatch, heapq, re, cPickle
 
 import wx
 from wx.lib.pubsub import Publisher
@@ -20,8 +20,15 @@ from peppy.actions import *
 from peppy.yapsy.plugins import *
 from peppy.lib.controls import DirBrowseButton2
 from peppy.lib.threadutils import *
+from peppy.searchworker import searchLocalFiles
+from peppy.project.project_plugin import ProjectPlugin
 from peppy.third_party.WidgetStack import WidgetStack
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 
 class SearchInFiles(SelectAction):
     """Display and edit key bindings."""
@@ -66,7 +73,23 @@ class StopSearch(SearchModeActionMixin, SelectAction):
         self.mode.OnStopSearch(None)
 
 
-class DirectorySearchMethod(AbstractSearchMethod):
+class LocalFileSearchMixin(object):
+    """Mixin for search methods whose items are filenames on the local
+    filesystem.
+
+    These items can be searched by worker processes using
+    L{searchLocalFiles}.
+    """
+    uses_local_files = True
+    
+    def getItemSize(self, item):
+        try:
+            return os.path.getsize(item)
+        except OSError:
+            return 0
+
+
+class DirectorySearchMethod(LocalFileSearchMixin, AbstractSearchMethod):
     def __init__(self, mode):
         AbstractSearchMethod.__init__(self, mode)
         self.pathname = ""
@@ -102,11 +125,13 @@ class DirectorySearchMethod(AbstractSearchMethod):
         return self.iterFilesInDir(self.pathname, ignorer)
 
 
-class ProjectSearchMethod(AbstractSearchMethod):
+class ProjectSearchMethod(LocalFileSearchMixin, AbstractSearchMethod):
     def __init__(self, mode):
         AbstractSearchMethod.__init__(self, mode)
         self.projects = []
         self.current_project = None
+        self.search_index = None
+        self.literal_text = None
     
     def getName(self):
         return "Project"
@@ -156,10 +181,26 @@ class ProjectSearchMethod(AbstractSearchMethod):
             prefix += "/"
         return prefix
     
+    def setLiteralText(self, text):
+        """Set the literal text that every match must contain, used to
+        narrow the files to search with the project's trigram index.
+        
+        @param text: search string, or None if the search type doesn't
+        require a literal string
+        """
+        self.literal_text = text
+        self.search_index = None
+        if text:
+            info = ProjectPlugin.loadProjectInfoFromKnownProject(self.current_project)
+            self.search_index = info.getSearchIndex()
+    
     def iterFiles(self, ignorer):
         url = self.current_project.getTopURL()
         dir = unicode(url.path)
-        return self.iterFilesInDir(dir, ignorer)
+        files = self.iterFilesInDir(dir, ignorer)
+        if self.search_index is not None:
+            return self.search_index.iterCandidates(files, self.literal_text)
+        return files
 
 
 class OpenDocsSearchMethod(AbstractSearchMethod):
@@ -213,6 +254,12 @@ class OpenDocsSearchMethod(AbstractSearchMethod):
             return matcher.iterMatches(url, fh)
         else:
             return iter([])
+    
+    def getItemSize(self, item):
+        url, buf = item
+        if hasattr(buf.stc, "GetLength"):
+            return buf.stc.GetLength()
+        return 0
 
     def iterFiles(self, ignorer):
         """Iterate through open files, returning the sort item that will
@@ -245,6 +292,12 @@ class TextSearchType(AbstractSearchType):
     def setUIDefaults(self):
         pass
 
+    def getLiteralText(self, search_text):
+        """Get the literal string that every match must contain"""
+        if self.regex.IsChecked():
+            return None
+        return search_text
+
     def getStringMatcher(self, search_text):
         if self.regex.IsChecked():
             return RegexStringMatcher(search_text, self.case.IsChecked())
@@ -365,6 +418,9 @@ class SearchSTC(UndoMixin, NonResidentSTC):
     def addSearchResult(self, result):
         self.results.append(result)
     
+    def addSearchResults(self, results):
+        self.results.extend(results)
+    
     def addNewResultsToGUI(self, mode):
         current = mode.list.GetItemCount()
         future = len(self.results)
@@ -375,9 +431,34 @@ class SearchSTC(UndoMixin, NonResidentSTC):
 
 
 class SearchStatus(ThreadStatus):
+    """Report the progress of the L{SearchThread} to the GUI, including the
+    search rate in files and bytes per second.
+    """
     def __init__(self, mode):
         ThreadStatus.__init__(self)
         self.mode = mode
+        self.files = 0
+        self.bytes = 0
+        self.start_time = time.time()
+    
+    def addSearched(self, files, bytes):
+        """Add to the count of files and bytes searched; called from the
+        search thread.
+        """
+        self.files += files
+        self.bytes += bytes
+    
+    def getRates(self):
+        """Get the search rate
+        
+        @returns: tuple of files per second and bytes per second
+        """
+        elapsed = max(time.time() - self.start_time, 0.001)
+        return self.files / elapsed, self.bytes / elapsed
+    
+    def getRateText(self):
+        files, bytes = self.getRates()
+        return "%.1f files/s, %.2f MB/s" % (files, bytes / (1024.0 * 1024.0))
     
     def updateStatusGUI(self, perc, text=None):
         self.mode.buffer.stc.addNewResultsToGUI(self.mode)
@@ -389,6 +470,7 @@ class SearchStatus(ThreadStatus):
         self.cleanup()
         
     def reportFailureGUI(self, text):
+        self.mode.buffer.stc.addNewResultsToGUI(self.mode)
         self.mode.status_info.stopProgress(text)
         self.cleanup()
     
@@ -397,46 +479,139 @@ class SearchStatus(ThreadStatus):
         self.mode.list.ResizeColumns()
 
 
-class SearchThread(threading.Thread):
-    def __init__(self, stc, matcher, ignorer, updater):
+class SearchThread(threading.Thread, debugmixin):
+    """Search for matches in the files supplied by the current search method.
+    
+    The search method's list of files is produced lazily and grouped into
+    chunks.  If the search method's items are local files and the matcher can
+    be pickled, the chunks are searched by a pool of worker processes while
+    the directories are still being walked; otherwise they are searched in
+    this thread.  Results are added to the STC in batches in the order the
+    files were produced, and the GUI is refreshed as soon as the first
+    results arrive and then at most once per interval.
+    """
+    def __init__(self, stc, matcher, ignorer, updater, processes=0, chunk_files=32):
         threading.Thread.__init__(self)
         self.stc = stc
         self.matcher = matcher
         self.ignorer = ignorer
         self.updater = updater
+        self.processes = processes
+        self.chunk_files = max(1, chunk_files)
         self.output = None
         self.interval = 0.5
         self.matches = 0
+        self.found = 0
         self.init_time = time.time()
         self.stop_request = False
     
+    def getNumProcesses(self):
+        if multiprocessing is None:
+            return 1
+        if self.processes < 1:
+            try:
+                return multiprocessing.cpu_count()
+            except NotImplementedError:
+                return 1
+        return self.processes
+    
+    def isParallel(self, method):
+        """Worker processes can only be used when the search method returns
+        local filenames and both the worker function and the matcher can be
+        sent to the workers.
+        """
+        if self.getNumProcesses() < 2 or not getattr(method, 'uses_local_files', False):
+            return False
+        for obj in [searchLocalFiles, self.matcher]:
+            try:
+                cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+            except Exception, e:
+                self.dprint("%s can't be used in worker processes: %s" % (obj, e))
+                return False
+        return True
+    
+    def iterChunks(self, method):
+        """Walk the search method's files, producing lists of at most
+        chunk_files items.
+        
+        When using the process pool, this runs in the pool's task handling
+        thread so the walk overlaps the searching.
+        """
+        chunk = []
+        for item in method.iterFiles(self.ignorer):
+            if self.stop_request:
+                return
+            self.found += 1
+            chunk.append(item)
+            if len(chunk) >= self.chunk_files:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    
+    def iterSerialResults(self, method):
+        for chunk in self.iterChunks(method):
+            output = []
+            for item in chunk:
+                results = list(method.getMatchGenerator(item, self.matcher))
+                if hasattr(method, 'getItemSize'):
+                    size = method.getItemSize(item)
+                else:
+                    size = 0
+                output.append((item, results, size))
+            yield output
+    
+    def iterResults(self, method):
+        """Iterate over the search results of each chunk of files, in the
+        order that the chunks were produced.
+        
+        @returns: generator that yields lists of tuples of the item, the
+        list of results for that item, and the number of bytes searched
+        """
+        if self.isParallel(method):
+            try:
+                pool = multiprocessing.Pool(self.getNumProcesses())
+            except (OSError, ImportError), e:
+                self.dprint("Can't create process pool: %s" % e)
+                pool = None
+            if pool is not None:
+                args = ((self.matcher, chunk) for chunk in self.iterChunks(method))
+                try:
+                    for output in pool.imap(searchLocalFiles, args):
+                        yield output
+                finally:
+                    pool.terminate()
+                return
+        for output in self.iterSerialResults(method):
+            yield output
+    
     def run(self):
         try:
             method = self.stc.search_method.option
-            sort_order = []
-            for item in method.iterFiles(self.ignorer):
-                sort_order.append(item)
-                if self.stop_request:
-                    self.updater.reportFailure("Aborted while determining file sort order")
-                    return
-            sort_order.sort()
-            
-            num_urls = len(sort_order)
-            start = time.time()
-            for item in sort_order:
-                self.matches += 1
-                gen = method.getMatchGenerator(item, self.matcher)
-                for result in gen:
-#                    dprint(result)
-                    self.stc.addSearchResult(result)
-#                time.sleep(0.1)
+            last = time.time()
+            shown = False
+            for output in self.iterResults(method):
+                batch = []
+                bytes = 0
+                for item, results, size in output:
+                    batch.extend(results)
+                    bytes += size
+                self.matches += len(output)
+                self.updater.addSearched(len(output), bytes)
+                if batch:
+                    self.stc.addSearchResults(batch)
                 if self.stop_request:
                     break
                 now = time.time()
-                if now - start > self.interval:
-                    self.updater.updateStatus(self.matches, num_urls)
-                    start = now
-            self.showStats()
+                if now - last > self.interval or (batch and not shown):
+                    if batch:
+                        shown = True
+                    self.updater.updateStatus(self.matches, max(self.found, self.matches), "Searched %d of %d files (%s)" % (self.matches, self.found, self.updater.getRateText()))
+                    last = now
+            if self.stop_request:
+                self.updater.reportFailure("Aborted after searching %d files (%s)" % (self.matches, self.updater.getRateText()))
+            else:
+                self.showStats()
         except Exception, e:
             import traceback
             error = traceback.format_exc()
@@ -444,7 +619,7 @@ class SearchThread(threading.Thread):
             self.updater.reportFailure(str(e))
     
     def showStats(self):
-        self.updater.reportSuccess("Finished searching %d files in %.2f seconds" % (self.matches, time.time() - self.init_time))
+        self.updater.reportSuccess("Finished searching %d files in %.2f seconds (%s)" % (self.matches, time.time() - self.init_time, self.updater.getRateText()))
     
     def stopSearch(self):
         self.stop_request = True
@@ -463,6 +638,11 @@ class SearchMode(ListMode):
     
     stc_class = SearchSTC
 
+    default_classprefs = (
+        IntParam('search_processes', 0, 'Number of worker processes used to search local files.  0 uses one process per CPU, and 1 searches without using worker processes.'),
+        IntParam('search_chunk_files', 32, 'Number of files sent to a worker process at one time'),
+        )
+
     @classmethod
     def verifyProtocol(cls, url):
         # Use the verifyProtocol to hijack the loading process and
@@ -605,11 +785,17 @@ class SearchMode(ListMode):
                 matcher = self.buffer.stc.search_type.option.getStringMatcher(self.search_text.GetValue())
                 ignorer = WildcardListIgnorer(self.ignore_filenames.GetValue())
                 if matcher.isValid():
+                    if hasattr(method, 'setLiteralText'):
+                        search_type = self.buffer.stc.search_type.option
+                        if hasattr(search_type, 'getLiteralText'):
+                            method.setLiteralText(search_type.getLiteralText(self.search_text.GetValue()))
+                        else:
+                            method.setLiteralText(None)
                     self.buffer.stc.clearSearchResults()
                     self.buffer.stc.setPrefix(method.getPrefix())
                     self.resetList()
                     self.status_info.startProgress("Searching...")
-                    self.thread = SearchThread(self.buffer.stc, matcher, ignorer, status)
+                    self.thread = SearchThread(self.buffer.stc, matcher, ignorer, status, self.classprefs.search_processes, self.classprefs.search_chunk_files)
                     self.thread.start()
                 else:
                     if hasattr(matcher, "getErrorString"):
@@ -60,19 +60,26 @@ class Complete_or_indent(SelectAction):
         return not self.mode.buffer.busy
     
     def matches(self, word, range):
+        current = self.word(range)
         if TabCompletionPlugin.classprefs.allOpenDocs:
             #search after keyword in all open documents
             #TODO: make allOpenDocs a settings alternative
             #TODO: only add textbuffers to bufferlist 
-            searchtext = ""
-            bufferlist = BufferList.getBuffers()
-            for i in bufferlist:
-                if not i.permanent:
-                    searchtext = searchtext + i.stc.GetText() + "\n"
+            buffers = None
         else:
-            searchtext = self.mode.GetText()
-        allmatches = re.findall("\\b" + re.escape(word) + "\\w+", searchtext )
-        allmatches.append(self.word(range))
+            buffers = [self.mode.buffer]
+        if re.match(r"\w+\Z", current):
+            index = BufferList.getWordIndex(buffers)
+            allmatches = index.findPrefix(current, buffers)
+        else:
+            # Words containing separators like "." or "::" aren't in the
+            # word index, so the text has to be searched
+            if buffers is None:
+                buffers = [i for i in BufferList.getBuffers() if not i.permanent]
+            allmatches = []
+            for i in buffers:
+                allmatches.extend(re.findall("\\b" + re.escape(current) + "\\w+", i.stc.GetText()))
+        allmatches.append(current)
         allmatches = set(allmatches)
         allmatches = list(allmatches)
         allmatches.sort()
@@ -12,6 +12,7 @@ from peppy.sidebar import *
 from peppy.lib.userparams import *
 from peppy.lib.pluginmanager import *
 from peppy.lib.processmanager import *
+from peppy.project.trigram import TrigramIndex
 
 
 
@@ -203,6 +204,7 @@ class ProjectInfo(CTAGS):
         StrParam('build_command', '', 'shell command to build project, relative to working directory', fullwidth=True),
         DirParam('run_dir', '', 'working directory in which to execute the project', fullwidth=True),
         StrParam('run_command', '', 'shell command to execute project, absolute path needed or will search current PATH environment variable', fullwidth=True),
+        BoolParam('use_search_index', False, 'Keep a trigram index of the project files in the project settings directory so that searches in the project only read files that can contain the search text'),
         )
     
     def __init__(self, url):
@@ -212,6 +214,7 @@ class ProjectInfo(CTAGS):
         self.loadPrefs()
         self.loadTags()
         self.process = None
+        self.search_index = None
     
     def __str__(self):
         return "ProjectInfo: settings=%s top=%s" % (self.project_settings_dir, self.project_top_dir)
@@ -235,6 +238,20 @@ class ProjectInfo(CTAGS):
     def getTopRelativeURL(self, name):
         return self.project_top_dir.resolve2(name)
     
+    def getSearchIndex(self):
+        """Get the trigram index of the project's files
+        
+        @returns: L{TrigramIndex} instance, or None if the index isn't enabled
+        or the project isn't on the local filesystem
+        """
+        if not self.use_search_index or self.project_settings_dir.scheme != "file":
+            return None
+        if self.search_index is None:
+            url = self.getSettingsRelativeURL(ProjectPlugin.classprefs.search_index_file_name)
+            self.search_index = TrigramIndex(unicode(url.path))
+            self.search_index.load()
+        return self.search_index
+    
     def loadPrefs(self):
         self.project_config = self.project_settings_dir.resolve2(ProjectPlugin.classprefs.project_file)
         try:
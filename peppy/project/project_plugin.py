@@ -49,6 +49,7 @@ class ProjectPlugin(IPeppyPlugin):
         PathParam('ctags_command', 'ctags', 'Path to ctags command', fullwidth=True),
         StrParam('ctags_tag_file_name', 'tags', 'name of the generated tags file', fullwidth=True),
         StrParam('ctags_args', '-R -n', 'extra arguments for the ctags command', fullwidth=True),
+        StrParam('search_index_file_name', 'search-index', 'name of the trigram index file used when searching in the project', fullwidth=True),
         )
     
     # mapping of projects we know about but haven't loaded ProjectInfo objects
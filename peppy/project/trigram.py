@@ -0,0 +1,244 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Trigram index of the files in a project
+
+The index maps every three byte sequence (trigram) of the lower-cased
+contents of each file to the set of files that contain it.  A search for a
+literal string only needs to read the files that contain all of the
+trigrams of the string, so repeat searches of a large project only read the
+files that can possibly match.
+
+The index is updated incrementally: files are only reread when their
+modification time or size changes.  Rather than removing the entries of a
+changed file from every posting list, the file is given a new id and the
+old id is dropped the next time the index is compacted.
+"""
+
+import os
+import cPickle as pickle
+from array import array
+
+from peppy.debug import *
+
+
+def getTrigrams(text):
+    """Get the set of trigrams of the text, ignoring case"""
+    text = text.lower()
+    return set([text[i:i + 3] for i in xrange(len(text) - 2)])
+
+
+def getSearchTrigrams(text):
+    """Get the set of trigrams that must be present in any file that
+    contains the search text.
+
+    Only trigrams made of ascii characters are used, because the encoding of
+    the files isn't known.
+
+    @param text: unicode or str search string
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return set([t for t in getTrigrams(text) if max(t) < '\x80'])
+
+
+class TrigramIndex(debugmixin):
+    """Persistent trigram index of files on the local filesystem.
+
+    Files larger than max_file_size or containing NUL bytes aren't indexed,
+    and are always returned as candidates.
+    """
+    #: Version of the pickled index; indexes of other versions are discarded
+    version = 1
+
+    #: Largest file that will be indexed
+    max_file_size = 4 * 1024 * 1024
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.clear()
+
+    def clear(self):
+        # maps the filename to a tuple of (mtime, size, id), where the id is
+        # None if the file isn't indexed
+        self.files = {}
+        # maps the trigram to the array of file ids containing it
+        self.postings = {}
+        self.next_id = 0
+        self.dead = 0
+        self.changed = False
+
+    def __len__(self):
+        return len(self.files)
+
+    def load(self):
+        """Load the index from its file, starting with an empty index if the
+        file doesn't exist or can't be read.
+        """
+        self.clear()
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            fh = open(self.filename, 'rb')
+            try:
+                data = pickle.load(fh)
+            finally:
+                fh.close()
+            if data.get('version') != self.version:
+                self.dprint("Discarding version %s index %s" % (data.get('version'), self.filename))
+                return
+            self.files = data['files']
+            self.next_id = data['next_id']
+            self.dead = data['dead']
+            for trigram, packed in data['postings'].iteritems():
+                ids = array('i')
+                ids.fromstring(packed)
+                self.postings[trigram] = ids
+        except Exception, e:
+            self.dprint("Failed loading index %s: %s" % (self.filename, e))
+            self.clear()
+
+    def save(self):
+        """Save the index if it has changed, compacting it first if more
+        than half of the ids in the posting lists belong to old versions of
+        files.
+        """
+        if not self.filename or not self.changed:
+            return
+        if self.dead > len(self.files):
+            self.compact()
+        data = {
+            'version': self.version,
+            'files': self.files,
+            'next_id': self.next_id,
+            'dead': self.dead,
+            'postings': dict([(t, ids.tostring()) for t, ids in self.postings.iteritems()]),
+            }
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        temp = self.filename + ".tmp"
+        fh = open(temp, 'wb')
+        try:
+            pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fh.close()
+        if os.name == "nt" and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(temp, self.filename)
+        self.changed = False
+
+    def compact(self):
+        """Remove the ids of old versions of files from the posting lists"""
+        live = set([info[2] for info in self.files.itervalues() if info[2] is not None])
+        postings = {}
+        for trigram, ids in self.postings.iteritems():
+            ids = array('i', [i for i in ids if i in live])
+            if ids:
+                postings[trigram] = ids
+        self.postings = postings
+        self.dead = 0
+        self.changed = True
+
+    def removeFile(self, filename):
+        info = self.files.pop(filename, None)
+        if info is not None:
+            if info[2] is not None:
+                self.dead += 1
+            self.changed = True
+
+    def indexFile(self, filename, mtime, size):
+        """Read the file and add its trigrams to the index
+
+        @returns: set of trigrams in the file, or None if the file isn't
+        indexed
+        """
+        self.removeFile(filename)
+        trigrams = None
+        if size <= self.max_file_size:
+            try:
+                fh = open(filename, 'rb')
+                try:
+                    text = fh.read()
+                finally:
+                    fh.close()
+                if '\0' not in text:
+                    trigrams = getTrigrams(text)
+            except (IOError, OSError), e:
+                self.dprint("Can't index %s: %s" % (filename, e))
+        if trigrams is None:
+            self.files[filename] = (mtime, size, None)
+        else:
+            id = self.next_id
+            self.next_id += 1
+            for trigram in trigrams:
+                if trigram not in self.postings:
+                    self.postings[trigram] = array('i')
+                self.postings[trigram].append(id)
+            self.files[filename] = (mtime, size, id)
+        self.changed = True
+        return trigrams
+
+    def getCandidateIds(self, trigrams):
+        """Get the set of ids of indexed files that contain all the
+        trigrams"""
+        candidates = None
+        # Start with the rarest trigram to keep the intersections small
+        for ids in sorted([self.postings.get(t, ()) for t in trigrams], key=len):
+            if candidates is None:
+                candidates = set(ids)
+            else:
+                candidates.intersection_update(ids)
+            if not candidates:
+                break
+        return candidates
+
+    def iterCandidates(self, filenames, text):
+        """Filter a list of files, updating the index along the way.
+
+        Unchanged files are checked against the index.  New or modified files
+        are indexed before being checked.  If all the files are processed,
+        files in the index that weren't in the list are removed from it.  The
+        index is saved when the iteration finishes or is abandoned.
+
+        @param filenames: iterable of filenames on the local filesystem
+
+        @param text: search string
+
+        @returns: generator yielding the filenames that may contain the text
+        """
+        trigrams = getSearchTrigrams(text)
+        if trigrams:
+            candidates = self.getCandidateIds(trigrams)
+        else:
+            candidates = None
+        seen = set()
+        complete = False
+        try:
+            for filename in filenames:
+                if self.filename and filename.startswith(self.filename):
+                    # don't search the index itself
+                    continue
+                seen.add(filename)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    self.removeFile(filename)
+                    continue
+                info = self.files.get(filename)
+                if info is None or info[0] != st.st_mtime or info[1] != st.st_size:
+                    found = self.indexFile(filename, st.st_mtime, st.st_size)
+                    if found is None or candidates is None or trigrams.issubset(found):
+                        yield filename
+                else:
+                    id = info[2]
+                    if id is None or candidates is None or id in candidates:
+                        yield filename
+            complete = True
+        finally:
+            if complete:
+                for filename in set(self.files.keys()) - seen:
+                    self.removeFile(filename)
+            try:
+                self.save()
+            except (IOError, OSError), e:
+                self.dprint("Failed saving index %s: %s" % (self.filename, e))
@@ -0,0 +1,39 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Worker functions used by the search in files processes
+
+Functions passed to the multiprocessing pool have to be pickled by name, so
+they must live in a normally imported module.  The plugins are loaded by
+yapsy using execfile, so functions defined in a plugin have no module and
+can't be sent to the worker processes.
+"""
+
+import os
+
+
+def searchLocalFiles(args):
+    """Search a chunk of files on the local filesystem.
+
+    Used by the worker processes of the search in files mode, so the matcher
+    and the results must be picklable.
+
+    @param args: tuple of the string matcher and the list of filenames
+
+    @returns: list of tuples of the filename, the list of results, and the
+    number of bytes searched
+    """
+    matcher, filenames = args
+    output = []
+    for filename in filenames:
+        try:
+            fh = open(filename, "rb")
+        except (IOError, OSError):
+            output.append((filename, [], 0))
+            continue
+        try:
+            size = os.fstat(fh.fileno()).st_size
+            results = list(matcher.iterMatches(filename, fh))
+        finally:
+            fh.close()
+        output.append((filename, results, size))
+    return output
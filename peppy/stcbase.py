@@ -1,6 +1,6 @@
 # peppy Copyright (c) 2006-2010 Rob McMullen
 # Licenced under the GPLv2; see http://peppy.flipturn.org for more info
-import os, re, time, codecs
+import os, re, time, codecs, threading
 
 import wx
 import wx.stc
@@ -16,6 +16,156 @@ from peppy.lib.textutil import *
 from peppy.lib.clipboard import *
 
 
+#: Number of bytes converted at a time between binary data and the styled
+#: text used to store binary data in the STC
+binary_block_size = 1024 * 1024
+
+def toStyledText(bytes, start=0, count=None):
+    """Convert binary data to the styled text format used by the STC.
+    
+    Each byte of the data is followed by a zero style byte.  The
+    interleaving is performed with a strided assignment into a bytearray
+    rather than joining a list of single characters.
+    
+    @param bytes: string of binary data
+    
+    @param start: optional offset into the data
+    
+    @param count: optional number of bytes to convert, or the rest of the
+    data if not specified
+    """
+    if count is None:
+        count = len(bytes) - start
+    styled = bytearray(count * 2)
+    styled[0::2] = buffer(bytes, start, count)
+    return str(styled)
+
+
+class IncrementalLoader(debugmixin):
+    """Decode the chunks of a file into an STC as they are read.
+    
+    The encoding is determined from the header of the file, and after that
+    each chunk is decoded and appended to the STC as soon as it arrives, so
+    the raw bytes of a chunk can be released once it has been added.  All
+    the methods must be called from the GUI thread.
+    
+    When the file is read by a background thread, the reader must acquire
+    the L{pending} semaphore before passing each chunk to the GUI thread, and
+    the GUI thread releases it once the chunk has been added.  This limits
+    the number of raw chunks waiting in the event queue if the GUI thread
+    falls behind the reader.
+    """
+    #: Maximum number of chunks passed to the GUI thread that haven't been
+    #: added to the STC yet
+    max_pending_chunks = 4
+    
+    #: Number of lines that are loaded before the first screen callback is
+    #: called
+    first_screen_lines = 100
+    
+    def __init__(self, stc, encoding=None, collect_undo=False, headersize=1024, first_screen_callback=None):
+        self.stc = stc
+        self.encoding = encoding
+        self.collect_undo = collect_undo
+        self.headersize = headersize
+        self.first_screen_callback = first_screen_callback
+        self.header = []
+        self.count = 0
+        self.started = False
+        self.decoder = None
+        self.pending = threading.Semaphore(self.max_pending_chunks)
+    
+    def start(self):
+        """Choose the encoding from the header and add the header chunks"""
+        refstc = self.stc.refstc
+        if self.encoding:
+            # Normalize the encoding name by running it through the codecs list
+            refstc.encoding = codecs.lookup(self.encoding).name
+        if not refstc.encoding:
+            refstc.encoding, refstc.bom = detectEncoding("".join(self.header)[0:self.headersize])
+        assert self.dprint("found encoding = %s" % refstc.encoding)
+        if refstc.encoding:
+            self.decoder = codecs.getincrementaldecoder(refstc.encoding)()
+        if not self.collect_undo:
+            # The undo history is emptied after the load, so don't make the
+            # STC keep a copy of all the inserted text in the meantime
+            self.stc.SetUndoCollection(False)
+        self.started = True
+        chunks = self.header
+        self.header = None
+        first = True
+        for bytes in chunks:
+            if first and refstc.bom and bytes.startswith(refstc.bom):
+                bytes = bytes[len(refstc.bom):]
+            first = False
+            self.add(bytes)
+    
+    def append(self, bytes):
+        """Add the next chunk of the file"""
+        if not self.started:
+            self.header.append(bytes)
+            self.count += len(bytes)
+            if self.count >= self.headersize:
+                self.start()
+        else:
+            self.add(bytes)
+    
+    def add(self, bytes, final=False):
+        if self.decoder:
+            try:
+                text = self.decoder.decode(bytes, final)
+            except UnicodeDecodeError, e:
+                self.switchToBinary(bytes)
+                return
+            if text:
+                self.stc.AppendText(text)
+                if self.first_screen_callback and self.stc.GetLineCount() > self.first_screen_lines:
+                    self.showFirstScreen()
+        else:
+            self.stc.AddBinaryData(bytes)
+    
+    def showFirstScreen(self):
+        """Pass the first screen of text to the callback; it's only called
+        once, and not at all for binary data or if the file is shorter than
+        a screen.
+        """
+        callback = self.first_screen_callback
+        self.first_screen_callback = None
+        callback(self.stc.GetTextRange(0, self.stc.PositionFromLine(self.first_screen_lines)))
+    
+    def switchToBinary(self, bytes):
+        """Replace the text decoded so far by the binary data it came from.
+        
+        If there's an error in the decoding, the binary bytes are stuffed in
+        the stc instead.  The text added so far is encoded again, which gives
+        back the bytes it was decoded from.
+        """
+        refstc = self.stc.refstc
+        assert self.dprint("bad encoding %s:" % refstc.encoding)
+        raw = self.stc.GetText().encode(refstc.encoding)
+        if refstc.bom:
+            raw = refstc.bom + raw
+        raw += self.decoder.getstate()[0] + bytes
+        refstc.badencoding = refstc.encoding
+        refstc.encoding = None
+        refstc.bom = None
+        self.decoder = None
+        self.first_screen_callback = None
+        self.stc.SetText('')
+        self.stc.AddBinaryData(raw)
+    
+    def finish(self):
+        """Flush the decoder once the whole file has been read"""
+        if not self.started:
+            self.start()
+        try:
+            self.add("", True)
+        finally:
+            if not self.collect_undo:
+                self.stc.SetUndoCollection(True)
+        self.stc.detectLineEndings()
+
+
 class FoldNode:
     def __init__(self,level,start,end,text,parent=None,styles=[]):
         """Folding node as data for tree item."""
@@ -103,6 +253,7 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
                 dprint("copying %s from old stc." % repr(txt))
                 self.AddStyledText(txt)
         self.maybe_undo_eolmode = None
+        self.first_screen_callback = None
 
     def updateSubordinateClasses(self):
         """Update the list of classes viewing this buffer."""
@@ -146,16 +297,24 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
         fh = vfs.open(url)
         if allow_undo:
             self.BeginUndoAction()
-        self.ClearAll()
-        self.readThreaded(fh, buffer, message)
-        self.openSuccess(buffer, encoding=encoding)
-        if allow_undo:
+            self.ClearAll()
+            self.readThreaded(fh, buffer, message, encoding, allow_undo)
+            self.loadFinished()
             self.EndUndoAction()
         else:
+            self.ClearAll()
+            self.readThreaded(fh, buffer, message, encoding)
+            self.openSuccess(buffer)
             self.EmptyUndoBuffer()
 
-    def readThreaded(self, fh, buffer, message=None):
-        self.refstc.tempstore = StringIO()
+    def setFirstScreenCallback(self, callback):
+        self.first_screen_callback = callback
+
+    def readThreaded(self, fh, buffer, message=None, encoding=None, allow_undo=False):
+        # Each chunk is decoded and added to the STC as soon as it is read,
+        # so a copy of the whole file is never needed
+        self.loader = IncrementalLoader(self, encoding, allow_undo, first_screen_callback=self.first_screen_callback)
+        self.first_screen_callback = None
         if fh:
             # if the file exists, read the contents.
             length = vfs.get_size(buffer.url)
@@ -171,25 +330,71 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
             # setting its initial state to be 'modified'
             buffer.setInitialStateIsModified()
     
-    def openSuccess(self, buffer, headersize=1024, encoding=None):
-        bytes = self.tempstore.getvalue()
-        
-        self.resetText(bytes, headersize, encoding)
+    def openSuccess(self, buffer):
+        self.loadFinished()
+    
+    def loadChunk(self, bytes):
+        """Add a chunk of the file to the STC.
         
-        del self.tempstore
+        The STC can only be changed from the GUI thread, so when the file is
+        read by the background loading thread the chunk is passed to the GUI
+        thread, which adds the chunks in the order they were read.  The
+        background thread waits here if the GUI thread hasn't caught up with
+        the chunks already passed to it.
+        """
+        if wx.Thread_IsMain():
+            self.loadChunkGUIThread(bytes)
+        else:
+            loader = self.loader
+            loader.pending.acquire()
+            wx.CallAfter(self.loadPendingChunk, loader, bytes)
+    
+    def loadChunkGUIThread(self, bytes):
+        if not hasattr(self, 'loader'):
+            self.loader = IncrementalLoader(self)
+        self.loader.append(bytes)
+    
+    def loadPendingChunk(self, loader, bytes):
+        """Add a chunk passed from the background thread and allow the
+        background thread to pass another one.
+        """
+        try:
+            loader.append(bytes)
+        finally:
+            loader.pending.release()
+    
+    def loadFinished(self):
+        """Finish adding the file to the STC after all the chunks are read"""
+        if not hasattr(self, 'loader'):
+            self.loader = IncrementalLoader(self)
+        loader = self.loader
+        del self.loader
+        loader.finish()
     
     def resetText(self, bytes, headersize=1024, encoding=None):
-        numbytes = len(bytes)
-        if headersize > numbytes:
-            headersize = numbytes
-        header = bytes[0:headersize]
+        self.resetTextChunks([bytes], headersize, encoding)
+    
+    def resetTextChunks(self, chunks, headersize=1024, encoding=None):
+        """Replace the text with the contents of the list of chunks.
+        
+        The encoding is determined from the header of the first chunks, and
+        then each chunk is decoded and added to the STC in turn.
+        """
+        header = []
+        count = 0
+        for chunk in chunks:
+            if count >= headersize:
+                break
+            header.append(chunk[0:headersize - count])
+            count += len(header[-1])
+        header = "".join(header)
         
         if encoding:
             # Normalize the encoding name by running it through the codecs list
             self.refstc.encoding = codecs.lookup(encoding).name
         if not self.refstc.encoding:
             self.refstc.encoding, self.refstc.bom = detectEncoding(header)
-        self.decodeText(bytes)
+        self.decodeChunks(chunks)
         assert self.dprint("found encoding = %s" % self.refstc.encoding)
         self.detectLineEndings()
     
@@ -220,9 +425,9 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
                     # to the mem: filesystem, but if it does happen to be
                     # unicode, there's no need to convert the data
                     self.refstc.encoding = "utf-8"
-                    self.tempstore.write(unicode.encode('utf-8'))
+                    self.loadChunk(txt.encode('utf-8'))
                 else:
-                    self.tempstore.write(txt)
+                    self.loadChunk(txt)
             else:
                 # stop when we reach the end.  An exception will be
                 # handled outside this class
@@ -235,11 +440,22 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
         comments"), change the text from the binary representation into the
         specified encoding.
         """
+        self.decodeChunks([bytes])
+    
+    #: Number of decoded characters that are collected before adding them to
+    #: the STC
+    load_batch_size = 1024 * 1024
+    
+    def decodeChunks(self, chunks):
+        """Decode the list of chunks and replace the text of the STC.
+        
+        The chunks are decoded incrementally, so the unicode version of the
+        text only exists a batch at a time rather than all at once.
+        """
         if self.refstc.encoding:
             try:
-                unicodestring = encodedBytesToUnicode(bytes, self.refstc.encoding, self.refstc.bom)
-                assert self.dprint("unicodestring(%s) = %s bytes" % (type(unicodestring), len(unicodestring)))
-                self.SetText(unicodestring)
+                self.SetText('')
+                self.appendDecodedChunks(chunks, self.refstc.encoding, self.refstc.bom)
                 return
             except UnicodeDecodeError, e:
                 assert self.dprint("bad encoding %s:" % self.refstc.encoding)
@@ -252,8 +468,28 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
         # is to convert it to two bytes per character: first byte is the
         # content, 2nd byte is styling (which we set to zero)
         self.SetText('')
-        styledtxt = '\0'.join(bytes)+'\0'
-        self.AddStyledText(styledtxt)
+        for bytes in chunks:
+            self.AddBinaryData(bytes)
+    
+    def appendDecodedChunks(self, chunks, encoding, bom=None):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        batch = []
+        count = 0
+        last = len(chunks) - 1
+        for i, bytes in enumerate(chunks):
+            if i == 0 and bom and bytes.startswith(bom):
+                bytes = bytes[len(bom):]
+            text = decoder.decode(bytes, i == last)
+            if text:
+                batch.append(text)
+                count += len(text)
+            if count >= self.load_batch_size:
+                self.AppendText(u"".join(batch))
+                batch = []
+                count = 0
+        if batch:
+            self.AppendText(u"".join(batch))
+        assert self.dprint("decoded %d chunks as %s" % (len(chunks), encoding))
     
     def prepareEncoding(self):
         """Prepare the file for encoding.
@@ -284,8 +520,7 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
             else:
                 # Have to use GetStyledText because GetText will truncate the
                 # string at the first zero character.
-                numchars = self.GetTextLength()
-                bytes = self.GetStyledText(0, numchars)[0:numchars*2:2]
+                bytes = self.GetBinaryData(0, self.GetTextLength())
             
             self.refstc.encoded = bytes
         except:
@@ -319,6 +554,13 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
         """Hook to allow STC to override autosave filename"""
         return wx.GetApp().autosave.getFilename(buffer.url)
 
+    def getAutosaveJournalFilename(self, buffer):
+        """Hook to allow STC to override autosave journal filename"""
+        # Binary documents can't be journaled because the modification
+        # events report their text as unicode
+        if self.refstc.encoding:
+            return wx.GetApp().autosave.getJournalFilename(buffer.url)
+
     def getBackupTemporaryFilename(self, buffer):
         """Hook to allow STC to override backup filename"""
         return wx.GetApp().backup.getFilename(buffer.url)
@@ -374,7 +616,22 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
         """
         if end == -1:
             end = self.GetTextLength()
-        return self.GetStyledText(start,end)[::2]
+        
+        # Get the styled text in blocks so that the styled copy of a large
+        # range is never needed all at once
+        pieces = []
+        for pos in xrange(start, end, binary_block_size):
+            pieces.append(self.GetStyledText(pos, min(pos + binary_block_size, end))[::2])
+        return "".join(pieces)
+    
+    def AddBinaryData(self, bytes):
+        """Insert binary data at the current position.
+        
+        The data is converted to styled text a block at a time, so the
+        styled version of the data is never needed all at once.
+        """
+        for pos in xrange(0, len(bytes), binary_block_size):
+            self.AddStyledText(toStyledText(bytes, pos, min(binary_block_size, len(bytes) - pos)))
     
     def SetBinaryData(self, loc, locend, bytes):
         """Replace the binary data in the specified range.
@@ -414,15 +671,19 @@ class PeppyBaseSTC(wx.stc.StyledTextCtrl, STCInterface, debugmixin):
         self.CmdKeyExecute(wx.stc.STC_CMD_CHARRIGHTEXTEND)
         end = self.GetSelectionEnd()
         data = self.GetStyledText(start, end)
+        self.BeginUndoAction()
         self.SetSelection(start, end)
         self.ReplaceSelection('')
         
-        styled = '\0'.join(bytes) + '\0'
         gap1 = loc - start
         gap2 = gap1 + locend - loc
-        replacement = data[:gap1 * 2] + styled + data[gap2 * 2:]
-        self.dprint("start=%d loc=%d locend=%d end=%d  data=%s styled=%s replace=%s" % (start, loc, locend, end, repr(data), repr(styled), repr(replacement)))
-        self.AddStyledText(replacement)
+        self.dprint("start=%d loc=%d locend=%d end=%d  data=%s bytes=%s" % (start, loc, locend, end, repr(data), repr(bytes)))
+        if gap1 > 0:
+            self.AddStyledText(data[:gap1 * 2])
+        self.AddBinaryData(bytes)
+        if gap2 * 2 < len(data):
+            self.AddStyledText(data[gap2 * 2:])
+        self.EndUndoAction()
 
     def GuessBinary(self,amount,percentage):
         """
@@ -1043,6 +1304,7 @@ class PeppySTC(PeppyBaseSTC):
             self.addSTCEventBindings()
         
         self.modified_callbacks = []
+        self.document_modified_callbacks = []
         
         # Remove all default scintilla keybindings so they will be replaced by
         # peppy actions.
@@ -1078,6 +1340,23 @@ class PeppySTC(PeppyBaseSTC):
     def removeDocumentChangeEvent(self):
         self.Unbind(wx.stc.EVT_STC_CHANGE)
         
+    def addDocumentModifiedEvent(self, callback):
+        if not self.document_modified_callbacks:
+            self.Bind(wx.stc.EVT_STC_MODIFIED, self.OnDocumentModified)
+        self.document_modified_callbacks.append(callback)
+        return True
+    
+    def removeDocumentModifiedEvent(self, callback):
+        if callback in self.document_modified_callbacks:
+            self.document_modified_callbacks.remove(callback)
+            if not self.document_modified_callbacks:
+                self.Unbind(wx.stc.EVT_STC_MODIFIED, handler=self.OnDocumentModified)
+    
+    def OnDocumentModified(self, evt):
+        for callback in self.document_modified_callbacks:
+            callback(evt)
+        evt.Skip()
+        
     def OnDestroy(self, evt):
         """
         Event handler for EVT_WINDOW_DESTROY. Preserve the clipboard
@@ -142,6 +142,18 @@ class STCInterface(object):
         """
         pass
 
+    def setFirstScreenCallback(self, callback):
+        """Set the function to be called when the first screen of text has
+        been loaded by L{readThreaded}.
+        
+        The callback is called from the GUI thread with the text of the first
+        screen as its only argument, so the user can see the start of the
+        file while the rest of it is being loaded.  It is only used for the
+        next load, and STCs that don't load the text incrementally never call
+        it.
+        """
+        pass
+
     def openSuccess(self, buffer):
         """Called after a file has been successfully opened.
         
@@ -153,6 +165,14 @@ class STCInterface(object):
         """Hook to allow STC to specify autosave filename"""
         pass
 
+    def getAutosaveJournalFilename(self, buffer):
+        """Hook to allow STC to specify the filename of the autosave journal.
+        
+        If no journal filename is returned, each autosave writes the entire
+        document to the autosave filename.
+        """
+        pass
+
     def getBackupTemporaryFilename(self, buffer):
         """Hook to allow STC to override backup filename"""
         pass
@@ -262,6 +282,25 @@ class STCInterface(object):
         """
         pass
 
+    def addDocumentModifiedEvent(self, callback):
+        """Add a callback for the EVT_STC_MODIFIED events of the document.
+        
+        Unlike the modify callbacks of the views, which are called once for
+        every view of the document, the callback is called once for each
+        modification of the document.
+        
+        @param callback: function taking the modification event as its only
+        argument
+        
+        @returns: True if the modifications are reported, or False if the
+        document doesn't support modification events.
+        """
+        return False
+    
+    def removeDocumentModifiedEvent(self, callback):
+        """Remove a callback added with L{addDocumentModifiedEvent}"""
+        pass
+
 
 class STCBinaryMixin(object):
     """Interface that major modes must implement to be editable with the HexEdit
@@ -54,6 +54,7 @@ __all__ = [
     'open_numpy_mmap',
     'open_write',
     'get_metadata',
+    'get_entry_metadata',
     'copy',
     'move',
     'get_names',
@@ -12,7 +12,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import httplib, copy, base64, StringIO, re
+import httplib, copy, base64, StringIO, re, socket, threading, time
 import urllib
 
 from peppy.vfs.utils import get_authentication_callback
@@ -24,7 +24,7 @@ try:
 except:
     from elementtree import ElementTree
 
-__all__ = ['DAVClient']
+__all__ = ['DAVClient', 'ConnectionPool']
 
 def object_to_etree(parent, obj, namespace=''):
     """This function takes in a python object, traverses it, and adds it to an existing etree object"""
@@ -58,9 +58,148 @@ def object_to_etree(parent, obj, namespace=''):
         
 
 
+class ConnectionPool(object):
+    """Pool of persistent HTTP/1.1 connections shared by all DAVClients
+    
+    Connections are keyed by scheme, host, port and username, and are
+    returned to the pool after each request unless the server indicated that
+    it would close the connection.  Idle connections are closed after
+    idle_timeout seconds, and no more than max_per_host connections are open
+    for each key at once; further requests wait for a connection to be
+    released.
+    """
+    max_per_host = 4
+    
+    idle_timeout = 30.0
+    
+    def __init__(self, max_per_host=None, idle_timeout=None):
+        if max_per_host is not None:
+            self.max_per_host = max_per_host
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        self.lock = threading.Condition()
+        
+        # key -> list of (connection, time returned to the pool) with the
+        # most recently used connection at the end
+        self.idle = {}
+        
+        # key -> number of connections currently in use
+        self.active = {}
+        self.reset_stats()
+    
+    def reset_stats(self):
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.discarded = 0
+        self.waits = 0
+    
+    def get_stats(self):
+        """Return a dict of the usage statistics of the pool"""
+        self.lock.acquire()
+        try:
+            return {'created': self.created,
+                    'reused': self.reused,
+                    'expired': self.expired,
+                    'discarded': self.discarded,
+                    'waits': self.waits,
+                    'active': sum(self.active.values()),
+                    'idle': sum([len(v) for v in self.idle.values()]),
+                    }
+        finally:
+            self.lock.release()
+    
+    def _expire(self, now):
+        """Close connections that have been idle too long.  Must be called
+        with the lock held."""
+        for key, idle in self.idle.items():
+            while idle and now - idle[0][1] > self.idle_timeout:
+                connection, last = idle.pop(0)
+                connection.close()
+                self.expired += 1
+            if not idle:
+                del self.idle[key]
+    
+    def get(self, key, factory):
+        """Get a connection from the pool, creating one if necessary
+        
+        @param key: tuple identifying the server and credentials
+        
+        @param factory: callable that creates a new connection
+        
+        @returns: tuple of the connection and a flag that is True if the
+        connection has been used before
+        """
+        self.lock.acquire()
+        try:
+            while True:
+                self._expire(time.time())
+                idle = self.idle.get(key)
+                if idle:
+                    connection, last = idle.pop()
+                    if not idle:
+                        del self.idle[key]
+                    self.reused += 1
+                    reused = True
+                    break
+                if self.active.get(key, 0) < self.max_per_host:
+                    connection = None
+                    reused = False
+                    break
+                self.waits += 1
+                self.lock.wait(self.idle_timeout)
+            self.active[key] = self.active.get(key, 0) + 1
+        finally:
+            self.lock.release()
+        if connection is None:
+            try:
+                connection = factory()
+            except:
+                self.release(key, None, False)
+                raise
+            self.lock.acquire()
+            self.created += 1
+            self.lock.release()
+        return connection, reused
+    
+    def release(self, key, connection, reusable=True):
+        """Return a connection to the pool
+        
+        @param reusable: if False, the connection is closed rather than kept
+        for the next request
+        """
+        self.lock.acquire()
+        try:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+            if connection is not None:
+                if reusable:
+                    self.idle.setdefault(key, []).append((connection, time.time()))
+                else:
+                    connection.close()
+                    self.discarded += 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+    
+    def close_all(self):
+        """Close all idle connections"""
+        self.lock.acquire()
+        try:
+            for idle in self.idle.values():
+                for connection, last in idle:
+                    connection.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
 class DAVClient(object):
     credentials = {}
     
+    pool = ConnectionPool()
+    
     def __init__(self, ref):
         """Initialization
         
@@ -95,6 +234,61 @@ class DAVClient(object):
         'webdavs': httplib.HTTPSConnection,
         }
     
+    def _create_connection(self):
+        try:
+            return self.scheme_map[self._ref.scheme](self._url, strict=0)
+        except KeyError:
+            raise Exception, 'Unsupported scheme'
+    
+    def _get_pool_key(self):
+        return (self._ref.scheme, self._url, self._username)
+    
+    # Methods that can be sent again if the response was lost
+    idempotent_methods = ['GET', 'HEAD', 'PROPFIND', 'OPTIONS']
+    
+    def _can_retry(self, method, body, sent, error):
+        """Check if a request that failed on a reused connection can be
+        safely sent again on a new connection.
+        
+        The request is only repeated if it couldn't have reached the server
+        (the send failed or the server closed the connection without
+        replying) or if repeating it has no side effects.  A file-like body
+        has already been consumed, so the request can't be repeated at all.
+        """
+        if body is not None and not isinstance(body, basestring):
+            return False
+        if not sent or method in self.idempotent_methods:
+            return True
+        return isinstance(error, httplib.BadStatusLine) and error.line in ("", "''")
+    
+    def _send(self, method, path, body, headers):
+        """Send the request using a pooled connection and read the entire
+        response, which is needed before the connection can be reused.
+        
+        A connection from the pool may have been closed by the server while
+        it was idle, so if a reused connection fails, the request is retried
+        once on a new connection when that is safe; see L{_can_retry}.
+        """
+        key = self._get_pool_key()
+        while True:
+            self._connection, reused = self.pool.get(key, self._create_connection)
+            sent = False
+            try:
+                self._connection.request(method, path, body, headers)
+                sent = True
+                response = self._connection.getresponse()
+                response.body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                self.pool.release(key, self._connection, False)
+                if reused and self._can_retry(method, body, sent, e):
+                    continue
+                raise
+            except:
+                self.pool.release(key, self._connection, False)
+                raise
+            self.pool.release(key, self._connection, not response.will_close)
+            return response
+    
     def _request(self, method, path='', body=None, headers=None):
         """Internal request method"""
         retry = True
@@ -105,18 +299,11 @@ class DAVClient(object):
             if headers:
                 connection_headers.update(headers)
             
-            try:
-                self._connection = self.scheme_map[self._ref.scheme](self._url, strict=0)
-            except KeyError:
-                raise Exception, 'Unsupported scheme'
-            
 #            dprint(method)
 #            dprint(path)
 #            dprint(body)
 #            dprint(connection_headers)
-            self._connection.request(method, path, body, connection_headers)
-            
-            self.response = self._connection.getresponse()
+            self.response = self._send(method, path, body, connection_headers)
             if self.response.status == 401:
                 scheme, realm = self.get_realm_from_response(self.response)
                 if realm:
@@ -124,8 +311,6 @@ class DAVClient(object):
                 else:
                     retry = False
             else:
-                self.response.body = self.response.read()
-                
                 # Try to parse and get an etree
                 try:
                     self._get_response_tree()
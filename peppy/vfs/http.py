@@ -24,15 +24,24 @@ from itools.vfs import BaseFS, register_file_system
 from itools.datatypes import HTTPDate
 from itools.vfs.vfs import READ, WRITE, READ_WRITE, APPEND, copy
 
+import utils
 
 
 class HTTPReadOnlyFS(BaseFS):
     @classmethod
     def _head(cls, reference):
+        # All the metadata comes from the same HEAD request, so cache the
+        # response rather than making a new request for each query
+        key = utils.get_metadata_key(reference)
+        if key in utils.metadata_cache:
+            return utils.metadata_cache[key]
         conn = HTTPConnection(str(reference.authority))
         # XXX Add the query
         conn.request('HEAD', str(reference.path))
-        return conn.getresponse()
+        response = conn.getresponse()
+        conn.close()
+        utils.metadata_cache[key] = response
+        return response
 
     @classmethod
     def exists(cls, reference):
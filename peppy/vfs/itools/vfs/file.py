@@ -17,13 +17,16 @@
 
 # Import from the Standard Library
 from datetime import datetime
+from mimetypes import guess_type
 from os import (listdir, makedirs, mkdir, remove, rename, rmdir, stat, walk,
-                access, chmod, R_OK, W_OK)
+                access, chmod, lstat, R_OK, W_OK)
 from os.path import (exists, getatime, getctime, getmtime, getsize, isfile,
     isdir, join)
+from stat import S_ISDIR, S_ISREG
 from subprocess import call
 
 # Import from itools
+from peppy.vfs.itools.datatypes import FileName
 from peppy.vfs.itools.uri import Path, Reference
 from vfs import READ, WRITE, READ_WRITE, APPEND, copy
 from base import BaseFS
@@ -104,6 +107,45 @@ class FileFS(BaseFS):
             return access(path.encode('utf-8'), W_OK)
 
 
+    @classmethod
+    def get_entry_metadata(cls, reference):
+        """Return the metadata needed to list the reference in a folder
+        listing, using a single stat for the size, time and type"""
+        path = unicode(reference.path)
+        try:
+            try:
+                st = stat(path)
+            except UnicodeEncodeError:
+                path = path.encode('utf-8')
+                st = stat(path)
+            can_read = access(path, R_OK)
+            can_write = access(path, W_OK)
+        except OSError:
+            # A broken symbolic link is still listed using the link itself
+            st = lstat(path)
+            can_read = can_write = False
+        if S_ISDIR(st.st_mode):
+            mimetype = 'inode/directory'
+        elif not S_ISREG(st.st_mode):
+            mimetype = 'application/x-not-regular-file'
+        else:
+            mimetype = 'application/octet-stream'
+            name, extension, language = FileName.decode(reference.path[-1])
+            if extension is not None:
+                guess, encoding = guess_type('.%s' % extension)
+                if guess is not None:
+                    mimetype = guess
+        return {
+            'mimetype': mimetype,
+            'description': '',
+            'mtime': datetime.fromtimestamp(st.st_mtime),
+            'size': st.st_size,
+            'is_folder': S_ISDIR(st.st_mode),
+            'can_read': can_read,
+            'can_write': can_write,
+            }
+
+
     @classmethod
     def get_ctime(cls, reference):
         return datetime.fromtimestamp(cls.unicode_wrapper(reference, getctime))
@@ -1,6 +1,6 @@
 # peppy Copyright (c) 2006-2010 Rob McMullen
 # Licenced under the GPLv2; see http://peppy.flipturn.org for more info
-import os, stat
+import os, stat, urllib
 import getpass
 from binascii import hexlify
 from datetime import datetime
@@ -190,11 +190,29 @@ class SFTPFS(BaseFS):
         
     @classmethod
     def _stat(cls, ref):
-        client = cls._get_client(ref)
-        attrs = client.stat(str(ref.path))
-        if cls.debug: dprint("%s: %s" % (ref, repr(attrs)))
+        key = utils.get_metadata_key(ref)
+        if key in utils.metadata_cache:
+            attrs = utils.metadata_cache[key]
+            if cls.debug: dprint("%s: cached %s" % (ref, repr(attrs)))
+        else:
+            client = cls._get_client(ref)
+            try:
+                attrs = client.stat(str(ref.path))
+            except IOError:
+                # Remember that the file doesn't exist, too
+                attrs = None
+            utils.metadata_cache[key] = attrs
+            if cls.debug: dprint("%s: %s" % (ref, repr(attrs)))
+        if attrs is None:
+            raise IOError("[Errno 2] No such file or directory: '%s'" % ref)
         return attrs
     
+    @classmethod
+    def _purge_cache(cls, *refs):
+        for ref in refs:
+            utils.metadata_cache.remove_prefix(utils.get_metadata_key(ref))
+            utils.metadata_cache.remove(utils.get_metadata_key(utils.get_dirname(ref)))
+    
     @classmethod
     def _copy_root_reference_without_username(cls, ref):
         newauth = ref.authority.host
@@ -288,6 +306,7 @@ class SFTPFS(BaseFS):
         fh = client.open(path, mode='w')
         fh.write(data)
         fh.close()
+        cls._purge_cache(ref)
 
     @classmethod
     def make_folder(cls, ref):
@@ -304,6 +323,7 @@ class SFTPFS(BaseFS):
         path = str(ref.path)
         if cls.debug: dprint(path)
         client.mkdir(path)
+        cls._purge_cache(ref)
 
     @classmethod
     def remove(cls, ref):
@@ -323,6 +343,7 @@ class SFTPFS(BaseFS):
             client.rmdir(str(ref.path))
         else:
             client.remove(str(ref.path))
+        cls._purge_cache(ref)
     
     @classmethod
     def walk(cls, client, top, topdown=True, onerror=None):
@@ -380,6 +401,7 @@ class SFTPFS(BaseFS):
 
         client = cls._get_client(source)
         client.rename(str(source.path), str(target.path))
+        cls._purge_cache(source, target)
 
     @classmethod
     def get_names(cls, ref):
@@ -388,7 +410,16 @@ class SFTPFS(BaseFS):
         if not cls.is_folder(ref):
             raise OSError("[Errno 20] Not a directory: '%s'" % ref)
         client = cls._get_client(ref)
-        filenames = client.listdir(str(ref.path))
+        # The attributes come along with the listing, so store them to
+        # prevent a separate stat of each file in the folder
+        entries = client.listdir_attr(str(ref.path))
+        filenames = []
+        items = []
+        for attrs in entries:
+            filenames.append(attrs.filename)
+            child = ref.resolve2(urllib.quote(attrs.filename))
+            items.append((utils.get_metadata_key(child), attrs))
+        utils.metadata_cache.update(items)
         if cls.debug: dprint(filenames)
         return filenames
 
@@ -15,7 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-import os
+import os, stat, bisect, zlib, threading, hashlib
+import cPickle as pickle
 from datetime import datetime
 from StringIO import StringIO
 import tarfile
@@ -26,13 +27,349 @@ from itools.vfs import READ, WRITE, APPEND, copy
 from itools.vfs.base import BaseFS
 from itools.vfs.registry import register_file_system
 
+from peppy.vfs.utils import get_index_cache_dir
+
+
+class GzipCheckpointFile(object):
+    """Seekable read-only file of the decompressed contents of a gzip file.
+    
+    gzip.GzipFile handles a backwards seek by decompressing from the start of
+    the file again, so reading a member near the end of a large .tar.gz
+    requires decompressing almost the whole archive each time.  This class
+    saves a copy of the decompressor state every L{checkpoint_interval}
+    bytes of output, and seeks resume from the nearest checkpoint instead.
+    """
+    #: Size of the compressed chunks read from the file
+    chunk_size = 64 * 1024
+    
+    #: Number of decompressed bytes between checkpoints.  Each checkpoint
+    #: holds a copy of the zlib state (including its 32K window)
+    checkpoint_interval = 4 * 1024 * 1024
+    
+    def __init__(self, name):
+        self.name = name
+        self.fh = open(name, 'rb')
+        
+        # Checkpoints are tuples of (uncompressed offset, compressed offset,
+        # decompressor), sorted by offset
+        self.checkpoints = [(0, 0, self._new_decompressor())]
+        self.offsets = [0]
+        
+        # The buffer holds the last chunk of decompressed data, starting at
+        # buffer_start in the decompressed stream
+        self.pos = 0
+        self.size = None
+        self._restart(self.checkpoints[0])
+    
+    def _new_decompressor(self):
+        # wbits of 16 + MAX_WBITS tells zlib to expect the gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    
+    def _restart(self, checkpoint):
+        uncompressed, compressed, decompressor = checkpoint
+        self.decompressor = decompressor.copy()
+        self.fh.seek(compressed)
+        self.buffer_start = uncompressed
+        self.buffer = ""
+    
+    def _decompress_chunk(self):
+        """Decompress the next chunk of the file
+        
+        @returns: the decompressed data, or an empty string at the end of the
+        file
+        """
+        output = ""
+        while not output:
+            data = self.fh.read(self.chunk_size)
+            if not data:
+                self.size = self.buffer_start + len(self.buffer)
+                return ""
+            try:
+                output = self.decompressor.decompress(data)
+                # Concatenated gzip files are allowed, so start a new
+                # decompressor for each following member
+                while self.decompressor.unused_data:
+                    data = self.decompressor.unused_data
+                    self.decompressor = self._new_decompressor()
+                    output += self.decompressor.decompress(data)
+            except zlib.error:
+                # Trailing garbage is ignored, like gzip does
+                self.size = self.buffer_start + len(self.buffer) + len(output)
+                self.fh.seek(0, 2)
+                return output
+        end = self.buffer_start + len(self.buffer) + len(output)
+        if end >= self.offsets[-1] + self.checkpoint_interval:
+            self.checkpoints.append((end, self.fh.tell(), self.decompressor.copy()))
+            self.offsets.append(end)
+        return output
+    
+    def _position(self, pos):
+        """Move the decompressor to a point at or before the position"""
+        buffer_end = self.buffer_start + len(self.buffer)
+        if pos < self.buffer_start or pos > buffer_end + self.checkpoint_interval:
+            index = bisect.bisect_right(self.offsets, pos) - 1
+            checkpoint = self.checkpoints[index]
+            if pos < self.buffer_start or checkpoint[0] > buffer_end:
+                self._restart(checkpoint)
+    
+    def read(self, size=-1):
+        self._position(self.pos)
+        offset = self.pos - self.buffer_start
+        pieces = []
+        count = 0
+        while size < 0 or count < size:
+            if offset < len(self.buffer):
+                if size < 0:
+                    piece = self.buffer[offset:]
+                else:
+                    piece = self.buffer[offset:offset + size - count]
+                pieces.append(piece)
+                offset += len(piece)
+                count += len(piece)
+            else:
+                chunk = self._decompress_chunk()
+                offset -= len(self.buffer)
+                self.buffer_start += len(self.buffer)
+                self.buffer = chunk
+                if not chunk:
+                    break
+        self.pos += count
+        return "".join(pieces)
+    
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            if self.size is None:
+                self.pos = max(self.pos, self.offsets[-1])
+                while self.read(self.chunk_size * 16):
+                    pass
+            pos += self.size
+        self.pos = max(0, pos)
+    
+    def tell(self):
+        return self.pos
+    
+    def close(self):
+        self.fh.close()
+
+
+class TarMemberFile(object):
+    """Read-only file of a member of a tar archive.
+    
+    The members share the archive's file object, so each read seeks the
+    archive to the current position in the member while holding the lock of
+    the index.  With a L{GzipCheckpointFile}, the seek resumes from the
+    nearest checkpoint.
+    """
+    def __init__(self, index, info):
+        self.index = index
+        self.offset = info.offset_data
+        self.size = info.size
+        self.pos = 0
+    
+    def read(self, size=-1):
+        remaining = self.size - self.pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ""
+        self.index.lock.acquire()
+        try:
+            fileobj = self.index.archive.fileobj
+            fileobj.seek(self.offset + self.pos)
+            data = fileobj.read(size)
+        finally:
+            self.index.lock.release()
+        self.pos += len(data)
+        return data
+    
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = min(max(0, pos), self.size)
+    
+    def tell(self):
+        return self.pos
+    
+    def close(self):
+        pass
+
+
+class TarIndex(object):
+    """Directory tree of the members of a tar archive.
+    
+    The archive is scanned once and each member is indexed by its name with
+    any trailing slashes removed, so lookups don't depend on the slash
+    conventions of the different versions of the tarfile module and don't
+    require the linear search of C{TarFile.getmember}.  Folders that are
+    only implied by the names of the members they contain are also
+    indexed.
+    
+    If an index cache directory has been registered, the index is saved
+    there and reused by later sessions as long as the path, modification
+    time and size of the archive are unchanged.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.archive = self.open_archive(path)
+        
+        # name -> TarInfo
+        self.members = {}
+        
+        # folder name -> list of names in the folder; the root is ''
+        self.folders = {'': []}
+        
+        if not self.load():
+            for info in self.archive:
+                self.add(info)
+            self.save()
+    
+    def open_archive(self, path):
+        fh = open(path, 'rb')
+        magic = fh.read(2)
+        fh.close()
+        if magic == '\x1f\x8b':
+            fileobj = GzipCheckpointFile(path)
+            try:
+                return tarfile.open(path, 'r:', fileobj)
+            except:
+                fileobj.close()
+                raise
+        return tarfile.open(path)
+    
+    def get_key(self):
+        st = _stat(self.path)
+        return (self.path, st.st_mtime, st.st_size)
+    
+    def get_cache_path(self):
+        dirname = get_index_cache_dir()
+        if not dirname:
+            return None
+        path = self.path
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return os.path.join(dirname, "tar-%s" % hashlib.md5(path).hexdigest())
+    
+    def load(self):
+        """Load the saved index of the archive
+        
+        @returns: True if a valid index was found
+        """
+        filename = self.get_cache_path()
+        if not filename or not os.path.exists(filename):
+            return False
+        try:
+            fh = open(filename, 'rb')
+            try:
+                key, members, folders = pickle.load(fh)
+            finally:
+                fh.close()
+        except Exception:
+            return False
+        if key != self.get_key():
+            return False
+        self.members = members
+        self.folders = folders
+        return True
+    
+    def save(self):
+        filename = self.get_cache_path()
+        if not filename:
+            return
+        try:
+            dirname = os.path.dirname(filename)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            fh = open(filename, 'wb')
+            try:
+                pickle.dump((self.get_key(), self.members, self.folders), fh,
+                            pickle.HIGHEST_PROTOCOL)
+            finally:
+                fh.close()
+        except (IOError, OSError, pickle.PicklingError):
+            # The saved index is only an optimization
+            pass
+    
+    def add(self, info):
+        name = info.name.replace('//', '/').rstrip('/')
+        if not name:
+            return
+        if name not in self.members and name not in self.folders:
+            self.add_to_folder(name)
+        self.members[name] = info
+        if info.isdir() and name not in self.folders:
+            self.folders[name] = []
+    
+    def add_to_folder(self, name):
+        if '/' in name:
+            parent, basename = name.rsplit('/', 1)
+        else:
+            parent, basename = '', name
+        if parent not in self.folders:
+            if parent not in self.members:
+                self.add_to_folder(parent)
+            self.folders[parent] = []
+        self.folders[parent].append(basename)
+    
+    def get_info(self, name):
+        """Return the TarInfo of the member, or None if the member doesn't
+        exist or is an implied folder"""
+        return self.members.get(name.rstrip('/'))
+    
+    def is_folder(self, name):
+        return name.rstrip('/') in self.folders
+    
+    def get_names(self, name):
+        return list(self.folders.get(name.rstrip('/'), []))
+    
+    def open(self, info):
+        if info.isreg() and not info.issparse():
+            return TarMemberFile(self, info)
+        self.lock.acquire()
+        try:
+            fh = self.archive.extractfile(info)
+            if fh is not None:
+                # Links and sparse files are rare, so they are read whole
+                # rather than interleaving seeks with other readers
+                fh = StringIO(fh.read())
+            return fh
+        finally:
+            self.lock.release()
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except UnicodeEncodeError:
+        return os.stat(path.encode('utf-8'))
+
+
 class TarFS(BaseFS):
     """Virtual file system to navigate tar (and compressed tar) files.
 
     The tar: file system is based on the operation of KDE's tar kioslave, where
     only tar files that reside in the local file system are navigable.
+    
+    Each archive is indexed once into a L{TarIndex}, which is kept in the
+    local cache until the modification time of the archive changes, and is
+    also saved to the index cache directory for later sessions.
     """
 
+    @classmethod
+    def _get_index(cls, archive_path):
+        index = BaseFS.find_local_cached('tar', archive_path)
+        if not index:
+            index = TarIndex(archive_path)
+            # FIXME: tarfile will successfully open zero length files, and
+            # currently we allow this.  Should this be the case, or should
+            # it not report success on a zero length file?
+            BaseFS.store_local_cache('tar', archive_path, index)
+        return index
+
     @classmethod
     def _open(cls, path):
         """Find the archive and the path within the archive
@@ -40,12 +377,10 @@ class TarFS(BaseFS):
         path: string representing the pathname in the local filesystem,
         including the tar file and the path within the tar file.
         
-        returns: tuple of (path_to_archive, path_within_archive).  If the
-        path to the archive is invalid, None will be returned, but the
+        returns: tuple of (index, path_to_archive, path_within_archive).  If
+        the path to the archive is invalid, None will be returned, but the
         path_within_archive is not checked for validity in this method.
         """
-        parent = None
-        
         path = path.rstrip('/')
         #print("_open: path=%s" % path)
         components = path.split('/')
@@ -59,92 +394,59 @@ class TarFS(BaseFS):
             components.pop()
         else:
             archive_path = os.getcwd()
-        archive_found = False
-        member_path = ''
-        archive = None
+        index = None
         
-        # Find the first archive in the path
+        # Find the first archive in the path.  Only the first file in the
+        # path can be the archive, so stop at the first component that isn't
+        # a directory.
         while components:
             comp = components.pop()
             archive_path = u'/'.join([archive_path, comp])
             #print("archive_path=%s" % archive_path)
             try:
-                path_exists = os.path.exists(archive_path)
-            except UnicodeEncodeError:
-                path_exists = os.path.exists(archive_path.encode('utf-8'))
-            if path_exists:
-                try:
-                    archive = BaseFS.find_local_cached('tar', archive_path)
-                    if not archive:
-                        archive = tarfile.open(archive_path)
-                        # FIXME: tarfile will successfully open zero length
-                        # files, and currently we allow this.  Should this be
-                        # the case, or should it not report success on a zero
-                        # length file?
-                        if archive:
-                            BaseFS.store_local_cache('tar', archive_path, archive)
-                    archive_found = True
-                    break
-                except Exception, e:
-                    #import traceback
-                    #traceback.print_exc()
-                    #print("Exception: %s" % str(e))
-                    pass
-        if archive_found:
-            #print archive.getmembers()
+                mode = _stat(archive_path).st_mode
+            except OSError:
+                break
+            if stat.S_ISDIR(mode):
+                continue
+            try:
+                index = cls._get_index(archive_path)
+            except Exception, e:
+                #import traceback
+                #traceback.print_exc()
+                #print("Exception: %s" % str(e))
+                pass
+            break
+        if index is not None:
             if components:
                 components.reverse()
             member_path = u"/".join(components)
-            return archive, archive_path, member_path
+            return index, archive_path, member_path
         return None, None, None
-    
-    @classmethod
-    def _get_info(cls, archive, name):
-        if archive and name:
-            name = name.rstrip('/')
-            try:
-                # Python 2.6 and later don't put slashes after directory names
-                m = archive.getmember(name)
-                return m
-            except KeyError:
-                # Python 2.4 puts a single slash after the directory name
-                try:
-                    m = archive.getmember(name + '/')
-                    return m
-                except KeyError:
-                    # Python 2.5 puts a double slash after directory names
-                    try:
-                        m = archive.getmember(name + '//')
-                        return m
-                    except:
-                        pass
-        return None
 
     @classmethod
     def exists(cls, reference):
         path = unicode(reference.path)
-        archive, path, name = cls._open(path)
-        return archive is not None
+        index, path, name = cls._open(path)
+        return index is not None
 
     @classmethod
     def is_file(cls, reference):
         path = unicode(reference.path)
-        archive, path, name = cls._open(path)
-        m = cls._get_info(archive, name)
-        if m:
-            return m.isfile()
+        index, path, name = cls._open(path)
+        if index and name:
+            m = index.get_info(name)
+            if m:
+                return m.isfile()
         return False
 
     @classmethod
     def is_folder(cls, reference):
         path = unicode(reference.path)
-        archive, path, name = cls._open(path)
-        if not name:
+        index, path, name = cls._open(path)
+        if index:
             # the root of the archive is a folder
-            return True
-        m = cls._get_info(archive, name)
-        if m:
-            return m.isdir()
+            return index.is_folder(name)
         return False
 
     @classmethod
@@ -158,33 +460,37 @@ class TarFS(BaseFS):
     @classmethod
     def get_size(cls, reference):
         path = unicode(reference.path)
-        archive, path, name = cls._open(path)
-        m = cls._get_info(archive, name)
-        if m:
-            return m.size
+        index, path, name = cls._open(path)
+        if index and name:
+            m = index.get_info(name)
+            if m:
+                return m.size
         raise OSError("[Errno 2] No such file or directory: '%s'" % reference)
 
     @classmethod
     def get_mtime(cls, reference):
         path = unicode(reference.path)
-        archive, path, name = cls._open(path)
-        m = cls._get_info(archive, name)
-        if m:
-            return datetime.fromtimestamp(m.mtime)
+        index, path, name = cls._open(path)
+        if index and name:
+            m = index.get_info(name)
+            if m:
+                return datetime.fromtimestamp(m.mtime)
         raise OSError("[Errno 2] No such file or directory: '%s'" % reference)
 
     @classmethod
     def open(cls, reference, mode=None):
         path = unicode(reference.path)
-        archive, path, name = cls._open(path)
-        m = cls._get_info(archive, name)
+        index, path, name = cls._open(path)
+        m = None
+        if index and name:
+            m = index.get_info(name)
         if not m:
             raise IOError("[Errno 2] No such file or directory: '%s'" % reference)
 
         if mode == WRITE or mode == APPEND:
             raise OSError("[Errno 30] Read-only file system")
         else:
-            fh = archive.extractfile(m)
+            fh = index.open(m)
         return fh
 
     ######################################################################
@@ -192,25 +498,10 @@ class TarFS(BaseFS):
     @classmethod
     def get_names(cls, reference):
         path = unicode(reference.path)
-        archive, path, name = cls._open(path)
-        if not archive:
+        index, path, name = cls._open(path)
+        if not index:
             raise OSError('[Errno 20] Not a directory')
-        names = []
-        if name and not name.endswith('/'):
-            name = name + '/'
-        cut = len(name)
-        for possible in archive.getnames():
-            if possible.startswith(name):
-                # Only match stuff in this directory; not directories further
-                # down.
-                #print("possible match for %s: %s" % (name, possible))
-                tmp = possible[cut:].replace('//', '/').rstrip('/') # for py 2.5
-                comps = tmp.split('/')
-                #print("tmp=%s comps=%s" % (tmp, comps))
-                if tmp and len(comps)==1:
-                    names.append(tmp)
-        #print("matches: %s" % names)
-        return names
+        return index.get_names(name)
 
 
 register_file_system('tar', TarFS)
@@ -1,4 +1,4 @@
-import os, sys
+import os, sys, time, threading
 import copy as pycopy
 
 from peppy.vfs.itools.datatypes import FileName
@@ -180,7 +180,7 @@ def store_local_cache(fstype, path, obj):
     #dprint(subcache)
     # truncate the list if it's getting too big.
     if len(subcache) > max_cache:
-        subcache = subcache[0:max_cache]
+        del subcache[max_cache:]
     
 BaseFS.store_local_cache = staticmethod(store_local_cache)
 
@@ -220,6 +220,206 @@ def get_metadata(ref):
         'size': fs.get_size(ref),
         }
 
+def get_entry_metadata(ref):
+    """Return the metadata needed to list the reference in a folder listing
+    
+    Along with the entries from L{get_metadata}, the dictionary includes
+    the boolean values 'is_folder', 'can_read', and 'can_write'.  Local files
+    are described using a single stat; the remote filesystems store the
+    attributes of every entry in the metadata cache when their folder is
+    listed, so the separate queries don't result in more round trips.
+    """
+    if not isinstance(ref, Reference):
+        ref = get_reference(ref)
+    fs = get_file_system(ref.scheme)
+    if hasattr(fs, 'get_entry_metadata'):
+        return fs.get_entry_metadata(ref)
+    metadata = dict(get_metadata(ref))
+    metadata['is_folder'] = fs.is_folder(ref)
+    metadata['can_read'] = bool(fs.can_read(ref))
+    metadata['can_write'] = bool(fs.can_write(ref))
+    return metadata
+
+def get_metadata_key(ref):
+    """Return the key used to identify the reference in the metadata cache.
+    
+    The key ignores the username, query string, fragment, and any trailing
+    slash so that a folder is found whether it was looked up by itself or as
+    an entry in a listing of its parent.
+    """
+    authority = ref.authority.host
+    if ref.authority.port:
+        authority += ":" + ref.authority.port
+    path = unicode(ref.path)
+    while len(path) > 1 and path.endswith("/"):
+        path = path[:-1]
+    return u"%s://%s%s" % (ref.scheme, authority, path)
+
+
+class MetadataCache(object):
+    """Size limited cache of metadata of remote files where each entry
+    expires after a fixed time.
+    
+    Remote filesystems store whatever they get from the server (HTTP headers,
+    stat results, PROPFIND responses) using the key from L{get_metadata_key},
+    and when a folder is listed, the metadata of every entry in the folder is
+    stored from the same listing so that subsequent queries about the
+    entries don't require any more round trips to the server.
+    
+    The cache is dict-like, and a lookup of an expired entry behaves as if
+    the entry is missing.
+    """
+    #: Number of seconds that an entry is valid
+    ttl = 10.0
+    
+    #: Maximum number of entries; the least recently used entries are
+    #: removed when the limit is reached
+    max_entries = 5000
+    
+    def __init__(self, ttl=None, max_entries=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self.lock = threading.RLock()
+        
+        # key -> [time stored, time last used, value]
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def set_limits(self, ttl=None, max_entries=None):
+        self.lock.acquire()
+        try:
+            if ttl is not None:
+                self.ttl = ttl
+            if max_entries is not None:
+                self.max_entries = max_entries
+                self._trim()
+        finally:
+            self.lock.release()
+    
+    def _get_entry(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            now = time.time()
+            if now - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            else:
+                entry[1] = now
+        return entry
+    
+    def _trim(self):
+        if len(self.entries) > self.max_entries:
+            # Remove a batch of entries at once so the sort isn't needed
+            # on every insertion
+            count = len(self.entries) - (self.max_entries * 9 / 10)
+            order = sorted(self.entries.iteritems(), key=lambda item: item[1][1])
+            for key, entry in order[0:count]:
+                del self.entries[key]
+    
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            return self._get_entry(key) is not None
+        finally:
+            self.lock.release()
+    
+    def __getitem__(self, key):
+        self.lock.acquire()
+        try:
+            entry = self._get_entry(key)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            return entry[2]
+        finally:
+            self.lock.release()
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.entries[key] = [now, now, value]
+            self._trim()
+        finally:
+            self.lock.release()
+    
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            del self.entries[key]
+        finally:
+            self.lock.release()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def keys(self):
+        return self.entries.keys()
+    
+    def update(self, items):
+        """Store many entries at once, e.g. from a folder listing
+        
+        @param items: dict or list of key/value pairs
+        """
+        self.lock.acquire()
+        try:
+            if isinstance(items, dict):
+                items = items.iteritems()
+            now = time.time()
+            for key, value in items:
+                self.entries[key] = [now, now, value]
+            self._trim()
+        finally:
+            self.lock.release()
+    
+    def remove(self, key):
+        """Remove the entry if it exists"""
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                del self.entries[key]
+        finally:
+            self.lock.release()
+    
+    def remove_prefix(self, prefix):
+        """Remove the entry and all entries contained within it if it is a
+        folder"""
+        self.lock.acquire()
+        try:
+            folder = prefix + u"/"
+            for key in self.entries.keys():
+                if key == prefix or key.startswith(folder):
+                    del self.entries[key]
+        finally:
+            self.lock.release()
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+        finally:
+            self.lock.release()
+    
+    def get_stats(self):
+        return {'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                }
+
+# Metadata cache shared by all the remote filesystems
+metadata_cache = MetadataCache()
+
+
 # Register a callback that the vfs can use to prompt the user for a
 # username/password combination.  The callback function should take four
 # arguments and return a username, password pair if successful or (None, None)
@@ -236,6 +436,17 @@ def get_authentication_callback():
     global auth_callback
     return auth_callback
 
+# Directory where the file systems can save the indexes of local archives
+# between sessions, or None if the indexes shouldn't be saved
+index_cache_dir = None
+def register_index_cache_dir(dirname):
+    global index_cache_dir
+    index_cache_dir = dirname
+
+def get_index_cache_dir():
+    global index_cache_dir
+    return index_cache_dir
+
 class AuthenticationCancelled(RuntimeError):
     pass
 
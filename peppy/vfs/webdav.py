@@ -15,8 +15,6 @@ from davclient import DAVClient
 import BaseHTTPServer
 BaseHTTPServer.BaseHTTPRequestHandler.responses[424] = ('Failed Dependency', 'Failed Dependency')
 
-from peppy.lib.dictutils import TimeExpiringDict
-
 from peppy.debug import dprint
 import pprint
 pp = pprint.PrettyPrinter(indent=0)
@@ -32,46 +30,43 @@ class WebDavFS(BaseFS):
     
     remap301 = LRUCache(200)
     
-    response_cache = TimeExpiringDict(10)
+    # PROPFIND results are stored in the metadata cache shared by the remote
+    # filesystems as (status, responses, listing) tuples, where listing is
+    # True if the responses include the contents of the folder
+    response_cache = utils.metadata_cache
     
     non_existent_time = datetime.datetime.utcfromtimestamp(0)
     
     debug = False
 
+    @classmethod
+    def _get_cache_key(cls, ref):
+        return utils.get_metadata_key(cls._copy_reference_without_username(ref))
+    
     @classmethod
     def _purge_cache(cls, *refs):
-        folders = []
         for orig_ref in refs:
             ref = cls._copy_reference_without_username(orig_ref)
             if cls.debug: dprint("Removing cache for %s" % ref)
             if ref in cls.remap301:
                 del cls.remap301[ref]
-            if ref in cls.response_cache:
-                status, responses = cls.response_cache[ref]
-                path_found, response = cls._get_response_from_ref(ref, responses)
-                try:
-                    if response['getcontenttype'] == "httpd/unix-directory":
-                        if cls.debug: dprint("Found folder %s" % ref)
-                        folders.append(ref)
-                except KeyError:
-                    pass
-                del cls.response_cache[ref]
-        
-        # Remove all the cached data for anything contained in any folders that
-        # have been removed.
-        for folder in folders:
-            if cls.debug: dprint("Checking folder %s" % folder)
-            folder_url = unicode(folder)
-            keys = cls.response_cache.keys()
-            for ref in keys:
-                if cls.debug: dprint("Checking cache %s" % str(ref))
-                ref_url = unicode(ref)
-                if ref_url.startswith(folder_url):
-                    if cls.debug: dprint("Removing cache hit %s for deleted folder: %s" % (ref_url, folder_url))
-                    del cls.response_cache[ref]
+            
+            # Remove the reference, anything contained in it if it's a folder,
+            # and the listing of its parent folder that included it.
+            key = cls._get_cache_key(ref)
+            cls.response_cache.remove_prefix(key)
+            cls.response_cache.remove(cls._get_cache_key(utils.get_dirname(ref)))
     
+    @classmethod
+    def get_connection_stats(cls):
+        """Return the usage statistics of the pool of persistent connections
+        shared by all the DAV clients"""
+        return DAVClient.pool.get_stats()
+
     @classmethod
     def _get_client(cls, ref):
+        # Clients are cheap to create because the HTTP connections are kept
+        # in DAVClient's connection pool
         if ref in cls.remap301:
             ref = cls.remap301[ref]
         client = DAVClient(ref)
@@ -79,10 +74,22 @@ class WebDavFS(BaseFS):
         return newref, client
         
     @classmethod
-    def _propfind(cls, ref):
+    def _propfind(cls, ref, listing=False):
+        """Get the depth 1 PROPFIND responses that include the reference.
+        
+        Every entry in the responses is cached, so once a folder has been
+        listed, metadata queries about any of the items in the folder don't
+        require another request.
+        
+        @param listing: if True, the responses must come from a PROPFIND
+        of the reference itself (i.e. a listing of the folder) rather than a
+        listing of its parent
+        """
         ref, client = cls._get_client(ref)
-        if ref in cls.response_cache:
-            status, responses = cls.response_cache[ref]
+        key = cls._get_cache_key(ref)
+        cached = cls.response_cache.get(key)
+        if cached is not None and (cached[2] or not listing):
+            status, responses, is_listing = cached
             if cls.debug: dprint("response_cache hit: %s" % str(ref))
         else:
             if cls.debug: dprint("response_cache miss: %s" % str(ref))
@@ -99,13 +106,21 @@ class WebDavFS(BaseFS):
                     cls.remap301[ref] = get_reference(newpath)
             status = client.response.status
             if cls.debug: dprint("response_cache miss: storing status=%s, response=%s" % (status, responses))
-        if responses is not None:
-            if cls.debug: dprint(ref)
-            newref = cls._copy_reference_without_username(ref)
-            cls.response_cache[newref] = (status, responses)
+            if responses is not None:
+                cls._store_responses(ref, status, responses)
         
         return ref, status, responses
     
+    @classmethod
+    def _store_responses(cls, ref, status, responses):
+        entries = []
+        if status < 400:
+            for href in responses.keys():
+                child = cls._get_cache_key(ref.resolve(href))
+                entries.append((child, (status, responses, False)))
+        entries.append((cls._get_cache_key(ref), (status, responses, True)))
+        cls.response_cache.update(entries)
+    
     @classmethod
     def _copy_reference_without_username(cls, ref):
         newauth = ref.authority.host
@@ -224,6 +239,31 @@ class WebDavFS(BaseFS):
         size = cls._get_metadata(ref, 'getcontentlength', 0)
         return int(size)
 
+    @classmethod
+    def get_metadata(cls, ref):
+        """Get all the metadata from a single (usually cached) PROPFIND"""
+        ref, status, responses = cls._propfind(ref)
+        if status == 403:
+            response = {}
+        elif not responses:
+            raise OSError("[Errno 2] No such file or directory: '%s'" % ref)
+        else:
+            try:
+                path_found, response = cls._get_response_from_ref(ref, responses)
+            except KeyError:
+                raise OSError("[Errno 2] No such file or directory: '%s'" % ref)
+        mtime = response.get('getlastmodified')
+        if mtime is not None:
+            mtime = HTTPDate.decode(mtime)
+        else:
+            mtime = cls.non_existent_time
+        return {
+            'mimetype': response.get('getcontenttype') or 'application/octet-stream',
+            'description': '',
+            'mtime': mtime,
+            'size': int(response.get('getcontentlength') or 0),
+            }
+
     @classmethod
     def make_file(cls, ref):
         folder_path = utils.get_dirname(ref)
@@ -324,7 +364,7 @@ class WebDavFS(BaseFS):
         if not cls.is_folder(ref):
             raise OSError("[Errno 20] Not a directory: '%s'" % ref)
 
-        ref, status, responses = cls._propfind(ref)
+        ref, status, responses = cls._propfind(ref, listing=True)
 #        if cls.debug: dprint(status)
 #        if cls.debug: dprint(pp.pformat(responses))
 #        if cls.debug: dprint(ref)
@@ -340,8 +380,6 @@ class WebDavFS(BaseFS):
                     filename = filename[1:]
                 if filename:
                     filenames.append(filename)
-                    # FIXME: since we have the metadata, it makes sense to
-                    # store it in the cache
 #        if cls.debug: dprint(filenames)
         return filenames
 
@@ -0,0 +1,204 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Index of the words in the open buffers
+
+Word completion needs the list of words in the open documents that start
+with a given prefix.  Rather than searching the text of every document each
+time, the L{WordIndex} keeps a reference count of every word in each buffer
+and a sorted list of all the words, so finding the completions is a binary
+search followed by a scan of only the matching words.
+
+The index of each buffer is created by scanning its text once, and is then
+updated from the insertions and deletions reported by the buffer's STC.  Only
+the partial words at either end of a modification are rescanned along with
+the modified text.
+"""
+
+import re
+from bisect import bisect_left, insort
+
+import wx.stc
+
+from peppy.debug import *
+
+
+class BufferWords(object):
+    """Words of a single buffer"""
+    def __init__(self, stc):
+        self.stc = stc
+        self.counts = {}
+        # length of the document when the counts were last updated, used to
+        # detect changes that weren't reported
+        self.length = -1
+        self.callback = None
+
+
+class WordIndex(debugmixin):
+    """Reference counted prefix index of the words in a set of buffers.
+    """
+    #: Regex used to split the text into words
+    word_regex = re.compile(r"\w+")
+
+    #: Number of characters read on either side of a modification when
+    #: looking for the ends of the words that it touches
+    context = 32
+
+    def __init__(self):
+        self.buffers = {}
+        # maps each word to the number of times it appears in all buffers
+        self.counts = {}
+        # sorted list of the words in counts
+        self.words = []
+
+    def __len__(self):
+        return len(self.words)
+
+    #: Maximum number of new words that are inserted into the sorted list one
+    #: at a time; more than this and the list is sorted again instead
+    insort_limit = 64
+
+    def addWords(self, entry, text):
+        counts = self.counts
+        new_words = []
+        for word in self.word_regex.findall(text):
+            if word in counts:
+                counts[word] += 1
+            else:
+                counts[word] = 1
+                new_words.append(word)
+            entry.counts[word] = entry.counts.get(word, 0) + 1
+        if len(new_words) <= self.insort_limit:
+            for word in new_words:
+                insort(self.words, word)
+        else:
+            self.words.extend(new_words)
+            self.words.sort()
+
+    def removeWords(self, entry, text):
+        for word in self.word_regex.findall(text):
+            self.removeWord(entry, word, 1)
+
+    def removeWord(self, entry, word, count):
+        remaining = entry.counts.get(word, 0) - count
+        if remaining > 0:
+            entry.counts[word] = remaining
+        elif word in entry.counts:
+            del entry.counts[word]
+        remaining = self.counts.get(word, 0) - count
+        if remaining > 0:
+            self.counts[word] = remaining
+        elif word in self.counts:
+            del self.counts[word]
+            index = bisect_left(self.words, word)
+            if index < len(self.words) and self.words[index] == word:
+                del self.words[index]
+
+    def clearBuffer(self, entry):
+        for word, count in entry.counts.items():
+            self.removeWord(entry, word, count)
+
+    def updateBuffer(self, buf):
+        """Make sure the words of the buffer are included and current.
+
+        The first time a buffer is seen its text is scanned and the index
+        starts listening for modifications of the document.  The buffer is
+        only scanned again if the length of its document shows that a
+        modification was missed, which happens for STCs that don't report
+        their modifications.
+        """
+        entry = self.buffers.get(buf)
+        if entry is not None and entry.stc is not buf.stc:
+            self.removeBuffer(buf)
+            entry = None
+        if entry is None:
+            entry = BufferWords(buf.stc)
+            entry.callback = lambda evt: self.OnModified(entry, evt)
+            if not buf.stc.addDocumentModifiedEvent(entry.callback):
+                entry.callback = None
+            self.buffers[buf] = entry
+        length = buf.stc.GetLength()
+        if entry.length != length:
+            self.dprint("Scanning %s" % buf.url)
+            self.clearBuffer(entry)
+            self.addWords(entry, buf.stc.GetText())
+            entry.length = length
+
+    def removeBuffer(self, buf):
+        entry = self.buffers.pop(buf, None)
+        if entry is not None:
+            if entry.callback is not None:
+                entry.stc.removeDocumentModifiedEvent(entry.callback)
+            self.clearBuffer(entry)
+
+    def getAdjacentWords(self, stc, start, end):
+        """Get the partial words immediately before start and after end.
+        
+        The positions of the STC are byte offsets into its UTF-8 text, so the
+        ends of the ranges that are read are moved to character boundaries.
+        """
+        size = self.context
+        while True:
+            first = max(0, start - size)
+            if first > 0:
+                first = stc.PositionAfter(stc.PositionBefore(first))
+            text = stc.GetTextRange(first, start)
+            before = re.search(r"\w*\Z", text).group(0)
+            if first == 0 or len(before) < len(text):
+                break
+            size *= 2
+        size = self.context
+        length = stc.GetLength()
+        while True:
+            last = min(length, end + size)
+            if last < length:
+                last = stc.PositionBefore(stc.PositionAfter(last))
+            text = stc.GetTextRange(end, last)
+            after = re.match(r"\w*", text).group(0)
+            if last == length or len(after) < len(text):
+                break
+            size *= 2
+        return before, after
+
+    def OnModified(self, entry, evt):
+        """Update the words of the buffer from an STC modification event"""
+        mod = evt.GetModificationType()
+        if mod & wx.stc.STC_MOD_INSERTTEXT:
+            start = evt.GetPosition()
+            text = evt.GetText()
+            before, after = self.getAdjacentWords(entry.stc, start, start + evt.GetLength())
+            self.removeWords(entry, before + after)
+            self.addWords(entry, before + text + after)
+        elif mod & wx.stc.STC_MOD_DELETETEXT:
+            start = evt.GetPosition()
+            text = evt.GetText()
+            before, after = self.getAdjacentWords(entry.stc, start, start)
+            self.removeWords(entry, before + text + after)
+            self.addWords(entry, before + after)
+        else:
+            return
+        entry.length = entry.stc.GetLength()
+
+    def findPrefix(self, prefix, buffers=None):
+        """Find the words that start with the prefix
+
+        @param prefix: the start of the word, which must contain only word
+        characters
+
+        @param buffers: optional list of buffers; if present, only the words
+        that appear in those buffers are returned
+
+        @returns: list of the words longer than the prefix, in sorted order
+        """
+        if buffers is not None:
+            counts = [self.buffers[buf].counts for buf in buffers if buf in self.buffers]
+        found = []
+        index = bisect_left(self.words, prefix)
+        while index < len(self.words):
+            word = self.words[index]
+            if not word.startswith(prefix):
+                break
+            if len(word) > len(prefix):
+                if buffers is None or [1 for c in counts if word in c]:
+                    found.append(word)
+            index += 1
+        return found
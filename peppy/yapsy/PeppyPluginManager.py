@@ -6,18 +6,283 @@ Defines the basic interface for a plugin manager that also keeps track
 of versions of plugins
 """
 
-import sys, os
+import sys, os, types
 
-from peppy.lib.userparams import getAllSubclassesOf
+try:
+    import _ast
+except ImportError:
+    _ast = None
+
+from peppy.lib.userparams import getAllSubclassesOf, GlobalPrefs
 from peppy.yapsy.VersionedPluginManager import VersionedPluginManager, VersionedPluginInfo
 from peppy.yapsy.plugins import *
 from peppy.debug import *
 
+
+class DeferredPlugin(debugmixin):
+    """Placeholder for a plugin that only provides major modes.
+
+    The plugin's code isn't executed until one of its major modes is
+    needed.  Until then, the information needed to match its major modes
+    comes from the L{PluginManifest}.
+    """
+    def __init__(self, infofile, filepath, plugin_info, modes):
+        self.infofile = infofile
+        self.filepath = filepath
+        self.plugin_info = plugin_info
+        self.modes = modes
+        self.is_activated = False
+    
+    def __repr__(self):
+        return "<DeferredPlugin %s>" % self.plugin_info.name
+
+    def activate(self):
+        self.is_activated = True
+
+    def deactivate(self):
+        self.is_activated = False
+    
+    def getDeferredModes(self):
+        """Return the list of descriptions of the plugin's major modes
+        
+        See L{DeferredModeTable.describeMode} for the contents of each
+        description.
+        """
+        return self.modes
+
+
 class PeppyPluginManager(VersionedPluginManager, debugmixin):
     """
     Manage several plugins by ordering them in several categories with
     versioning capabilities.
+    
+    If a L{PluginManifest} is used, the search of the plugin directories
+    and the compiled code of the plugins are cached between runs, and
+    plugins that only provide major modes can be replaced by
+    L{DeferredPlugin} placeholders until their modes are needed.
     """
+    manifest = None
+    manifest_extra_files = []
+    lazy = False
+    deferred = ()
+    
+    # Top level statements allowed in a plugin that can be deferred.  Other
+    # statements might have side effects that are needed at startup.
+    deferrable_statements = ('Import', 'ImportFrom', 'ClassDef')
+
+    def setManifest(self, manifest, extra_files=[], lazy=True):
+        """Use a manifest to skip searching the plugin directories and
+        compiling the plugins when nothing has changed since the last run.
+        
+        @param manifest: L{PluginManifest} instance, already loaded
+        
+        @param extra_files: other files (e.g. configuration files) that
+        invalidate the manifest's list of plugins when they change
+        
+        @param lazy: if True, plugins that only provide major modes aren't
+        loaded until one of their major modes is needed
+        """
+        self.manifest = manifest
+        self.manifest_extra_files = list(extra_files)
+        self.lazy = lazy
+    
+    def getPlaces(self):
+        return [os.path.abspath(p) for p in self.plugins_places]
+
+    def getPluginInfoAttributes(self, plugin_info):
+        attrs = dict(plugin_info.__dict__)
+        attrs.pop('plugin_object', None)
+        return attrs
+
+    def createPluginInfo(self, attrs):
+        plugin_info = self._plugin_info_cls(attrs['name'], attrs['path'])
+        plugin_info.__dict__.update(attrs)
+        return plugin_info
+
+    def locatePlugins(self):
+        """Find the plugins, using the list of plugins from the manifest if
+        nothing has changed since it was created.
+        """
+        if self.manifest is None:
+            return self._component.locatePlugins()
+        places = self.getPlaces()
+        if self.manifest.isValid(places, self.manifest_extra_files):
+            self.dprint("Using plugin list from manifest %s" % self.manifest.filename)
+            self._component._candidates = [(infofile, filepath, self.createPluginInfo(attrs)) for infofile, filepath, attrs in self.manifest.candidates]
+            return len(self._candidates)
+        count = self._component.locatePlugins()
+        candidates = [(infofile, filepath, self.getPluginInfoAttributes(plugin_info)) for infofile, filepath, plugin_info in self._candidates]
+        self.manifest.setCandidates(places, candidates, self.manifest_extra_files)
+        return count
+    
+    def executePluginFile(self, candidate_filepath):
+        """Execute the plugin using the compiled code from the manifest"""
+        if self.manifest is None:
+            return self._component.executePluginFile(candidate_filepath)
+        candidate_globals = {}
+        try:
+            code = self.manifest.getCode(candidate_filepath + ".py")
+            exec code in candidate_globals
+        except Exception, e:
+            import traceback
+            eprint("Unable to execute the code in plugin %s:\n%s" % (candidate_filepath, traceback.format_exc()))
+        return candidate_globals
+
+    def loadPlugins(self, callback=None):
+        """Load the plugins found by L{locatePlugins}, creating placeholders
+        for the plugins that the manifest reports can be deferred.
+        """
+        if self.manifest is None:
+            return VersionedPluginManager.loadPlugins(self, callback)
+        if not hasattr(self, '_candidates'):
+            raise ValueError("locatePlugins must be called before loadPlugins")
+
+        self.loaded_candidates = self._candidates
+        self.deferred = []
+        for candidate_infofile, candidate_filepath, plugin_info in self._candidates:
+            if callback is not None:
+                callback(plugin_info)
+            info = None
+            if self.lazy:
+                info = self.manifest.getDeferred(candidate_infofile, candidate_filepath + ".py")
+            if info is not None:
+                self.addDeferredPlugin(candidate_infofile, candidate_filepath, plugin_info, info)
+            else:
+                candidate_globals = self.executePluginFile(candidate_filepath)
+                self.loadPluginFromGlobals(candidate_infofile, candidate_filepath, plugin_info, candidate_globals)
+        del self._component._candidates
+        self.findLatestVersions()
+    
+    def addDeferredPlugin(self, candidate_infofile, candidate_filepath, plugin_info, info):
+        category = info['category']
+        if category not in self.category_mapping or candidate_infofile in self._category_file_mapping[category]:
+            return
+        proxy = DeferredPlugin(candidate_infofile, candidate_filepath, plugin_info, info['modes'])
+        plugin_info.plugin_object = proxy
+        plugin_info.category = category
+        self.category_mapping[category].append(plugin_info)
+        self._category_file_mapping[category].append(candidate_infofile)
+        self.deferred.append(proxy)
+        self.dprint("Deferred loading %s" % plugin_info.name)
+    
+    def getDeferredPlugins(self):
+        """Return the list of active plugins that haven't been loaded yet"""
+        return [proxy for proxy in self.deferred if proxy.is_activated]
+    
+    def loadDeferredPlugin(self, proxy):
+        """Load the plugin represented by a L{DeferredPlugin}, replacing the
+        placeholder with the real plugin.
+        """
+        if proxy not in self.deferred:
+            return
+        self.deferred.remove(proxy)
+        plugin_info = proxy.plugin_info
+        self.dprint("Loading deferred plugin %s" % plugin_info.name)
+        candidate_globals = self.executePluginFile(proxy.filepath)
+        element, category = self.findPluginClass(candidate_globals)
+        if element is None:
+            eprint("Plugin %s not found in %s" % (plugin_info.name, proxy.filepath))
+            proxy.deactivate()
+            return
+        plugin = element()
+        plugin._import_dir = os.path.dirname(proxy.filepath)
+        plugin_info.plugin_object = plugin
+        
+        # The user's configuration of the new classes can only be applied
+        # now that they exist
+        GlobalPrefs.convertConfig()
+        if proxy.is_activated and not plugin.classprefs.disable_at_startup:
+            plugin.activate()
+    
+    def loadDeferredPlugins(self):
+        """Load all the deferred plugins.
+        
+        Used when the complete list of plugins or major modes is needed.
+        """
+        for proxy in list(self.deferred):
+            self.loadDeferredPlugin(proxy)
+    
+    def isModuleDeferrable(self, filename):
+        """Check that executing the plugin's source only imports modules and
+        defines classes.
+        """
+        if _ast is None:
+            return False
+        try:
+            fh = open(filename, 'rU')
+            try:
+                source = fh.read()
+            finally:
+                fh.close()
+            tree = compile(source, filename, 'exec', _ast.PyCF_ONLY_AST)
+        except (IOError, OSError, SyntaxError, TypeError), e:
+            return False
+        for i, node in enumerate(tree.body):
+            if i == 0 and isinstance(node, _ast.Expr) and isinstance(node.value, _ast.Str):
+                # docstring
+                continue
+            if node.__class__.__name__ not in self.deferrable_statements:
+                return False
+        return True
+    
+    def isPluginDeferrable(self, plugin):
+        """Check that the plugin only overrides the L{IPeppyPlugin.getMajorModes}
+        method, so nothing but its major modes are needed until one of them
+        is used.
+        """
+        for cls in plugin.__class__.__mro__:
+            if cls is IPeppyPlugin:
+                return True
+            for name, value in cls.__dict__.iteritems():
+                if isinstance(value, (types.FunctionType, classmethod, staticmethod)) and name != "getMajorModes":
+                    return False
+        return False
+    
+    def getDeferredInfo(self, plugin_info, filename):
+        """Get the information needed to create a L{DeferredPlugin} for a
+        loaded plugin.
+        
+        @returns: dict, or None if the plugin can't be deferred
+        """
+        from peppy.majormodematcher import DeferredModeTable
+        
+        plugin = plugin_info.plugin_object
+        if plugin is None or not isinstance(plugin, IPeppyPlugin):
+            return None
+        if not self.isPluginDeferrable(plugin) or not self.isModuleDeferrable(filename):
+            return None
+        modes = []
+        for mode in plugin.getMajorModes():
+            desc = DeferredModeTable.describeMode(mode)
+            if desc is None:
+                return None
+            modes.append(desc)
+        if not modes:
+            return None
+        return {'category': plugin_info.category,
+                'modes': modes,
+                }
+    
+    def saveManifest(self):
+        """Update the deferred plugin information of the loaded plugins and
+        save the manifest.
+        
+        The major mode information is updated here rather than when the
+        plugin is loaded so that it includes the user's configuration.
+        """
+        if self.manifest is None or self.manifest.candidates is None:
+            return
+        for infofile, filepath, plugin_info in getattr(self, 'loaded_candidates', []):
+            if not isinstance(plugin_info.plugin_object, DeferredPlugin):
+                filename = filepath + ".py"
+                self.manifest.setDeferred(infofile, filename, self.getDeferredInfo(plugin_info, filename))
+        # The configuration is saved by the application, so changes to the
+        # config files made up to now are already reflected in the manifest
+        self.manifest.watchFiles(self.manifest_extra_files)
+        try:
+            self.manifest.save()
+        except (IOError, OSError), e:
+            eprint("Failed saving plugin manifest %s: %s" % (self.manifest.filename, e))
 
     def getAllPlugins(self):
         if not hasattr(self, 'all_plugins'):
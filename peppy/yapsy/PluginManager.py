@@ -271,41 +271,61 @@ class PluginManager(object):
 
 			# now execute the file and get its content into a
 			# specific dictionnary
-			candidate_globals = {}
-			try:
-				execfile(candidate_filepath+".py",candidate_globals)
-			except Exception,e:
-				logging.error("Unable to execute the code in plugin: %s" % candidate_filepath)
-				import traceback
-				logging.error("\t The following problem occured: %s %s " % (os.linesep, traceback.format_exc()))
-
-			# now try to find and initialise the first subclass of the correct plugin interface
-			for element in candidate_globals.values():
-				current_category = None
-				for category_name in self.categories_interfaces.keys():
-					try:
-						is_correct_subclass = issubclass(element, self.categories_interfaces[category_name])
-					except:
-						continue
-					if is_correct_subclass:
-						if element is not self.categories_interfaces[category_name]:
-							current_category = category_name
-							break
-				if current_category is not None:
-					if not (candidate_infofile in self._category_file_mapping[current_category]): 
-						# we found a new plugin: initialise it and search for the next one
-						plugin_info.plugin_object = element()
-						plugin_info.plugin_object._import_dir = os.path.dirname(candidate_filepath)
-						plugin_info.category = current_category
-						self.category_mapping[current_category].append(plugin_info)
-						self._category_file_mapping[current_category].append(candidate_infofile)
-						current_category = None
-					break
+			candidate_globals = self.executePluginFile(candidate_filepath)
+			self.loadPluginFromGlobals(candidate_infofile, candidate_filepath, plugin_info, candidate_globals)
 
 		# Remove candidates list since we don't need them any more and
 		# don't need to take up the space
 		delattr(self, '_candidates')
 
+	def executePluginFile(self, candidate_filepath):
+		"""
+		Execute the code of a plugin and return its global namespace.
+		"""
+		candidate_globals = {}
+		try:
+			execfile(candidate_filepath+".py",candidate_globals)
+		except Exception,e:
+			logging.error("Unable to execute the code in plugin: %s" % candidate_filepath)
+			import traceback
+			logging.error("\t The following problem occured: %s %s " % (os.linesep, traceback.format_exc()))
+		return candidate_globals
+
+	def findPluginClass(self, candidate_globals):
+		"""
+		Find the first subclass of one of the plugin interfaces in the
+		global namespace of a plugin.
+
+		Return a tuple of the class and its category, or (None, None)
+		if no plugin class is found.
+		"""
+		for element in candidate_globals.values():
+			for category_name in self.categories_interfaces.keys():
+				try:
+					is_correct_subclass = issubclass(element, self.categories_interfaces[category_name])
+				except:
+					continue
+				if is_correct_subclass:
+					if element is not self.categories_interfaces[category_name]:
+						return element, category_name
+		return None, None
+
+	def loadPluginFromGlobals(self, candidate_infofile, candidate_filepath, plugin_info, candidate_globals):
+		"""
+		Find and initialise the plugin class from the global namespace of
+		the executed plugin, and store it in the appropriate slot of the
+		category_mapping.
+		"""
+		element, current_category = self.findPluginClass(candidate_globals)
+		if current_category is not None:
+			if not (candidate_infofile in self._category_file_mapping[current_category]): 
+				# we found a new plugin: initialise it
+				plugin_info.plugin_object = element()
+				plugin_info.plugin_object._import_dir = os.path.dirname(candidate_filepath)
+				plugin_info.category = current_category
+				self.category_mapping[current_category].append(plugin_info)
+				self._category_file_mapping[current_category].append(candidate_infofile)
+
 	def collectPlugins(self):
 		"""
 		Walk through the plugins' places and look for plugins.  Then
@@ -0,0 +1,237 @@
+# peppy Copyright (c) 2006-2010 Rob McMullen
+# Licenced under the GPLv2; see http://peppy.flipturn.org for more info
+"""Cache of the information needed to load the yapsy plugins
+
+Searching the plugin directories, parsing the plugin info files, and
+compiling every plugin is a large part of the startup time.  The manifest
+stores the results of the search, the compiled code of each plugin, and the
+information needed to match the major modes of plugins that only provide
+major modes so that those plugins don't have to be loaded until one of their
+modes is used.
+
+The search results are reused as long as none of the plugin directories
+(including their subdirectories), plugin info files, or the other watched
+files like the configuration files have changed.  The compiled code and
+major mode information of each plugin are checked against the modification
+time and size of its source file.
+"""
+
+import os, marshal
+import cPickle as pickle
+
+from peppy.debug import *
+
+
+class PluginManifest(debugmixin):
+    """Persistent cache of the plugin search results and plugin code.
+    """
+    #: Version of the pickled manifest; manifests of other versions are
+    #: discarded
+    version = 2
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.clear()
+
+    def clear(self):
+        # list of plugin directories used to create the candidate list
+        self.places = None
+        # maps each directory and file that affects the candidate list to its
+        # modification time, or None if it doesn't exist
+        self.watched = {}
+        # list of (infofile, filepath, attrs) tuples, where attrs is a dict of
+        # the attributes of the plugin info object
+        self.candidates = None
+        # maps the source filename to a tuple of (key, marshalled code)
+        self.code = {}
+        # maps the plugin info filename to a tuple of (key, info) where info
+        # is the data needed to create a deferred plugin
+        self.deferred = {}
+        self.changed = False
+
+    @classmethod
+    def getMtime(cls, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    @classmethod
+    def getFileKey(cls, path):
+        """Get the modification time and size used to determine if a file has
+        changed, or None if it doesn't exist"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def load(self):
+        """Load the manifest from its file, starting with an empty manifest
+        if the file doesn't exist or can't be read.
+        """
+        self.clear()
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            fh = open(self.filename, 'rb')
+            try:
+                data = pickle.load(fh)
+            finally:
+                fh.close()
+            if data.get('version') != self.version:
+                self.dprint("Discarding version %s manifest %s" % (data.get('version'), self.filename))
+                return
+            self.places = data['places']
+            self.watched = data['watched']
+            self.candidates = data['candidates']
+            self.code = data['code']
+            self.deferred = data['deferred']
+        except Exception, e:
+            self.dprint("Failed loading manifest %s: %s" % (self.filename, e))
+            self.clear()
+
+    def save(self):
+        """Save the manifest if it has changed"""
+        if not self.filename or not self.changed:
+            return
+        data = {
+            'version': self.version,
+            'places': self.places,
+            'watched': self.watched,
+            'candidates': self.candidates,
+            'code': self.code,
+            'deferred': self.deferred,
+            }
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        temp = self.filename + ".tmp"
+        fh = open(temp, 'wb')
+        try:
+            pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fh.close()
+        if os.name == "nt" and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(temp, self.filename)
+        self.changed = False
+
+    def isValid(self, places, extra_files=[]):
+        """Check if the candidate list can be reused.
+
+        Adding or removing a file changes the modification time of its
+        directory, so only the directories and plugin info files have to be
+        checked rather than walking the entire directory tree.
+
+        @param places: list of absolute pathnames of the plugin directories
+
+        @param extra_files: list of other files that invalidate the
+        candidates when they change
+        """
+        if self.candidates is None or places != self.places:
+            return False
+        for path in extra_files:
+            if path not in self.watched:
+                return False
+        for path, mtime in self.watched.iteritems():
+            if self.getMtime(path) != mtime:
+                self.dprint("%s has changed" % path)
+                return False
+        return True
+
+    def setCandidates(self, places, candidates, extra_files=[]):
+        """Record the results of a search of the plugin directories
+
+        @param places: list of absolute pathnames of the plugin directories
+
+        @param candidates: list of (infofile, filepath, attrs) tuples
+
+        @param extra_files: list of other files that invalidate the
+        candidates when they change
+        """
+        self.places = list(places)
+        self.candidates = list(candidates)
+        self.watched = {}
+        for directory in self.places:
+            if os.path.isdir(directory):
+                for dirpath, dirnames, filenames in os.walk(directory):
+                    self.watched[dirpath] = self.getMtime(dirpath)
+            else:
+                self.watched[directory] = None
+        for infofile, filepath, attrs in self.candidates:
+            self.watched[infofile] = self.getMtime(infofile)
+        for path in extra_files:
+            self.watched[path] = self.getMtime(path)
+
+        # The deferred plugin information may depend on the changes, so it
+        # is recreated after the plugins are loaded again.  The compiled code
+        # only depends on the source, but plugins that no longer exist are
+        # removed.
+        self.deferred = {}
+        sources = set([c[1] + ".py" for c in self.candidates])
+        for filename in self.code.keys():
+            if filename not in sources:
+                del self.code[filename]
+        self.changed = True
+
+    def watchFiles(self, paths):
+        """Update the modification times of watched files that have been
+        changed by the application itself, like the configuration files.
+        """
+        for path in paths:
+            mtime = self.getMtime(path)
+            if self.watched.get(path) != mtime:
+                self.watched[path] = mtime
+                self.changed = True
+
+    def getCode(self, filename):
+        """Get the compiled code of a python source file, only compiling it
+        if the file has changed since it was last compiled.
+        """
+        key = self.getFileKey(filename)
+        entry = self.code.get(filename)
+        if entry is not None and entry[0] == key:
+            return marshal.loads(entry[1])
+        fh = open(filename, 'rU')
+        try:
+            source = fh.read()
+        finally:
+            fh.close()
+        if not source.endswith("\n"):
+            source += "\n"
+        code = compile(source, filename, 'exec')
+        self.code[filename] = (key, marshal.dumps(code))
+        self.changed = True
+        return code
+
+    def getDeferred(self, infofile, filename):
+        """Get the deferred plugin information of a plugin
+
+        @param infofile: pathname of the plugin info file
+
+        @param filename: pathname of the plugin's source file
+
+        @returns: the information stored by L{setDeferred}, or None if the
+        plugin can't be deferred or its source has changed
+        """
+        entry = self.deferred.get(infofile)
+        if entry is not None and entry[0] == self.getFileKey(filename):
+            return entry[1]
+        return None
+
+    def setDeferred(self, infofile, filename, info):
+        """Store the deferred plugin information of a plugin
+
+        @param info: pickleable information about the plugin, or None if the
+        plugin must always be loaded at startup
+        """
+        if info is None:
+            if infofile in self.deferred:
+                del self.deferred[infofile]
+                self.changed = True
+        else:
+            entry = (self.getFileKey(filename), info)
+            if self.deferred.get(infofile) != entry:
+                self.deferred[infofile] = entry
+                self.changed = True
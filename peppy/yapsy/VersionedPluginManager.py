@@ -107,9 +107,13 @@ class VersionedPluginManager(PluginManagerDecorator):
 		"""
 # 		print "%s.loadPlugins" % self.__class__
 		self._component.loadPlugins(callback)
-		
-		# Search through all the loaded plugins to find the latest
-		# version of each.
+		self.findLatestVersions()
+
+	def findLatestVersions(self):
+		"""
+		Search through all the loaded plugins to find the latest
+		version of each.
+		"""
 		for categ, items in self._component.category_mapping.iteritems():
 			unique_items = {}
 			for item in items:
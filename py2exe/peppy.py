@@ -10,6 +10,16 @@ import os,sys
 import __builtin__
 __builtin__._ = unicode
 
-import peppy.main
+if __name__ == "__main__":
+    # Worker processes of the multiprocessing pools used by the search and
+    # cube comparison code start by running this script; on Windows they
+    # must not start another copy of the application
+    try:
+        import multiprocessing
+        multiprocessing.freeze_support()
+    except ImportError:
+        pass
 
-peppy.main.main()
+    import peppy.main
+
+    peppy.main.main()
@@ -43,6 +43,26 @@ class MockWX(object):
 class MockSTC(PeppyBaseSTC):
     pass
 
+class MockModifiedEvent(object):
+    """Modification event of an STC, used by mock STCs that report their
+    modifications to document modified callbacks"""
+    def __init__(self, mod, pos, text):
+        self.mod = mod
+        self.pos = pos
+        self.text = text
+
+    def GetModificationType(self):
+        return self.mod
+
+    def GetPosition(self):
+        return self.pos
+
+    def GetLength(self):
+        return len(self.text)
+
+    def GetText(self):
+        return self.text
+
 class MockBuffer(object):
     def __init__(self, stc):
         self.stc = stc
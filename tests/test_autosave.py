@@ -0,0 +1,150 @@
+import os, sys, re, shutil, tempfile
+
+import wx.stc
+
+import peppy.vfs as vfs
+from peppy.autosave import *
+
+from mock_wx import *
+
+from nose.tools import *
+
+class MockJournalSTC(object):
+    def __init__(self, text):
+        self.text = text
+        self.callbacks = []
+        self.target = (0, 0)
+        self.undo_level = 0
+
+    def GetText(self):
+        return self.text
+
+    def GetLength(self):
+        return len(self.text)
+
+    def addDocumentModifiedEvent(self, callback):
+        self.callbacks.append(callback)
+        return True
+
+    def removeDocumentModifiedEvent(self, callback):
+        self.callbacks.remove(callback)
+
+    def BeginUndoAction(self):
+        self.undo_level += 1
+
+    def EndUndoAction(self):
+        self.undo_level -= 1
+
+    def InsertText(self, pos, text):
+        self.text = self.text[:pos] + text + self.text[pos:]
+        for callback in self.callbacks:
+            callback(MockModifiedEvent(wx.stc.STC_MOD_INSERTTEXT, pos, text))
+
+    def SetTargetStart(self, pos):
+        self.target = (pos, self.target[1])
+
+    def SetTargetEnd(self, pos):
+        self.target = (self.target[0], pos)
+
+    def ReplaceTarget(self, text):
+        start, end = self.target
+        deleted = self.text[start:end]
+        self.text = self.text[:start] + self.text[end:]
+        for callback in self.callbacks:
+            callback(MockModifiedEvent(wx.stc.STC_MOD_DELETETEXT, start, deleted))
+        if text:
+            self.InsertText(start, text)
+
+    def delete(self, pos, length):
+        self.SetTargetStart(pos)
+        self.SetTargetEnd(pos + length)
+        self.ReplaceTarget("")
+
+class TestAutosaveJournal(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.base_url = vfs.normalize(os.path.join(self.dir, "base.txt"))
+        self.snapshot_url = vfs.normalize(os.path.join(self.dir, "snapshot.txt"))
+        self.journal_url = vfs.normalize(os.path.join(self.dir, "base.txt.journal"))
+        self.original = u"first line\nsecond line\n"
+        self.save(self.base_url, self.original)
+        self.stc = MockJournalSTC(self.original)
+        self.journal = AutosaveJournal()
+        self.journal.clear(True)
+        self.journal.start(self.stc)
+
+    def teardown(self):
+        self.journal.stop()
+        shutil.rmtree(self.dir)
+
+    def save(self, url, text):
+        fh = vfs.open_write(url)
+        fh.write(text.encode('utf-8'))
+        fh.close()
+        return True
+
+    def restore(self, text):
+        kind, size, mtime, records = AutosaveJournal.read(self.journal_url)
+        stc = MockJournalSTC(text)
+        AutosaveJournal.replay(stc, records)
+        eq_(0, stc.undo_level)
+        return kind, stc.GetText()
+
+    def test_file(self):
+        self.stc.InsertText(6, u"\u00e9dited ")
+        self.journal.startFromFile(self.journal_url, self.base_url)
+        self.journal.write()
+        self.stc.delete(0, 6)
+        self.stc.InsertText(self.stc.GetLength(), u"third line\n")
+        self.journal.write()
+        eq_([], self.journal.pending)
+        kind, size, mtime, records = AutosaveJournal.read(self.journal_url)
+        eq_("file", kind)
+        eq_(True, AutosaveJournal.isBaseValid(self.base_url, size, mtime))
+        eq_(("file", self.stc.GetText()), self.restore(self.original))
+
+    def test_snapshot(self):
+        self.stc.InsertText(0, u"zeroth line\n")
+        self.journal.startFromSnapshot(self.journal_url, self.snapshot_url, lambda url: self.save(url, self.stc.GetText()))
+        eq_([], self.journal.pending)
+        eq_(0, self.journal.size)
+        snapshot = self.stc.GetText()
+        self.stc.delete(0, 7)
+        self.journal.write()
+        eq_(("snapshot", self.stc.GetText()), self.restore(snapshot))
+        eq_(True, self.journal.needsSnapshot(0, 5))
+        eq_(False, self.journal.needsSnapshot(self.stc.GetLength(), 5))
+
+    def test_real_stc(self):
+        # The positions of the real STC are byte offsets into its UTF-8 text
+        self.journal.stop()
+        stc = MockSTC(MockWX.root)
+        stc.SetText(self.original)
+        self.journal.start(stc)
+        self.journal.startFromFile(self.journal_url, self.base_url)
+        stc.InsertText(6, u"caf\u00e9 ")
+        stc.InsertText(stc.GetLength(), u"\u00e9t\u00e9\n")
+        text = stc.GetText()
+        pos = len(text[:text.index(u"second")].encode('utf-8'))
+        stc.SetTargetStart(pos)
+        stc.SetTargetEnd(pos + 7)
+        stc.ReplaceTarget("")
+        self.journal.write()
+        kind, size, mtime, records = AutosaveJournal.read(self.journal_url)
+        restored = MockSTC(MockWX.root)
+        restored.SetText(self.original)
+        AutosaveJournal.replay(restored, records)
+        eq_(u"first caf\u00e9 line\nline\n\u00e9t\u00e9\n", restored.GetText())
+        eq_(stc.GetText(), restored.GetText())
+        stc.Destroy()
+        restored.Destroy()
+
+    def test_truncated(self):
+        self.journal.startFromFile(self.journal_url, self.base_url)
+        self.stc.InsertText(0, u"kept ")
+        self.journal.write()
+        expected = self.stc.GetText()
+        fh = vfs.open(self.journal_url, vfs.APPEND)
+        fh.write("I 0 10\nlost")
+        fh.close()
+        eq_(("file", expected), self.restore(self.original))
@@ -0,0 +1,227 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2007 Rob McMullen <robm@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Import from the Standard Library
+import unittest
+from unittest import TestCase
+import threading, time
+import BaseHTTPServer, httplib
+
+# Import from itools
+import peppy.vfs as vfs
+from peppy.vfs.davclient import DAVClient, ConnectionPool
+from peppy.vfs.webdav import WebDavFS
+
+
+class StandInDAVHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal keep-alive WebDAV server that serves a dict of files"""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.close_connections:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        if self.path in self.server.files:
+            self.send_body(200, self.server.files[self.path])
+        else:
+            self.send_body(404, "")
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        self.server.puts += 1
+        self.server.files[self.path] = self.read_body()
+        if self.path in self.server.broken:
+            # Fail after the request has been carried out
+            self.wfile.write("HTTP/1.1 garbage\r\n")
+            self.close_connection = 1
+            return
+        self.send_body(201, "")
+
+    def do_PROPFIND(self):
+        self.read_body()
+        self.server.propfinds += 1
+        responses = []
+        for path, data in self.server.files.iteritems():
+            if path.startswith(self.path):
+                responses.append("<D:response><D:href>%s</D:href><D:propstat><D:prop><D:getcontentlength>%d</D:getcontentlength></D:prop></D:propstat></D:response>" % (path, len(data)))
+        body = '<?xml version="1.0" encoding="utf-8" ?><D:multistatus xmlns:D="DAV:">%s</D:multistatus>' % "".join(responses)
+        self.send_body(207, body, 'text/xml; charset="utf-8"')
+
+
+class StandInDAVServer(BaseHTTPServer.HTTPServer):
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", 0), StandInDAVHandler)
+        self.connections = 0
+        self.propfinds = 0
+        self.puts = 0
+        self.close_connections = False
+        self.broken = set()
+        self.files = {"/dir/file.txt": "contents"}
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class DAVClientPoolTestCase(TestCase):
+    def setUp(self):
+        self.server = StandInDAVServer()
+        self.saved_pool = DAVClient.pool
+        DAVClient.pool = ConnectionPool()
+        self.ref = vfs.get_reference("http://localhost:%d/" % self.server.server_address[1])
+
+    def tearDown(self):
+        DAVClient.pool.close_all()
+        DAVClient.pool = self.saved_pool
+        self.server.stop()
+
+    def test00_reuse(self):
+        client = DAVClient(self.ref)
+        responses = client.propfind("/dir/", depth=1)
+        self.assertEqual(responses["/dir/file.txt"]["getcontentlength"], "8")
+        self.assertEqual(client.get("/dir/file.txt"), "contents")
+        client.put("/dir/new.txt", "new")
+        self.assertEqual(client.response.status, 201)
+        # a new client uses the same pool
+        client = DAVClient(self.ref)
+        client.head("/dir/new.txt")
+        self.assertEqual(client.response.status, 200)
+        self.assertEqual(self.server.files["/dir/new.txt"], "new")
+        self.assertEqual(self.server.connections, 1)
+        stats = DAVClient.pool.get_stats()
+        self.assertEqual((stats['created'], stats['reused'], stats['idle'], stats['active']), (1, 3, 1, 0))
+
+    def test01_server_closes(self):
+        self.server.close_connections = True
+        client = DAVClient(self.ref)
+        self.assertEqual(client.get("/dir/file.txt"), "contents")
+        self.assertEqual(client.get("/dir/file.txt"), "contents")
+        self.assertEqual(self.server.connections, 2)
+        stats = DAVClient.pool.get_stats()
+        self.assertEqual((stats['created'], stats['discarded'], stats['idle']), (2, 2, 0))
+
+    def test02_stale_connection(self):
+        client = DAVClient(self.ref)
+        client.get("/dir/file.txt")
+        # Simulate the server dropping the idle connection
+        DAVClient.pool.idle.values()[0][0][0].sock.close()
+        self.assertEqual(client.get("/dir/file.txt"), "contents")
+        self.assertEqual(DAVClient.pool.get_stats()['created'], 2)
+
+    def test03_no_replay(self):
+        self.server.broken.add("/dir/broken.txt")
+        client = DAVClient(self.ref)
+        client.get("/dir/file.txt")
+        self.assertRaises(httplib.BadStatusLine, client.put, "/dir/broken.txt", "data")
+        self.assertEqual(self.server.puts, 1)
+
+    def test04_idle_timeout(self):
+        DAVClient.pool.idle_timeout = 0.01
+        client = DAVClient(self.ref)
+        client.get("/dir/file.txt")
+        time.sleep(0.05)
+        client.get("/dir/file.txt")
+        stats = DAVClient.pool.get_stats()
+        self.assertEqual((stats['created'], stats['expired']), (2, 1))
+
+
+class WebDavMetadataTestCase(TestCase):
+    def setUp(self):
+        self.server = StandInDAVServer()
+        self.server.files["/dir/other.txt"] = "other file"
+        self.saved_pool = DAVClient.pool
+        DAVClient.pool = ConnectionPool()
+        self.saved_cache = WebDavFS.response_cache
+        WebDavFS.response_cache = vfs.MetadataCache()
+        self.root = "webdav://localhost:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+        WebDavFS.response_cache = self.saved_cache
+        DAVClient.pool.close_all()
+        DAVClient.pool = self.saved_pool
+        self.server.stop()
+
+    def test00_listing_fills_cache(self):
+        folder = vfs.get_reference(self.root + "/dir/")
+        WebDavFS._propfind(folder, listing=True)
+        self.assertEqual(self.server.propfinds, 1)
+        ref = vfs.get_reference(self.root + "/dir/other.txt")
+        self.assertEqual(WebDavFS.exists(ref), True)
+        self.assertEqual(WebDavFS.get_size(ref), 10)
+        metadata = WebDavFS.get_metadata(vfs.get_reference(self.root + "/dir/file.txt"))
+        self.assertEqual(metadata['size'], 8)
+        self.assertEqual(self.server.propfinds, 1)
+
+    def test01_purge(self):
+        ref = vfs.get_reference(self.root + "/dir/file.txt")
+        WebDavFS._propfind(vfs.get_reference(self.root + "/dir/"), listing=True)
+        WebDavFS._purge_cache(ref)
+        self.assertEqual(len(WebDavFS.response_cache), 1)
+        WebDavFS.get_size(ref)
+        self.assertEqual(self.server.propfinds, 2)
+
+
+class FakeConnection(object):
+    def close(self):
+        pass
+
+
+class ConnectionPoolTestCase(TestCase):
+    def test00_max_per_host(self):
+        pool = ConnectionPool(max_per_host=1)
+        first, reused = pool.get("key", FakeConnection)
+        results = []
+        def request():
+            results.append(pool.get("key", FakeConnection))
+        thread = threading.Thread(target=request)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(results, [])
+        pool.release("key", first)
+        thread.join()
+        self.assertEqual(results, [(first, True)])
+        stats = pool.get_stats()
+        self.assertEqual((stats['created'], stats['waits'], stats['active']), (1, 1, 1))
+        # other hosts aren't limited by the first
+        other, reused = pool.get("other", FakeConnection)
+        self.assertEqual(reused, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os, sys, re
+
+from peppy.lib.foldexplorer import FoldExplorerNode
+from peppy.foldhierarchy import *
+
+from nose.tools import *
+
+class MockFoldMode(object):
+    """Document where each line is either a fold entry "name:level" or text"""
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.scanned = []
+
+    def GetLineCount(self):
+        return len(self.lines)
+
+    def GetEndStyled(self):
+        return len(self.lines)
+
+    def LineFromPosition(self, pos):
+        return pos
+
+    def PositionFromLine(self, line):
+        return line
+
+    def GetLineEndPosition(self, line):
+        return line
+
+    def Colourise(self, start, end):
+        pass
+
+    def iterFoldEntries(self, line, last_line=-1):
+        if last_line < 0:
+            last_line = len(self.lines)
+        for num in range(line, min(last_line, len(self.lines))):
+            self.scanned.append(num)
+            if ":" in self.lines[num]:
+                text, level = self.lines[num].split(":")
+                node = FoldExplorerNode(level=int(level), start=num, end=last_line, text=text)
+                node.show = True
+                yield node
+
+    def insert(self, hierarchy, line, lines):
+        self.lines[line + 1:line + 1] = lines
+        hierarchy.addChange(line, len(lines))
+
+    def delete(self, hierarchy, line, count):
+        del self.lines[line + 1:line + 1 + count]
+        hierarchy.addChange(line, -count)
+
+def summary(node):
+    return [(child.text, child.start, summary(child)) for child in node.children]
+
+class TestFoldHierarchy(object):
+    def setup(self):
+        self.mode = MockFoldMode(["class A:1", "", "f:2", "", "class B:1", "g:2", "", "h:2", ""])
+        self.hierarchy = FoldHierarchy()
+        self.hierarchy.update(self.mode)
+        self.mode.scanned = []
+
+    def check(self):
+        full = FoldHierarchy()
+        full.update(MockFoldMode(self.mode.lines))
+        eq_(summary(full.root), summary(self.hierarchy.root))
+
+    def test_insert(self):
+        version = self.hierarchy.version
+        nodes = list(self.hierarchy.entries)
+        self.mode.insert(self.hierarchy, 5, ["x:2", ""])
+        self.hierarchy.update(self.mode)
+        self.check()
+        eq_([5, 6, 7], self.mode.scanned)
+        # entries outside the changed lines are reused
+        eq_(True, self.hierarchy.entries[0] is nodes[0])
+        eq_(True, self.hierarchy.entries[-1] is nodes[-1])
+        eq_(9, nodes[-1].start)
+        version, changed = self.hierarchy.getChangesSince(version)
+        eq_([nodes[2]], changed)
+
+    def test_delete(self):
+        self.mode.delete(self.hierarchy, 3, 2)
+        self.hierarchy.update(self.mode)
+        self.check()
+        eq_([3], self.mode.scanned)
+        eq_([('class A', 0, [('f', 2, []), ('h', 5, [])])], summary(self.hierarchy.root))
+
+    def test_changes(self):
+        eq_((1, []), self.hierarchy.getChangesSince(1))
+        eq_((1, None), self.hierarchy.getChangesSince(None))
+        self.hierarchy.addChange(2)
+        self.hierarchy.update(self.mode)
+        # reparsing the same entry still replaces it
+        version, changed = self.hierarchy.getChangesSince(1)
+        eq_(2, version)
+        for count in range(FoldHierarchy.max_log):
+            self.hierarchy.addChange(2)
+            self.hierarchy.update(self.mode)
+        eq_(None, self.hierarchy.getChangesSince(1)[1])
@@ -0,0 +1,75 @@
+import os, sys, re, struct
+
+import wx.stc
+
+from mock_wx import *
+
+from peppy.major_modes.hexedit import HugeTable
+
+from nose.tools import *
+
+class MockBinarySTC(object):
+    def __init__(self, data):
+        self.data = data
+
+    def GetLength(self):
+        return len(self.data)
+
+    def GetBinaryData(self, start, end):
+        return self.data[start:end]
+
+
+class TestHugeTable(object):
+    def setUp(self):
+        # 766 bytes isn't a multiple of the size of any of the formats, so
+        # the last row is always partly filled
+        self.data = "".join([chr(i) for i in range(256)]) * 3
+        self.data = self.data[0:766]
+        self.formats = ["ic", ">ic", "hb", "16c"]
+
+    def getExpectedRows(self, format, data):
+        nbytes = struct.calcsize(format)
+        return [struct.unpack(format, data[i:i + nbytes]) for i in range(0, len(data), nbytes)]
+
+    def testUniform(self):
+        for format, uniform in [("ic", False), (">ic", True), ("hb", False), ("16c", True), ("=hb", True)]:
+            table = HugeTable(MockBinarySTC(self.data), format)
+            eq_(table._block_uniform, uniform)
+
+    def testUnpackRows(self):
+        for format in self.formats:
+            table = HugeTable(MockBinarySTC(self.data), format)
+            count = len(self.data) / table.nbytes
+            data = self.data[0:count * table.nbytes]
+            eq_(table.unpackRows(data, count), self.getExpectedRows(format, data))
+            eq_(table.unpackRows(data[0:table.nbytes], 1), self.getExpectedRows(format, data[0:table.nbytes]))
+
+    def testDecodeBlock(self):
+        for format in self.formats:
+            table = HugeTable(MockBinarySTC(self.data), format)
+            nbytes = table.nbytes
+            rows = table._block_rows
+            table.decodeRows(rows + 5)
+            # the whole block containing the row is decoded, stopping at the
+            # last full row for the formats with fewer than two blocks
+            end = min(rows * 2, len(self.data) / nbytes)
+            for row in range(rows, end):
+                assert row in table._cache
+                data = self.data[row * nbytes:(row + 1) * nbytes]
+                eq_(table._cache[row], (data, struct.unpack(format, data)))
+            assert rows - 1 not in table._cache
+            if end == rows * 2:
+                assert end not in table._cache
+
+    def testPartialLastRow(self):
+        for format in self.formats:
+            table = HugeTable(MockBinarySTC(self.data), format)
+            nbytes = table.nbytes
+            last = table._rows - 1
+            eq_(last, len(self.data) / nbytes)
+            data = self.data[last * nbytes:]
+            assert 0 < len(data) < nbytes
+            padded = data + "\0" * (nbytes - len(data))
+            eq_(table.getRowData(last), (padded, struct.unpack(format, padded)))
+            eq_(table.getRowData(last - 1)[0], self.data[(last - 1) * nbytes:last * nbytes])
+            assert last + 1 not in table._cache
@@ -3,7 +3,7 @@
 Test the capabilities of HSI.Cube
 
 """
-import os,os.path,sys,re,time,commands
+import os,os.path,sys,re,time,commands,tempfile
 
 from nose.tools import *
 
@@ -11,6 +11,13 @@ import peppy.vfs as vfs
 
 import peppy.hsi.common as HSI
 import peppy.hsi.ENVI as ENVI
+import peppy.hsi.FITS as FITS
+from peppy.hsi.cube import getFileCubeReader
+from peppy.hsi.cache import BandCache, BandPrefetcher
+from peppy.hsi.utils import CubeCompare
+from peppy.hsi.statistics import CubeStatistics
+from peppy.hsi.filter import ContrastFilter, RGBMapper, PaletteMapper, ClipFilter, MedianFilter1D, GaussianFilter, ChainFilter
+from peppy.hsi.transpose import CubeTransposer
 
 from cStringIO import StringIO
 import numpy
@@ -68,7 +75,7 @@ fwhm = {
 """ % HSI.nativeByteOrder
 
 
-def fakeCube(interleave,default=None, file=fakeNmFile):
+def fakeCube(interleave,default=None, file=fakeNmFile, writable=False):
     file=StringIO(file)
     h=ENVI.Header()
     h.read(file)
@@ -82,7 +89,10 @@ def fakeCube(interleave,default=None, file=fakeNmFile):
         data = numpy.zeros((other.samples*other.lines*other.bands),dtype=other.data_type)
         data += default
     
-    cube = HSI.createCubeLike(other, data=data.tostring())
+    data = data.tostring()
+    if writable:
+        data = bytearray(data)
+    cube = HSI.createCubeLike(other, data=data)
     h.setCubeAttributes(cube)
     return cube
    
@@ -329,3 +339,531 @@ class testGuessBands(object):
         eq_(bands,[7])
         bands = self.cube.getBandListByWavelength(680.0,units='nm')
         eq_(bands,[7])
+
+
+class testFileCubeReaders(object):
+    def setUp(self):
+        self.saved_block_size = HSI.FileCubeReader.io_block_size
+        self.tempfiles = []
+    
+    def tearDown(self):
+        HSI.FileCubeReader.io_block_size = self.saved_block_size
+        for filename in self.tempfiles:
+            os.remove(filename)
+    
+    def getFileCube(self, interleave):
+        mmap_cube = fakeCube(interleave)
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, mmap_cube.getNumpyArray().tostring())
+        os.close(fd)
+        self.tempfiles.append(filename)
+        cube = HSI.createCubeLike(mmap_cube)
+        cube.setURL(filename)
+        cube.cube_io = getFileCubeReader(cube)(cube, cube.url)
+        return mmap_cube, cube
+    
+    def checkReader(self, interleave):
+        # block sizes smaller than a line, a few lines, and the whole cube
+        for block_size in [1, 64, 1024 * 1024]:
+            HSI.FileCubeReader.io_block_size = block_size
+            mmap_cube, cube = self.getFileCube(interleave)
+            for band in range(cube.bands):
+                eq_(cube.getBandRaw(band).tolist(), mmap_cube.getBandRaw(band).tolist())
+                for sample in range(cube.samples):
+                    eq_(cube.getFocalPlaneDepthRaw(sample, band).tolist(),
+                        mmap_cube.getFocalPlaneDepthRaw(sample, band).tolist())
+    
+    def testBIP(self):
+        self.checkReader('bip')
+    
+    def testBIL(self):
+        self.checkReader('bil')
+    
+    def testBSQ(self):
+        self.checkReader('bsq')
+    
+    def testPrefetch(self):
+        mmap_cube, cube = self.getFileCube('bip')
+        assert cube.canPrefetch()
+        prefetcher = BandPrefetcher(cube, cube.prefetchBand)
+        prefetcher.start()
+        prefetcher.request([2, 0])
+        cache = cube.getBandCache()
+        for i in range(100):
+            if ('band', 0) in cache and ('band', 2) in cache:
+                break
+            time.sleep(.01)
+        prefetcher.stop()
+        prefetcher.join()
+        assert ('band', 1) not in cache
+        eq_(cube.getBandRaw(2).tolist(), mmap_cube.getBandRaw(2).tolist())
+        eq_((cache.hits, cache.misses), (1, 2))
+
+    def testOverviews(self):
+        for interleave in ['bip', 'bil', 'bsq']:
+            mmap_cube, cube = self.getFileCube(interleave)
+            for band in range(cube.bands):
+                for step in [2, 3, 4, 8]:
+                    expected = mmap_cube.getBandRaw(band)[::step, ::step].tolist()
+                    eq_(cube.cube_io.getBandDecimated(band, step).tolist(), expected)
+                    eq_(mmap_cube.getBandOverview(band, step).tolist(), expected)
+
+    def testProfiles(self):
+        # the profiles shown with an overview are read without the full band
+        for interleave in ['bip', 'bil', 'bsq']:
+            mmap_cube, cube = self.getFileCube(interleave)
+            cache = cube.getBandCache()
+            for band in range(cube.bands):
+                expected = mmap_cube.getBandRaw(band)
+                eq_(cube.getFocalPlaneInPlace(1, False)[band,:].tolist(), expected[1,:].tolist())
+                eq_(cube.getFocalPlaneDepthInPlace(2, band).tolist(), expected[:,2].tolist())
+                assert ('band', band) not in cache
+
+    def testOverviewPyramid(self):
+        mmap_cube, cube = self.getFileCube('bsq')
+        cache = cube.getBandCache()
+        overview = cube.getBandOverview(1, 2)
+        eq_(cache.misses, 1)
+        assert ('band', 1) not in cache
+        # coarser levels are created from the cached level without reading
+        # from the file
+        cube.cube_io.fh.close()
+        eq_(cube.getBandOverview(1, 4).tolist(), mmap_cube.getBandRaw(1)[::4, ::4].tolist())
+        eq_(cube.getBandOverview(1, 2).tolist(), overview.tolist())
+        eq_((cache.hits, cache.misses), (1, 2))
+
+
+class testBandCache(object):
+    def testReadOnly(self):
+        cache = BandCache(1000)
+        data = cache.get(('band', 0), lambda: numpy.zeros((4,), dtype=numpy.float64))
+        assert_raises(ValueError, data.__setitem__, 0, 1.0)
+        cached = cache.get(('band', 0), None)
+        assert_raises(ValueError, cached.__setitem__, 0, 1.0)
+        eq_(cached.tolist(), [0.0] * 4)
+
+    def testEviction(self):
+        cache = BandCache(3 * 8)
+        loads = []
+        def loader(value):
+            def load():
+                loads.append(value)
+                return numpy.zeros((1,), dtype=numpy.float64) + value
+            return load
+        for i in range(3):
+            cache.get(('band', i), loader(i))
+        eq_(cache.current_bytes, 24)
+        # touch band 0 so that band 1 becomes the least recently used
+        eq_(cache.get(('band', 0), loader(0))[0], 0)
+        cache.get(('band', 3), loader(3))
+        assert ('band', 1) not in cache
+        assert ('band', 0) in cache
+        eq_(loads, [0, 1, 2, 3])
+        eq_((cache.hits, cache.misses), (1, 4))
+    
+    def testCubeSharesCache(self):
+        cube = fakeCube('bip')
+        band = cube.getBand(1)
+        eq_(band.tolist(), cube.getBandRaw(1).tolist())
+        cache = cube.getBandCache()
+        eq_((cache.hits, cache.misses), (1, 1))
+        cube.clearCache()
+        assert ('band', 1) not in cache
+    
+    def testDiscard(self):
+        cube = fakeCube('bip')
+        for i in range(3):
+            cube.getBandRaw(i)
+        cube.getFocalPlaneRaw(0)
+        cache = cube.getBandCache()
+        cube.discardBand(1)
+        assert ('band', 0) in cache
+        assert ('band', 1) not in cache
+        assert ('band', 2) in cache
+        assert ('focalplane', 0) not in cache
+        eq_(cache.current_bytes, 2 * cube.getBandRaw(0).nbytes)
+
+
+class testModifyCube(object):
+    def testFillBandWithConstant(self):
+        cube = fakeCube('bil', writable=True)
+        expected = cube.getBand(0)
+        eq_(cube.getBandRaw(1).tolist(), cube.getBand(1).tolist())
+        cube.fillBandWithConstant(1, 42)
+        eq_(cube.getBandRaw(1).tolist(), [[42] * cube.samples] * cube.lines)
+        eq_(cube.getSpectraRaw(2, 3)[1], 42)
+        eq_(cube.getBandRaw(0).tolist(), expected.tolist())
+    
+    def testRGBImage(self):
+        cube = fakeCube('bip')
+        rgb = cube.guessDisplayBands()
+        rgb.reverse()
+        image = cube.getRGBImage()
+        eq_(image.bands, len(rgb))
+        for index, band in enumerate(rgb):
+            eq_(image.getBandRaw(index).tolist(), cube.getBandRaw(band).tolist())
+
+
+class testCubeCompare(object):
+    def setUp(self):
+        self.cube1 = fakeCube('bip')
+        self.cube2 = fakeCube('bil', default=7)
+        self.comp = CubeCompare(self.cube1, self.cube2)
+        self.comp.bbl = [1, 1, 1]
+    
+    def getExpected(self):
+        spectra1 = numpy.array([[self.cube1.getSpectraRaw(line, sample) for sample in range(self.cube1.samples)] for line in range(self.cube1.lines)], dtype=numpy.float64)
+        spectra2 = numpy.zeros(spectra1.shape) + 7
+        return spectra1, spectra2
+    
+    def testEuclideanDistance(self):
+        spectra1, spectra2 = self.getExpected()
+        expected = numpy.sqrt(((spectra1 - spectra2) ** 2).sum(axis=2))
+        dist = self.comp.getEuclideanDistance().getBandRaw(0)
+        assert numpy.allclose(dist, expected)
+    
+    def testChunks(self):
+        engine = self.comp.getCompareEngine()
+        engine.chunk_bytes = 1
+        engine.processes = 1
+        results = engine.compute(['euclidean', 'histogram'], nbins=100)
+        dist = self.comp.getEuclideanDistance().getBandRaw(0)
+        assert numpy.allclose(results['euclidean'], dist)
+        eq_(results['histogram'].tolist(), self.comp.getHistogram(100).data.tolist())
+
+
+class testCubeStatistics(object):
+    def setUp(self):
+        self.tempfiles = []
+    
+    def tearDown(self):
+        for filename in self.tempfiles:
+            if os.path.exists(filename):
+                os.remove(filename)
+    
+    def checkInterleave(self, interleave):
+        cube = fakeCube(interleave)
+        stats = CubeStatistics.fromCube(cube)
+        for band in range(cube.bands):
+            raw = cube.getBandRaw(band)
+            b = stats.getBand(band)
+            eq_(b.count, raw.size)
+            eq_(b.min, raw.min())
+            eq_(b.max, raw.max())
+            assert numpy.allclose(b.mean, raw.mean())
+            assert numpy.allclose(b.stddev, raw.std())
+            eq_(b.histogram.sum(), raw.size)
+    
+    def testBIP(self):
+        self.checkInterleave('bip')
+    
+    def testBIL(self):
+        self.checkInterleave('bil')
+    
+    def testBSQ(self):
+        self.checkInterleave('bsq')
+    
+    def testExpandingHistogram(self):
+        numpy.random.seed(1)
+        data = numpy.random.normal(100.0, 20.0, (2, 10000))
+        # make the range grow in both directions as the chunks are added
+        data[:, :5000].sort(axis=1)
+        data[:, :5000] = data[:, 2500:5000].repeat(2, axis=1)
+        stats = CubeStatistics(2, numpy.float64, nbins=64)
+        for start in range(0, 10000, 1000):
+            stats.add(data[:, start:start+1000])
+        for band in range(2):
+            b = stats.getBand(band)
+            eq_(b.histogram.sum(), 10000)
+            assert numpy.allclose(b.mean, data[band].mean())
+            assert numpy.allclose(b.stddev, data[band].std())
+            for fraction in [0.01, 0.1, 0.5, 0.9, 0.99]:
+                expected = numpy.percentile(data[band], fraction * 100)
+                assert abs(b.getPercentile(fraction) - expected) <= b.bin_width
+    
+    def testIntegerHistogram(self):
+        stats = CubeStatistics(1, numpy.int16, nbins=16)
+        stats.add(numpy.array([[3, 4, 5]]))
+        eq_(stats.bin_width[0], 1.0)
+        stats.add(numpy.array([[-10, 40]]))
+        eq_(stats.bin_width[0], 4.0)
+        eq_(stats.histogram[0].sum(), 5)
+        eq_(stats.getExtrema(), (-10, 40))
+    
+    def testSidecar(self):
+        data = numpy.arange(60, dtype=numpy.int16)
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, data.tostring())
+        os.close(fd)
+        self.tempfiles.append(filename)
+        self.tempfiles.append(filename + CubeStatistics.sidecar_extension)
+        
+        def openCube():
+            cube = HSI.createCubeLike(fakeCube('bil'))
+            cube.setURL(filename)
+            cube.cube_io = getFileCubeReader(cube)(cube, cube.url)
+            return cube
+        
+        cube = openCube()
+        eq_(cube.getCachedStatistics(), None)
+        stats = cube.getStatistics()
+        assert os.path.exists(filename + CubeStatistics.sidecar_extension)
+        eq_(cube.getUpdatedExtrema(), [0, 59])
+        
+        loaded = openCube().getCachedStatistics()
+        assert loaded is not None
+        eq_(loaded.histogram.tolist(), stats.histogram.tolist())
+        assert numpy.allclose(loaded.m2, stats.m2)
+        
+        # a changed data file invalidates the sidecar
+        fh = open(filename, "ab")
+        fh.write("\0\0")
+        fh.close()
+        eq_(openCube().getCachedStatistics(), None)
+    
+    def testContrastFilter(self):
+        numpy.random.seed(2)
+        raw = numpy.random.randint(0, 1000, (50, 40)).astype(numpy.int16)
+        stats = CubeStatistics(1, numpy.int16)
+        stats.add(raw.reshape(1, -1))
+        filt = ContrastFilter(0.1)
+        plane, clipped = filt.getPlaneWithStatistics(raw, stats.getBand(0))
+        lo = numpy.percentile(raw, 10)
+        hi = numpy.percentile(raw, 90)
+        assert abs(plane.min() - lo) <= stats.bin_width[0]
+        assert abs(plane.max() - hi) <= stats.bin_width[0]
+        eq_((clipped.min, clipped.max), stats.getBand(0).getStretchRange(0.1))
+
+
+class testRGBMapper(object):
+    def setUp(self):
+        self.saved_threads = RGBMapper.threads
+        numpy.random.seed(3)
+        self.planes = [numpy.random.randint(-500, 3000, (70, 30)).astype(numpy.int16) for i in range(3)]
+    
+    def tearDown(self):
+        RGBMapper.threads = self.saved_threads
+    
+    def getExpectedGray(self, raw):
+        minval = float(raw.min())
+        maxval = float(raw.max())
+        return ((raw - minval) * (255.0/(maxval-minval))).astype(numpy.uint8)
+    
+    def testGray(self):
+        for threads in [1, 4]:
+            RGBMapper.threads = threads
+            mapper = RGBMapper()
+            for tile_size in [1, 16, 256]:
+                eq_(mapper.getGray(self.planes[0], tile_size).tolist(), self.getExpectedGray(self.planes[0]).tolist())
+    
+    def testRGB(self):
+        RGBMapper.threads = 4
+        mapper = RGBMapper()
+        mapper.tile_size = 16
+        rgb = mapper.getRGB(70, 30, self.planes)
+        for i in range(3):
+            eq_(rgb[:,:,i].tolist(), self.getExpectedGray(self.planes[i]).tolist())
+        rgb = mapper.getRGB(70, 30, self.planes[0:1])
+        for i in range(3):
+            eq_(rgb[:,:,i].tolist(), self.getExpectedGray(self.planes[0]).tolist())
+    
+    def testStatistics(self):
+        stats = CubeStatistics(1, numpy.int16)
+        stats.add(self.planes[0].reshape(1, -1))
+        mapper = RGBMapper()
+        eq_(mapper.getGray(self.planes[0], stats=stats.getBand(0)).tolist(), self.getExpectedGray(self.planes[0]).tolist())
+    
+    def testPalette(self):
+        RGBMapper.threads = 4
+        mapper = PaletteMapper('jet')
+        mapper.tile_size = 16
+        rgb = mapper.getRGB(70, 30, self.planes[0:1])
+        expected = mapper.colormap(self.getExpectedGray(self.planes[0]), bytes=True)[:,:,0:3]
+        eq_(rgb.tolist(), expected.tolist())
+
+
+class testFilters(object):
+    def setUp(self):
+        numpy.random.seed(4)
+        self.raw = numpy.random.rand(150, 40).astype(numpy.float32) * 1000
+    
+    def getGaussian(self, filt, raw):
+        # original line by line implementation
+        filtered = numpy.zeros(raw.shape, dtype=raw.dtype)
+        for line in range(raw.shape[0]):
+            filtered[line,:] = numpy.convolve(raw[line,:], filt.kernel, mode='same')
+        for sample in range(raw.shape[1]):
+            filtered[:, sample] = numpy.convolve(filtered[:,sample], filt.kernel, mode='same')
+        return filtered
+    
+    def getMedian(self, filt, raw):
+        kl, ks = filt.kernel
+        padded = numpy.zeros((raw.shape[0] + kl - 1, raw.shape[1] + ks - 1))
+        padded[kl/2:kl/2 + raw.shape[0], ks/2:ks/2 + raw.shape[1]] = raw
+        filtered = numpy.empty(raw.shape)
+        for line in range(raw.shape[0]):
+            for sample in range(raw.shape[1]):
+                filtered[line, sample] = numpy.median(padded[line:line + kl, sample:sample + ks])
+        return filtered
+    
+    def testGaussian(self):
+        for radius in [0, 1, 5]:
+            filt = GaussianFilter(radius)
+            assert numpy.allclose(filt.getPlane(self.raw), self.getGaussian(filt, self.raw), rtol=1e-4, atol=1e-2)
+    
+    def testMedian(self):
+        for kernel in [(3, 1), (1, 3), (3, 3), (5, 5)]:
+            filt = MedianFilter1D(*kernel)
+            filt.window_bytes = 1000
+            eq_(filt.getPlane(self.raw).tolist(), self.getMedian(filt, self.raw).astype(numpy.float32).tolist())
+    
+    def testChain(self):
+        filters = [GaussianFilter(3), ClipFilter(200, 800), MedianFilter1D(3, 3), ContrastFilter(0.1), MedianFilter1D(1, 5)]
+        expected = self.raw
+        for filt in filters:
+            expected = filt.getPlane(expected)
+        for tile_size in [1, 7, 64, 1000]:
+            chain = ChainFilter(filters=filters)
+            chain.tile_size = tile_size
+            eq_(chain.getPlane(self.raw).tolist(), expected.tolist())
+
+
+class testFITS(object):
+    def setUp(self):
+        self.tempfiles = []
+    
+    def tearDown(self):
+        for filename in self.tempfiles:
+            os.remove(filename)
+    
+    def getHeader(self, cards):
+        text = "".join(["%-80s" % card for card in cards + ["END"]])
+        return text + " " * ((2880 - len(text) % 2880) % 2880)
+    
+    def getData(self, data):
+        text = data.astype(data.dtype.newbyteorder('>')).tostring()
+        return text + "\0" * ((2880 - len(text) % 2880) % 2880)
+    
+    def getFITSFile(self):
+        self.band3d = numpy.arange(4 * 6 * 5, dtype=numpy.int16).reshape(4, 6, 5) - 50
+        self.band2d = numpy.linspace(0, 1, 7 * 3).astype(numpy.float32).reshape(7, 3)
+        text = self.getHeader(["SIMPLE  =                    T", "BITPIX  =                    8", "NAXIS   =                    0"])
+        text += self.getHeader(["XTENSION= 'IMAGE   '", "BITPIX  =                   16", "NAXIS   =                    3",
+                                "NAXIS1  =                    5", "NAXIS2  =                    6", "NAXIS3  =                    4",
+                                "PCOUNT  =                    0", "GCOUNT  =                    1"])
+        text += self.getData(self.band3d)
+        # a table extension whose size depends on PCOUNT
+        text += self.getHeader(["XTENSION= 'BINTABLE'", "BITPIX  =                    8", "NAXIS   =                    2",
+                                "NAXIS1  =                   10", "NAXIS2  =                    3",
+                                "PCOUNT  =                 3000", "GCOUNT  =                    1"])
+        text += "\0" * 5760
+        text += self.getHeader(["XTENSION= 'IMAGE   '", "BITPIX  =                  -32", "NAXIS   =                    2",
+                                "NAXIS1  =                    3", "NAXIS2  =                    7",
+                                "PCOUNT  =                    0", "GCOUNT  =                    1",
+                                "EXTNAME = 'FLAT    '"])
+        text += self.getData(self.band2d)
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, text)
+        os.close(fd)
+        self.tempfiles.append(filename)
+        return filename
+    
+    def checkCubes(self, dataset):
+        eq_(dataset.getCubeNames(), ["HDU #1", "HDU #3: FLAT"])
+        cube = dataset.getCube(index=1)
+        eq_((cube.samples, cube.lines, cube.bands), (3, 7, 1))
+        eq_(cube.getBandRaw(0).tolist(), self.band2d.tolist())
+        cube = dataset.getCube(index=0)
+        eq_((cube.samples, cube.lines, cube.bands), (5, 6, 4))
+        for band in range(cube.bands):
+            eq_(cube.getBandRaw(band).tolist(), self.band3d[band].tolist())
+        assert_raises(IndexError, dataset.getCube, index=2)
+        return cube
+    
+    def testMMap(self):
+        dataset = FITS.FITSDataset(self.getFITSFile())
+        eq_(len(dataset.hdus), 4)
+        cube = self.checkCubes(dataset)
+        assert isinstance(cube.cube_io, HSI.MMapCubeReader)
+    
+    def testFile(self):
+        filename = self.getFITSFile()
+        dataset = FITS.FITSDataset()
+        fh = open(filename, "rb")
+        dataset.read(fh)
+        fh.close()
+        eq_([hdu.image_offset for hdu in dataset.images], [5760, 20160])
+        dataset.setURL(filename)
+        self.checkCubes(dataset)
+
+
+class testCubeTransposer(object):
+    def setUp(self):
+        self.tempfiles = []
+    
+    def tearDown(self):
+        for filename in self.tempfiles:
+            os.remove(filename)
+    
+    def getFileCube(self, interleave, byte_order=HSI.nativeByteOrder):
+        mmap_cube = fakeCube(interleave)
+        fd, filename = tempfile.mkstemp()
+        data = mmap_cube.getNumpyArray()
+        if byte_order != HSI.nativeByteOrder:
+            data = data.byteswap()
+        os.write(fd, data.tostring())
+        os.close(fd)
+        self.tempfiles.append(filename)
+        cube = HSI.createCubeLike(mmap_cube)
+        cube.byte_order = byte_order
+        cube.setURL(filename)
+        cube.cube_io = getFileCubeReader(cube)(cube, cube.url)
+        return mmap_cube, cube
+    
+    def getExpected(self, cube, interleave, endian):
+        data = numpy.array([cube.getBandRaw(band) for band in range(cube.bands)])
+        if interleave == 'bip':
+            data = data.transpose(1, 2, 0)
+        elif interleave == 'bil':
+            data = data.transpose(1, 0, 2)
+        return data.astype(data.dtype.newbyteorder(endian)).tostring()
+    
+    def checkConversions(self, source):
+        for interleave in ['bip', 'bil', 'bsq']:
+            for byte_order in [HSI.LittleEndian, HSI.BigEndian]:
+                expected = self.getExpected(source, interleave, HSI.byteordertext[byte_order])
+                # memory budgets of less than a line, a few lines, and the
+                # whole cube
+                for budget in [1, 200, 1024 * 1024]:
+                    fh = StringIO()
+                    source.writeRawData(fh, {'interleave': interleave, 'byte_order': byte_order}, block_size=budget)
+                    eq_(fh.getvalue(), expected)
+    
+    def testMMap(self):
+        for interleave in ['bip', 'bil', 'bsq']:
+            self.checkConversions(fakeCube(interleave))
+    
+    def testFile(self):
+        for interleave in ['bip', 'bil', 'bsq']:
+            for byte_order in [HSI.LittleEndian, HSI.BigEndian]:
+                mmap_cube, cube = self.getFileCube(interleave, byte_order)
+                self.checkConversions(cube)
+    
+    def testSequentialBSQ(self):
+        cube = fakeCube('bip')
+        expected = self.getExpected(cube, 'bsq', '<')
+        for budget in [1, 200, 1024 * 1024]:
+            fh = StringIO()
+            CubeTransposer(cube, 'bsq', '<', budget).writeBSQSequential(fh)
+            eq_(fh.getvalue(), expected)
+    
+    def testExportMem(self):
+        cube = fakeCube('bip')
+        for interleave in ['bip', 'bil', 'bsq']:
+            url = 'mem:/export.%s' % interleave
+            ENVI.Header.export(url, cube, {'interleave': interleave, 'byte_order': HSI.LittleEndian})
+            fh = vfs.open(url)
+            data = fh.read()
+            fh.close()
+            eq_(len(data), cube.samples * cube.lines * cube.bands * 2)
+            eq_(data, self.getExpected(cube, interleave, '<'))
@@ -1,6 +1,7 @@
 import os,sys,re
 
 from peppy.major import *
+from peppy.majormodematcher import MajorModeDispatchTable
 
 from nose.tools import *
 
@@ -91,3 +92,30 @@ class TestMatcherBase:
         eq_(None, self.driver.scanShell("#!/usr/bin/env amock"))
         eq_(None, self.driver.scanShell("#!/usr/bin/env mach"))
         eq_(None, self.driver.scanShell("#!/usr/bin/env -a_machine"))
+
+class MockMagicMode(MajorMode):
+    keyword = "Mock Magic"
+    magic = ["MAGIC", "MG"]
+
+class TestDispatchTable:
+    def setUp(self):
+        self.table = MajorModeDispatchTable([MockMagicMode, MockMode])
+
+    def testFilename(self):
+        eq_(set([MockMode]), self.table.getFilenameModes("test.mock"))
+        eq_(set(), self.table.getFilenameModes("test.mocking"))
+
+    def testKeyword(self):
+        eq_([MockMode], self.table.getKeywordModes("mach"))
+        eq_([], self.table.getKeywordModes("mawck"))
+
+    def testMagic(self):
+        eq_(set([MockMagicMode]), self.table.getMagicModes("MAGIC number"))
+        eq_(set([MockMagicMode]), self.table.getMagicModes("MG"))
+        eq_(set(), self.table.getMagicModes("M"))
+
+    def testShell(self):
+        eq_(set([MockMode]), self.table.getShellModes("#!/usr/bin/env mock.exe"))
+        eq_(set([MockMagicMode, MockMode]), self.table.getShellModes("#!/usr/bin/mock magic"))
+        eq_(set(), self.table.getShellModes("#!/usr/bin/mocking"))
+        eq_([MockMagicMode, MockMode], self.table.sort([MockMode, MockMagicMode]))
@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2007 Rob McMullen <robm@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Import from the Standard Library
+import unittest
+from unittest import TestCase
+import time
+
+# Import from itools
+import peppy.vfs as vfs
+from peppy.vfs.utils import MetadataCache, get_metadata_key
+
+
+class MetadataCacheTestCase(TestCase):
+    def test00_key(self):
+        key = get_metadata_key(vfs.get_reference("sftp://user@host:22/dir/"))
+        self.assertEqual(key, u"sftp://host:22/dir")
+        key = get_metadata_key(vfs.get_reference("http://host/"))
+        self.assertEqual(key, u"http://host/")
+
+    def test01_expire(self):
+        cache = MetadataCache(ttl=0.05)
+        cache[u"a"] = 1
+        self.assertEqual(cache[u"a"], 1)
+        time.sleep(0.1)
+        self.assertEqual(u"a" in cache, False)
+        self.assertRaises(KeyError, cache.__getitem__, u"a")
+        self.assertEqual(cache.get(u"a", 2), 2)
+
+    def test02_size_limit(self):
+        cache = MetadataCache(max_entries=10)
+        cache.update([(u"%d" % i, i) for i in range(10)])
+        self.assertEqual(len(cache), 10)
+        # make the first entry the most recently used
+        time.sleep(0.01)
+        cache[u"0"]
+        cache[u"10"] = 10
+        self.assertEqual(len(cache), 9)
+        self.assertEqual(u"0" in cache, True)
+        self.assertEqual(u"1" in cache, False)
+        self.assertEqual(u"10" in cache, True)
+
+    def test03_remove_prefix(self):
+        cache = MetadataCache()
+        cache.update({u"sftp://host/dir": 1,
+                      u"sftp://host/dir/file": 2,
+                      u"sftp://host/dir/sub/file": 3,
+                      u"sftp://host/directory": 4,
+                      })
+        cache.remove_prefix(u"sftp://host/dir")
+        self.assertEqual(cache.keys(), [u"sftp://host/directory"])
+
+
+if __name__ == '__main__':
+    unittest.main()
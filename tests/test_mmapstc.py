@@ -0,0 +1,134 @@
+import os, sys, re, tempfile, shutil
+
+import wx.stc
+
+import peppy.vfs as vfs
+from peppy.mmapstc import *
+
+from nose.tools import *
+
+class TestPieceTable:
+    def setup(self):
+        self.t = PieceTable("0123456789")
+
+    def test_get(self):
+        eq_("0123456789", self.t.get(0, 10))
+        eq_("345", self.t.get(3, 6))
+        eq_("89", self.t.get(8, 20))
+        eq_("", self.t.get(5, 5))
+
+    def test_replace(self):
+        eq_("345", self.t.replace(3, 6, "abcd"))
+        eq_("012abcd6789", self.t.get(0, 11))
+        eq_(11, len(self.t))
+        eq_("2abcd6", self.t.get(2, 8))
+        eq_("0", self.t.replace(0, 1, ""))
+        eq_("12abcd6789", self.t.get(0, 10))
+        self.t.replace(10, 10, "XY")
+        eq_("12abcd6789XY", self.t.get(0, 20))
+
+    def test_in_place(self):
+        self.t.replace(2, 4, "ab")
+        eq_(True, self.t.isOriginalInPlace())
+        eq_([(2, "ab")], list(self.t.iterChangedRanges()))
+        self.t.replace(0, 1, "")
+        eq_(False, self.t.isOriginalInPlace())
+
+    def test_blocks(self):
+        self.t.replace(4, 5, "xyz")
+        eq_(["012", "3", "xyz", "567", "89"], list(self.t.iterBlocks(3)))
+
+
+class MockBuffer(object):
+    def __init__(self, url):
+        self.url = url
+
+class TestMMapSTC:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "data.bin")
+        fh = open(self.path, "wb")
+        fh.write("".join(chr(i) for i in range(256)) * 16)
+        fh.close()
+        self.url = vfs.normalize(self.path)
+        self.stc = MMapSTC()
+        self.stc.open(MockBuffer(self.url))
+
+    def teardown(self):
+        self.stc.Destroy()
+        shutil.rmtree(self.tmpdir)
+
+    def save(self):
+        fh = self.stc.openFileForWriting(self.url)
+        self.stc.writeTo(fh, self.url)
+        self.stc.closeFileAfterWriting(fh)
+        return open(self.path, "rb").read()
+
+    def test_edit(self):
+        eq_(4096, self.stc.GetLength())
+        eq_("\x10\x11", self.stc.GetBinaryData(16, 18))
+        self.stc.SetBinaryData(16, 18, "ab")
+        eq_("\x0fab\x12", self.stc.GetBinaryData(15, 19))
+        eq_(True, self.stc.GetModify())
+        self.stc.Undo()
+        eq_("\x10\x11", self.stc.GetBinaryData(16, 18))
+        self.stc.Redo()
+        eq_("ab", self.stc.GetBinaryData(16, 18))
+
+    def test_save_in_place(self):
+        self.stc.SetBinaryData(4000, 4002, "zz")
+        data = self.save()
+        eq_(4096, len(data))
+        eq_("zz", data[4000:4002])
+        eq_("zz", self.stc.GetBinaryData(4000, 4002))
+
+    def test_save_moved(self):
+        self.stc.SetBinaryData(0, 0, "inserted")
+        data = self.save()
+        eq_(4104, len(data))
+        eq_("inserted\x00\x01", data[0:10])
+        eq_(4104, self.stc.GetLength())
+
+    def test_modify_callback(self):
+        events = []
+        def callback(evt):
+            events.append((evt.GetModificationType(), evt.GetPosition(), evt.GetLength(), evt.GetText()))
+        self.stc.addModifyCallback(callback)
+        self.stc.SetBinaryData(16, 18, "abc")
+        self.stc.Undo()
+        self.stc.removeModifyCallback(callback)
+        self.stc.Redo()
+        both = wx.stc.STC_MOD_INSERTTEXT | wx.stc.STC_MOD_DELETETEXT
+        eq_([(both, 16, 3, "abc"), (both, 16, 2, "\x10\x11")], events)
+
+    def check_failed_save(self):
+        before = self.stc.GetBinaryData()
+        assert_raises(IOError, self.save)
+        eq_(before, self.stc.GetBinaryData())
+        eq_(4096, len(open(self.path, "rb").read()))
+        return before
+
+    def test_failed_save_in_place(self):
+        import peppy.mmapstc
+        self.stc.SetBinaryData(4000, 4002, "zz")
+        def fail(*args):
+            raise IOError("write failed")
+        peppy.mmapstc.open = fail
+        try:
+            before = self.check_failed_save()
+        finally:
+            del peppy.mmapstc.open
+        eq_(before, self.save())
+
+    def test_failed_save_moved(self):
+        self.stc.SetBinaryData(0, 0, "inserted")
+        rename = os.rename
+        def fail(*args):
+            raise IOError("rename failed")
+        os.rename = fail
+        try:
+            before = self.check_failed_save()
+        finally:
+            os.rename = rename
+        eq_([], [name for name in os.listdir(self.tmpdir) if name != "data.bin"])
+        eq_(before, self.save())
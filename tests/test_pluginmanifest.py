@@ -0,0 +1,95 @@
+import os, sys, re, time, tempfile, shutil
+
+from peppy.yapsy.PluginManifest import *
+
+from nose.tools import *
+
+class TestPluginManifest:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.plugindir = os.path.join(self.tmpdir, "plugins")
+        os.mkdir(self.plugindir)
+        self.infofile = self.write("plugins/a.peppy-plugin", "[Core]\nName = A\nModule = a\n")
+        self.source = self.write("plugins/a.py", "value = 1\n")
+        self.config = self.write("preferences.cfg", "")
+        self.filename = os.path.join(self.tmpdir, "plugin-manifest")
+        self.manifest = PluginManifest(self.filename)
+        self.manifest.load()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        fh = open(path, "wb")
+        fh.write(text)
+        fh.close()
+        return path
+
+    def touch(self, path):
+        # make sure the modification time changes even on filesystems with
+        # coarse timestamps
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+
+    def setCandidates(self):
+        candidates = [(self.infofile, self.source[:-3], {'name': 'A'})]
+        self.manifest.setCandidates([self.plugindir], candidates, [self.config])
+        self.manifest.save()
+
+    def reload(self):
+        manifest = PluginManifest(self.filename)
+        manifest.load()
+        return manifest
+
+    def test_valid(self):
+        eq_(False, self.manifest.isValid([self.plugindir], [self.config]))
+        self.setCandidates()
+        manifest = self.reload()
+        eq_(True, manifest.isValid([self.plugindir], [self.config]))
+        eq_(False, manifest.isValid([self.plugindir, self.tmpdir], [self.config]))
+        eq_([(self.infofile, self.source[:-3], {'name': 'A'})], manifest.candidates)
+
+        self.touch(self.config)
+        eq_(False, manifest.isValid([self.plugindir], [self.config]))
+        manifest.watchFiles([self.config])
+        eq_(True, manifest.isValid([self.plugindir], [self.config]))
+
+        self.write("plugins/b.peppy-plugin", "[Core]\nName = B\nModule = b\n")
+        self.touch(self.plugindir)
+        eq_(False, manifest.isValid([self.plugindir], [self.config]))
+
+    def test_code(self):
+        self.setCandidates()
+        globals = {}
+        exec self.manifest.getCode(self.source) in globals
+        eq_(1, globals['value'])
+        self.manifest.save()
+
+        manifest = self.reload()
+        eq_(False, manifest.changed)
+        globals = {}
+        exec manifest.getCode(self.source) in globals
+        eq_(1, globals['value'])
+        eq_(False, manifest.changed)
+
+        self.write("plugins/a.py", "value = 22\n")
+        self.touch(self.source)
+        globals = {}
+        exec manifest.getCode(self.source) in globals
+        eq_(22, globals['value'])
+        eq_(True, manifest.changed)
+
+    def test_deferred(self):
+        self.setCandidates()
+        self.manifest.setDeferred(self.infofile, self.source, {'modes': []})
+        self.manifest.save()
+        manifest = self.reload()
+        eq_({'modes': []}, manifest.getDeferred(self.infofile, self.source))
+        self.touch(self.source)
+        eq_(None, manifest.getDeferred(self.infofile, self.source))
+
+        # a new search of the plugin directories discards the deferred info
+        self.manifest.setDeferred(self.infofile, self.source, {'modes': []})
+        self.setCandidates()
+        eq_(None, self.manifest.getDeferred(self.infofile, self.source))
@@ -0,0 +1,72 @@
+import os, sys, re, shutil, tempfile
+
+import wx
+
+from peppy.plugins.search_in_files import SearchThread, LocalFileSearchMixin
+
+from nose.tools import *
+
+class MockLineMatcher(object):
+    def __init__(self, text):
+        self.text = text
+
+    def iterMatches(self, filename, fh):
+        for index, line in enumerate(fh):
+            if self.text in line:
+                yield (filename, index + 1, line)
+
+
+class MockDirectorySearchMethod(LocalFileSearchMixin):
+    def __init__(self, pathname):
+        self.pathname = pathname
+
+    def iterFiles(self, ignorer):
+        for name in sorted(os.listdir(self.pathname)):
+            yield os.path.join(self.pathname, name)
+
+    def getMatchGenerator(self, item, matcher):
+        fh = open(item, "rb")
+        try:
+            return list(matcher.iterMatches(item, fh))
+        finally:
+            fh.close()
+
+
+class TestSearchThread(object):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        for index in range(20):
+            fh = open(os.path.join(self.dirname, "file%02d.txt" % index), "wb")
+            for line in range(index * 3):
+                if line % 4 == 0:
+                    fh.write("line %d of file %d spam\n" % (line, index))
+                else:
+                    fh.write("line %d of file %d\n" % (line, index))
+            fh.close()
+        self.method = MockDirectorySearchMethod(self.dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def getResults(self, matcher, processes):
+        thread = SearchThread(None, matcher, None, None, processes=processes, chunk_files=3)
+        return thread, list(thread.iterResults(self.method))
+
+    def testParallel(self):
+        matcher = MockLineMatcher("spam")
+        serial_thread, serial = self.getResults(matcher, 1)
+        assert not serial_thread.isParallel(self.method)
+        thread, results = self.getResults(matcher, 2)
+        assert thread.isParallel(self.method)
+        eq_(results, serial)
+        eq_(thread.found, 20)
+        eq_(len(results), 7)
+        eq_(sum([len(r[1]) for output in results for r in output]), sum([(index * 3 + 3) / 4 for index in range(20)]))
+
+    def testUnpicklableMatcher(self):
+        matcher = MockLineMatcher("spam")
+        serial_thread, serial = self.getResults(matcher, 1)
+        matcher.callback = lambda line: line
+        thread, results = self.getResults(matcher, 2)
+        assert not thread.isParallel(self.method)
+        eq_(results, serial)
@@ -167,3 +167,39 @@ class TestProxy(object):
       eq_(self.stc.CanEdit(), False)
       eq_(self.stc.CanUndo(), 5)
       eq_(self.stc.GetTextLength(), 0)
+
+class TestIncrementalLoader(object):
+   def setUp(self):
+      self.stc = getSTC()
+      self.screens = []
+      self.lines = ['line %d\n' % index for index in range(250)]
+
+   def load(self, text, size):
+      self.stc.ClearAll()
+      loader = IncrementalLoader(self.stc, 'utf-8', first_screen_callback=self.screens.append)
+      for index in range(0, len(text), size):
+         loader.pending.acquire()
+         self.stc.loadPendingChunk(loader, text[index:index + size])
+      loader.finish()
+      return loader
+
+   def testFirstScreen(self):
+      text = ''.join(self.lines)
+      self.load(text, 100)
+      eq_(self.stc.GetText(), text)
+      eq_(self.screens, [''.join(self.lines[0:IncrementalLoader.first_screen_lines])])
+
+   def testShortFile(self):
+      text = ''.join(self.lines[0:10])
+      self.load(text, 100)
+      eq_(self.stc.GetText(), text)
+      eq_(self.screens, [])
+
+   def testPendingChunks(self):
+      text = ''.join(self.lines)
+      loader = self.load(text, 7)
+      # every chunk was released after it was added, so the background
+      # thread could still pass the maximum number of chunks
+      for index in range(IncrementalLoader.max_pending_chunks):
+         eq_(loader.pending.acquire(False), True)
+      eq_(loader.pending.acquire(False), False)
@@ -17,11 +17,14 @@
 
 # Import from the Standard Library
 from datetime import datetime
+import os, tempfile, shutil, tarfile, random
+from StringIO import StringIO
 import unittest
 from unittest import TestCase
 
 # Import from itools
 import peppy.vfs as vfs
+from peppy.vfs.tar import TarFS, TarIndex, GzipCheckpointFile
 
 
 
@@ -74,5 +77,89 @@ class TarTestCase(TestCase):
             #print("traversing %s" % x)
             self.assertEqual(vfs.exists(x), True)
 
+class TarIndexTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "large.tar.gz")
+        rand = random.Random(1234)
+        self.contents = {}
+        archive = tarfile.open(self.path, "w:gz")
+        for i in range(20):
+            # no folder members, so the folders are implied by the names
+            name = "implied/dir%d/file%d.dat" % (i % 3, i)
+            data = "".join(chr(rand.randint(0, 255)) for j in range(20000))
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, StringIO(data))
+            self.contents[name] = data
+        archive.close()
+        self.saved_interval = GzipCheckpointFile.checkpoint_interval
+        GzipCheckpointFile.checkpoint_interval = 32 * 1024
+
+    def tearDown(self):
+        GzipCheckpointFile.checkpoint_interval = self.saved_interval
+        vfs.remove_from_cache('tar', self.path)
+        shutil.rmtree(self.tmpdir)
+
+    def test00_index(self):
+        index = TarIndex(self.path)
+        self.assertEqual(index.get_names(""), ["implied"])
+        self.assertEqual(index.get_names("implied/"), ["dir0", "dir1", "dir2"])
+        self.assertEqual(len(index.get_names("implied/dir1")), 7)
+        self.assertEqual(index.is_folder("implied/dir1"), True)
+        self.assertEqual(index.get_info("implied/dir1"), None)
+        self.assertEqual(index.get_info("implied/dir1/file4.dat").size, 20000)
+
+    def test01_checkpoints(self):
+        index = TarIndex(self.path)
+        fileobj = index.archive.fileobj
+        self.assertEqual(len(fileobj.checkpoints) > 5, True)
+        # read the members in reverse order so every open seeks backwards
+        names = sorted(self.contents.keys(), reverse=True)
+        for name in names:
+            fh = index.open(index.get_info(name))
+            self.assertEqual(fh.read(), self.contents[name])
+
+    def test02_vfs(self):
+        url = "tar:%s/implied/dir2/file5.dat" % self.path
+        self.assertEqual(vfs.is_folder("tar:%s/implied/dir2" % self.path), True)
+        self.assertEqual(vfs.is_file(url), True)
+        self.assertEqual(vfs.open(url).read(), self.contents["implied/dir2/file5.dat"])
+        self.assertEqual(vfs.exists("tar:%s/missing/file" % self.tmpdir), False)
+        # the index is reused until the archive is modified
+        index = TarFS._get_index(self.path)
+        self.assertEqual(TarFS._get_index(self.path) is index, True)
+
+    def test03_member_file(self):
+        index = TarIndex(self.path)
+        data = self.contents["implied/dir0/file9.dat"]
+        fh = index.open(index.get_info("implied/dir0/file9.dat"))
+        other = index.open(index.get_info("implied/dir1/file1.dat"))
+        self.assertEqual(fh.read(100), data[:100])
+        self.assertEqual(other.read(100), self.contents["implied/dir1/file1.dat"][:100])
+        self.assertEqual(fh.read(100), data[100:200])
+        fh.seek(-10, 2)
+        self.assertEqual(fh.read(), data[-10:])
+        self.assertEqual(fh.read(), "")
+
+    def test04_saved_index(self):
+        vfs.register_index_cache_dir(os.path.join(self.tmpdir, "cache"))
+        try:
+            index = TarIndex(self.path)
+            saved = TarIndex(self.path)
+            self.assertEqual(saved.load(), True)
+            self.assertEqual(sorted(saved.members.keys()), sorted(index.members.keys()))
+            self.assertEqual(saved.folders, index.folders)
+            self.assertEqual(saved.open(saved.get_info("implied/dir2/file5.dat")).read(), self.contents["implied/dir2/file5.dat"])
+            # modifying the archive invalidates the saved index
+            mtime = os.path.getmtime(self.path)
+            os.utime(self.path, (mtime + 10, mtime + 10))
+            self.assertEqual(TarIndex(self.path).load(), True)
+            os.utime(self.path, (mtime + 20, mtime + 20))
+            self.assertEqual(saved.load(), False)
+        finally:
+            vfs.register_index_cache_dir(None)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,71 @@
+import os, sys, re, time, tempfile, shutil
+
+from peppy.project.trigram import *
+
+from nose.tools import *
+
+class TestTrigramIndex:
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.write("a.txt", "def getValue(self):\n")
+        self.write("b.txt", "class Value(object):\n")
+        self.write("c.txt", "nothing to see here\n")
+        self.write("d.bin", "binary\0getvalue")
+        self.indexname = os.path.join(self.tmpdir, ".index", "search-index")
+        self.index = TrigramIndex(self.indexname)
+        self.index.load()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        fh = open(os.path.join(self.tmpdir, name), "wb")
+        fh.write(text)
+        fh.close()
+
+    def filenames(self):
+        return [os.path.join(self.tmpdir, n) for n in sorted(os.listdir(self.tmpdir)) if not n.startswith(".")]
+
+    def search(self, text):
+        found = self.index.iterCandidates(self.filenames(), text)
+        return [os.path.basename(f) for f in found]
+
+    def test_search_trigrams(self):
+        eq_(set(["get", "etv", "tva"]), getSearchTrigrams(u"GetVa"))
+        eq_(set(), getSearchTrigrams(u"ab"))
+        eq_(set(["abc"]), getSearchTrigrams(u"abc\u00e9"))
+
+    def test_candidates(self):
+        # unindexed binary files are always candidates
+        eq_(["a.txt", "d.bin"], self.search("GETVALUE"))
+        eq_(["a.txt", "b.txt", "d.bin"], self.search("value"))
+        # too short to narrow the search
+        eq_(["a.txt", "b.txt", "c.txt", "d.bin"], self.search("va"))
+        eq_(["d.bin"], self.search("missing"))
+
+    def test_incremental(self):
+        self.search("value")
+        eq_(True, os.path.exists(self.indexname))
+        ids = dict(self.index.files)
+
+        index = TrigramIndex(self.indexname)
+        index.load()
+        eq_(ids, index.files)
+
+        self.write("c.txt", "now it has a value\n")
+        st = os.stat(os.path.join(self.tmpdir, "c.txt"))
+        os.utime(os.path.join(self.tmpdir, "c.txt"), (st.st_atime, st.st_mtime + 10))
+        os.remove(os.path.join(self.tmpdir, "b.txt"))
+        found = [os.path.basename(f) for f in index.iterCandidates(self.filenames(), "value")]
+        eq_(["a.txt", "c.txt", "d.bin"], found)
+        eq_(ids[os.path.join(self.tmpdir, "a.txt")], index.files[os.path.join(self.tmpdir, "a.txt")])
+        eq_(False, os.path.join(self.tmpdir, "b.txt") in index.files)
+        eq_(2, index.dead)
+
+    def test_compact(self):
+        self.search("value")
+        for name in ["a.txt", "b.txt", "c.txt"]:
+            self.index.removeFile(os.path.join(self.tmpdir, name))
+        self.index.save()
+        eq_(0, self.index.dead)
+        eq_({}, self.index.postings)
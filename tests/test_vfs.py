@@ -92,6 +92,17 @@ class FileTestCase(TestCase):
         self.assertEqual(mimetype, 'text/plain')
 
 
+    def test11_get_entry_metadata(self):
+        metadata = vfs.get_entry_metadata(vfs.normalize('vfs/hello.txt'))
+        self.assertEqual(metadata['mimetype'], vfs.get_mimetype('vfs/hello.txt'))
+        self.assertEqual(metadata['size'], vfs.get_size('vfs/hello.txt'))
+        self.assertEqual(metadata['mtime'], vfs.get_mtime('vfs/hello.txt'))
+        self.assertEqual(metadata['is_folder'], False)
+        self.assertEqual(metadata['can_read'], True)
+        metadata = vfs.get_entry_metadata(vfs.normalize('vfs'))
+        self.assertEqual(metadata['is_folder'], True)
+
+
     def test12_remove_file(self):
         vfs.remove('vfs/file')
         self.assertEqual(vfs.exists('vfs/file'), False)
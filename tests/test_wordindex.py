@@ -0,0 +1,128 @@
+import os, sys, re
+
+import wx.stc
+
+from peppy.wordindex import *
+
+from mock_wx import *
+
+from nose.tools import *
+
+class MockWordSTC(object):
+    def __init__(self, text):
+        self.text = text
+        self.callbacks = []
+
+    def GetText(self):
+        return self.text
+
+    def GetLength(self):
+        return len(self.text)
+
+    def GetTextRange(self, start, end):
+        return self.text[start:end]
+
+    def PositionBefore(self, pos):
+        return max(0, pos - 1)
+
+    def PositionAfter(self, pos):
+        return min(len(self.text), pos + 1)
+
+    def addDocumentModifiedEvent(self, callback):
+        self.callbacks.append(callback)
+        return True
+
+    def removeDocumentModifiedEvent(self, callback):
+        self.callbacks.remove(callback)
+
+    def insert(self, pos, text):
+        self.text = self.text[:pos] + text + self.text[pos:]
+        for callback in self.callbacks:
+            callback(MockModifiedEvent(wx.stc.STC_MOD_INSERTTEXT, pos, text))
+
+    def delete(self, pos, length):
+        text = self.text[pos:pos + length]
+        self.text = self.text[:pos] + self.text[pos + length:]
+        for callback in self.callbacks:
+            callback(MockModifiedEvent(wx.stc.STC_MOD_DELETETEXT, pos, text))
+
+class MockWordBuffer(object):
+    url = "mem:test"
+    def __init__(self, text):
+        self.stc = MockWordSTC(text)
+
+class TestWordIndex(object):
+    def setup(self):
+        self.buf1 = MockWordBuffer("def getValue(self): return self.value")
+        self.buf2 = MockWordBuffer("getter = setValue(value)")
+        self.index = WordIndex()
+        self.index.updateBuffer(self.buf1)
+        self.index.updateBuffer(self.buf2)
+
+    def check(self):
+        index = WordIndex()
+        index.updateBuffer(MockWordBuffer(self.buf1.stc.text))
+        index.updateBuffer(MockWordBuffer(self.buf2.stc.text))
+        eq_(index.counts, self.index.counts)
+        eq_(index.words, self.index.words)
+
+    def test_prefix(self):
+        eq_(["getValue", "getter"], self.index.findPrefix("get"))
+        eq_(["getValue"], self.index.findPrefix("get", [self.buf1]))
+        eq_([], self.index.findPrefix("getter"))
+        eq_(["self"], self.index.findPrefix("se", [self.buf1]))
+
+    def test_modify(self):
+        # split a word, join it back, and replace part of one
+        self.buf1.stc.insert(7, " ")
+        eq_(["get"], self.index.findPrefix("ge", [self.buf1]))
+        self.check()
+        self.buf1.stc.delete(7, 1)
+        eq_(["getValue"], self.index.findPrefix("ge", [self.buf1]))
+        self.check()
+        self.buf2.stc.delete(0, 6)
+        self.buf2.stc.insert(0, "total_count")
+        self.check()
+        eq_(["total_count"], self.index.findPrefix("to"))
+
+    def test_remove(self):
+        self.index.removeBuffer(self.buf2)
+        eq_(["getValue"], self.index.findPrefix("get"))
+        eq_([], self.buf2.stc.callbacks)
+        self.index.removeBuffer(self.buf1)
+        eq_({}, self.index.counts)
+        eq_([], self.index.words)
+
+class TestRealSTC(object):
+    def setup(self):
+        self.stc = MockSTC(MockWX.root)
+        self.stc.SetText(u"caf\u00e9 \u00e9t\u00e9 " * 10 + u"getValue = 1\n")
+        self.buf = MockBuffer(self.stc)
+        self.index = WordIndex()
+        self.index.updateBuffer(self.buf)
+
+    def teardown(self):
+        self.index.removeBuffer(self.buf)
+        self.stc.Destroy()
+
+    def check(self):
+        index = WordIndex()
+        stc = MockSTC(MockWX.root)
+        stc.SetText(self.stc.GetText())
+        buf = MockBuffer(stc)
+        index.updateBuffer(buf)
+        eq_(index.counts, self.index.counts)
+        index.removeBuffer(buf)
+        stc.Destroy()
+
+    def test_non_ascii(self):
+        # The positions of the real STC are byte offsets, so the context
+        # around a modification can start in the middle of a character
+        pos = self.stc.GetLength() - len("Value = 1\n")
+        self.stc.InsertText(pos, u"\u00e9")
+        self.check()
+        self.stc.SetTargetStart(pos)
+        self.stc.SetTargetEnd(pos + 2)
+        self.stc.ReplaceTarget(u"_x")
+        self.check()
+        eq_(["get_xValue"], self.index.findPrefix("get"))